@@ -10,6 +10,19 @@
 #
 # "directory" indicates a directory inside the GCS bucket to write the files to
 #
+# With --chunk_size N, each table is exported in parallel parts of up to N rows (in primary key
+# order), to <directory>/<table>/part-NNNNN.csv files; <directory>/<table>/manifest.json is written
+# (listing the parts and their row counts) when all parts are done. Failed parts are retried on
+# their own.
+#
+# With --compress, files are gzipped (and named .csv.gz instead of .csv).
+#
+# With --incremental, only rows changed since the last incremental export of each table to the same
+# directory are exported, to <directory>/<table>/delta-NNNNN.csv files. Each has a delta-NNNNN.json
+# manifest with the range of log_position_id or last_modified values it covers, the table's primary
+# key columns to upsert the rows on, and whether it is a full export (which the first exports are,
+# as are exports of tables without either column).
+#
 # If "rdr" is chosen for the database, the data will be written to <ENVIRONMENT>-rdr-export;
 # If "cdm" or "voc" are chosen, the data will be written to <ENVIRONMENT>-cdm.
 
@@ -27,6 +40,12 @@ def export_tables(client):
                   'directory': client.args.directory,
                   'deidentify': client.args.deidentify
   }
+  if client.args.compress:
+    request_body['compress'] = True
+  if client.args.incremental:
+    request_body['incremental'] = True
+  if client.args.chunk_size:
+    request_body['chunk_size'] = client.args.chunk_size
   response = client.request_json('ExportTables', 'POST', request_body)
   logging.info('Data is being exported to: %s' % response['destination'])
 
@@ -41,4 +60,12 @@ if __name__ == '__main__':
                       required=True)
   parser.add_argument('--deidentify', help='Whether to deidentify the exports',
                       action='store_true')
+  parser.add_argument('--compress', help='Whether to gzip the exported files (named .csv.gz)',
+                      action='store_true')
+  parser.add_argument('--incremental',
+                      help='Export only rows changed since the last incremental export',
+                      action='store_true')
+  parser.add_argument('--chunk_size',
+                      help='Export each table in parallel parts of this many primary key values',
+                      type=int)
   export_tables(Client(parser=parser, base_path='offline'))
@@ -1,10 +1,17 @@
+import json
+
 from api.base_api import BaseApi, make_sync_results_for_request
 from api_util import PTC_HEALTHPRO_AWARDEE, AWARDEE, DEV_MAIL
 from app_util import auth_required, get_validated_user_info
+from dao import database_factory
 from dao.participant_summary_dao import ParticipantSummaryDao
-from flask import request
+from flask import request, Response, stream_with_context
+from query import Query
 from werkzeug.exceptions import Forbidden, InternalServerError
 
+# Number of rows fetched from the server-side cursor at a time by the export.
+_EXPORT_BATCH_SIZE = 1000
+
 
 class ParticipantSummaryApi(BaseApi):
   def __init__(self):
@@ -12,17 +19,7 @@ class ParticipantSummaryApi(BaseApi):
 
   @auth_required(PTC_HEALTHPRO_AWARDEE)
   def get(self, p_id=None):
-    auth_awardee = None
-    user_email, user_info = get_validated_user_info()
-    if AWARDEE in user_info['roles']:
-      if user_email == DEV_MAIL:
-        auth_awardee = request.args.get('awardee')
-      else:
-        try:
-          auth_awardee = user_info['awardee']
-
-        except KeyError:
-          raise InternalServerError("Config error for awardee")
+    user_email, auth_awardee = _get_auth_awardee()
 
     # data only for user_awardee, assert that query has same awardee
     if p_id:
@@ -30,11 +27,7 @@ class ParticipantSummaryApi(BaseApi):
         raise Forbidden
       return super(ParticipantSummaryApi, self).get(p_id)
     else:
-      if auth_awardee:
-        # make sure request has awardee
-        requested_awardee = request.args.get('awardee')
-        if requested_awardee != auth_awardee:
-          raise Forbidden
+      _check_requested_awardee(auth_awardee)
       return super(ParticipantSummaryApi, self)._query('participantId')
 
   def _make_query(self):
@@ -51,3 +44,56 @@ class ParticipantSummaryApi(BaseApi):
 
   def _is_last_modified_sync(self):
     return request.args.get('_sync') == 'true'
+
+
+@auth_required(PTC_HEALTHPRO_AWARDEE)
+def export_participant_summaries():
+  """Streams all participant summaries matching the request's filters as newline-delimited JSON.
+
+  Accepts the same filters as a ParticipantSummary search, but returns every match (ordered by
+  participant ID) with one to_client_json object per line, instead of pages of FHIR Bundles.
+  Rows are read through a server-side cursor and written as they are read.
+  """
+  _, auth_awardee = _get_auth_awardee()
+  _check_requested_awardee(auth_awardee)
+  dao = ParticipantSummaryDao()
+  field_filters = []
+  for key, value in request.args.iteritems(multi=True):
+    if key.startswith('_'):
+      continue
+    field_filter = dao.make_query_filter(key, value)
+    if field_filter:
+      field_filters.append(field_filter)
+  summaries = dao.iter_query_results(Query(field_filters, None, None, None),
+                                     database=database_factory.make_server_cursor_database(),
+                                     batch_size=_EXPORT_BATCH_SIZE)
+
+  def generate():
+    for summary in summaries:
+      yield json.dumps(dao.to_client_json(summary)) + '\n'
+
+  return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+def _get_auth_awardee():
+  """Returns the user's e-mail and the awardee they are restricted to (or None)."""
+  auth_awardee = None
+  user_email, user_info = get_validated_user_info()
+  if AWARDEE in user_info['roles']:
+    if user_email == DEV_MAIL:
+      auth_awardee = request.args.get('awardee')
+    else:
+      try:
+        auth_awardee = user_info['awardee']
+
+      except KeyError:
+        raise InternalServerError("Config error for awardee")
+  return user_email, auth_awardee
+
+
+def _check_requested_awardee(auth_awardee):
+  """Makes sure queries by awardee users are limited to their awardee."""
+  if auth_awardee:
+    requested_awardee = request.args.get('awardee')
+    if requested_awardee != auth_awardee:
+      raise Forbidden
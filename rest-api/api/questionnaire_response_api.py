@@ -3,6 +3,15 @@ import app_util
 from api.base_api import BaseApi
 from api_util import PTC
 from dao.questionnaire_response_dao import QuestionnaireResponseDao
+from flask import request, jsonify
+from model.utils import from_client_participant_id, to_client_participant_id
+from werkzeug.exceptions import BadRequest, HTTPException
+
+# Maximum number of entries in a QuestionnaireResponse/$batch request.
+MAX_BATCH_ENTRIES = 1000
+
+_PATIENT_PREFIX = 'Patient/'
+
 
 class QuestionnaireResponseApi(BaseApi):
   def __init__(self):
@@ -16,3 +25,65 @@ class QuestionnaireResponseApi(BaseApi):
   @app_util.auth_required(PTC)
   def post(self, p_id):
     return super(QuestionnaireResponseApi, self).post(participant_id=p_id)
+
+
+@app_util.auth_required(PTC)
+def insert_questionnaire_response_batch():
+  """Inserts the questionnaire responses in a FHIR batch Bundle.
+
+  Each entry's resource is a QuestionnaireResponse, as would be posted to
+  Participant/:participant_id/QuestionnaireResponse for the participant in its subject. Each
+  participant's responses are inserted in the order they appear in the Bundle.
+
+  Returns a batch-response Bundle with an entry for each entry in the request, in the same order,
+  with the status of the insert and either the location of the new QuestionnaireResponse or an
+  OperationOutcome describing why it was rejected.
+  """
+  bundle = request.get_json(force=True)
+  if bundle.get('resourceType') != 'Bundle' or bundle.get('type') != 'batch':
+    raise BadRequest('Expected a Bundle with type "batch".')
+  entries = bundle.get('entry') or []
+  if len(entries) > MAX_BATCH_ENTRIES:
+    raise BadRequest('Batch has %d entries; at most %d are allowed.' %
+                     (len(entries), MAX_BATCH_ENTRIES))
+
+  results = [None] * len(entries)
+  indexes = []
+  participant_ids_and_resources = []
+  for i, entry in enumerate(entries):
+    resource = entry.get('resource')
+    try:
+      participant_ids_and_resources.append((_get_participant_id(resource), resource))
+      indexes.append(i)
+    except HTTPException, e:
+      results[i] = e
+  inserted = QuestionnaireResponseDao().insert_batch(participant_ids_and_resources,
+                                                     client_id=app_util.get_oauth_id())
+  for i, result in zip(indexes, inserted):
+    results[i] = result
+  return jsonify({'resourceType': 'Bundle',
+                  'type': 'batch-response',
+                  'entry': [_make_response_entry(result) for result in results]})
+
+
+def _get_participant_id(resource):
+  if not isinstance(resource, dict) or resource.get('resourceType') != 'QuestionnaireResponse':
+    raise BadRequest('Entry resource must be a QuestionnaireResponse.')
+  reference = (resource.get('subject') or {}).get('reference') or ''
+  if not reference.startswith(_PATIENT_PREFIX):
+    raise BadRequest('Invalid subject reference: %r.' % reference)
+  return from_client_participant_id(reference[len(_PATIENT_PREFIX):])
+
+
+def _make_response_entry(result):
+  if isinstance(result, HTTPException):
+    return {'response': {
+        'status': '%d %s' % (result.code, result.name),
+        'outcome': {'resourceType': 'OperationOutcome',
+                    'issue': [{'severity': 'error',
+                               'code': 'processing',
+                               'diagnostics': result.description}]}}}
+  return {'response': {
+      'status': '201 Created',
+      'location': 'Participant/%s/QuestionnaireResponse/%d' % (
+          to_client_participant_id(result.participantId), result.questionnaireResponseId)}}
@@ -15,6 +15,7 @@ import config
 
 
 _GMT = pytz.timezone('GMT')
+_NDJSON_MIMETYPE = 'application/x-ndjson'
 SCOPE = 'https://www.googleapis.com/auth/userinfo.email'
 
 
@@ -50,7 +51,7 @@ def check_auth(role_whitelist):
   """Raises Unauthorized or Forbidden if the current user is not allowed."""
   user_email, user_info = get_validated_user_info()
 
-  if set(user_info.get('roles', [])) & set(role_whitelist):
+  if not _get_roles(user_info).isdisjoint(role_whitelist):
     return
 
   logging.info('User {} has roles {}, but {} is required'.format(
@@ -81,7 +82,13 @@ def check_cron():
 
 
 def lookup_user_info(user_email):
-  return config.getSettingJson(config.USER_INFO, {}).get(user_email)
+  return config.get_request_config().get_user_info(user_email)
+
+
+def _get_roles(user_info):
+  if isinstance(user_info, config.UserInfo):
+    return user_info.roles
+  return frozenset(user_info.get('roles', []))
 
 
 def _is_self_request():
@@ -116,11 +123,9 @@ def get_validated_user_info():
 
 
 def get_whitelisted_ips(user_info):
-  if not user_info.get('whitelisted_ip_ranges'):
-    return None
-  return [netaddr.IPNetwork(rng)
-          for rng in user_info['whitelisted_ip_ranges']['ip6'] + \
-                     user_info['whitelisted_ip_ranges']['ip4']]
+  if isinstance(user_info, config.UserInfo):
+    return user_info.whitelisted_ips
+  return config.parse_whitelisted_ips(user_info)
 
 
 def enforce_ip_whitelisted(request_ip, whitelisted_ips):
@@ -155,12 +160,14 @@ def enforce_appid_whitelisted(request_app_id, whitelisted_appids):
 def add_headers(response):
   """Add uniform headers to all API responses.
 
-  All responses are JSON, so we tag them as such at the app level to provide uniform protection
-  against content-sniffing-based attacks.
+  All responses are JSON (or newline-delimited JSON, for exports), so we tag them as such at the
+  app level to provide uniform protection against content-sniffing-based attacks.
   """
   response.headers['Content-Disposition'] = 'attachment; filename="f.txt"'
   response.headers['X-Content-Type-Options'] = 'nosniff'
-  response.headers['Content-Type'] = 'application/json; charset=utf-8'  # override to add charset
+  ndjson = response.headers.get('Content-Type', '').startswith(_NDJSON_MIMETYPE)
+  mimetype = _NDJSON_MIMETYPE if ndjson else 'application/json'
+  response.headers['Content-Type'] = mimetype + '; charset=utf-8'  # override to add charset
   response.headers['Date'] = email.utils.formatdate(
       time.mktime(pytz.utc.localize(clock.CLOCK.now()).astimezone(_GMT).timetuple()),
       usegmt=True)
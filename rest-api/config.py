@@ -4,6 +4,8 @@ Contains things such as the accounts allowed access to the system.
 """
 import logging
 
+import netaddr
+from flask import g, has_request_context
 from google.appengine.ext import ndb
 from werkzeug.exceptions import NotFound
 
@@ -19,13 +21,24 @@ DB_CONFIG_KEY = 'db_config'
 
 LAST_MODIFIED_BUFFER_SECONDS = 60
 CONFIG_CACHE_TTL_SECONDS = 60
+# How long a query total (for _includeTotal) is reused when paging through the same results.
+QUERY_TOTAL_CACHE_TTL_SECONDS = 300
 BIOBANK_ID_PREFIX = 'biobank_id_prefix'
 METRICS_SHARDS = 'metrics_shards'
+# Format of the data written between metrics pipeline stages: 'text' (the default) or 'records'.
+METRICS_INTERMEDIATE_FORMAT = 'metrics_intermediate_format'
+# If true, the metrics pipeline writes a bucket per HPO for each range of dates with unchanged
+# counts, rather than a bucket per HPO and date.
+METRICS_BUCKET_RANGES = 'metrics_bucket_ranges'
 PARTICIPANT_SUMMARY_SHARDS = 'participant_summary_shards'
 AGE_RANGE_SHARDS = 'age_range_shards'
 BIOBANK_SAMPLES_SHARDS = 'biobank_samples_shards'
 BIOBANK_SAMPLES_BUCKET_NAME = 'biobank_samples_bucket_name'
+# Number of samples written per INSERT statement when importing the Biobank samples CSV.
+BIOBANK_SAMPLES_UPSERT_BATCH_SIZE = 'biobank_samples_upsert_batch_size'
 CONSENT_PDF_BUCKET = 'consent_pdf_bucket'
+# Number of participants whose responses are inserted concurrently by QuestionnaireResponse/$batch.
+QUESTIONNAIRE_RESPONSE_BATCH_THREADS = 'questionnaire_response_batch_threads'
 USER_INFO = 'user_info'
 SYNC_SHARDS_PER_CHANNEL = 'sync_shards_per_channel'
 MEASUREMENTS_ENTITIES_PER_SYNC = 'measurements_entities_per_sync'
@@ -47,6 +60,11 @@ BIOBANK_STATUS_MAIL_RECIPIENTS = 'biobank_status_mail_recipients'
 # aren't in the code book; false if we should reject the questionnaires.
 ADD_QUESTIONNAIRE_CODES_IF_MISSING = 'add_questionnaire_codes_if_missing'
 
+# If true, log the number, time and rows of the SQL statements executed by each request, and the
+# statements executed at least SQL_REPEATED_STATEMENT_THRESHOLD times (see sql_instrumentation).
+SQL_INSTRUMENTATION = 'sql_instrumentation'
+SQL_REPEATED_STATEMENT_THRESHOLD = 'sql_repeated_statement_threshold'
+
 REQUIRED_CONFIG_KEYS = [BIOBANK_SAMPLES_BUCKET_NAME]
 
 
@@ -144,7 +162,7 @@ def getSettingJson(key, default=_NO_DEFAULT):
   if config_values is not None:
     return config_values
 
-  current_config = get_config()
+  current_config = get_request_config().configuration
 
   config_values = current_config.get(key, default)
   if config_values == _NO_DEFAULT:
@@ -205,7 +223,149 @@ def get_db_config():
   return model.configuration
 
 def get_config():
-  model = singletons.get(singletons.MAIN_CONFIG_INDEX,
-                         lambda: load(CONFIG_SINGLETON_KEY),
-                         cache_ttl_seconds=CONFIG_CACHE_TTL_SECONDS)
-  return model.configuration
+  return get_compiled_config().configuration
+
+
+def get_compiled_config():
+  """Returns the current CompiledConfig, reloading it every CONFIG_CACHE_TTL_SECONDS.
+
+  Once loaded, an expired config keeps being returned while one thread reloads it.
+  """
+  return singletons.get(singletons.MAIN_CONFIG_INDEX,
+                        lambda: CompiledConfig(load(CONFIG_SINGLETON_KEY).configuration),
+                        cache_ttl_seconds=CONFIG_CACHE_TTL_SECONDS,
+                        serve_stale=True)
+
+
+def get_request_config():
+  """Returns the RequestConfig for the current request, which fetches the CompiledConfig once and
+  uses it for the rest of the request. Outside of requests, the current CompiledConfig is used."""
+  if not has_request_context():
+    return _NON_REQUEST_CONFIG
+  request_config = getattr(g, 'request_config', None)
+  if request_config is None:
+    request_config = g.request_config = RequestConfig(per_request=True)
+  return request_config
+
+
+def parse_whitelisted_ips(user_info):
+  """Returns the IP networks a user's requests must come from, or None if any IP is allowed."""
+  if not user_info.get('whitelisted_ip_ranges'):
+    return None
+  return [netaddr.IPNetwork(rng)
+          for rng in user_info['whitelisted_ip_ranges']['ip6'] + \
+                     user_info['whitelisted_ip_ranges']['ip4']]
+
+
+class UserInfo(dict):
+  """A user's entry in the USER_INFO setting, with their roles and whitelisted IP networks
+  parsed."""
+
+  def __init__(self, user_info):
+    super(UserInfo, self).__init__(user_info)
+    self.roles = frozenset(user_info.get('roles', []))
+    self.whitelisted_ips = parse_whitelisted_ips(user_info)
+
+
+# List settings read on hot request paths, and the types CompiledConfig parses them to.
+_COMPILED_LIST_TYPES = {
+  BASELINE_PPI_QUESTIONNAIRE_FIELDS: frozenset,
+  PPI_QUESTIONNAIRE_FIELDS: frozenset,
+  BASELINE_SAMPLE_TEST_CODES: tuple,
+  DNA_SAMPLE_TEST_CODES: tuple,
+}
+_COMPILED_KEYS = _COMPILED_LIST_TYPES.keys() + [USER_INFO]
+
+
+def _compile_setting(key, value):
+  if key == USER_INFO:
+    if not isinstance(value, dict):
+      raise InvalidConfigException(
+          'Config key {} is a {} instead of a dict'.format(key, type(value)))
+    return {user_email: UserInfo(user_info) for user_email, user_info in value.iteritems()}
+  if not isinstance(value, list):
+    raise InvalidConfigException(
+        'Config key {} is a {} instead of a list'.format(key, type(value)))
+  return _COMPILED_LIST_TYPES[key](value)
+
+
+class CompiledConfig(object):
+  """A snapshot of the main configuration, with the settings in _COMPILED_KEYS parsed once when it
+  is loaded rather than on every use. Don't modify it; it is shared between threads.
+  """
+
+  def __init__(self, configuration):
+    self.configuration = configuration
+    self._compiled = {}
+    for key in _COMPILED_KEYS:
+      if key in configuration:
+        try:
+          self._compiled[key] = _compile_setting(key, configuration[key])
+        except InvalidConfigException, e:
+          # Only fail the requests that use the setting.
+          self._compiled[key] = e
+
+  def get(self, key, default=_NO_DEFAULT):
+    """Gets the parsed value of a setting in _COMPILED_KEYS.
+
+    Raises:
+      MissingConfigException: If the setting is missing and a default is not provided.
+      InvalidConfigException: If the setting is not in the expected form.
+    """
+    override = _get_compiled_override(key)
+    if override is not None:
+      return override
+    value = self._compiled.get(key, default)
+    if value == _NO_DEFAULT:
+      raise MissingConfigException('Config key "{}" has no values.'.format(key))
+    if isinstance(value, InvalidConfigException):
+      raise value
+    return value
+
+  def get_user_info(self, user_email):
+    """Returns the UserInfo for a user, or None if the user is not configured."""
+    return self.get(USER_INFO, {}).get(user_email)
+
+
+def _get_compiled_override(key):
+  override = CONFIG_OVERRIDES.get(key)
+  if override is None:
+    return None
+  return _compile_setting(key, override)
+
+
+class RequestConfig(object):
+  """Reads settings like CompiledConfig, but only loads the CompiledConfig for settings that aren't
+  overridden; processes that override all the settings they use never load it from Datastore.
+  """
+
+  def __init__(self, per_request):
+    """If per_request is true, the CompiledConfig is loaded once and kept; otherwise the current
+    one is used each time."""
+    self._per_request = per_request
+    self._compiled_config = None
+
+  def _get_compiled_config(self):
+    if not self._per_request:
+      return get_compiled_config()
+    if self._compiled_config is None:
+      self._compiled_config = get_compiled_config()
+    return self._compiled_config
+
+  @property
+  def configuration(self):
+    return self._get_compiled_config().configuration
+
+  def get(self, key, default=_NO_DEFAULT):
+    """Like CompiledConfig.get."""
+    override = _get_compiled_override(key)
+    if override is not None:
+      return override
+    return self._get_compiled_config().get(key, default)
+
+  def get_user_info(self, user_email):
+    """Returns the UserInfo for a user, or None if the user is not configured."""
+    return self.get(USER_INFO, {}).get(user_email)
+
+
+_NON_REQUEST_CONFIG = RequestConfig(per_request=False)
@@ -4,17 +4,20 @@ import json
 import logging
 import datetime
 import random
+import threading
 
 from fhirclient.models.domainresource import DomainResource
 from fhirclient.models.fhirabstractbase import FHIRValidationError
 from protorpc import messages
 from query import Operator, PropertyType, FieldFilter, Results
-from sqlalchemy import or_, and_
+from sqlalchemy import or_, and_, literal, tuple_
 from sqlalchemy.exc import IntegrityError
 from werkzeug.exceptions import BadRequest, NotFound, PreconditionFailed, ServiceUnavailable
 
 import api_util
+import clock
 import dao.database_factory
+import singletons
 from model.utils import get_property_type
 
 # Maximum number of times we will attempt to insert an entity with a random ID before
@@ -22,8 +25,11 @@ from model.utils import get_property_type
 MAX_INSERT_ATTEMPTS = 20
 
 # Range of possible values for random IDs.
-_MIN_ID = 100000000
-_MAX_ID = 999999999
+MIN_RANDOM_ID = 100000000
+MAX_RANDOM_ID = 999999999
+
+# Maximum number of query totals cached in each process.
+QUERY_TOTAL_CACHE_SIZE = 1000
 
 _COMPARABLE_PROPERTY_TYPES = [PropertyType.DATE, PropertyType.DATETIME, PropertyType.INTEGER]
 
@@ -45,13 +51,18 @@ class BaseDao(object):
   order_by_ending is a list of field names to always order by (in ascending order, possibly after
   another sort field) when query() is invoked. It should always end in the primary key.
   If not specified, query() is not supported.
+
+  total_cache_ttl_seconds, if set, lets query() reuse the total it computed for the first page of
+  a query (for include_total) on subsequent pages with the same filters, for up to that many
+  seconds. If not specified, the total is counted on every page.
   """
-  def __init__(self, model_type, order_by_ending=None, db=None):
+  def __init__(self, model_type, order_by_ending=None, db=None, total_cache_ttl_seconds=None):
     self.model_type = model_type
     if not db:
       db = dao.database_factory.get_database()
     self._database = db
     self.order_by_ending = order_by_ending
+    self.total_cache_ttl_seconds = total_cache_ttl_seconds
 
   def session(self):
     return self._database.session()
@@ -161,7 +172,7 @@ class BaseDao(object):
 
       total = None
       if query_def.include_total:
-        total = self._count_query(session, query_def)
+        total = self._get_total(session, query_def)
 
       if not items:
         return Results([], total=total)
@@ -177,6 +188,24 @@ class BaseDao(object):
                else None)
       return Results(items, token, more_available=False, total=total)
 
+  def iter_query_results(self, query_def, database=None, batch_size=1000):
+    """Returns an iterator over all entities matching the filters in query_def, ordered by primary
+    key. Ordering, pagination and max results in query_def are ignored.
+
+    Pass a database made by database_factory.make_server_cursor_database() to stream results
+    rather than loading them all into memory. The query is set up (and validated) before this
+    returns; the session is closed once the iterator is exhausted or closed.
+    """
+    session = (database or self._database).make_session()
+    try:
+      query = self._initialize_query(session, query_def)
+      query = self._set_filters(query, query_def.field_filters)
+      query = query.order_by(*self.model_type.__mapper__.primary_key)
+    except:
+      session.close()
+      raise
+    return _iter_and_close(session, query.yield_per(batch_size))
+
   def _make_pagination_token(self, item_dict, field_names):
     vals = [item_dict.get(field_name) for field_name in field_names]
     vals_json = json.dumps(vals, default=json_serial)
@@ -194,6 +223,30 @@ class BaseDao(object):
     query = self._set_filters(query, query_def.field_filters)
     return query.count()
 
+  def _get_total(self, session, query_def):
+    """Returns the total number of results for the query. If total_cache_ttl_seconds is set, the
+    count done for the first page is reused for later pages (requests with a pagination token)
+    with the same filters, until it expires."""
+    if not self.total_cache_ttl_seconds:
+      return self._count_query(session, query_def)
+    total_cache = singletons.get(singletons.QUERY_TOTAL_CACHE_INDEX, QueryTotalCache)
+    key = self._make_total_cache_key(query_def)
+    if query_def.pagination_token:
+      total = total_cache.get(key)
+      if total is not None:
+        return total
+    total = self._count_query(session, query_def)
+    total_cache.put(key, total, self.total_cache_ttl_seconds)
+    return total
+
+  def _make_total_cache_key(self, query_def):
+    """Returns a signature for the filters of the query; queries with the same signature have
+    the same total."""
+    filter_keys = sorted((field_filter.field_name, str(field_filter.operator),
+                          repr(field_filter.value))
+                         for field_filter in query_def.field_filters)
+    return (self.model_type.__name__, tuple(filter_keys))
+
   def _make_query(self, session, query_def):
     query = self._initialize_query(session, query_def)
     query = self._set_filters(query, query_def.field_filters)
@@ -239,28 +292,11 @@ class BaseDao(object):
     """Adds a pagination filter for the decoded values in the pagination token based on
     the sort order."""
     decoded_vals = self._decode_token(query_def, fields)
-    # SQLite does not support tuple comparisons, so make an or-of-ands statements that is
-    # equivalent.
-    or_clauses = []
-    if first_descending:
-      if decoded_vals[0] is not None:
-        or_clauses.append(fields[0] < decoded_vals[0])
-        or_clauses.append(fields[0].is_(None))
-    else:
-      if decoded_vals[0] is None:
-        or_clauses.append(fields[0].isnot(None))
-      else:
-        or_clauses.append(fields[0] > decoded_vals[0])
-    for i in range(1, len(fields)):
-      and_clauses = []
-      for j in range(0, i):
-        and_clauses.append(fields[j] == decoded_vals[j])
-      if decoded_vals[i] is None:
-        and_clauses.append(fields[i].isnot(None))
-      else:
-        and_clauses.append(fields[i] > decoded_vals[i])
-      or_clauses.append(and_(*and_clauses))
-    return query.filter(or_(*or_clauses))
+    # Row value comparisons can't express the ordering of NULLs, so only use them when the token
+    # has no NULL values.
+    if self._database.db_type == 'mysql' and None not in decoded_vals:
+      return query.filter(_make_keyset_filter(fields, decoded_vals, first_descending))
+    return query.filter(_make_or_of_ands_filter(fields, decoded_vals, first_descending))
 
   def _decode_token(self, query_def, fields):
     pagination_token = query_def.pagination_token
@@ -306,7 +342,7 @@ class BaseDao(object):
     return query
 
   def _get_random_id(self):
-    return random.randint(_MIN_ID, _MAX_ID)
+    return random.randint(MIN_RANDOM_ID, MAX_RANDOM_ID)
 
   def _insert_with_random_id(self, obj, fields):
     """Attempts to insert an entity with randomly assigned ID(s) repeatedly until success
@@ -427,6 +463,105 @@ class UpdatableDao(BaseDao):
     with self.session() as session:
       return self.update_with_session(session, obj)
 
+def _iter_and_close(session, query):
+  try:
+    for obj in query:
+      yield obj
+  finally:
+    session.close()
+
+
+def _make_keyset_filter(fields, decoded_vals, first_descending):
+  """Makes a filter for rows after the (non-NULL) decoded token values using row value
+  comparisons, which MySQL can satisfy with a range scan over a matching composite index.
+  All fields but the first are sorted in ascending order."""
+  if not first_descending:
+    return tuple_(*fields) > _make_row_value(fields, decoded_vals)
+  # MySQL sorts NULLs last in descending order.
+  or_clauses = [fields[0] < decoded_vals[0], fields[0].is_(None)]
+  if len(fields) > 1:
+    or_clauses.append(and_(fields[0] == decoded_vals[0],
+                           tuple_(*fields[1:]) > _make_row_value(fields[1:], decoded_vals[1:])))
+  return or_(*or_clauses)
+
+
+def _make_row_value(fields, vals):
+  """Binds the values with the types of their fields, so that e.g. enums are converted."""
+  return tuple_(*[literal(val, type_=field.property.columns[0].type)
+                  for field, val in zip(fields, vals)])
+
+
+def _make_or_of_ands_filter(fields, decoded_vals, first_descending):
+  """Makes a filter for rows after the decoded token values.
+
+  SQLite does not support tuple comparisons, so make an or-of-ands statements that is
+  equivalent. This is also used on MySQL for tokens containing NULL values.
+  """
+  or_clauses = []
+  if first_descending:
+    if decoded_vals[0] is not None:
+      or_clauses.append(fields[0] < decoded_vals[0])
+      or_clauses.append(fields[0].is_(None))
+  else:
+    if decoded_vals[0] is None:
+      or_clauses.append(fields[0].isnot(None))
+    else:
+      or_clauses.append(fields[0] > decoded_vals[0])
+  for i in range(1, len(fields)):
+    and_clauses = []
+    for j in range(0, i):
+      and_clauses.append(fields[j] == decoded_vals[j])
+    if decoded_vals[i] is None:
+      and_clauses.append(fields[i].isnot(None))
+    else:
+      and_clauses.append(fields[i] > decoded_vals[i])
+    or_clauses.append(and_(*and_clauses))
+  return or_(*or_clauses)
+
+
+class QueryTotalCache(object):
+  """Totals computed for queries, keyed by filter signature, each valid until an expiration time.
+  Stored in singletons, so shared by all DAOs in the process.
+
+  Expired totals are removed when totals are added, and at most max_size (the most recently used)
+  are kept.
+  """
+
+  def __init__(self, max_size=QUERY_TOTAL_CACHE_SIZE):
+    self._lock = threading.Lock()
+    self._max_size = max_size
+    self._totals = collections.OrderedDict()
+
+  def get(self, key):
+    """Returns the unexpired total for the key, or None."""
+    with self._lock:
+      entry = self._totals.pop(key, None)
+      if entry is None:
+        return None
+      if entry[1] < clock.CLOCK.now():
+        return None
+      # Move it to the end, as the most recently used.
+      self._totals[key] = entry
+    return entry[0]
+
+  def put(self, key, total, ttl_seconds):
+    now = clock.CLOCK.now()
+    expiration_time = now + datetime.timedelta(seconds=ttl_seconds)
+    with self._lock:
+      self._totals.pop(key, None)
+      for expired_key in [k for k, (_, expiration) in self._totals.iteritems() if expiration < now]:
+        del self._totals[expired_key]
+      self._totals[key] = (total, expiration_time)
+      while len(self._totals) > self._max_size:
+        self._totals.popitem(last=False)
+
+  def size(self):
+    """Returns the number of stored totals. (Not __len__, as an empty cache must stay truthy for
+    singletons.get to reuse it.)"""
+    with self._lock:
+      return len(self._totals)
+
+
 def json_serial(obj):
   """JSON serializer for objects not serializable by default json code"""
   if isinstance(obj, datetime.datetime) or isinstance(obj, datetime.date):
@@ -171,7 +171,7 @@ class BiobankOrderDao(BaseDao):
                 .filter(Participant.biobankId % 100 < percentage * 100)
                 .yield_per(batch_size))
 
-  def _get_order_status_and_time(self, sample, order):
+  def get_order_status_and_time(self, sample, order):
     if sample.finalized:
       return (OrderStatus.FINALIZED, sample.finalized)
     if sample.processed:
@@ -196,7 +196,7 @@ class BiobankOrderDao(BaseDao):
     participant_summary.lastModified = clock.CLOCK.now()
     for sample in obj.samples:
       status_field = 'sampleOrderStatus' + sample.test
-      status, time = self._get_order_status_and_time(sample, obj)
+      status, time = self.get_order_status_and_time(sample, obj)
       setattr(participant_summary, status_field, status)
       setattr(participant_summary, status_field + 'Time', time)
 
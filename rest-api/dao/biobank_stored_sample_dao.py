@@ -3,6 +3,11 @@ import logging
 from code_constants import BIOBANK_TESTS_SET
 from dao.base_dao import BaseDao
 from model.biobank_stored_sample import BiobankStoredSample
+from sqlalchemy import inspect
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+
+# Number of samples written by each INSERT statement in upsert_all.
+DEFAULT_UPSERT_BATCH_SIZE = 500
 
 
 class BiobankStoredSampleDao(BaseDao):
@@ -13,21 +18,54 @@ class BiobankStoredSampleDao(BaseDao):
   def get_id(self, obj):
     return obj.biobankStoredSampleId
 
-  def upsert_all(self, samples):
-    """Inserts/updates samples. """
-    # Ensure that the sample set can be re-iterated if the operation needs to be retried
-    samples = list(samples)
+  def get_biobank_ids(self, sample_ids):
+    """Returns the set of biobank IDs that the given samples are stored for."""
+    if not sample_ids:
+      return set()
+    with self.session() as session:
+      query = (session.query(BiobankStoredSample.biobankId)
+               .filter(BiobankStoredSample.biobankStoredSampleId.in_(sample_ids))
+               .distinct())
+      return set(biobank_id for (biobank_id,) in query)
+
+  def upsert_all(self, samples, batch_size=DEFAULT_UPSERT_BATCH_SIZE):
+    """Inserts/updates samples, writing up to batch_size samples per statement.
+
+    Samples for unrecognized tests are skipped. Returns (written, skipped), the numbers of samples
+    written and skipped.
+    """
+    # Build the rows up front, so that they can be re-used if the operation needs to be retried.
+    mapper = inspect(BiobankStoredSample)
+    columns = [(column.key, mapper.get_property_by_column(column).key)
+               for column in BiobankStoredSample.__table__.columns]
+    rows = []
+    skipped_tests = set()
+    skipped = 0
+    for sample in samples:
+      if sample.test not in BIOBANK_TESTS_SET:
+        skipped_tests.add(sample.test)
+        skipped += 1
+      else:
+        rows.append({column_key: getattr(sample, attribute) for column_key, attribute in columns})
+    if skipped:
+      logging.warn('Skipped %d samples with unrecognized tests: %s.', skipped,
+                   ', '.join(sorted(skipped_tests)))
+
     def upsert(session):
-      # TODO(DA-230) Scale this to handle full study data.  SQLAlchemy does not provide batch
-      # upserting; individual session.merge() calls as below may be expensive but cannot be
-      # effectively batched, see stackoverflow.com/questions/25955200. If this proves to be a
-      # bottleneck, we can switch to generating "INSERT .. ON DUPLICATE KEY UPDATE".
-      written = 0
-      for sample in samples:
-        if sample.test not in BIOBANK_TESTS_SET:
-          logging.warn('test sample %s not recognized.' % sample.test)
-        else:
-          session.merge(sample)
-          written += 1
-      return written
-    return self._database.autoretry(upsert)
+      for i in range(0, len(rows), batch_size):
+        session.execute(self._make_upsert_statement(rows[i:i + batch_size]))
+      return len(rows)
+    return self._database.autoretry(upsert), skipped
+
+  def _make_upsert_statement(self, rows):
+    """Returns a multi-row INSERT statement for the rows that replaces existing samples.
+
+    Unlike session.merge(), this doesn't need to SELECT each sample before writing it.
+    """
+    table = BiobankStoredSample.__table__
+    if self._database.db_type == 'sqlite':
+      return table.insert().prefix_with('OR REPLACE').values(rows)
+    statement = mysql_insert(table).values(rows)
+    return statement.on_duplicate_key_update(
+        **{column.key: statement.inserted[column.key]
+           for column in table.columns if not column.primary_key})
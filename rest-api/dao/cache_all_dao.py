@@ -1,20 +1,38 @@
 from base_dao import UpdatableDao
+from datetime import timedelta
+from model.cache_version import CacheVersion, CacheChange
+from sqlalchemy import event, inspect
 from sqlalchemy.orm.session import make_transient
 
+import clock
 import singletons
 
+# How often each instance checks whether other instances have changed a cached table.
+CACHE_VERSION_CHECK_SECONDS = 10
+# Number of versions of each cached table that changes are kept for (see CacheChange); caches
+# older than that are reloaded in full. Older changes are deleted every _CACHE_CHANGE_PRUNE_VERSIONS
+# versions.
+_MAX_CACHE_CHANGE_VERSIONS = 1000
+_CACHE_CHANGE_PRUNE_VERSIONS = 100
+# Key in session.info for the IDs of entities written to cached tables in the session's transaction,
+# by table name.
+_CACHE_CHANGES_KEY = 'cache_changes'
+
 class EntityCache(object):
   """A cache of entities of a particular type, indexed by ID (in id_to_entity) and optionally other
    fields (in index_maps).
    """
-  def __init__(self, dao, entities, index_field_keys):
-    """Constructor taking the DAO, all the entities in the database for this type, and a list of
-    field names or tuples of field names to index the entities by."""
+  def __init__(self, dao, entities, index_field_keys, version=None):
+    """Constructor taking the DAO, all the entities in the database for this type, a list of
+    field names or tuples of field names to index the entities by, and the CacheVersion of the
+    table the entities were read at (None if the table has never been written to)."""
+    self.version = version
+    self.version_check_time = clock.CLOCK.now()
     self.id_to_entity = {}
     if index_field_keys:
       self.index_maps = {index_field_key: {} for index_field_key in index_field_keys}
     for entity in entities:
-      make_transient(entity)
+      entity = self._to_cached_entity(dao, entity)
       self.id_to_entity[dao.get_id(entity)] = entity
       if index_field_keys:
         for index_field_key in index_field_keys:
@@ -24,13 +42,88 @@ class EntityCache(object):
             key = getattr(entity, index_field_key)
           self.index_maps[index_field_key][key] = entity
 
+  def _to_cached_entity(self, dao, entity):
+    #pylint: disable=unused-argument
+    make_transient(entity)
+    return entity
+
+
+class CachedRecord(object):
+  """Base class for the records CompactEntityCache stores in place of model objects.
+
+  Subclasses (see _get_record_type) have a slot for each column of the model, and for any
+  relationships the DAO links cached entities with; they have no __dict__ or SQLAlchemy instance
+  state.
+  """
+  __slots__ = ()
+  column_keys = ()
+  relationship_keys = ()
+
+  def asdict(self):
+    """Returns a dictionary of the column fields, like asdict() for model objects."""
+    return {key: getattr(self, key) for key in self.column_keys}
+
+  def __repr__(self):
+    return '%s(%r)' % (type(self).__name__, self.asdict())
+
+
+class CompactEntityCache(EntityCache):
+  """An EntityCache that stores a CachedRecord for each entity instead of the model object.
+
+  Records use a fraction of the memory model objects do, and their fields are faster to read.
+  Equal strings in different records are stored once. Records can't be written to the database;
+  the DAO's relationships listed in cache_record_relationships start out empty (None or []), for
+  the DAO to link records to each other in _load_cache.
+  """
+  def __init__(self, dao, entities, index_field_keys, version=None):
+    self._record_type = _get_record_type(dao.model_type, dao.cache_record_relationships)
+    self._strings = {}
+    super(CompactEntityCache, self).__init__(dao, entities, index_field_keys, version)
+    del self._record_type
+    del self._strings
+
+  def _to_cached_entity(self, dao, entity):
+    record_type = self._record_type
+    if type(entity) is record_type:
+      # Records from a cache being refreshed can be re-used.
+      return entity
+    record = record_type()
+    for key in record_type.column_keys:
+      value = getattr(entity, key)
+      if isinstance(value, basestring):
+        value = self._strings.setdefault(value, value)
+      setattr(record, key, value)
+    for key, uselist in record_type.relationship_keys:
+      setattr(record, key, [] if uselist else None)
+    return record
+
+
+# CachedRecord subclasses by model type and relationship names.
+_record_types = {}
+
+
+def _get_record_type(model_type, relationship_keys):
+  record_type = _record_types.get((model_type, relationship_keys))
+  if record_type is None:
+    mapper = inspect(model_type)
+    column_keys = tuple(column_attr.key for column_attr in mapper.column_attrs)
+    record_type = type('Cached%s' % model_type.__name__, (CachedRecord,), {
+        '__slots__': column_keys + relationship_keys,
+        'column_keys': column_keys,
+        'relationship_keys': tuple((key, mapper.relationships[key].uselist)
+                                   for key in relationship_keys)})
+    _record_types[(model_type, relationship_keys)] = record_type
+  return record_type
+
+
 class CacheAllDao(UpdatableDao):
   """A DAO that loads all values from the database and caches them in memory for some period of time
   when the cache is empty and is being used.
   Used for tables that have relatively few rows and updates and high read usage.
 
-  Updates to rows will invalidate the entire cache on the server where the update occurs, but not
-  on other servers.
+  Updates to rows will invalidate the entire cache on the server where the update occurs. They also
+  increment the table's CacheVersion in the same transaction; other servers check the version
+  every CACHE_VERSION_CHECK_SECONDS, and reload just the changed rows (see CacheChange).
 
   cache_index is an index from singletons (e.g. CODE_CACHE_INDEX) provided by subclasses
   to specify a key for the cache. (This is faster than hashing the type name.)
@@ -40,8 +133,18 @@ class CacheAllDao(UpdatableDao):
   index_field_keys is an optional list for secondary indexes; elements in it can either by
   individual field names or tuples of field names. Cached objects will be keyed by those fields.
 
+  Subclasses with large tables can set compact_cache to cache read-only records instead of model
+  objects (see CompactEntityCache).
+
   See BaseDao for documentation on order_by_ending.
   """
+  # Whether caches are refreshed by reloading only changed entities, rather than all of them.
+  # Subclasses whose caches link entities to each other should reload all of them instead.
+  incremental_refresh = True
+  # Whether to cache CachedRecords rather than model objects, and the names of relationships that
+  # the records have fields for.
+  compact_cache = False
+  cache_record_relationships = ()
 
   def __init__(self, model_type, cache_index, cache_ttl_seconds, index_field_keys=None,
                order_by_ending=None):
@@ -52,11 +155,51 @@ class CacheAllDao(UpdatableDao):
 
   def _load_cache(self):
     with self.session() as session:
+      version = _get_cache_version(session, self.model_type.__tablename__)
       all_entities = session.query(self.model_type).all()
-    return EntityCache(self, all_entities, self.index_field_keys)
+    return self._make_cache(all_entities, version)
+
+  def _make_cache(self, entities, version):
+    cache_type = CompactEntityCache if self.compact_cache else EntityCache
+    return cache_type(self, entities, self.index_field_keys, version)
+
+  def _refresh_cache(self, cache):
+    """Returns the cache if the table hasn't been changed since it was loaded, or an up to date
+    copy of it otherwise."""
+    table_name = self.model_type.__tablename__
+    with self.session() as session:
+      version = _get_cache_version(session, table_name)
+      if version == cache.version:
+        cache.version_check_time = clock.CLOCK.now()
+        return cache
+      changed_ids = None
+      if self.incremental_refresh:
+        changed_ids = _get_changed_entity_ids(session, table_name, cache.version or 0, version)
+      if changed_ids is None:
+        return self._load_cache()
+      entities = dict(cache.id_to_entity)
+      for entity_id in changed_ids:
+        # Entities that no longer exist are left out.
+        entities.pop(entity_id, None)
+      id_column = inspect(self.model_type).primary_key[0]
+      changed_entities = (session.query(self.model_type)
+                          .filter(id_column.in_(changed_ids))
+                          .all())
+    return self._make_cache(entities.values() + changed_entities, version)
 
   def _get_cache(self):
-    return singletons.get(self.cache_index, (lambda: self._load_cache()), self.cache_ttl_seconds)
+    # When the cache expires, keep serving it while one thread reloads it.
+    cache = singletons.get(self.cache_index, (lambda: self._load_cache()), self.cache_ttl_seconds,
+                           serve_stale=True)
+    check_time = cache.version_check_time + timedelta(seconds=CACHE_VERSION_CHECK_SECONDS)
+    if check_time <= clock.CLOCK.now():
+      # If the cache was invalidated meanwhile, load it again.
+      cache = singletons.refresh(self.cache_index, self._refresh_cache) or self._get_cache()
+    return cache
+
+  def warm_cache(self):
+    """Loads the cache if it isn't loaded yet, e.g. before an instance starts serving requests."""
+    self._get_cache()
 
   def get_with_session(self, session, obj_id, **kwargs):
     #pylint: disable=unused-argument
@@ -70,9 +213,16 @@ class CacheAllDao(UpdatableDao):
 
   def insert_with_session(self, session, obj):
     created_obj = super(CacheAllDao, self).insert_with_session(session, obj)
+    # Flush the insert so that the object's ID gets assigned.
+    session.flush()
+    _add_cache_change(session, self.model_type.__tablename__, self.get_id(created_obj))
     self._invalidate_cache()
     return created_obj
 
+  def _do_update(self, session, obj, existing_obj):
+    super(CacheAllDao, self)._do_update(session, obj, existing_obj)
+    _add_cache_change(session, self.model_type.__tablename__, self.get_id(obj))
+
   def update_with_session(self, session, obj):
     super(CacheAllDao, self).update_with_session(session, obj)
     self._invalidate_cache()
@@ -84,3 +234,63 @@ class CacheAllDao(UpdatableDao):
 
   def get_all(self):
     return self._get_cache().id_to_entity.values()
+
+
+def _get_cache_version(session, table_name):
+  return (session.query(CacheVersion.version)
+          .filter(CacheVersion.tableName == table_name)
+          .scalar())
+
+
+def _get_changed_entity_ids(session, table_name, since_version, version):
+  """Returns the IDs of entities changed after since_version, up to version; or None if changes
+  for some of those versions are no longer kept."""
+  changes = (session.query(CacheChange.version, CacheChange.entityId)
+             .filter(CacheChange.tableName == table_name)
+             .filter(CacheChange.version > since_version)
+             .filter(CacheChange.version <= version)
+             .all())
+  if len(set(change_version for change_version, _ in changes)) != version - since_version:
+    return None
+  return list(set(entity_id for _, entity_id in changes))
+
+
+def _add_cache_change(session, table_name, entity_id):
+  """Records an entity written to a cached table in the session's transaction. The changes are
+  written when the transaction commits (see _write_cache_changes), by listeners registered only on
+  sessions that write to cached tables."""
+  changes = session.info.get(_CACHE_CHANGES_KEY)
+  if changes is None:
+    changes = session.info[_CACHE_CHANGES_KEY] = {}
+    if not event.contains(session, 'before_commit', _write_cache_changes):
+      event.listen(session, 'before_commit', _write_cache_changes)
+      event.listen(session, 'after_rollback', _discard_cache_changes)
+  changes.setdefault(table_name, set()).add(entity_id)
+
+
+def _write_cache_changes(session):
+  """Increments the version of each cached table written to in the transaction once, and records
+  the entities written to it under the new version. The version rows (seeded by migrations) stay
+  locked only while the transaction commits, so versions are committed in order."""
+  changes = session.info.pop(_CACHE_CHANGES_KEY, None)
+  if not changes:
+    return
+  for table_name in sorted(changes):
+    updated = (session.query(CacheVersion)
+               .filter(CacheVersion.tableName == table_name)
+               .update({CacheVersion.version: CacheVersion.version + 1},
+                       synchronize_session=False))
+    if not updated:
+      session.add(CacheVersion(tableName=table_name, version=1))
+    version = _get_cache_version(session, table_name)
+    session.add_all([CacheChange(tableName=table_name, version=version, entityId=entity_id)
+                     for entity_id in changes[table_name]])
+    if version % _CACHE_CHANGE_PRUNE_VERSIONS == 0:
+      (session.query(CacheChange)
+       .filter(CacheChange.tableName == table_name)
+       .filter(CacheChange.version <= version - _MAX_CACHE_CHANGE_VERSIONS)
+       .delete(synchronize_session=False))
+
+
+def _discard_cache_changes(session):
+  session.info.pop(_CACHE_CHANGES_KEY, None)
@@ -106,8 +106,14 @@ SYSTEM_AND_VALUE = ('system', 'value')
 
 
 class CodeDao(CacheAllDao):
+  # Cached codes are linked to their parents and children, so reload all of them on changes.
+  incremental_refresh = False
+  # The codebook can have tens of thousands of codes; cache them as compact records.
+  compact_cache = True
+  cache_record_relationships = ('parent', 'children')
+
   def __init__(self):
-    super(CodeDao, self).__init__(Code, cache_index=CODE_CACHE_INDEX, cache_ttl_seconds=600,
+    super(CodeDao, self).__init__(Code, cache_index=CODE_CACHE_INDEX, cache_ttl_seconds=3600,
                                   index_field_keys=[SYSTEM_AND_VALUE])
 
   def _load_cache(self):
@@ -186,7 +192,7 @@ class CodeDao(CacheAllDao):
           # Check to see if it's in the database. (Normally it won't be.)
           existing_code = self._get_code_with_session(session, system, value)
           if existing_code:
-            result_map[(system, value)] = code.codeId
+            result_map[(system, value)] = existing_code.codeId
             continue
 
           if not add_codes_if_missing:
@@ -12,11 +12,21 @@ DB_CONNECTION_STRING = os.getenv('DB_CONNECTION_STRING')
 SCHEMA_TRANSLATE_MAP = None
 
 
+# Database config keys for connection pool settings, and the Database arguments they set.
+_POOL_SETTINGS = {
+  'db_pool_size': 'pool_size',
+  'db_max_overflow': 'max_overflow',
+  'db_ping_interval_seconds': 'ping_interval_seconds',
+}
+
+
 class _SqlDatabase(Database):
   def __init__(self, db_name, **kwargs):
     url = make_url(get_db_connection_string())
     if url.drivername != "sqlite" and not url.database:
       url.database = db_name
+    for arg_name, value in get_db_pool_settings().iteritems():
+      kwargs.setdefault(arg_name, value)
     super(_SqlDatabase, self).__init__(url, **kwargs)
 
 
@@ -50,13 +60,24 @@ def get_db_connection_string():
   return config.get_db_config()['db_connection_string']
 
 
+def get_db_pool_settings():
+  """Returns Database connection pool arguments set in the database config."""
+  if DB_CONNECTION_STRING:
+    return {}
+  import config
+  db_config = config.get_db_config()
+  return {arg_name: int(db_config[key])
+          for key, arg_name in _POOL_SETTINGS.iteritems() if key in db_config}
+
+
 def make_server_cursor_database():
   """
-  Returns a database object that uses a server-side cursor when talking to the database.
+  Returns a singleton database object that uses a server-side cursor when talking to the database.
   Useful in cases where you're reading a very large amount of data.
   """
   if get_db_connection_string().startswith('sqlite'):
     # SQLite doesn't have cursors; use the normal database during tests.
     return get_database()
   else:
-    return _SqlDatabase('rdr', connect_args={'cursorclass': SSCursor})
+    return singletons.get(singletons.SERVER_CURSOR_SQL_DATABASE_INDEX, _SqlDatabase,
+                          db_name='rdr', connect_args={'cursorclass': SSCursor})
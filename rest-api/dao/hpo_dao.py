@@ -24,7 +24,7 @@ class HPODao(CacheAllDao):
 
   def __init__(self):
     super(HPODao, self).__init__(HPO, cache_index=HPO_CACHE_INDEX,
-                                 cache_ttl_seconds=600, index_field_keys=['name'],
+                                 cache_ttl_seconds=3600, index_field_keys=['name'],
                                  order_by_ending=_ORDER_BY_ENDING)
 
   def _validate_update(self, session, obj, existing_obj):
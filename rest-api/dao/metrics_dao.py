@@ -5,6 +5,7 @@ import logging
 from model.metrics import MetricsVersion, MetricsBucket
 from dao.base_dao import BaseDao, UpsertableDao
 from werkzeug.exceptions import PreconditionFailed
+from sqlalchemy import or_
 from sqlalchemy.orm import subqueryload
 from datetime import timedelta
 
@@ -94,6 +95,9 @@ class MetricsBucketDao(UpsertableDao):
     return [obj.metricsVersionId, obj.date, obj.hpoId]
 
   def get_active_buckets(self, start_date=None, end_date=None):
+    """Returns the buckets of the serving metrics version between the given dates, one per HPO ID
+    and date; buckets stored for ranges of dates (with an endDate) are expanded into a bucket for
+    each of their dates in [start_date, end_date]."""
     with self.session() as session:
       version = MetricsVersionDao().get_serving_version_with_session(session)
       if version is None:
@@ -101,13 +105,37 @@ class MetricsBucketDao(UpsertableDao):
       version_id = version.metricsVersionId
       query = session.query(MetricsBucket).filter(MetricsBucket.metricsVersionId == version_id)
       if start_date:
-        query = query.filter(MetricsBucket.date >= start_date)
+        query = query.filter(or_(MetricsBucket.date >= start_date,
+                                 MetricsBucket.endDate >= start_date))
       if end_date:
         query = query.filter(MetricsBucket.date <= end_date)
-      return query.order_by(MetricsBucket.date).order_by(MetricsBucket.hpoId).all()
+      buckets = query.order_by(MetricsBucket.date).order_by(MetricsBucket.hpoId).all()
+      if not any(bucket.endDate for bucket in buckets):
+        return buckets
+      return _expand_bucket_ranges(buckets, start_date, end_date)
 
   def to_client_json(self, model):
     facets = {'date': model.date.isoformat()}
     if model.hpoId:
       facets['hpoId'] = model.hpoId
     return {'facets': facets, 'entries': json.loads(model.metrics)}
+
+
+def _expand_bucket_ranges(buckets, start_date, end_date):
+  """Returns a (transient) bucket for each date of buckets with an endDate, within the given
+  dates, along with the other buckets, ordered by date and HPO ID."""
+  result = []
+  for bucket in buckets:
+    if not bucket.endDate:
+      result.append(bucket)
+      continue
+    date = max(bucket.date, start_date) if start_date else bucket.date
+    last_date = min(bucket.endDate, end_date) if end_date else bucket.endDate
+    while date <= last_date:
+      result.append(MetricsBucket(metricsVersionId=bucket.metricsVersionId,
+                                  date=date,
+                                  hpoId=bucket.hpoId,
+                                  metrics=bucket.metrics))
+      date += timedelta(days=1)
+  result.sort(key=lambda bucket: (bucket.date, bucket.hpoId))
+  return result
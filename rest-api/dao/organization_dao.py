@@ -18,7 +18,7 @@ class _FhirOrganization(FhirMixin, BackboneElement):
 class OrganizationDao(CacheAllDao):
   def __init__(self):
     super(OrganizationDao, self).__init__(Organization, cache_index=ORGANIZATION_CACHE_INDEX,
-                                 cache_ttl_seconds=600, index_field_keys=['externalId'])
+                                 cache_ttl_seconds=3600, index_field_keys=['externalId'])
 
   def _validate_update(self, session, obj, existing_obj):
     # Organizations aren't versioned; suppress the normal check here.
@@ -5,12 +5,9 @@ from query import OrderBy, PropertyType
 from werkzeug.exceptions import BadRequest, NotFound
 from sqlalchemy import or_
 
-from api_util import format_json_date, format_json_enum, format_json_code, format_json_hpo, \
-  format_json_org
-from api_util import format_json_site
 import clock
 import config
-from code_constants import PPI_SYSTEM, UNSET, BIOBANK_TESTS
+from code_constants import PPI_SYSTEM, UNSET, UNMAPPED, BIOBANK_TESTS
 from dao.base_dao import UpdatableDao
 from dao.database_utils import get_sql_and_params_for_array, replace_null_safe_equals
 from dao.code_dao import CodeDao
@@ -71,7 +68,12 @@ _SAMPLE_SQL = """,
           AND biobank_stored_sample.test = %(sample_param_ref)s)
    """
 
-_PARTICIPANT_ID_FILTER = " WHERE participant_id = :participant_id"
+_PARTICIPANT_ID_FILTER = " participant_id = :participant_id"
+
+_BIOBANK_ID_FILTER = " biobank_id IN %s"
+
+# Number of participants updated per statement when updating summaries for given biobank IDs.
+_BIOBANK_ID_BATCH_SIZE = 1000
 
 _WHERE_SQL = """
 not sample_status_%(test)s_time <=>
@@ -98,7 +100,7 @@ def _get_sample_sql_and_params():
       where_sql += ' or '
     where_sql += _WHERE_SQL % {"test": lower_test, "sample_param_ref": sample_param_ref}
 
-  sql += ' where ' + where_sql
+  sql += ' where (' + where_sql + ')'
 
   return sql, params
 
@@ -106,12 +108,16 @@ def _get_sample_sql_and_params():
 class ParticipantSummaryDao(UpdatableDao):
 
   def __init__(self):
-    super(ParticipantSummaryDao, self).__init__(ParticipantSummary,
-                                                order_by_ending=_ORDER_BY_ENDING)
+    super(ParticipantSummaryDao, self).__init__(
+        ParticipantSummary, order_by_ending=_ORDER_BY_ENDING,
+        total_cache_ttl_seconds=config.QUERY_TOTAL_CACHE_TTL_SECONDS)
     self.hpo_dao = HPODao()
     self.code_dao = CodeDao()
     self.site_dao = SiteDao()
     self.organization_dao = OrganizationDao()
+    # Lazily built by _get_field_writers().
+    self._field_writers = None
+    self._withdrawn_field_writers = None
 
   def get_id(self, obj):
     return obj.participantId
@@ -211,13 +217,16 @@ class ParticipantSummaryDao(UpdatableDao):
       return super(ParticipantSummaryDao, self).make_query_filter(field_name + 'Id', code.codeId)
     return super(ParticipantSummaryDao, self).make_query_filter(field_name, value)
 
-  def update_from_biobank_stored_samples(self, participant_id=None):
+  def update_from_biobank_stored_samples(self, participant_id=None, biobank_ids=None):
     """Rewrites sample-related summary data. Call this after updating BiobankStoredSamples.
-    If participant_id is provided, only that participant will have their summary updated."""
+    If participant_id is provided, only that participant will have their summary updated; if
+    biobank_ids is provided, only participants with those biobank IDs are updated, in batches of
+    _BIOBANK_ID_BATCH_SIZE (each in its own transaction)."""
+    request_config = config.get_request_config()
     baseline_tests_sql, baseline_tests_params = get_sql_and_params_for_array(
-        config.getSettingList(config.BASELINE_SAMPLE_TEST_CODES), 'baseline')
+        request_config.get(config.BASELINE_SAMPLE_TEST_CODES), 'baseline')
     dna_tests_sql, dna_tests_params = get_sql_and_params_for_array(
-        config.getSettingList(config.DNA_SAMPLE_TEST_CODES), 'dna')
+        request_config.get(config.DNA_SAMPLE_TEST_CODES), 'dna')
     sample_sql, sample_params = _get_sample_sql_and_params()
     sql = """
     UPDATE
@@ -254,20 +263,36 @@ class ParticipantSummaryDao(UpdatableDao):
                                 'interested': int(EnrollmentStatus.INTERESTED)}
 
     enrollment_status_sql = _ENROLLMENT_STATUS_SQL
+    sql = replace_null_safe_equals(sql)
     # If participant_id is provided, add the participant ID filter to both update statements.
     if participant_id:
-      sql += _PARTICIPANT_ID_FILTER
       params['participant_id'] = participant_id
-      enrollment_status_sql += _PARTICIPANT_ID_FILTER
       enrollment_status_params['participant_id'] = participant_id
+      self._update_from_biobank_stored_samples(
+          sql + ' AND' + _PARTICIPANT_ID_FILTER, params,
+          enrollment_status_sql + ' WHERE' + _PARTICIPANT_ID_FILTER, enrollment_status_params)
+    elif biobank_ids is not None:
+      biobank_ids = sorted(biobank_ids)
+      for i in range(0, len(biobank_ids), _BIOBANK_ID_BATCH_SIZE):
+        biobank_ids_sql, biobank_ids_params = get_sql_and_params_for_array(
+            biobank_ids[i:i + _BIOBANK_ID_BATCH_SIZE], 'biobank_id')
+        biobank_id_filter = _BIOBANK_ID_FILTER % biobank_ids_sql
+        self._update_from_biobank_stored_samples(
+            sql + ' AND' + biobank_id_filter, dict(params, **biobank_ids_params),
+            enrollment_status_sql + ' WHERE' + biobank_id_filter,
+            dict(enrollment_status_params, **biobank_ids_params))
+    else:
+      self._update_from_biobank_stored_samples(sql, params, enrollment_status_sql,
+                                               enrollment_status_params)
 
-    sql = replace_null_safe_equals(sql)
+  def _update_from_biobank_stored_samples(self, sql, params, enrollment_status_sql,
+                                          enrollment_status_params):
     with self.session() as session:
       session.execute(sql, params)
       session.execute(enrollment_status_sql, enrollment_status_params)
 
   def _get_num_baseline_ppi_modules(self):
-    return len(config.getSettingList(config.BASELINE_PPI_QUESTIONNAIRE_FIELDS))
+    return len(config.get_request_config().get(config.BASELINE_PPI_QUESTIONNAIRE_FIELDS))
 
   def update_enrollment_status(self, summary):
     """Updates the enrollment status field on the provided participant summary to
@@ -294,47 +319,41 @@ class ParticipantSummaryDao(UpdatableDao):
     return EnrollmentStatus.INTERESTED
 
   def to_client_json(self, model):
-    result = model.asdict()
+    now = clock.CLOCK.now()
     # Participants that withdrew more than 48 hours ago should have fields other than
     # WITHDRAWN_PARTICIPANT_FIELDS cleared.
-    if (model.withdrawalStatus == WithdrawalStatus.NO_USE and
-        model.withdrawalTime < clock.CLOCK.now() - WITHDRAWN_PARTICIPANT_VISIBILITY_TIME):
-      result = {k: result.get(k) for k in WITHDRAWN_PARTICIPANT_FIELDS}
-
-    result['participantId'] = to_client_participant_id(model.participantId)
-    biobank_id = result.get('biobankId')
-    if biobank_id:
-      result['biobankId'] = to_client_biobank_id(biobank_id)
-    date_of_birth = result.get('dateOfBirth')
-    if date_of_birth:
-      result['ageRange'] = get_bucketed_age(date_of_birth, clock.CLOCK.now())
-    else:
-      result['ageRange'] = UNSET
-
-    if 'organizationId' in result:
-      result['organization'] = result['organizationId']
-      del result['organizationId']
-      format_json_org(result, self.organization_dao, 'organization')
-
-    format_json_hpo(result, self.hpo_dao, 'hpoId')
-    result['awardee'] = result['hpoId']
-    _initialize_field_type_sets()
-    for fieldname in _DATE_FIELDS:
-      format_json_date(result, fieldname)
-    for fieldname in _CODE_FIELDS:
-      format_json_code(result, self.code_dao, fieldname)
-    for fieldname in _ENUM_FIELDS:
-      format_json_enum(result, fieldname)
-    for fieldname in _SITE_FIELDS:
-      format_json_site(result, self.site_dao, fieldname)
+    withdrawn = (model.withdrawalStatus == WithdrawalStatus.NO_USE and
+                 model.withdrawalTime < now - WITHDRAWN_PARTICIPANT_VISIBILITY_TIME)
+    result = {}
+    for field_name, write in self._get_field_writers(withdrawn):
+      write(result, getattr(model, field_name))
+    result['ageRange'] = get_bucketed_age(model.dateOfBirth, now)
     if (model.withdrawalStatus == WithdrawalStatus.NO_USE or
         model.suspensionStatus == SuspensionStatus.NO_CONTACT):
       result['recontactMethod'] = 'NO_CONTACT'
-    # Strip None values.
-    result = {k: v for k, v in result.iteritems() if v is not None}
-
     return result
 
+  def _get_field_writers(self, withdrawn):
+    """Returns the (field name, writer) pairs used by to_client_json; see _make_field_writer.
+
+    For withdrawn participants, only WITHDRAWN_PARTICIPANT_FIELDS are written; code, enum and site
+    fields are UNSET.
+    """
+    if self._field_writers is None:
+      _initialize_field_type_sets()
+      field_writers = [(prop.key, _make_field_writer(self, prop.key))
+                       for prop in ParticipantSummary.__mapper__.column_attrs]
+      withdrawn_field_writers = [(field_name, write) for field_name, write in field_writers
+                                 if field_name in WITHDRAWN_PARTICIPANT_FIELDS]
+      for field_name, _ in field_writers:
+        if field_name not in WITHDRAWN_PARTICIPANT_FIELDS:
+          client_field_name = _get_unset_client_field_name(field_name)
+          if client_field_name:
+            withdrawn_field_writers.append((field_name, _make_unset_writer(client_field_name)))
+      self._withdrawn_field_writers = withdrawn_field_writers
+      self._field_writers = field_writers
+    return self._withdrawn_field_writers if withdrawn else self._field_writers
+
   def _decode_token(self, query_def, fields):
     """ If token exists in participant_summary api, decode and use lastModified to add a buffer
     of 60 seconds. This ensures when a _sync link is used no one is missed. This will return
@@ -348,6 +367,82 @@ class ParticipantSummaryDao(UpdatableDao):
 
     return decoded_vals
 
+def _get_site_field_name(field_name):
+  """Returns the client field name for a site ID field, or None if it isn't one."""
+  if field_name.endswith('Id') and field_name[:-2] in _SITE_FIELDS:
+    return field_name[:-2]
+  return None
+
+
+def _get_unset_client_field_name(field_name):
+  """Returns the client field name for fields that are UNSET (rather than omitted) in client JSON
+  when they have no value, or None for other fields."""
+  if field_name in _CODE_FIELDS:
+    return field_name[:-2]
+  if field_name in _ENUM_FIELDS:
+    return field_name
+  return _get_site_field_name(field_name)
+
+
+def _make_unset_writer(client_field_name):
+  def write(result, value):  # pylint: disable=unused-argument
+    result[client_field_name] = UNSET
+  return write
+
+
+def _make_field_writer(dao, field_name):
+  """Returns a function (result, value) which writes the client JSON for the value of the
+  ParticipantSummary field into the result dict. Built once per field from the column metadata,
+  so that to_client_json doesn't need to check field types for every summary. None values are
+  never written.
+  """
+  if field_name == 'participantId':
+    def write(result, value):
+      result['participantId'] = to_client_participant_id(value)
+  elif field_name == 'biobankId':
+    def write(result, value):
+      if value:
+        result['biobankId'] = to_client_biobank_id(value)
+      elif value is not None:
+        result['biobankId'] = value
+  elif field_name == 'hpoId':
+    hpo_dao = dao.hpo_dao
+    def write(result, value):
+      hpo_name = hpo_dao.get(value).name if value else UNSET
+      result['hpoId'] = hpo_name
+      result['awardee'] = hpo_name
+  elif field_name == 'organizationId':
+    organization_dao = dao.organization_dao
+    def write(result, value):
+      result['organization'] = organization_dao.get(value).externalId if value else UNSET
+  elif field_name in _DATE_FIELDS:
+    def write(result, value):
+      if value is not None:
+        result[field_name] = value.isoformat()
+  elif field_name in _CODE_FIELDS:
+    code_dao = dao.code_dao
+    code_field_name = field_name[:-2]
+    def write(result, value):
+      if value:
+        code = code_dao.get(value)
+        result[code_field_name] = code.value if code.mapped else UNMAPPED
+      else:
+        result[code_field_name] = UNSET
+  elif field_name in _ENUM_FIELDS:
+    def write(result, value):
+      result[field_name] = str(value) if value is not None else UNSET
+  elif _get_site_field_name(field_name):
+    site_dao = dao.site_dao
+    site_field_name = _get_site_field_name(field_name)
+    def write(result, value):
+      result[site_field_name] = site_dao.get(value).googleGroup if value is not None else UNSET
+  else:
+    def write(result, value):
+      if value is not None:
+        result[field_name] = value
+  return write
+
+
 def _initialize_field_type_sets():
   """Using reflection, populate _DATE_FIELDS, _ENUM_FIELDS, and _CODE_FIELDS, which are
   used when formatting JSON from participant summaries.
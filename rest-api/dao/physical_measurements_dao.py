@@ -296,8 +296,8 @@ class PhysicalMeasurementsDao(BaseDao):
 
   def _update_amended(self, obj, extension, url, session):
     """Finds the measurements that are being amended; sets the resource status to 'amended',
-    the 'final' flag to False, and sets the new measurements' amendedMeasurementsId field to
-    its ID."""
+    the 'final' flag to False, and a new log position (so that syncs and exports see the change),
+    and sets the new measurements' amendedMeasurementsId field to its ID."""
     value_ref = extension.get('valueReference')
     if value_ref is None:
       raise BadRequest('No valueReference in extension %r.' % url)
@@ -321,6 +321,7 @@ class PhysicalMeasurementsDao(BaseDao):
     amended_resource['status'] = 'amended'
     amended_measurement.final = False
     amended_measurement.resource = json.dumps(amended_resource_json)
+    amended_measurement.logPosition = LogPosition()
     session.merge(amended_measurement)
     obj.amendedMeasurementsId = amended_measurement_id
 
@@ -1,5 +1,7 @@
 import clock
+import collections
 import json
+import threading
 
 import fhirclient.models.questionnaire
 from sqlalchemy.orm import subqueryload
@@ -10,7 +12,10 @@ from code_constants import PPI_EXTRA_SYSTEM
 from model.code import CodeType
 from model.questionnaire import Questionnaire, QuestionnaireHistory, QuestionnaireConcept
 from model.questionnaire import QuestionnaireQuestion
+import singletons
 
+# Number of questionnaire versions kept in each process's QuestionnaireVersionCache.
+QUESTIONNAIRE_VERSION_CACHE_SIZE = 200
 
 class QuestionnaireDao(UpdatableDao):
 
@@ -26,6 +31,13 @@ class QuestionnaireDao(UpdatableDao):
                                                    subqueryload(Questionnaire.questions))
       return query.get(questionnaireId)
 
+  def get_version(self, questionnaire_id):
+    """Returns the current version of the questionnaire, or None if it doesn't exist."""
+    with self.session() as session:
+      return (session.query(Questionnaire.version)
+              .filter(Questionnaire.questionnaireId == questionnaire_id)
+              .scalar())
+
   def get_latest_questionnaire_with_concept(self, codeId):
     """Find the questionnaire most recently modified that has the specified concept code."""
     with self.session() as session:
@@ -219,6 +231,80 @@ class QuestionnaireHistoryDao(BaseDao):
     with self.session() as session:
       return self.get_with_children_with_session(session, questionnaireIdAndVersion)
 
+  def get_frozen_with_session(self, session, questionnaire_id, version):
+    """Returns a FrozenQuestionnaire for the questionnaire version, or None if it doesn't exist."""
+    cache = _get_questionnaire_version_cache()
+    key = (questionnaire_id, version)
+    questionnaire = cache.get(key)
+    if questionnaire is None:
+      history = self.get_with_children_with_session(session, [questionnaire_id, version])
+      if history is None:
+        return None
+      questionnaire = FrozenQuestionnaire(history)
+      cache.put(key, questionnaire)
+    return questionnaire
+
+  def get_frozen(self, questionnaire_id, version):
+    questionnaire = _get_questionnaire_version_cache().get((questionnaire_id, version))
+    if questionnaire is not None:
+      return questionnaire
+    with self.session() as session:
+      return self.get_frozen_with_session(session, questionnaire_id, version)
+
+
+FrozenQuestion = collections.namedtuple(
+    'FrozenQuestion', ('questionnaireQuestionId', 'linkId', 'codeId'))
+
+
+class FrozenQuestionnaire(object):
+  """A read-only copy of a questionnaire version's questions and concepts, with the lookups needed
+  to ingest questionnaire responses for it.
+
+  A questionnaire version never changes once it's written, so these are cached in
+  QuestionnaireVersionCache and shared between requests; don't modify them.
+  """
+  def __init__(self, questionnaire_history):
+    self.questionnaireId = questionnaire_history.questionnaireId
+    self.version = questionnaire_history.version
+    self.questions = tuple(
+        FrozenQuestion(question.questionnaireQuestionId, question.linkId, question.codeId)
+        for question in questionnaire_history.questions)
+    self.question_ids = frozenset(question.questionnaireQuestionId for question in self.questions)
+    self.question_id_to_code_id = {question.questionnaireQuestionId: question.codeId
+                                   for question in self.questions}
+    self.link_id_to_question = {question.linkId: question for question in self.questions}
+    self.concept_code_ids = tuple(concept.codeId for concept in questionnaire_history.concepts)
+
+
+class QuestionnaireVersionCache(object):
+  """The most recently used FrozenQuestionnaires, keyed by (questionnaireId, version). Stored in
+  singletons, so shared by all DAOs in the process."""
+
+  def __init__(self, max_size=QUESTIONNAIRE_VERSION_CACHE_SIZE):
+    self._lock = threading.Lock()
+    self._max_size = max_size
+    self._questionnaires = collections.OrderedDict()
+
+  def get(self, key):
+    """Returns the cached questionnaire for the key, or None."""
+    with self._lock:
+      questionnaire = self._questionnaires.pop(key, None)
+      if questionnaire is not None:
+        # Move it to the end, as the most recently used.
+        self._questionnaires[key] = questionnaire
+    return questionnaire
+
+  def put(self, key, questionnaire):
+    with self._lock:
+      self._questionnaires.pop(key, None)
+      self._questionnaires[key] = questionnaire
+      while len(self._questionnaires) > self._max_size:
+        self._questionnaires.popitem(last=False)
+
+
+def _get_questionnaire_version_cache():
+  return singletons.get(singletons.QUESTIONNAIRE_VERSION_CACHE_INDEX, QuestionnaireVersionCache)
+
 
 class QuestionnaireConceptDao(BaseDao):
 
@@ -1,13 +1,17 @@
+import Queue
 import clock
+import collections
 import config
 import json
 import logging
 import os
+import threading
 
 from cloudstorage import cloudstorage_api
 import fhirclient.models.questionnaireresponse
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import subqueryload
-from werkzeug.exceptions import BadRequest
+from werkzeug.exceptions import BadRequest, HTTPException, InternalServerError
 
 from code_constants import PPI_SYSTEM, RACE_QUESTION_CODE, CONSENT_FOR_STUDY_ENROLLMENT_MODULE
 from code_constants import EHR_CONSENT_QUESTION_CODE, CONSENT_PERMISSION_YES_CODE
@@ -18,11 +22,11 @@ from dao.base_dao import BaseDao
 from dao.code_dao import CodeDao
 from dao.participant_dao import ParticipantDao, raise_if_withdrawn
 from dao.participant_summary_dao import ParticipantSummaryDao
-from dao.questionnaire_dao import QuestionnaireHistoryDao, QuestionnaireQuestionDao
+from dao.questionnaire_dao import QuestionnaireHistoryDao
 from field_mappings import FieldType, QUESTION_CODE_TO_FIELD, QUESTIONNAIRE_MODULE_CODE_TO_FIELD
 from model.code import CodeType
-from model.questionnaire import QuestionnaireQuestion
 from model.questionnaire_response import QuestionnaireResponse, QuestionnaireResponseAnswer
+from model.questionnaire_response import QuestionnaireResponseCurrentAnswer
 from participant_enums import QuestionnaireStatus, get_race
 
 _QUESTIONNAIRE_PREFIX = 'Questionnaire/'
@@ -30,18 +34,22 @@ _QUESTIONNAIRE_HISTORY_SEGMENT = '/_history/'
 _QUESTIONNAIRE_REFERENCE_FORMAT = (_QUESTIONNAIRE_PREFIX + "%d" +
                                    _QUESTIONNAIRE_HISTORY_SEGMENT + "%d")
 
+# Number of participants whose responses insert_batch inserts concurrently, by default.
+DEFAULT_BATCH_THREADS = 8
+
 _SIGNED_CONSENT_EXTENSION = (
     'http://terminology.pmi-ops.org/StructureDefinition/consent-form-signed-pdf')
 
 
 def count_completed_baseline_ppi_modules(participant_summary):
-  baseline_ppi_module_fields = config.getSettingList(config.BASELINE_PPI_QUESTIONNAIRE_FIELDS, [])
+  baseline_ppi_module_fields = config.get_request_config().get(
+      config.BASELINE_PPI_QUESTIONNAIRE_FIELDS, frozenset())
   return sum(1 for field in baseline_ppi_module_fields
              if getattr(participant_summary, field) == QuestionnaireStatus.SUBMITTED)
 
 
 def count_completed_ppi_modules(participant_summary):
-  ppi_module_fields = config.getSettingList(config.PPI_QUESTIONNAIRE_FIELDS, [])
+  ppi_module_fields = config.get_request_config().get(config.PPI_QUESTIONNAIRE_FIELDS, frozenset())
   return sum(1 for field in ppi_module_fields
              if getattr(participant_summary, field) == QuestionnaireStatus.SUBMITTED)
 
@@ -80,51 +88,90 @@ class QuestionnaireResponseDao(BaseDao):
           'QuestionnaireResponse model has no answers. This is harmless but probably an error.')
 
   def insert_with_session(self, session, questionnaire_response):
-    questionnaire_history = (
-        QuestionnaireHistoryDao().
-        get_with_children_with_session(session, [questionnaire_response.questionnaireId,
-                                                 questionnaire_response.questionnaireVersion]))
-    if not questionnaire_history:
-      raise BadRequest('Questionnaire with ID %s, version %s is not found' %
-                       (questionnaire_response.questionnaireId,
-                        questionnaire_response.questionnaireVersion))
-    q_question_ids = set([
-        question.questionnaireQuestionId for question in questionnaire_history.questions])
-    for answer in questionnaire_response.answers:
-      if answer.questionId not in q_question_ids:
-        raise BadRequest('Questionnaire response contains question ID %s not in questionnaire.' %
-                         answer.questionId)
-
-    questionnaire_response.created = clock.CLOCK.now()
-
-    # Put the ID into the resource.
-    resource_json = json.loads(questionnaire_response.resource)
-    resource_json['id'] = str(questionnaire_response.questionnaireResponseId)
-    questionnaire_response.resource = json.dumps(resource_json)
-
-    question_ids = [answer.questionId for answer in questionnaire_response.answers]
-    questions = QuestionnaireQuestionDao().get_all_with_session(session, question_ids)
-    code_ids = [question.codeId for question in questions]
-    current_answers = (QuestionnaireResponseAnswerDao().
-        get_current_answers_for_concepts(session, questionnaire_response.participantId, code_ids))
-
-    # IMPORTANT: update the participant summary first to grab an exclusive lock on the participant
-    # row. If you insetad do this after the insert of the questionnaire response, MySQL will get a
-    # shared lock on the participant row due the foreign key, and potentially deadlock later trying
-    # to get the exclusive lock if another thread is updating the participant. See DA-269.
-    # (We need to lock both participant and participant summary because the summary row may not
-    # exist yet.)
-    self._update_participant_summary(
-        session, questionnaire_response, code_ids, questions, questionnaire_history)
-
-    super(QuestionnaireResponseDao, self).insert_with_session(session, questionnaire_response)
-    # Mark existing answers for the questions in this response given previously by this participant
-    # as ended.
-    for answer in current_answers:
-      answer.endTime = questionnaire_response.created
-      session.merge(answer)
-
-    return questionnaire_response
+    return self._insert_responses_with_session(
+        session, questionnaire_response.participantId, [questionnaire_response])[0]
+
+  def _insert_responses_with_session(self, session, participant_id, questionnaire_responses):
+    """Inserts responses for one participant in order, in the session's transaction.
+
+    The participant's current answers to all the questions in the responses are looked up once,
+    and answers the responses supersede (including answers from earlier responses in the list) are
+    ended and replaced in the current answer index together.
+    """
+    questionnaires_and_code_ids = []
+    for questionnaire_response in questionnaire_responses:
+      questionnaire = QuestionnaireHistoryDao().get_frozen_with_session(
+          session, questionnaire_response.questionnaireId,
+          questionnaire_response.questionnaireVersion)
+      if not questionnaire:
+        raise BadRequest('Questionnaire with ID %s, version %s is not found' %
+                         (questionnaire_response.questionnaireId,
+                          questionnaire_response.questionnaireVersion))
+      for answer in questionnaire_response.answers:
+        if answer.questionId not in questionnaire.question_ids:
+          raise BadRequest('Questionnaire response contains question ID %s not in questionnaire.' %
+                           answer.questionId)
+      code_ids = list(set(questionnaire.question_id_to_code_id[answer.questionId]
+                          for answer in questionnaire_response.answers))
+      questionnaires_and_code_ids.append((questionnaire, code_ids))
+
+    # The responses are committed together, so they are all created at the same time (which is
+    # also the time the answers they supersede end.)
+    created = clock.CLOCK.now()
+    answer_dao = QuestionnaireResponseAnswerDao()
+    # Answers that are current so far, by question code ID: IDs of answers already in the database,
+    # or QuestionnaireResponseAnswers from the responses.
+    current_answers = answer_dao.get_current_answer_ids_by_code_id(
+        session, participant_id,
+        set(code_id for _, code_ids in questionnaires_and_code_ids for code_id in code_ids))
+    ended_answer_ids = []
+    for i, questionnaire_response in enumerate(questionnaire_responses):
+      questionnaire, code_ids = questionnaires_and_code_ids[i]
+      questionnaire_response.created = created
+
+      # Put the ID into the resource.
+      resource_json = json.loads(questionnaire_response.resource)
+      resource_json['id'] = str(questionnaire_response.questionnaireResponseId)
+      questionnaire_response.resource = json.dumps(resource_json)
+
+      # Mark existing answers for the questions in this response given previously by this
+      # participant as ended.
+      for code_id in code_ids:
+        for previous_answer in current_answers.pop(code_id, []):
+          if isinstance(previous_answer, QuestionnaireResponseAnswer):
+            previous_answer.endTime = created
+          else:
+            ended_answer_ids.append(previous_answer)
+      for answer in questionnaire_response.answers:
+        current_answers.setdefault(questionnaire.question_id_to_code_id[answer.questionId],
+                                   []).append(answer)
+
+      # IMPORTANT: update the participant summary first to grab an exclusive lock on the
+      # participant row. If you insetad do this after the insert of the questionnaire response,
+      # MySQL will get a shared lock on the participant row due the foreign key, and potentially
+      # deadlock later trying to get the exclusive lock if another thread is updating the
+      # participant. See DA-269.
+      # (We need to lock both participant and participant summary because the summary row may not
+      # exist yet.)
+      self._update_participant_summary(session, questionnaire_response, list(code_ids),
+                                       questionnaire)
+
+      super(QuestionnaireResponseDao, self).insert_with_session(session, questionnaire_response)
+      if i < len(questionnaire_responses) - 1:
+        # The participant stays in the session; make sure the next response sees the participant
+        # summary if this one created it.
+        session.flush()
+        session.expire(ParticipantDao().get_with_session(session, participant_id),
+                       ['participantSummary'])
+
+    answer_dao.end_answers(session, ended_answer_ids, created)
+    # Write the new answers, so they have IDs to replace the ended ones in the current answer index.
+    session.flush()
+    answer_dao.replace_current_answers(
+        session, participant_id, ended_answer_ids,
+        [(answer.questionnaireResponseAnswerId, code_id)
+         for code_id, answers in current_answers.iteritems() for answer in answers])
+    return questionnaire_responses
 
   def _get_field_value(self, field_type, answer):
     if field_type == FieldType.CODE:
@@ -143,8 +190,7 @@ class QuestionnaireResponseDao(BaseDao):
       return True
     return False
 
-  def _update_participant_summary(
-      self, session, questionnaire_response, code_ids, questions, questionnaire_history):
+  def _update_participant_summary(self, session, questionnaire_response, code_ids, questionnaire):
     """Updates the participant summary based on questions answered and modules completed
     in the questionnaire response.
 
@@ -160,7 +206,7 @@ class QuestionnaireResponseDao(BaseDao):
 
     participant_summary = participant.participantSummary
 
-    code_ids.extend([concept.codeId for concept in questionnaire_history.concepts])
+    code_ids.extend(questionnaire.concept_code_ids)
 
     code_dao = CodeDao()
 
@@ -183,14 +229,13 @@ class QuestionnaireResponseDao(BaseDao):
     codes = code_dao.get_with_ids(code_ids)
 
     code_map = {code.codeId: code for code in codes if code.system == PPI_SYSTEM}
-    question_map = {question.questionnaireQuestionId: question for question in questions}
     race_code_ids = []
     ehr_consent = False
     # Set summary fields for answers that have questions with codes found in QUESTION_CODE_TO_FIELD
     for answer in questionnaire_response.answers:
-      question = question_map.get(answer.questionId)
-      if question:
-        code = code_map.get(question.codeId)
+      question_code_id = questionnaire.question_id_to_code_id.get(answer.questionId)
+      if question_code_id:
+        code = code_map.get(question_code_id)
         if code:
           summary_field = QUESTION_CODE_TO_FIELD.get(code.value)
           if summary_field:
@@ -221,8 +266,8 @@ class QuestionnaireResponseDao(BaseDao):
     # Set summary fields to SUBMITTED for questionnaire concepts that are found in
     # QUESTIONNAIRE_MODULE_CODE_TO_FIELD
     module_changed = False
-    for concept in questionnaire_history.concepts:
-      code = code_map.get(concept.codeId)
+    for concept_code_id in questionnaire.concept_code_ids:
+      code = code_map.get(concept_code_id)
       if code:
         summary_field = QUESTIONNAIRE_MODULE_CODE_TO_FIELD.get(code.value)
         if summary_field:
@@ -256,6 +301,86 @@ class QuestionnaireResponseDao(BaseDao):
       return super(QuestionnaireResponseDao, self).insert(obj)
     return self._insert_with_random_id(obj, ['questionnaireResponseId'])
 
+  def insert_batch(self, participant_ids_and_resources, client_id=None):
+    """Inserts questionnaire responses given as (participant ID, resource JSON) pairs.
+
+    Each participant's responses are inserted in order, in one transaction; different
+    participants' responses are inserted concurrently. Returns a list with the inserted
+    QuestionnaireResponse or the HTTPException it was rejected with for each response.
+    """
+    results = [None] * len(participant_ids_and_resources)
+    participant_batches = collections.OrderedDict()
+    for i, (participant_id, resource_json) in enumerate(participant_ids_and_resources):
+      participant_batches.setdefault(participant_id, []).append((i, resource_json))
+    batch_queue = Queue.Queue()
+    for participant_id, batch in participant_batches.iteritems():
+      batch_queue.put((participant_id, batch))
+
+    def insert_batches():
+      while True:
+        try:
+          participant_id, batch = batch_queue.get_nowait()
+        except Queue.Empty:
+          return
+        try:
+          for i, result in self._insert_participant_batch(participant_id, batch, client_id):
+            results[i] = result
+        except Exception:  # pylint: disable=broad-except
+          logging.exception('Failed to insert responses for participant %s.', participant_id)
+          for i, _ in batch:
+            results[i] = InternalServerError()
+
+    num_threads = config.getSetting(config.QUESTIONNAIRE_RESPONSE_BATCH_THREADS,
+                                    DEFAULT_BATCH_THREADS)
+    if self._database.db_type == 'sqlite':
+      # SQLite doesn't support concurrent writes (and connections in different threads don't see
+      # the same in-memory database.)
+      num_threads = 1
+    threads = [threading.Thread(target=insert_batches)
+               for _ in range(min(num_threads, len(participant_batches)) - 1)]
+    for thread in threads:
+      thread.start()
+    insert_batches()
+    for thread in threads:
+      thread.join()
+    return results
+
+  def _insert_participant_batch(self, participant_id, batch, client_id):
+    """Inserts one participant's responses, given as (index, resource JSON) pairs, in one
+    transaction. If any of them is rejected, inserts them one at a time instead, so that the others
+    are still inserted. Returns (index, result) pairs as in insert_batch."""
+    results = []
+    responses = []
+    for i, resource_json in batch:
+      try:
+        responses.append((i, resource_json, self.from_client_json(
+            resource_json, participant_id=participant_id, client_id=client_id)))
+      except HTTPException, e:
+        results.append((i, e))
+    try:
+      with self.session() as session:
+        for _, _, questionnaire_response in responses:
+          questionnaire_response.questionnaireResponseId = self._get_random_id()
+        self._insert_responses_with_session(
+            session, participant_id,
+            [questionnaire_response for _, _, questionnaire_response in responses])
+      results.extend((i, questionnaire_response)
+                     for i, _, questionnaire_response in responses)
+    except (HTTPException, IntegrityError), e:
+      logging.info('Inserting responses for participant %s one at a time: %s', participant_id, e)
+      for i, resource_json, _ in responses:
+        try:
+          questionnaire_response = self.from_client_json(
+              resource_json, participant_id=participant_id, client_id=client_id)
+          results.append((i, self.insert(questionnaire_response)))
+        except HTTPException, e:
+          results.append((i, e))
+        except Exception:  # pylint: disable=broad-except
+          # Responses inserted before this one are committed, and keep their results.
+          logging.exception('Failed to insert response for participant %s.', participant_id)
+          results.append((i, InternalServerError()))
+    return results
+
   def from_client_json(self, resource_json, participant_id=None, client_id=None):
     #pylint: disable=unused-argument
     # Parse the questionnaire response, but preserve the original response when persisting
@@ -286,8 +411,8 @@ class QuestionnaireResponseDao(BaseDao):
 
   @staticmethod
   def _get_questionnaire(questionnaire, resource_json):
-    """Retrieves the questionnaire referenced by this response; mutates the resource JSON to include
-    the version if it doesn't already."""
+    """Retrieves the FrozenQuestionnaire for the questionnaire version referenced by this response;
+    mutates the resource JSON to include the version if it doesn't already."""
     if not questionnaire.reference.startswith(_QUESTIONNAIRE_PREFIX):
       raise BadRequest('Questionnaire reference %s is invalid' % questionnaire.reference)
     questionnaire_reference = questionnaire.reference[len(_QUESTIONNAIRE_PREFIX):]
@@ -299,7 +424,7 @@ class QuestionnaireResponseDao(BaseDao):
       try:
         questionnaire_id = int(questionnaire_ref_parts[0])
         version = int(questionnaire_ref_parts[1])
-        q = QuestionnaireHistoryDao().get_with_children((questionnaire_id, version))
+        q = QuestionnaireHistoryDao().get_frozen(questionnaire_id, version)
         if not q:
           raise BadRequest('Questionnaire with id %d, version %d is not found' %
                            (questionnaire_id, version))
@@ -310,11 +435,12 @@ class QuestionnaireResponseDao(BaseDao):
       try:
         questionnaire_id = int(questionnaire_reference)
         from dao.questionnaire_dao import QuestionnaireDao
-        q = QuestionnaireDao().get_with_children(questionnaire_id)
+        version = QuestionnaireDao().get_version(questionnaire_id)
+        q = version and QuestionnaireHistoryDao().get_frozen(questionnaire_id, version)
         if not q:
           raise BadRequest('Questionnaire with id %d is not found' % questionnaire_id)
         # Mutate the questionnaire reference to include the version.
-        questionnaire_reference = _QUESTIONNAIRE_REFERENCE_FORMAT % (questionnaire_id, q.version)
+        questionnaire_reference = _QUESTIONNAIRE_REFERENCE_FORMAT % (questionnaire_id, version)
         resource_json["questionnaire"]["reference"] = questionnaire_reference
         return q
       except ValueError:
@@ -327,10 +453,7 @@ class QuestionnaireResponseDao(BaseDao):
     """
     code_map = {}
     answers = []
-    link_id_to_question = {}
-    if q.questions:
-      link_id_to_question = {question.linkId: question for question in q.questions}
-    cls._populate_codes_and_answers(group, code_map, answers, link_id_to_question,
+    cls._populate_codes_and_answers(group, code_map, answers, q.link_id_to_question,
                                                       q.questionnaireId)
     return (code_map, answers)
 
@@ -456,9 +579,52 @@ class QuestionnaireResponseAnswerDao(BaseDao):
     code IDs."""
     if not code_ids:
       return []
-    return (session.query(QuestionnaireResponseAnswer).join(QuestionnaireResponse)
-        .join(QuestionnaireQuestion)
-        .filter(QuestionnaireResponse.participantId == participant_id)
-        .filter(QuestionnaireResponseAnswer.endTime == None)
-        .filter(QuestionnaireQuestion.codeId.in_(code_ids))
+    return (session.query(QuestionnaireResponseAnswer)
+        .join(QuestionnaireResponseCurrentAnswer,
+              QuestionnaireResponseCurrentAnswer.questionnaireResponseAnswerId ==
+              QuestionnaireResponseAnswer.questionnaireResponseAnswerId)
+        .filter(QuestionnaireResponseCurrentAnswer.participantId == participant_id)
+        .filter(QuestionnaireResponseCurrentAnswer.questionCodeId.in_(code_ids))
         .all())
+
+  @staticmethod
+  def get_current_answer_ids_by_code_id(session, participant_id, code_ids):
+    """Returns the IDs of the participant's current answers to questions with the specified code
+    IDs, as a dictionary of lists by question code ID."""
+    answer_ids_by_code_id = {}
+    if not code_ids:
+      return answer_ids_by_code_id
+    for code_id, answer_id in (
+        session.query(QuestionnaireResponseCurrentAnswer.questionCodeId,
+                      QuestionnaireResponseCurrentAnswer.questionnaireResponseAnswerId)
+        .filter(QuestionnaireResponseCurrentAnswer.participantId == participant_id)
+        .filter(QuestionnaireResponseCurrentAnswer.questionCodeId.in_(code_ids))):
+      answer_ids_by_code_id.setdefault(code_id, []).append(answer_id)
+    return answer_ids_by_code_id
+
+  @staticmethod
+  def end_answers(session, answer_ids, end_time):
+    """Sets endTime on the answers with the specified IDs in one UPDATE.
+
+    Answers already loaded into the session are not updated.
+    """
+    if not answer_ids:
+      return
+    (session.query(QuestionnaireResponseAnswer)
+     .filter(QuestionnaireResponseAnswer.questionnaireResponseAnswerId.in_(answer_ids))
+     .update({QuestionnaireResponseAnswer.endTime: end_time}, synchronize_session=False))
+
+  @staticmethod
+  def replace_current_answers(session, participant_id, ended_answer_ids, answer_ids_and_code_ids):
+    """Removes ended answers from the participant's current answers, and adds new answers given as
+    (answer ID, question code ID) pairs."""
+    if ended_answer_ids:
+      (session.query(QuestionnaireResponseCurrentAnswer)
+       .filter(QuestionnaireResponseCurrentAnswer.participantId == participant_id)
+       .filter(QuestionnaireResponseCurrentAnswer.questionnaireResponseAnswerId.in_(
+           ended_answer_ids))
+       .delete(synchronize_session=False))
+    session.add_all(QuestionnaireResponseCurrentAnswer(participantId=participant_id,
+                                                       questionCodeId=code_id,
+                                                       questionnaireResponseAnswerId=answer_id)
+                    for answer_id, code_id in answer_ids_and_code_ids)
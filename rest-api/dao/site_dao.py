@@ -36,7 +36,7 @@ class _FhirSite(FhirMixin, BackboneElement):
 class SiteDao(CacheAllDao):
   def __init__(self):
     super(SiteDao, self).__init__(Site, cache_index=SITE_CACHE_INDEX,
-                                  cache_ttl_seconds=600, index_field_keys=['googleGroup'])
+                                  cache_ttl_seconds=3600, index_field_keys=['googleGroup'])
 
   def _validate_update(self, session, obj, existing_obj):
     # Sites aren't versioned; suppress the normal check here.
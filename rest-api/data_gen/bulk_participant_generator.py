@@ -0,0 +1,591 @@
+"""Creates participants with questionnaire responses, physical measurements, biobank orders and
+samples directly in the database, for building large datasets for scale tests.
+
+BulkParticipantGenerator draws participants from the same distributions as
+FakeParticipantGenerator, but rather than sending a request to the API for each step, it builds
+the rows the API would write (including participant history and summaries) and inserts them in
+batches. generate_participants runs generators in a pool of processes, each of which writes its
+own range of participants and IDs.
+"""
+import collections
+import datetime
+import itertools
+import json
+import logging
+import multiprocessing
+import random
+
+from sqlalchemy import func, inspect, text
+
+from code_constants import PPI_SYSTEM, BIOBANK_TESTS, RACE_QUESTION_CODE
+from code_constants import CABOR_SIGNATURE_QUESTION_CODE, EHR_CONSENT_QUESTION_CODE
+from code_constants import CONSENT_PERMISSION_YES_CODE, CONSENT_FOR_ELECTRONIC_HEALTH_RECORDS_MODULE
+from dao import database_factory
+from dao.base_dao import MIN_RANDOM_ID
+from dao.biobank_order_dao import BiobankOrderDao
+from dao.code_dao import CodeDao
+from dao.participant_dao import ParticipantDao, make_primary_provider_link_for_hpo
+from dao.participant_summary_dao import ParticipantSummaryDao
+from dao.physical_measurements_dao import PhysicalMeasurementsDao
+from dao.questionnaire_response_dao import count_completed_baseline_ppi_modules
+from dao.questionnaire_response_dao import count_completed_ppi_modules
+from data_gen.fake_biobank_samples_generator import PARTICIPANTS_WITH_ORPHAN_SAMPLES
+from data_gen.fake_biobank_samples_generator import (
+    MAX_MINUTES_BETWEEN_PARTICIPANT_CREATED_AND_CONFIRMED,
+    MAX_MINUTES_BETWEEN_SAMPLE_COLLECTED_AND_CONFIRMED)
+from data_gen.fake_participant_generator import FakeParticipantGenerator, CALIFORNIA_HPOS
+from data_gen.fake_participant_generator import MAX_DAYS_BEFORE_BIOBANK_ORDER
+from data_gen.fake_participant_generator import MAX_DAYS_BEFORE_HPO_CHANGE
+from data_gen.fake_participant_generator import MAX_DAYS_BEFORE_SUSPENSION
+from data_gen.fake_participant_generator import MAX_DAYS_BEFORE_WITHDRAWAL
+from data_gen.fake_participant_generator import MAX_DAYS_BETWEEN_SUBMISSIONS
+from data_gen.fake_participant_generator import MAX_DAYS_HISTORY, MULTIPLE_BIOBANK_ORDERS
+from data_gen.fake_participant_generator import NO_BIOBANK_ORDERS, NO_BIOBANK_SAMPLES
+from data_gen.fake_participant_generator import NO_HPO_CHANGE, NO_HPO_PERCENT
+from data_gen.fake_participant_generator import NO_PHYSICAL_MEASUREMENTS
+from data_gen.fake_participant_generator import NO_QUESTIONNAIRES_SUBMITTED
+from data_gen.fake_participant_generator import QUESTIONNAIRE_NOT_SUBMITTED
+from data_gen.fake_participant_generator import SUSPENDED_PERCENT, WITHDRAWN_PERCENT
+from dateutil.parser import parse
+from field_mappings import FieldType, QUESTION_CODE_TO_FIELD, QUESTIONNAIRE_MODULE_CODE_TO_FIELD
+from model.biobank_order import BiobankOrderIdentifier, BiobankOrderedSample
+from model.biobank_stored_sample import BiobankStoredSample
+from model.code import CodeType
+from model.log_position import LogPosition
+from model.measurements import PhysicalMeasurements, measurement_to_qualifier
+from model.participant import Participant, ParticipantHistory
+from model.questionnaire import QuestionnaireConcept, QuestionnaireQuestion
+from model.questionnaire_response import QuestionnaireResponse, QuestionnaireResponseAnswer
+from model.utils import to_client_participant_id
+from participant_enums import OrderStatus, PhysicalMeasurementsStatus, QuestionnaireStatus
+from participant_enums import SuspensionStatus, WithdrawalStatus
+from participant_enums import UNSET_HPO_ID, get_race
+
+# Participants whose rows are inserted in each transaction.
+DEFAULT_BATCH_SIZE = 500
+# Client ID recorded on generated participants.
+_CLIENT_ID = 'example@example.com'
+# Fraction of the ordered samples for participants with biobank samples that are not stored.
+_SAMPLES_MISSING_FRACTION = 0.1
+# Log positions reserved per participant: physical measurements, and up to two biobank orders.
+_LOG_POSITIONS_PER_PARTICIPANT = 3
+
+# Adds the current answers of the participants in a range (as
+# QuestionnaireResponseAnswerDao.replace_current_answers does for responses the API inserts.)
+_INSERT_CURRENT_ANSWERS_SQL = """
+INSERT INTO questionnaire_response_current_answer
+  (participant_id, question_code_id, questionnaire_response_answer_id)
+SELECT qr.participant_id, qq.code_id, qra.questionnaire_response_answer_id
+  FROM questionnaire_response_answer qra
+  JOIN questionnaire_response qr
+    ON qra.questionnaire_response_id = qr.questionnaire_response_id
+  JOIN questionnaire_question qq
+    ON qra.question_id = qq.questionnaire_question_id
+ WHERE qra.end_time IS NULL
+   AND qr.participant_id BETWEEN :first_participant_id AND :last_participant_id
+"""
+
+# Answer fields whose FHIR JSON values are stored as they are.
+_ANSWER_VALUE_FIELDS = ('valueString', 'valueDecimal', 'valueInteger', 'valueBoolean', 'valueUri')
+
+# The first IDs to use for rows written by generate_participants; participant n (counting from 0)
+# has IDs derived from these (see BulkParticipantGenerator).
+IdStarts = collections.namedtuple('IdStarts', ['participant_id', 'biobank_id',
+                                               'questionnaire_response_id',
+                                               'physical_measurements_id', 'log_position_id'])
+
+
+def get_id_starts(session):
+  """Returns IdStarts after the largest IDs in the database (and no smaller than the random IDs
+  DAOs assign.)"""
+  def next_id(column, minimum=MIN_RANDOM_ID):
+    max_id = session.query(func.max(column)).scalar()
+    return max(max_id + 1 if max_id is not None else minimum, minimum)
+  return IdStarts(participant_id=next_id(Participant.participantId),
+                  biobank_id=next_id(Participant.biobankId),
+                  questionnaire_response_id=next_id(QuestionnaireResponse.questionnaireResponseId),
+                  physical_measurements_id=next_id(PhysicalMeasurements.physicalMeasurementsId),
+                  log_position_id=next_id(LogPosition.logPositionId, minimum=1))
+
+
+def generate_participants(num_participants, num_processes=None, batch_size=DEFAULT_BATCH_SIZE,
+                          include_physical_measurements=True, include_biobank_orders=True,
+                          seed=None):
+  """Creates participants in the database, split between a pool of processes.
+
+  Args:
+    num_participants: the number of participants to create.
+    num_processes: size of the multiprocessing pool (defaults to the number of CPUs); 0 creates all
+      participants in this process.
+    batch_size: the number of participants whose rows are inserted in each transaction.
+    include_physical_measurements: whether to create physical measurements.
+    include_biobank_orders: whether to create biobank orders and stored samples.
+    seed: if set, seeds the random number generator of each process so that runs with the same
+      arguments create the same participants.
+
+  Returns:
+    The IdStarts of the created participants; their participant IDs range from
+    IdStarts.participant_id to IdStarts.participant_id + num_participants - 1.
+  """
+  if num_processes is None:
+    num_processes = multiprocessing.cpu_count()
+  num_tasks = max(num_processes, 1)
+  # Add any missing answer codes before starting workers, so that they don't all try to.
+  BulkParticipantGenerator.add_answer_codes()
+  with ParticipantDao().session() as session:
+    id_starts = get_id_starts(session)
+  if num_processes:
+    # Each worker connects to the database itself.
+    database_factory.get_database().get_engine().dispose()
+
+  tasks = []
+  task_size = max((num_participants + num_tasks - 1) // num_tasks, 1)
+  for first_index in range(0, num_participants, task_size):
+    tasks.append((first_index, min(task_size, num_participants - first_index), id_starts,
+                  batch_size, include_physical_measurements, include_biobank_orders, seed))
+  pool = multiprocessing.Pool(num_processes) if num_processes else None
+  try:
+    num_created = sum((pool.map if pool else map)(_generate_task, tasks))
+  finally:
+    if pool:
+      pool.close()
+      pool.join()
+  logging.info('Created %d participants with IDs starting at %d.', num_created,
+               id_starts.participant_id)
+  return id_starts
+
+
+def _generate_task(args):
+  (first_index, num_participants, id_starts, batch_size, include_physical_measurements,
+   include_biobank_orders, seed) = args
+  if seed is not None:
+    random.seed(seed + first_index)
+  generator = BulkParticipantGenerator(id_starts)
+  end_index = first_index + num_participants
+  for batch_start in range(first_index, end_index, batch_size):
+    generator.insert_participants(batch_start, min(batch_size, end_index - batch_start),
+                                  include_physical_measurements, include_biobank_orders)
+    logging.info('Created participants %d to %d.', batch_start,
+                 min(batch_start + batch_size, end_index) - 1)
+  return num_participants
+
+
+def _get_answer_code_map(generator):
+  """Returns a code map for CodeDao.get_or_add_codes of the codes a FakeParticipantGenerator's
+  answers can use."""
+  return {(PPI_SYSTEM, value): (value, CodeType.ANSWER, None)
+          for value in generator.get_answer_code_values()}
+
+
+def _get_set_attributes(obj):
+  return sorted(inspect(obj).dict)
+
+
+class _ParticipantRows(object):
+  """The rows created for a batch of participants, in the order they must be inserted."""
+
+  def __init__(self):
+    self.log_positions = []
+    self.participants = []
+    self.participant_history = []
+    self.summaries = []
+    self.questionnaire_responses = []
+    self.answers = []
+    self.physical_measurements = []
+    self.measurements = []
+    self.measurement_qualifiers = []
+    self.biobank_orders = []
+    self.biobank_order_identifiers = []
+    self.biobank_ordered_samples = []
+    self.biobank_stored_samples = []
+
+  def insert(self, session):
+    for objects in (self.log_positions, self.participants, self.participant_history,
+                    self.summaries, self.questionnaire_responses, self.answers,
+                    self.physical_measurements, self.measurements, self.biobank_orders,
+                    self.biobank_order_identifiers, self.biobank_ordered_samples,
+                    self.biobank_stored_samples):
+      if objects is not self.measurements:
+        # bulk_save_objects inserts each run of objects that set the same attributes with one
+        # executemany(), so put those together. (Measurements refer to other measurements, which
+        # must be inserted first.)
+        objects.sort(key=_get_set_attributes)
+      if objects:
+        session.bulk_save_objects(objects)
+    if self.measurement_qualifiers:
+      session.execute(measurement_to_qualifier.insert(), self.measurement_qualifiers)
+
+
+class BulkParticipantGenerator(FakeParticipantGenerator):
+  """Builds rows for participants, their questionnaire responses, physical measurements and
+  biobank data, and inserts them a batch at a time.
+
+  Participant n (counting from 0 for the first participant generate_participants creates) gets
+  participant and biobank IDs IdStarts.participant_id + n and IdStarts.biobank_id + n, and the
+  corresponding ranges of questionnaire response, physical measurements and log position IDs, so
+  that generators in different processes never write the same IDs.
+  """
+
+  def __init__(self, id_starts):
+    super(BulkParticipantGenerator, self).__init__(None, use_local_files=True)
+    self._id_starts = id_starts
+    self._questionnaire_ids = sorted(self._questionnaire_to_questions)
+    self._biobank_order_dao = BiobankOrderDao()
+    self._load_questionnaire_questions()
+    self._code_ids = CodeDao().get_or_add_codes(_get_answer_code_map(self))
+
+  @staticmethod
+  def add_answer_codes():
+    """Adds any codes that participants' answers can use that are missing, as the API does when it
+    receives them."""
+    generator = FakeParticipantGenerator(None, use_local_files=True)
+    CodeDao().get_or_add_codes(_get_answer_code_map(generator))
+
+  def _load_questionnaire_questions(self):
+    """Looks up the question IDs and codes for the link IDs, and module codes, of each
+    questionnaire."""
+    self._link_id_to_question = {}
+    self._questionnaire_to_module_fields = collections.defaultdict(list)
+    code_dao = CodeDao()
+    with code_dao.session() as session:
+      for questionnaire_id, version in self._questionnaire_ids:
+        questions = (session.query(QuestionnaireQuestion)
+                     .filter(QuestionnaireQuestion.questionnaireId == questionnaire_id)
+                     .filter(QuestionnaireQuestion.questionnaireVersion == version)
+                     .all())
+        for question in questions:
+          self._link_id_to_question[(questionnaire_id, version, question.linkId)] = question
+        concepts = (session.query(QuestionnaireConcept)
+                    .filter(QuestionnaireConcept.questionnaireId == questionnaire_id)
+                    .filter(QuestionnaireConcept.questionnaireVersion == version)
+                    .all())
+        for concept in concepts:
+          code = code_dao.get(concept.codeId)
+          summary_field = QUESTIONNAIRE_MODULE_CODE_TO_FIELD.get(code.value) if code else None
+          if summary_field:
+            self._questionnaire_to_module_fields[(questionnaire_id, version)].append(
+                (summary_field, code.value))
+
+  def insert_participants(self, first_index, num_participants, include_physical_measurements=True,
+                          include_biobank_orders=True):
+    """Creates participants first_index to first_index + num_participants - 1 in one
+    transaction, then updates their summaries' sample fields and enrollment status."""
+    rows = _ParticipantRows()
+    for index in range(first_index, first_index + num_participants):
+      self._make_participant(index, rows, include_physical_measurements, include_biobank_orders)
+    dao = ParticipantDao()
+    with dao.session() as session:
+      rows.insert(session)
+      session.execute(text(_INSERT_CURRENT_ANSWERS_SQL), {
+          'first_participant_id': self._id_starts.participant_id + first_index,
+          'last_participant_id': self._id_starts.participant_id + first_index + num_participants - 1
+      })
+    ParticipantSummaryDao().update_from_biobank_stored_samples(
+        biobank_ids=[summary.biobankId for summary in rows.summaries])
+
+  def _make_participant(self, index, rows, include_physical_measurements, include_biobank_orders):
+    """Makes the rows for one participant, as FakeParticipantGenerator.generate_participant's
+    requests would."""
+    hpo = random.choice(self._hpos) if random.random() > NO_HPO_PERCENT else None
+    creation_time = self._days_ago(random.randint(0, MAX_DAYS_HISTORY))
+    participant = Participant(
+        participantId=self._id_starts.participant_id + index,
+        biobankId=self._id_starts.biobank_id + index,
+        version=1,
+        signUpTime=creation_time,
+        lastModified=creation_time,
+        clientId=_CLIENT_ID,
+        withdrawalStatus=WithdrawalStatus.NOT_WITHDRAWN,
+        suspensionStatus=SuspensionStatus.NOT_SUSPENDED)
+    self._set_hpo(participant, hpo)
+    rows.participants.append(participant)
+    self._add_history(participant, rows)
+    log_position_ids = iter(range(
+        self._id_starts.log_position_id + index * _LOG_POSITIONS_PER_PARTICIPANT,
+        self._id_starts.log_position_id + (index + 1) * _LOG_POSITIONS_PER_PARTICIPANT))
+
+    california_hpo = hpo is not None and hpo.name in CALIFORNIA_HPOS
+    if random.random() <= NO_QUESTIONNAIRES_SUBMITTED:
+      return
+    summary = ParticipantDao.create_summary_for_participant(participant)
+    rows.summaries.append(summary)
+    consent_time, last_request_time, the_basics_submission_time = (
+        self._make_questionnaire_responses(index, participant, summary, california_hpo,
+                                           creation_time, rows))
+    if include_physical_measurements and the_basics_submission_time:
+      last_request_time = max(last_request_time, self._make_physical_measurements_rows(
+          index, summary, the_basics_submission_time, log_position_ids, rows))
+    if include_biobank_orders and the_basics_submission_time:
+      last_request_time = max(last_request_time, self._make_biobank_rows(
+          summary, the_basics_submission_time, log_position_ids, rows))
+    if random.random() > NO_HPO_CHANGE:
+      change_time = consent_time + datetime.timedelta(
+          days=random.randint(0, MAX_DAYS_BEFORE_HPO_CHANGE))
+      self._set_hpo(participant, random.choice(self._hpos))
+      self._update_participant(participant, change_time, rows)
+      last_request_time = max(last_request_time, change_time)
+    if random.random() <= SUSPENDED_PERCENT:
+      last_request_time += datetime.timedelta(days=random.randint(0, MAX_DAYS_BEFORE_SUSPENSION))
+      participant.suspensionStatus = SuspensionStatus.NO_CONTACT
+      participant.suspensionTime = last_request_time
+      self._update_participant(participant, last_request_time, rows)
+    if random.random() <= WITHDRAWN_PERCENT:
+      change_time = last_request_time + datetime.timedelta(
+          days=random.randint(0, MAX_DAYS_BEFORE_WITHDRAWAL))
+      participant.withdrawalStatus = WithdrawalStatus.NO_USE
+      participant.withdrawalTime = change_time
+      self._update_participant(participant, change_time, rows)
+    for field in ('hpoId', 'organizationId', 'siteId', 'withdrawalStatus', 'withdrawalTime',
+                  'suspensionStatus', 'suspensionTime'):
+      setattr(summary, field, getattr(participant, field))
+    summary.lastModified = max(summary.lastModified, participant.lastModified)
+
+  @staticmethod
+  def _set_hpo(participant, hpo):
+    participant.hpoId = hpo.hpoId if hpo else UNSET_HPO_ID
+    participant.providerLink = (make_primary_provider_link_for_hpo(hpo)
+                                if hpo and hpo.hpoId != UNSET_HPO_ID else None)
+    participant.organizationId = None
+    participant.siteId = None
+
+  @staticmethod
+  def _add_history(participant, rows):
+    rows.participant_history.append(ParticipantHistory(**participant.asdict()))
+
+  def _update_participant(self, participant, change_time, rows):
+    participant.version += 1
+    participant.lastModified = change_time
+    self._add_history(participant, rows)
+
+  def _make_questionnaire_responses(self, index, participant, summary, california_hpo, start_time,
+                                    rows):
+    """Makes responses to the consent questionnaire, and at random to the others, and updates
+    the summary for them as QuestionnaireResponseDao does."""
+    answer_map = self._make_answer_map(california_hpo)
+    submission_time = start_time + datetime.timedelta(
+        days=random.randint(0, MAX_DAYS_BETWEEN_SUBMISSIONS))
+    consent_time = submission_time
+    submitted = [(self._consent_questionnaire_id_and_version, submission_time)]
+    the_basics_submission_time = None
+    for questionnaire_id_and_version in self._questionnaire_ids:
+      if (questionnaire_id_and_version != self._consent_questionnaire_id_and_version and
+          random.random() > QUESTIONNAIRE_NOT_SUBMITTED):
+        submission_time += datetime.timedelta(
+            days=random.randint(0, MAX_DAYS_BETWEEN_SUBMISSIONS))
+        submitted.append((questionnaire_id_and_version, submission_time))
+        if questionnaire_id_and_version == self._the_basics_questionnaire_id_and_version:
+          the_basics_submission_time = submission_time
+
+    # The answers to each question code not yet ended by a later response.
+    current_answers = {}
+    for questionnaire_id_and_version, created in submitted:
+      response_number = self._questionnaire_ids.index(questionnaire_id_and_version)
+      response_id = (self._id_starts.questionnaire_response_id +
+                     index * len(self._questionnaire_ids) + response_number)
+      questions_with_answers = []
+      answers_by_code_id = collections.defaultdict(list)
+      for question_code, link_id in self._questionnaire_to_questions[questionnaire_id_and_version]:
+        answer_jsons = answer_map.get(question_code)
+        question = self._link_id_to_question.get(questionnaire_id_and_version + (link_id,))
+        if not answer_jsons or not question:
+          continue
+        questions_with_answers.append(self._create_question_answer(link_id, answer_jsons))
+        for answer_json in answer_jsons:
+          answer = self._make_answer(response_id, question.questionnaireQuestionId, answer_json)
+          rows.answers.append(answer)
+          answers_by_code_id[question.codeId].append((question_code, answer))
+      resource = self._create_questionnaire_response(
+          to_client_participant_id(participant.participantId), questionnaire_id_and_version,
+          questions_with_answers)
+      resource['id'] = str(response_id)
+      rows.questionnaire_responses.append(QuestionnaireResponse(
+          questionnaireResponseId=response_id,
+          questionnaireId=questionnaire_id_and_version[0],
+          questionnaireVersion=questionnaire_id_and_version[1],
+          participantId=participant.participantId,
+          created=created,
+          resource=json.dumps(resource)))
+      for code_id, code_answers in answers_by_code_id.iteritems():
+        for _, ended_answer in current_answers.get(code_id, []):
+          ended_answer.endTime = created
+        current_answers[code_id] = code_answers
+      self._update_summary_modules(summary, questionnaire_id_and_version, created,
+                                   answers_by_code_id)
+    self._update_summary_answers(summary, current_answers)
+    return consent_time, submission_time, the_basics_submission_time
+
+  def _make_answer(self, response_id, question_id, answer_json):
+    answer = QuestionnaireResponseAnswer(questionnaireResponseId=response_id,
+                                         questionId=question_id)
+    if 'valueCoding' in answer_json:
+      answer.valueSystem = answer_json['valueCoding']['system']
+      answer.valueCodeId = self._code_ids[(answer_json['valueCoding']['system'],
+                                          answer_json['valueCoding']['code'])]
+    elif 'valueDate' in answer_json:
+      answer.valueDate = parse(answer_json['valueDate']).date()
+    elif 'valueDateTime' in answer_json:
+      answer.valueDateTime = parse(answer_json['valueDateTime']).replace(tzinfo=None)
+    else:
+      for field in _ANSWER_VALUE_FIELDS:
+        if field in answer_json:
+          setattr(answer, field, answer_json[field])
+    return answer
+
+  def _update_summary_modules(self, summary, questionnaire_id_and_version, created,
+                              answers_by_code_id):
+    ehr_consent = False
+    for question_code, answer in itertools.chain.from_iterable(answers_by_code_id.values()):
+      if (question_code == EHR_CONSENT_QUESTION_CODE and
+          answer.valueCodeId == self._code_ids.get((PPI_SYSTEM, CONSENT_PERMISSION_YES_CODE))):
+        ehr_consent = True
+      elif (question_code == CABOR_SIGNATURE_QUESTION_CODE and
+            (answer.valueUri or answer.valueString) and
+            summary.consentForCABoR != QuestionnaireStatus.SUBMITTED):
+        summary.consentForCABoR = QuestionnaireStatus.SUBMITTED
+        summary.consentForCABoRTime = created
+    for summary_field, module_code in self._questionnaire_to_module_fields[
+        questionnaire_id_and_version]:
+      new_status = QuestionnaireStatus.SUBMITTED
+      if module_code == CONSENT_FOR_ELECTRONIC_HEALTH_RECORDS_MODULE and not ehr_consent:
+        new_status = QuestionnaireStatus.SUBMITTED_NO_CONSENT
+      if getattr(summary, summary_field) != new_status:
+        setattr(summary, summary_field, new_status)
+        setattr(summary, summary_field + 'Time', created)
+    summary.numCompletedBaselinePPIModules = count_completed_baseline_ppi_modules(summary)
+    summary.numCompletedPPIModules = count_completed_ppi_modules(summary)
+    summary.lastModified = created
+
+  def _update_summary_answers(self, summary, current_answers):
+    code_dao = CodeDao()
+    race_codes = []
+    for answers in current_answers.itervalues():
+      for question_code, answer in answers:
+        summary_field = QUESTION_CODE_TO_FIELD.get(question_code)
+        if summary_field:
+          field_name, field_type = summary_field
+          if field_type == FieldType.CODE:
+            setattr(summary, field_name, answer.valueCodeId)
+          elif field_type == FieldType.STRING:
+            setattr(summary, field_name, answer.valueString)
+          elif field_type == FieldType.DATE:
+            setattr(summary, field_name, answer.valueDate)
+        elif question_code == RACE_QUESTION_CODE:
+          race_codes.append(code_dao.get(answer.valueCodeId))
+    if race_codes:
+      summary.race = get_race(race_codes)
+
+  def _make_physical_measurements_rows(self, index, summary, consent_time, log_position_ids,
+                                       rows):
+    """Makes rows for physical measurements, as PhysicalMeasurementsDao.insert would."""
+    if random.random() <= NO_PHYSICAL_MEASUREMENTS:
+      return consent_time
+    measurements_time = consent_time + datetime.timedelta(
+        days=random.randint(0, MAX_DAYS_BEFORE_BIOBANK_ORDER))
+    resource_json = self._make_physical_measurements(
+        to_client_participant_id(summary.participantId), measurements_time)
+    physical_measurements_id = self._id_starts.physical_measurements_id + index
+    resource_json['id'] = str(physical_measurements_id)
+    physical_measurements = PhysicalMeasurementsDao.from_client_json(
+        resource_json, participant_id=summary.participantId)
+    physical_measurements.physicalMeasurementsId = physical_measurements_id
+    physical_measurements.created = measurements_time
+    physical_measurements.final = True
+    finalized_date = resource_json['entry'][0]['resource'].get('date')
+    if finalized_date:
+      physical_measurements.finalized = parse(finalized_date).replace(tzinfo=None)
+    physical_measurements.logPositionId = self._add_log_position(log_position_ids, rows)
+    PhysicalMeasurementsDao.set_measurement_ids(physical_measurements)
+    rows.physical_measurements.append(physical_measurements)
+    for measurement in physical_measurements.measurements:
+      rows.measurements.append(measurement)
+      for sub_measurement in measurement.measurements:
+        sub_measurement.parentId = measurement.measurementId
+        rows.measurements.append(sub_measurement)
+      rows.measurement_qualifiers.extend(
+          {'measurement_id': measurement.measurementId, 'qualifier_id': qualifier.measurementId}
+          for qualifier in measurement.qualifiers)
+
+    summary.physicalMeasurementsStatus = PhysicalMeasurementsStatus.COMPLETED
+    summary.physicalMeasurementsTime = physical_measurements.created
+    summary.physicalMeasurementsFinalizedTime = physical_measurements.finalized
+    summary.physicalMeasurementsCreatedSiteId = physical_measurements.createdSiteId
+    summary.physicalMeasurementsFinalizedSiteId = physical_measurements.finalizedSiteId
+    summary.lastModified = measurements_time
+    return measurements_time
+
+  def _make_biobank_rows(self, summary, consent_time, log_position_ids, rows):
+    """Makes rows for biobank orders, as BiobankOrderDao.insert would, and for the samples a
+    Biobank samples import would store for them."""
+    last_request_time = consent_time
+    orders = []
+    if random.random() > NO_BIOBANK_ORDERS:
+      orders.append(self._make_biobank_order(summary, last_request_time, log_position_ids, rows))
+      last_request_time = orders[-1].created
+      if random.random() <= MULTIPLE_BIOBANK_ORDERS:
+        orders.append(self._make_biobank_order(summary, last_request_time, log_position_ids, rows))
+        last_request_time = orders[-1].created
+
+    stored_samples = []
+    if orders and random.random() > NO_BIOBANK_SAMPLES:
+      for order in orders:
+        for sample in order.samples:
+          if sample.collected and random.random() > _SAMPLES_MISSING_FRACTION:
+            stored_samples.append((sample.test, sample.collected + datetime.timedelta(
+                minutes=random.randint(0, MAX_MINUTES_BETWEEN_SAMPLE_COLLECTED_AND_CONFIRMED))))
+    if random.random() <= PARTICIPANTS_WITH_ORPHAN_SAMPLES:
+      confirmed_time = summary.signUpTime + datetime.timedelta(
+          minutes=random.randint(0, MAX_MINUTES_BETWEEN_PARTICIPANT_CREATED_AND_CONFIRMED))
+      stored_samples.extend((test, confirmed_time) for test in random.sample(
+          BIOBANK_TESTS, random.randint(1, len(BIOBANK_TESTS))))
+    for i, (test, confirmed_time) in enumerate(stored_samples):
+      rows.biobank_stored_samples.append(BiobankStoredSample(
+          biobankStoredSampleId='%d-%d' % (summary.biobankId, i),
+          biobankId=summary.biobankId,
+          biobankOrderIdentifier='KIT',
+          test=test,
+          confirmed=confirmed_time,
+          created=confirmed_time))
+    return last_request_time
+
+  def _make_biobank_order(self, summary, start_time, log_position_ids, rows):
+    num_samples = random.randint(1, len(BIOBANK_TESTS))
+    order_tests = random.sample(BIOBANK_TESTS, num_samples)
+    created_time = start_time + datetime.timedelta(
+        days=random.randint(0, MAX_DAYS_BEFORE_BIOBANK_ORDER))
+    order_json = self._make_biobank_order_request(
+        to_client_participant_id(summary.participantId), order_tests, created_time)
+    order = self._biobank_order_dao.from_client_json(order_json,
+                                                     participant_id=summary.participantId)
+    order.logPositionId = self._add_log_position(log_position_ids, rows)
+    rows.biobank_orders.append(order)
+    rows.biobank_order_identifiers.extend(
+        BiobankOrderIdentifier(system=identifier.system, value=identifier.value,
+                               biobankOrderId=order.biobankOrderId)
+        for identifier in order.identifiers)
+    rows.biobank_ordered_samples.extend(
+        BiobankOrderedSample(biobankOrderId=order.biobankOrderId, test=sample.test,
+                             description=sample.description,
+                             processingRequired=sample.processingRequired,
+                             collected=sample.collected, processed=sample.processed,
+                             finalized=sample.finalized)
+        for sample in order.samples)
+
+    summary.biospecimenStatus = OrderStatus.FINALIZED
+    summary.biospecimenOrderTime = order.created
+    summary.biospecimenSourceSiteId = order.sourceSiteId
+    summary.biospecimenCollectedSiteId = order.collectedSiteId
+    summary.biospecimenProcessedSiteId = order.processedSiteId
+    summary.biospecimenFinalizedSiteId = order.finalizedSiteId
+    summary.lastModified = created_time
+    for sample in order.samples:
+      status_field = 'sampleOrderStatus' + sample.test
+      status, time = self._biobank_order_dao.get_order_status_and_time(sample, order)
+      setattr(summary, status_field, status)
+      setattr(summary, status_field + 'Time', time)
+    return order
+
+  @staticmethod
+  def _add_log_position(log_position_ids, rows):
+    log_position_id = next(log_position_ids)
+    rows.log_positions.append(LogPosition(logPositionId=log_position_id))
+    return log_position_id
@@ -13,11 +13,11 @@ from model.config_utils import to_client_biobank_id
 from offline.biobank_samples_pipeline import INPUT_CSV_TIME_FORMAT
 
 # 1% of participants have samples with no associated order
-_PARTICIPANTS_WITH_ORPHAN_SAMPLES = 0.01
+PARTICIPANTS_WITH_ORPHAN_SAMPLES = 0.01
 # Max amount of time between collected ordered samples and confirmed biobank stored samples.
-_MAX_MINUTES_BETWEEN_SAMPLE_COLLECTED_AND_CONFIRMED = 72 * 60
+MAX_MINUTES_BETWEEN_SAMPLE_COLLECTED_AND_CONFIRMED = 72 * 60
 # Max amount of time between creating a participant and orphaned biobank samples
-_MAX_MINUTES_BETWEEN_PARTICIPANT_CREATED_AND_CONFIRMED = 30 * 24 * 60
+MAX_MINUTES_BETWEEN_PARTICIPANT_CREATED_AND_CONFIRMED = 30 * 24 * 60
 
 _TIME_FORMAT = "%Y/%m/%d %H:%M:%S"
 
@@ -66,7 +66,7 @@ def generate_samples(fraction_missing):
           logging.warning(
              'biobank_id=%s test=%s skipped (collected=%s)', biobank_id, test, collected_time)
           continue
-        minutes_delta = random.randint(0, _MAX_MINUTES_BETWEEN_SAMPLE_COLLECTED_AND_CONFIRMED)
+        minutes_delta = random.randint(0, MAX_MINUTES_BETWEEN_SAMPLE_COLLECTED_AND_CONFIRMED)
         confirmed_time = collected_time + datetime.timedelta(minutes=minutes_delta)
         writer.writerow([
             sample_id_start + num_rows,
@@ -79,10 +79,10 @@ def generate_samples(fraction_missing):
     participant_dao = ParticipantDao()
     with participant_dao.session() as session:
       rows = participant_dao.get_biobank_ids_sample(session,
-                                                    _PARTICIPANTS_WITH_ORPHAN_SAMPLES,
+                                                    PARTICIPANTS_WITH_ORPHAN_SAMPLES,
                                                     _BATCH_SIZE)
       for biobank_id, sign_up_time in rows:
-        minutes_delta = random.randint(0, _MAX_MINUTES_BETWEEN_PARTICIPANT_CREATED_AND_CONFIRMED)
+        minutes_delta = random.randint(0, MAX_MINUTES_BETWEEN_PARTICIPANT_CREATED_AND_CONFIRMED)
         confirmed_time = sign_up_time + datetime.timedelta(minutes=minutes_delta)
         tests = random.sample(BIOBANK_TESTS, random.randint(1, len(BIOBANK_TESTS)))
         for test in tests:
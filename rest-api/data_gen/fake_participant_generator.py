@@ -46,29 +46,29 @@ _ANSWER_SPECS_FILE = "answer_specs.csv"
 
 _TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
 # 30%+ of participants have no primary provider link / HPO set
-_NO_HPO_PERCENT = 0.3
+NO_HPO_PERCENT = 0.3
 # 20%+ of participants have no questionnaires submitted (including consent)
-_NO_QUESTIONNAIRES_SUBMITTED = 0.2
+NO_QUESTIONNAIRES_SUBMITTED = 0.2
 # 20% of consented participants that submit the basics questionnaire have no biobank orders
-_NO_BIOBANK_ORDERS = 0.2
+NO_BIOBANK_ORDERS = 0.2
 # 20% of consented participants that submit the basics questionnaire have no physical measurements
-_NO_PHYSICAL_MEASUREMENTS = 0.2
+NO_PHYSICAL_MEASUREMENTS = 0.2
 # 10% of individual physical measurements are absent
 _PHYSICAL_MEASUREMENT_ABSENT = 0.1
 # 20% of eligible physical measurements have qualifiers
 _PHYSICAL_MEASURMENT_QUALIFIED = 0.2
 # 80% of consented participants have no changes to their HPO
-_NO_HPO_CHANGE = 0.8
+NO_HPO_CHANGE = 0.8
 # 5% of participants withdraw from the study
-_WITHDRAWN_PERCENT = 0.05
+WITHDRAWN_PERCENT = 0.05
 # 5% of participants suspend their account
-_SUSPENDED_PERCENT = 0.05
+SUSPENDED_PERCENT = 0.05
 # 5% of participants with biobank orders have multiple
-_MULTIPLE_BIOBANK_ORDERS = 0.05
+MULTIPLE_BIOBANK_ORDERS = 0.05
 # 20% of participants with biobank orders have no biobank samples
-_NO_BIOBANK_SAMPLES = 0.2
+NO_BIOBANK_SAMPLES = 0.2
 # Any other questionnaire has a 40% chance of not being submitted
-_QUESTIONNAIRE_NOT_SUBMITTED = 0.4
+QUESTIONNAIRE_NOT_SUBMITTED = 0.4
 # Any given question on a submitted questionnaire has a 10% chance of not being answered
 _QUESTION_NOT_ANSWERED = 0.1
 # The maximum percentage deviation of repeated measurements.
@@ -78,13 +78,13 @@ _PMI_MEASUREMENTS_SYSTEM = "http://terminology.pmi-ops.org/CodeSystem/physical-m
 # Maximum number of days between a participant consenting and submitting physical measurements
 _MAX_DAYS_BEFORE_PHYSICAL_MEASUREMENTS = 60
 # Maximum number of days between a participant consenting and submitting a biobank order.
-_MAX_DAYS_BEFORE_BIOBANK_ORDER = 60
+MAX_DAYS_BEFORE_BIOBANK_ORDER = 60
 # Maximum number of days between a participant consenting and changing their HPO
-_MAX_DAYS_BEFORE_HPO_CHANGE = 60
+MAX_DAYS_BEFORE_HPO_CHANGE = 60
 # Maximum number of days between the last request and the participant withdrawing from the study
-_MAX_DAYS_BEFORE_WITHDRAWAL = 30
+MAX_DAYS_BEFORE_WITHDRAWAL = 30
 # Maximum number of days between the last request and the participant suspending their account
-_MAX_DAYS_BEFORE_SUSPENSION = 30
+MAX_DAYS_BEFORE_SUSPENSION = 30
 # Max amount of time between created biobank orders and collected time for a sample.
 _MAX_MINUTES_BETWEEN_ORDER_CREATED_AND_SAMPLE_COLLECTED = 72 * 60
 # Max amount of time between collected and processed biobank order samples.
@@ -93,10 +93,10 @@ _MAX_MINUTES_BETWEEN_SAMPLE_COLLECTED_AND_PROCESSED = 72 * 60
 _MAX_MINUTES_BETWEEN_SAMPLE_PROCESSED_AND_FINALIZED = 72 * 60
 # Max amount of time between processed and finalized biobank orders.
 # Random amount of time between questionnaire submissions
-_MAX_DAYS_BETWEEN_SUBMISSIONS = 30
+MAX_DAYS_BETWEEN_SUBMISSIONS = 30
 
 # Start creating participants from 4 years ago
-_MAX_DAYS_HISTORY = 4 * 365
+MAX_DAYS_HISTORY = 4 * 365
 
 # Percentage of participants with multiple race answers
 _MULTIPLE_RACE_ANSWERS = 0.2
@@ -115,7 +115,7 @@ _QUESTIONNAIRE_CONCEPTS = [CONSENT_FOR_STUDY_ENROLLMENT_MODULE,
                           OVERALL_HEALTH_PPI_MODULE,
                           LIFESTYLE_PPI_MODULE,
                           THE_BASICS_PPI_MODULE]
-_CALIFORNIA_HPOS = ['CAL_PMC', 'SAN_YSIDRO']
+CALIFORNIA_HPOS = ['CAL_PMC', 'SAN_YSIDRO']
 
 _QUESTION_CODES = QUESTION_CODE_TO_FIELD.keys() + [RACE_QUESTION_CODE,
                                                    CABOR_SIGNATURE_QUESTION_CODE]
@@ -150,6 +150,16 @@ class FakeParticipantGenerator(object):
         result.extend(self._get_answer_codes(child))
     return result
 
+  def get_answer_code_values(self):
+    """Returns the values of all the PPI codes this generator's answers can use."""
+    values = set('PIIState_%s' % state for state in self._zip_code_to_state.itervalues())
+    for answer_codes in self._question_code_to_answer_codes.itervalues():
+      values.update(answer_codes)
+    for answer_spec in self._answer_specs.itervalues():
+      if int(answer_spec['code_answer_count']) > 0:
+        values.update(answer_spec['code_answers'].split(','))
+    return values
+
   def _setup_questionnaires(self):
     """Locates questionnaires and verifies that they have the appropriate questions in them."""
     questionnaire_dao = QuestionnaireDao()
@@ -559,9 +569,9 @@ class FakeParticipantGenerator(object):
             "entry": entries}
 
   def _submit_physical_measurements(self, participant_id, consent_time):
-    if random.random() <= _NO_PHYSICAL_MEASUREMENTS:
+    if random.random() <= NO_PHYSICAL_MEASUREMENTS:
       return consent_time
-    days_delta = random.randint(0, _MAX_DAYS_BEFORE_BIOBANK_ORDER)
+    days_delta = random.randint(0, MAX_DAYS_BEFORE_BIOBANK_ORDER)
     measurements_time = consent_time + datetime.timedelta(days=days_delta)
     request_json = self._make_physical_measurements(participant_id, measurements_time)
     self._client.request_json(
@@ -624,7 +634,7 @@ class FakeParticipantGenerator(object):
   def _submit_biobank_order(self, participant_id, start_time):
     num_samples = random.randint(1, len(BIOBANK_TESTS))
     order_tests = random.sample(BIOBANK_TESTS, num_samples)
-    days_delta = random.randint(0, _MAX_DAYS_BEFORE_BIOBANK_ORDER)
+    days_delta = random.randint(0, MAX_DAYS_BEFORE_BIOBANK_ORDER)
     created_time = start_time + datetime.timedelta(days=days_delta)
     order_json = self._make_biobank_order_request(participant_id, order_tests, created_time)
     self._client.request_json(
@@ -635,10 +645,10 @@ class FakeParticipantGenerator(object):
     return created_time
 
   def _submit_biobank_data(self, participant_id, consent_time):
-    if random.random() <= _NO_BIOBANK_ORDERS:
+    if random.random() <= NO_BIOBANK_ORDERS:
       return consent_time
     last_request_time = self._submit_biobank_order(participant_id, consent_time)
-    if random.random() <= _MULTIPLE_BIOBANK_ORDERS:
+    if random.random() <= MULTIPLE_BIOBANK_ORDERS:
       last_request_time = self._submit_biobank_order(participant_id, last_request_time)
     return last_request_time
 
@@ -652,34 +662,34 @@ class FakeParticipantGenerator(object):
         pretend_date=change_time)
 
   def _submit_hpo_changes(self, participant_response, participant_id, consent_time):
-    if random.random() <= _NO_HPO_CHANGE:
+    if random.random() <= NO_HPO_CHANGE:
       return consent_time, participant_response
     # Re-fetch the participant to make sure we have the up-to-date version.
     participant_response = self._client.request_json(_participant_url(participant_id), method='GET')
     hpo = random.choice(self._hpos)
     participant_response['providerLink'] = json.loads(make_primary_provider_link_for_hpo(hpo))
-    days_delta = random.randint(0, _MAX_DAYS_BEFORE_HPO_CHANGE)
+    days_delta = random.randint(0, MAX_DAYS_BEFORE_HPO_CHANGE)
     change_time = consent_time + datetime.timedelta(days=days_delta)
     result = self._update_participant(change_time, participant_response, participant_id)
     return change_time, result
 
   def _submit_status_changes(self, participant_id, last_request_time):
-    if random.random() <= _SUSPENDED_PERCENT:
+    if random.random() <= SUSPENDED_PERCENT:
       # Fetch the participant to ensure its version is up-to-date.
       participant_response = self._client.request_json(_participant_url(participant_id),
                                                        method='GET')
       participant_response['suspensionStatus'] = 'NO_CONTACT'
-      days_delta = random.randint(0, _MAX_DAYS_BEFORE_SUSPENSION)
+      days_delta = random.randint(0, MAX_DAYS_BEFORE_SUSPENSION)
       change_time = last_request_time + datetime.timedelta(days=days_delta)
       participant_response = self._update_participant(change_time, participant_response,
                                                       participant_id)
       last_request_time = change_time
-    if random.random() <= _WITHDRAWN_PERCENT:
+    if random.random() <= WITHDRAWN_PERCENT:
       # Fetch the participant to ensure its version is up-to-date.
       participant_response = self._client.request_json(_participant_url(participant_id),
                                                        method='GET')
       participant_response['withdrawalStatus'] = 'NO_USE'
-      days_delta = random.randint(0, _MAX_DAYS_BEFORE_WITHDRAWAL)
+      days_delta = random.randint(0, MAX_DAYS_BEFORE_WITHDRAWAL)
       change_time = last_request_time + datetime.timedelta(days=days_delta)
       self._update_participant(change_time, participant_response, participant_id)
 
@@ -687,7 +697,7 @@ class FakeParticipantGenerator(object):
                            requested_hpo=None):
     participant_response, creation_time, hpo = self._create_participant(requested_hpo)
     participant_id = participant_response['participantId']
-    california_hpo = hpo is not None and hpo.name in _CALIFORNIA_HPOS
+    california_hpo = hpo is not None and hpo.name in CALIFORNIA_HPOS
     consent_time, last_qr_time, the_basics_submission_time = (self._submit_questionnaire_responses(
       participant_id, california_hpo, creation_time))
     if consent_time:
@@ -715,12 +725,12 @@ class FakeParticipantGenerator(object):
     if hpo_name:
       hpo = HPODao().get_by_name(hpo_name)
     else:
-      if random.random() > _NO_HPO_PERCENT:
+      if random.random() > NO_HPO_PERCENT:
         hpo = random.choice(self._hpos)
     if hpo:
       if hpo.hpoId != UNSET_HPO_ID:
         participant_json['providerLink'] = json.loads(make_primary_provider_link_for_hpo(hpo))
-    creation_time = self._days_ago(random.randint(0, _MAX_DAYS_HISTORY))
+    creation_time = self._days_ago(random.randint(0, MAX_DAYS_HISTORY))
     participant_response = self._client.request_json(
         'Participant', method='POST', body=participant_json, pretend_date=creation_time)
     return (participant_response, creation_time, hpo)
@@ -745,10 +755,11 @@ class FakeParticipantGenerator(object):
       return None
     if random.random() <= _QUESTION_NOT_ANSWERED:
       return None
-    if random.random() > percent_with_multiple:
+    if random.random() > percent_with_multiple or len(answer_codes) < 2:
       return self._random_code_answer(question_code)
-    num_answers = random.randint(2, max_answers)
-    codes = random.sample(self._question_code_to_answer_codes[question_code], num_answers)
+    # Questions without codes for their answers only have the constant codes to choose from.
+    num_answers = random.randint(2, min(max_answers, len(answer_codes)))
+    codes = random.sample(answer_codes, num_answers)
     return [_code_answer(code) for code in codes]
 
   def _choose_street_address(self):
@@ -872,12 +883,12 @@ class FakeParticipantGenerator(object):
     return answer_map
 
   def _submit_questionnaire_responses(self, participant_id, california_hpo, start_time):
-    if random.random() <= _NO_QUESTIONNAIRES_SUBMITTED:
+    if random.random() <= NO_QUESTIONNAIRES_SUBMITTED:
       return None, None, None
     submission_time = start_time
     answer_map = self._make_answer_map(california_hpo)
 
-    delta = datetime.timedelta(days=random.randint(0, _MAX_DAYS_BETWEEN_SUBMISSIONS))
+    delta = datetime.timedelta(days=random.randint(0, MAX_DAYS_BETWEEN_SUBMISSIONS))
     submission_time = submission_time + delta
     consent_time = submission_time
     # Submit the consent questionnaire always and other questionnaires at random.
@@ -888,8 +899,8 @@ class FakeParticipantGenerator(object):
     the_basics_submission_time = None
     for questionnaire_id_and_version, questions in self._questionnaire_to_questions.iteritems():
       if (questionnaire_id_and_version != self._consent_questionnaire_id_and_version and
-          random.random() > _QUESTIONNAIRE_NOT_SUBMITTED):
-        delta = datetime.timedelta(days=random.randint(0, _MAX_DAYS_BETWEEN_SUBMISSIONS))
+          random.random() > QUESTIONNAIRE_NOT_SUBMITTED):
+        delta = datetime.timedelta(days=random.randint(0, MAX_DAYS_BETWEEN_SUBMISSIONS))
         submission_time = submission_time + delta
         self._submit_questionnaire_response(participant_id, questionnaire_id_and_version,
                                             questions, submission_time, answer_map)
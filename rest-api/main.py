@@ -10,8 +10,10 @@ from sqlalchemy.exc import DBAPIError
 from werkzeug.exceptions import HTTPException
 
 import app_util
+import sql_instrumentation
 import config_api
 import version_api
+import warmup
 from api.awardee_api import AwardeeApi
 from api.biobank_order_api import BiobankOrderApi
 from api.check_ppi_data_api import check_ppi_data
@@ -21,11 +23,12 @@ from api.metrics_api import MetricsApi
 from api.participant_counts_over_time_api import ParticipantCountsOverTimeApi
 from api.metrics_fields_api import MetricsFieldsApi
 from api.participant_api import ParticipantApi
-from api.participant_summary_api import ParticipantSummaryApi
+from api.participant_summary_api import ParticipantSummaryApi, export_participant_summaries
 from api.physical_measurements_api import PhysicalMeasurementsApi, sync_physical_measurements
 from api.metric_sets_api import MetricSetsApi
 from api.questionnaire_api import QuestionnaireApi
 from api.questionnaire_response_api import QuestionnaireResponseApi
+from api.questionnaire_response_api import insert_questionnaire_response_batch
 from model.utils import ParticipantIdConverter
 
 
@@ -149,6 +152,16 @@ app.add_url_rule(PREFIX + 'PhysicalMeasurements/_history',
                  view_func=sync_physical_measurements,
                  methods=['GET'])
 
+app.add_url_rule(PREFIX + 'ParticipantSummary/$export',
+                 endpoint='participant.summary.export',
+                 view_func=export_participant_summaries,
+                 methods=['GET'])
+
+app.add_url_rule(PREFIX + 'QuestionnaireResponse/$batch',
+                 endpoint='questionnaire_response.batch',
+                 view_func=insert_questionnaire_response_batch,
+                 methods=['POST'])
+
 app.add_url_rule(PREFIX + 'CheckPpiData',
                  endpoint='check_ppi_data',
                  view_func=check_ppi_data,
@@ -159,6 +172,15 @@ app.add_url_rule(PREFIX + 'ImportCodebook',
                  view_func=import_codebook,
                  methods=['POST'])
 
+# Sent by App Engine to new instances before they serve traffic; see app_base.yaml.
+app.add_url_rule('/_ah/warmup',
+                 endpoint='warmup',
+                 view_func=warmup.warmup,
+                 methods=['GET'])
+
 app.after_request(app_util.add_headers)
 app.before_request(app_util.request_logging)
+app.before_request(sql_instrumentation.start_request_stats)
+app.after_request(sql_instrumentation.finish_request_stats)
+app.teardown_request(sql_instrumentation.clear_request_stats)
 app.register_error_handler(DBAPIError, app_util.handle_database_disconnect)
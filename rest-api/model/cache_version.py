@@ -0,0 +1,36 @@
+from model.base import Base
+from sqlalchemy import Column, Integer, String, event
+
+# Tables cached by CacheAllDao subclasses, which have CacheVersion rows from when they're created.
+CACHED_TABLE_NAMES = ('code', 'hpo', 'organization', 'site')
+
+
+class CacheVersion(Base):
+  """The version of a table cached in memory by CacheAllDao, incremented by every write to it.
+
+  Instances compare their cache's version to this one to find out when other instances have
+  changed the table (see CacheChange).
+  """
+  __tablename__ = 'cache_version'
+  tableName = Column('table_name', String(80), primary_key=True)
+  version = Column('version', Integer, nullable=False)
+
+
+@event.listens_for(CacheVersion.__table__, 'after_create')
+def _insert_cache_versions(target, connection, **kwargs):
+  #pylint: disable=unused-argument
+  # Writers only update existing version rows, rather than racing to insert them.
+  connection.execute(target.insert(), [{'table_name': table_name, 'version': 0}
+                                       for table_name in CACHED_TABLE_NAMES])
+
+
+class CacheChange(Base):
+  """The ID of an entity written to a cached table, and the version of the table it was written in.
+
+  Instances with the table cached in memory reload just the entities changed since their cache's
+  version. Only recent changes are kept; older caches are reloaded in full.
+  """
+  __tablename__ = 'cache_change'
+  tableName = Column('table_name', String(80), primary_key=True)
+  version = Column('version', Integer, primary_key=True)
+  entityId = Column('entity_id', Integer, primary_key=True, autoincrement=False)
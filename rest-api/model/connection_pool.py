@@ -0,0 +1,162 @@
+"""Connection pool statistics and liveness checks for Database engines.
+
+PoolStats counts how long checkouts wait for a connection, how close the pool comes to running out
+of connections, and how many connections are opened, closed and invalidated, and logs them
+periodically so instances can be sized against the database's connection limit.
+"""
+import json
+import logging
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.exc import DisconnectionError
+from sqlalchemy.pool import QueuePool
+
+# How often PoolStats are logged (on connection checkin).
+POOL_STATS_LOG_INTERVAL_SECONDS = 60
+# Key in a pooled connection's info of the time it was last connected or checked in.
+_LAST_USED_TIME = 'last_used_time'
+
+
+class PoolStats(object):
+  """Counters for a connection pool, shared by the pools an engine recreates.
+
+  Counts are totals since the pool was created, except maxCheckoutWaitMillis and maxCheckedOut,
+  which are since the stats were last logged.
+  """
+
+  def __init__(self, name, capacity=None):
+    self.name = name
+    # The most connections the pool can have checked out at once (None if unlimited.)
+    self.capacity = capacity
+    self._lock = threading.Lock()
+    self.checkouts = 0
+    self.checkout_wait_seconds = 0.0
+    self.max_checkout_wait_seconds = 0.0
+    self.checked_out = 0
+    self.max_checked_out = 0
+    self.connections_opened = 0
+    self.connections_closed = 0
+    self.connections_invalidated = 0
+    self._last_log_time = time.time()
+
+  def add_checkout_wait(self, seconds):
+    with self._lock:
+      self.checkout_wait_seconds += seconds
+      self.max_checkout_wait_seconds = max(self.max_checkout_wait_seconds, seconds)
+
+  def on_checkout(self):
+    with self._lock:
+      self.checkouts += 1
+      self.checked_out += 1
+      self.max_checked_out = max(self.max_checked_out, self.checked_out)
+
+  def on_checkin(self):
+    with self._lock:
+      self.checked_out -= 1
+      if time.time() - self._last_log_time < POOL_STATS_LOG_INTERVAL_SECONDS:
+        return
+      self._last_log_time = time.time()
+      stats_json = self._to_json()
+      self.max_checkout_wait_seconds = 0.0
+      self.max_checked_out = self.checked_out
+    logging.info('Connection pool stats: %s', json.dumps(stats_json, sort_keys=True))
+
+  def on_connect(self):
+    with self._lock:
+      self.connections_opened += 1
+
+  def on_close(self):
+    with self._lock:
+      self.connections_closed += 1
+
+  def on_invalidate(self):
+    with self._lock:
+      self.connections_invalidated += 1
+
+  def to_json(self):
+    with self._lock:
+      return self._to_json()
+
+  def _to_json(self):
+    return {
+      'name': self.name,
+      'capacity': self.capacity,
+      'checkouts': self.checkouts,
+      'checkoutWaitMillis': int(self.checkout_wait_seconds * 1000),
+      'maxCheckoutWaitMillis': int(self.max_checkout_wait_seconds * 1000),
+      'checkedOut': self.checked_out,
+      'maxCheckedOut': self.max_checked_out,
+      'saturation': (float(self.max_checked_out) / self.capacity) if self.capacity else None,
+      'connectionsOpened': self.connections_opened,
+      'connectionsClosed': self.connections_closed,
+      'connectionsInvalidated': self.connections_invalidated,
+    }
+
+
+class MonitoredQueuePool(QueuePool):
+  """A QueuePool that adds the time spent waiting for each checkout to its PoolStats."""
+
+  def __init__(self, creator, stats=None, **kwargs):
+    super(MonitoredQueuePool, self).__init__(creator, **kwargs)
+    self.stats = stats
+
+  def _do_get(self):
+    start_time = time.time()
+    try:
+      return super(MonitoredQueuePool, self)._do_get()
+    finally:
+      if self.stats:
+        self.stats.add_checkout_wait(time.time() - start_time)
+
+  def recreate(self):
+    # Called when connections are invalidated; the new pool keeps counting in the same stats.
+    pool = super(MonitoredQueuePool, self).recreate()
+    pool.stats = self.stats
+    return pool
+
+
+def monitor_pool(pool, stats):
+  """Updates stats on a pool's connection events. The listeners are kept when the pool is
+  recreated."""
+  event.listen(pool, 'connect', lambda *_: stats.on_connect())
+  event.listen(pool, 'checkout', lambda *_: stats.on_checkout())
+  event.listen(pool, 'checkin', lambda *_: stats.on_checkin())
+  event.listen(pool, 'close', lambda *_: stats.on_close())
+  event.listen(pool, 'invalidate', lambda *_: stats.on_invalidate())
+
+
+def ping_idle_connections(pool, ping_interval_seconds):
+  """Checks that a connection is still alive when it is checked out, if it hasn't been used for
+  ping_interval_seconds. Dead connections are replaced (by raising DisconnectionError).
+
+  This is instead of the engine's pool_pre_ping, which pings on every checkout.
+  """
+  def on_connect(dbapi_connection, connection_record):
+    # pylint: disable=unused-argument
+    connection_record.info[_LAST_USED_TIME] = time.time()
+
+  def on_checkout(dbapi_connection, connection_record, connection_proxy):
+    # pylint: disable=unused-argument
+    last_used_time = connection_record.info.get(_LAST_USED_TIME)
+    if last_used_time is not None and time.time() - last_used_time < ping_interval_seconds:
+      return
+    try:
+      cursor = dbapi_connection.cursor()
+      try:
+        cursor.execute('SELECT 1')
+      finally:
+        cursor.close()
+    except Exception, e:  # pylint: disable=broad-except
+      logging.warning('Replacing dead pooled connection: %s', e)
+      raise DisconnectionError()
+    connection_record.info[_LAST_USED_TIME] = time.time()
+
+  def on_checkin(dbapi_connection, connection_record):
+    # pylint: disable=unused-argument
+    connection_record.info[_LAST_USED_TIME] = time.time()
+
+  event.listen(pool, 'connect', on_connect)
+  event.listen(pool, 'checkout', on_checkout)
+  event.listen(pool, 'checkin', on_checkin)
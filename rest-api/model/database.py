@@ -5,13 +5,18 @@ from sqlalchemy import create_engine
 from sqlalchemy.exc import DBAPIError
 from sqlalchemy.orm import sessionmaker
 
+import sql_instrumentation
+
 from model.base import Base, MetricsBase
+from model.connection_pool import MonitoredQueuePool, PoolStats
+from model.connection_pool import monitor_pool, ping_idle_connections
 # All tables in the schema should be imported below here.
 # pylint: disable=unused-import
 from model.participant import Participant, ParticipantHistory
 from model.participant_summary import ParticipantSummary
 from model.biobank_stored_sample import BiobankStoredSample
 from model.biobank_order import BiobankOrder, BiobankOrderIdentifier, BiobankOrderedSample
+from model.cache_version import CacheVersion, CacheChange
 from model.code import CodeBook, Code, CodeHistory
 from model.hpo import HPO
 from model.log_position import LogPosition
@@ -22,21 +27,53 @@ from model.organization import Organization
 from model.questionnaire import Questionnaire, QuestionnaireHistory, QuestionnaireQuestion
 from model.questionnaire import QuestionnaireConcept
 from model.questionnaire_response import QuestionnaireResponse, QuestionnaireResponseAnswer
+from model.questionnaire_response import QuestionnaireResponseCurrentAnswer
 from model.site import Site
 
 RETRY_CONNECTION_LIMIT = 10
+# The size of each engine's connection pool, and how many connections can be opened beyond it when
+# they are all in use, by default. (These are SQLAlchemy's defaults.)
+DEFAULT_POOL_SIZE = 5
+DEFAULT_MAX_OVERFLOW = 10
+# How long a pooled connection can go unused before it is pinged on checkout, by default.
+DEFAULT_PING_INTERVAL_SECONDS = 30
 
 
 class Database(object):
   """Maintains state for accessing the database."""
 
-  def __init__(self, url, **kwargs):
+  def __init__(self, url, pool_size=DEFAULT_POOL_SIZE, max_overflow=DEFAULT_MAX_OVERFLOW,
+               ping_interval_seconds=DEFAULT_PING_INTERVAL_SECONDS, **kwargs):
+    """Creates an engine for url; extra kwargs are passed to create_engine.
+
+    Args:
+      pool_size: The number of connections kept open in the pool (not used for SQLite).
+      max_overflow: The number of connections that can be opened beyond pool_size when they are all
+        checked out (not used for SQLite).
+      ping_interval_seconds: Connections that haven't been used for this long are pinged when they
+        are checked out, and replaced if they are dead. If 0, they are pinged on every checkout.
+    """
+    if url.drivername != 'sqlite':
+      # SQLite in-memory databases only exist for the connection that created them; keep its pool.
+      kwargs.setdefault('poolclass', MonitoredQueuePool)
+      kwargs.setdefault('pool_size', pool_size)
+      kwargs.setdefault('max_overflow', max_overflow)
     # Add echo=True here to spit out SQL statements.
     # Set pool_recycle to 3600 -- one hour in seconds -- which is lower than the MySQL wait_timeout
     # parameter (which defaults to 8 hours) to ensure that we don't attempt to use idle database
     # connections after this period. (See DA-237.) To change the db wait_timeout (seconds), run:
     # gcloud --project <proj> sql instances patch rdrmaindb --database-flags wait_timeout=28800
-    self._engine = create_engine(url, pool_pre_ping=True, pool_recycle=3600, **kwargs)
+    self._engine = create_engine(url, pool_recycle=3600, **kwargs)
+    pool = self._engine.pool
+    # Ping before the stats listeners see the checkout, so dead connections aren't counted.
+    ping_idle_connections(pool, ping_interval_seconds)
+    self.pool_stats = PoolStats('%s/%s' % (url.drivername, url.database))
+    if isinstance(pool, MonitoredQueuePool):
+      pool.stats = self.pool_stats
+      if kwargs['max_overflow'] >= 0:
+        self.pool_stats.capacity = kwargs['pool_size'] + kwargs['max_overflow']
+    monitor_pool(pool, self.pool_stats)
+    sql_instrumentation.instrument_engine(self._engine)
     self.db_type = url.drivername
     if self.db_type == 'sqlite':
       self._engine.execute('PRAGMA foreign_keys = ON;')
@@ -22,7 +22,8 @@ class MetricsVersion(Base):
 
 
 class MetricsBucket(Base):
-  """A bucket belonging to a MetricsVersion, containing metrics for a particular HPO ID and date.
+  """A bucket belonging to a MetricsVersion, containing metrics for a particular HPO ID and date
+  (or range of dates).
   """
   __tablename__ = 'metrics_bucket'
   metricsVersionId = Column('metrics_version_id', Integer,
@@ -31,3 +32,6 @@ class MetricsBucket(Base):
   date = Column('date', Date, primary_key=True)
   hpoId = Column('hpo_id', String(20), primary_key=True) # Set to '' for cross-HPO metrics
   metrics = Column('metrics', BLOB, nullable=False)
+  # For buckets covering a range of dates, the last date the metrics apply to; null for buckets
+  # covering just their date. (See MetricsBucketDao.get_active_buckets.)
+  endDate = Column('end_date', Date)
@@ -61,3 +61,21 @@ class QuestionnaireResponseAnswer(Base):
   valueDate = Column('value_date', Date)
   valueDateTime = Column('value_datetime', UTCDateTime)
   valueUri = Column('value_uri', String(1024))
+
+
+class QuestionnaireResponseCurrentAnswer(Base):
+  """An index of the answers each participant has given that have no endTime, by the concept code
+  of the question they answer.
+
+  Rows are replaced in the same transaction as the answers they refer to are ended, so that the
+  current answers to a question can be found without joining answers to their responses and
+  questions.
+  """
+  __tablename__ = 'questionnaire_response_current_answer'
+  participantId = Column('participant_id', Integer, ForeignKey('participant.participant_id'),
+                         primary_key=True)
+  questionCodeId = Column('question_code_id', Integer, ForeignKey('code.code_id'),
+                          primary_key=True)
+  questionnaireResponseAnswerId = Column('questionnaire_response_answer_id', Integer,
+      ForeignKey('questionnaire_response_answer.questionnaire_response_answer_id'),
+      primary_key=True, autoincrement=False)
@@ -14,7 +14,7 @@ import clock
 import config
 from code_constants import RACE_QUESTION_CODE, RACE_AIAN_CODE, PPI_SYSTEM
 from dao import database_factory
-from dao.biobank_stored_sample_dao import BiobankStoredSampleDao
+from dao.biobank_stored_sample_dao import BiobankStoredSampleDao, DEFAULT_UPSERT_BATCH_SIZE
 from dao.code_dao import CodeDao
 from dao.database_utils import replace_isodate, parse_datetime
 from dao.participant_summary_dao import ParticipantSummaryDao
@@ -27,6 +27,7 @@ from participant_enums import OrganizationType
 _FILENAME_DATE_FORMAT = '%Y-%m-%d'
 # The output of the reconciliation report goes into this subdirectory within the upload bucket.
 _REPORT_SUBDIR = 'reconciliation'
+# Number of samples upserted per transaction.
 _BATCH_SIZE = 1000
 
 # Biobank provides timestamps without time zone info, which should be in central time (see DA-235).
@@ -70,9 +71,11 @@ def upsert_from_latest_csv():
         external=True)
 
   csv_reader = csv.DictReader(csv_file, delimiter='\t')
-  written = _upsert_samples_from_csv(csv_reader)
-  ParticipantSummaryDao().update_from_biobank_stored_samples()
-  return written, timestamp
+  written, skipped, biobank_ids = _upsert_samples_from_csv(csv_reader)
+  # Samples are only ever added or updated by the import, so only the summaries of participants
+  # with samples in the CSV (or that had them before) can change.
+  ParticipantSummaryDao().update_from_biobank_stored_samples(biobank_ids=biobank_ids)
+  return written, skipped, timestamp
 
 
 def _timestamp_from_filename(csv_filename):
@@ -132,29 +135,51 @@ class _Columns(object):
 
 
 def _upsert_samples_from_csv(csv_reader):
-  """Inserts/updates BiobankStoredSamples from a csv.DictReader."""
+  """Inserts/updates BiobankStoredSamples from a csv.DictReader.
+
+  Returns the numbers of samples written and skipped (for unrecognized tests), and the set of
+  biobank IDs of the samples in the CSV, including the biobank IDs that the samples were previously
+  stored for.
+  """
   missing_cols = _Columns.ALL - set(csv_reader.fieldnames)
   if missing_cols:
     raise DataError(
         'CSV is missing columns %s, had columns %s.' % (missing_cols, csv_reader.fieldnames))
   samples_dao = BiobankStoredSampleDao()
   biobank_id_prefix = get_biobank_id_prefix()
+  upsert_batch_size = config.getSetting(config.BIOBANK_SAMPLES_UPSERT_BATCH_SIZE,
+                                        DEFAULT_UPSERT_BATCH_SIZE)
   written = 0
+  skipped = 0
+  biobank_ids = set()
   try:
     samples = []
     for row in csv_reader:
       sample = _create_sample_from_row(row, biobank_id_prefix)
       if sample:
         samples.append(sample)
+        biobank_ids.add(sample.biobankId)
         if len(samples) >= _BATCH_SIZE:
-          written += samples_dao.upsert_all(samples)
+          batch_written, batch_skipped = _upsert_samples(samples_dao, samples, upsert_batch_size,
+                                                         biobank_ids)
+          written += batch_written
+          skipped += batch_skipped
           samples = []
     if samples:
-      written += samples_dao.upsert_all(samples)
-    return written
+      batch_written, batch_skipped = _upsert_samples(samples_dao, samples, upsert_batch_size,
+                                                     biobank_ids)
+      written += batch_written
+      skipped += batch_skipped
+    return written, skipped, biobank_ids
   except ValueError, e:
     raise DataError(e)
 
+def _upsert_samples(samples_dao, samples, upsert_batch_size, biobank_ids):
+  # A sample can move to another participant, whose summary needs updating as well.
+  biobank_ids.update(samples_dao.get_biobank_ids([sample.biobankStoredSampleId
+                                                  for sample in samples]))
+  return samples_dao.upsert_all(samples, upsert_batch_size)
+
 def _parse_timestamp(row, key, sample):
   str_val = row[key]
   if str_val:
@@ -318,15 +343,12 @@ def _get_hpo_type_sql(hpo_alias):
 # selected.
 _NATIVE_AMERICAN_SQL = """
   (SELECT (CASE WHEN count(*) > 0 THEN 'Y' ELSE 'N' END)
-       FROM questionnaire_response qr
+       FROM questionnaire_response_current_answer qrca
        INNER JOIN questionnaire_response_answer qra
-         ON qra.questionnaire_response_id = qr.questionnaire_response_id
-       INNER JOIN questionnaire_question qq
-         ON qra.question_id = qq.questionnaire_question_id
-      WHERE qr.participant_id = participant.participant_id
-        AND qq.code_id = :race_question_code_id
-        AND qra.value_code_id = :native_american_race_code_id
-        AND qra.end_time IS NULL) is_native_american"""
+         ON qra.questionnaire_response_answer_id = qrca.questionnaire_response_answer_id
+      WHERE qrca.participant_id = participant.participant_id
+        AND qrca.question_code_id = :race_question_code_id
+        AND qra.value_code_id = :native_american_race_code_id) is_native_american"""
 
 # Joins orders and samples, and computes some derived values (elapsed_hours, counts).
 # MySQL does not support FULL OUTER JOIN, so instead we UNION ALL a LEFT OUTER JOIN
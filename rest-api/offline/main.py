@@ -10,11 +10,12 @@ from sqlalchemy.exc import DBAPIError
 from werkzeug.exceptions import BadRequest
 
 import app_util
+import sql_instrumentation
 import config
 from api_util import EXPORTER
 from dao.metrics_dao import MetricsVersionDao
 from dao.metric_set_dao import AggregateMetricsDao
-from offline import biobank_samples_pipeline
+from offline import biobank_samples_pipeline, metrics_incremental
 from offline.base_pipeline import send_failure_alert
 from offline.table_exporter import TableExporter
 from offline.metrics_export import MetricsExport
@@ -62,6 +63,9 @@ def recalculate_metrics():
   if in_progress:
     logging.info("=========== Metrics pipeline already running ============")
     return '{"metrics-pipeline-status": "running"}'
+  elif request.args.get('full') != 'true' and metrics_incremental.update_serving_version():
+    logging.info("=========== Updated metrics incrementally ============")
+    return '{"metrics-pipeline-status": "updated"}'
   else:
     bucket_name = app_identity.get_default_gcs_bucket_name()
     logging.info("=========== Starting metrics export ============")
@@ -95,14 +99,14 @@ def import_biobank_samples():
   # Note that crons always have a 10 minute deadline instead of the normal 60s; additionally our
   # offline service uses basic scaling with has no deadline.
   logging.info('Starting samples import.')
-  written, timestamp = biobank_samples_pipeline.upsert_from_latest_csv()
+  written, skipped, timestamp = biobank_samples_pipeline.upsert_from_latest_csv()
   logging.info(
-      'Import complete (%d written), generating report.', written)
+      'Import complete (%d written, %d skipped), generating report.', written, skipped)
 
   logging.info('Generating reconciliation report.')
   biobank_samples_pipeline.write_reconciliation_report(timestamp)
   logging.info('Generated reconciliation report.')
-  return json.dumps({'written': written})
+  return json.dumps({'written': written, 'skipped': skipped})
 
 
 @app_util.auth_required(EXPORTER)
@@ -121,8 +125,15 @@ def export_tables():
 
   # Ensure this has a boolean value to avoid downstream issues.
   deidentify = resource_json.get('deidentify') is True
+  compress = resource_json.get('compress') is True
+  incremental = resource_json.get('incremental') is True
+  chunk_size = resource_json.get('chunk_size')
+  if chunk_size is not None and (type(chunk_size) is not int or chunk_size <= 0):
+    raise BadRequest("chunk_size must be a positive integer")
 
-  return json.dumps(TableExporter.export_tables(database, tables, directory, deidentify))
+  return json.dumps(TableExporter.export_tables(database, tables, directory, deidentify,
+                                                chunk_size=chunk_size, compress=compress,
+                                                incremental=incremental))
 
 
 def _build_pipeline_app():
@@ -155,6 +166,9 @@ def _build_pipeline_app():
 
   offline_app.after_request(app_util.add_headers)
   offline_app.before_request(app_util.request_logging)
+  offline_app.before_request(sql_instrumentation.start_request_stats)
+  offline_app.after_request(sql_instrumentation.finish_request_stats)
+  offline_app.teardown_request(sql_instrumentation.clear_request_stats)
   offline_app.register_error_handler(DBAPIError, app_util.handle_database_disconnect)
 
   return offline_app
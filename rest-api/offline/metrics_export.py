@@ -2,6 +2,7 @@ from google.appengine.ext import deferred
 
 import clock
 import config
+import sql_instrumentation
 
 from offline.sql_exporter import SqlExporter
 from dao.code_dao import CodeDao
@@ -40,6 +41,7 @@ SELECT p.participant_id, ps.date_of_birth date_of_birth,
    AND p.participant_id % :num_shards = :shard_number
    AND p.hpo_id != :test_hpo_id
    AND NOT ps.email LIKE :test_email_pattern
+   {}
 """
 
 # Find HPO ID changes in participant history.
@@ -59,6 +61,7 @@ SELECT ph.participant_id participant_id, hpo.name hpo,
     (SELECT * FROM participant_summary ps
       WHERE ps.participant_id = ph.participant_id
         AND ps.email LIKE :test_email_pattern)
+   {}
 """
 
 _ANSWER_QUERY = """
@@ -80,6 +83,7 @@ SELECT qr.participant_id participant_id, ISODATE[qr.created] start_time,
     (SELECT * FROM participant_summary ps
       WHERE ps.participant_id = p.participant_id
         AND ps.email LIKE :test_email_pattern)
+   {}
  ORDER BY qr.participant_id, qr.created, qc.value
 """
 
@@ -90,7 +94,14 @@ def _get_params(num_shards, shard_number):
           'test_hpo_id': test_hpo.hpoId,
           'test_email_pattern': TEST_EMAIL_PATTERN}
 
-def _get_participant_sql(num_shards, shard_number):
+def _get_participant_filter(column_name, participant_ids):
+  """Returns SQL and params limiting a query to the given participant IDs (if provided)."""
+  if participant_ids is None:
+    return '', {}
+  ids_sql, params = get_sql_and_params_for_array(participant_ids, 'participant_id')
+  return 'AND %s IN %s' % (column_name, ids_sql), params
+
+def _get_participant_sql(num_shards, shard_number, participant_ids=None):
   module_time_fields = ['ISODATE[ps.{0}] {0}'.format(get_column_name(ParticipantSummary,
                                                             field_name + 'Time'))
                         for field_name in QUESTIONNAIRE_MODULE_FIELD_NAMES]
@@ -98,12 +109,19 @@ def _get_participant_sql(num_shards, shard_number):
   dna_tests_sql, params = get_sql_and_params_for_array(
         config.getSettingList(config.DNA_SAMPLE_TEST_CODES), 'dna')
   params.update(_get_params(num_shards, shard_number))
-  return replace_isodate(_PARTICIPANT_SQL_TEMPLATE.format(dna_tests_sql, modules_sql)), params
+  filter_sql, filter_params = _get_participant_filter('p.participant_id', participant_ids)
+  params.update(filter_params)
+  return (replace_isodate(_PARTICIPANT_SQL_TEMPLATE.format(dna_tests_sql, modules_sql,
+                                                           filter_sql)),
+          params)
 
-def _get_hpo_id_sql(num_shards, shard_number):
-  return replace_isodate(_HPO_ID_QUERY), _get_params(num_shards, shard_number)
+def _get_hpo_id_sql(num_shards, shard_number, participant_ids=None):
+  params = _get_params(num_shards, shard_number)
+  filter_sql, filter_params = _get_participant_filter('ph.participant_id', participant_ids)
+  params.update(filter_params)
+  return replace_isodate(_HPO_ID_QUERY.format(filter_sql)), params
 
-def _get_answer_sql(num_shards, shard_number):
+def _get_answer_sql(num_shards, shard_number, participant_ids=None):
   code_dao = CodeDao()
   code_ids = []
   question_codes = list(ANSWER_FIELD_TO_QUESTION_CODE.values())
@@ -114,7 +132,9 @@ def _get_answer_sql(num_shards, shard_number):
     code_ids.append(str(code.codeId))
   params = _get_params(num_shards, shard_number)
   params['unmapped'] = UNMAPPED
-  return replace_isodate(_ANSWER_QUERY.format((','.join(code_ids)))), params
+  filter_sql, filter_params = _get_participant_filter('qr.participant_id', participant_ids)
+  params.update(filter_params)
+  return replace_isodate(_ANSWER_QUERY.format(','.join(code_ids), filter_sql)), params
 
 class MetricsExport(object):
   """Exports data from the database needed to generate metrics.
@@ -155,8 +175,10 @@ class MetricsExport(object):
   @staticmethod
   def _start_export(bucket_name, filename_prefix, num_shards, shard_number, export_methodname,
                     next_shard_methodname, next_type_methodname, finish_methodname=None):
-    getattr(MetricsExport, export_methodname)(bucket_name, filename_prefix,
-                                              num_shards, shard_number)
+    with sql_instrumentation.record_job_query_stats(
+        'MetricsExport.%s %d' % (export_methodname, shard_number)):
+      getattr(MetricsExport, export_methodname)(bucket_name, filename_prefix,
+                                                num_shards, shard_number)
     shard_number += 1
     if shard_number == num_shards:
       if next_type_methodname:
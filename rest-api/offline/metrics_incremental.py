@@ -0,0 +1,226 @@
+"""Incremental updates of the serving metrics version.
+
+The metrics pipeline (see metrics_pipeline.py) rebuilds every metrics bucket for every HPO and
+date from scratch, so its cost grows with the number of participants times the days of history.
+Between full rebuilds, this module brings the buckets of the serving MetricsVersion up to date
+instead:
+
+* The buckets for the day before the last bucket date (the "since" date) are read back as running
+  hpoId|participant_type|metric counters.
+* Only participants with data dated on or after the since date are exported, straight from the
+  database: participant history (HPO changes), questionnaire responses, physical measurements,
+  biobank orders and samples, plus participants whose age range changes in that window.
+* Their data goes through the same mapper and participant reducer as the first MapReduce of the
+  pipeline; the deltas dated on or after the since date are added to the counters, day by day.
+* The buckets from the since date through today are rewritten in a single transaction.
+
+Versions written with bucket ranges (see MetricsBucket.endDate) are updated the same way: the
+since date is the last date covered by a bucket, bucket ranges running into it are cut short the
+day before, and the buckets from the since date on are written for single dates.
+
+Deltas dated before the since date are assumed to already be counted. Data that shows up later
+with an earlier date (e.g. samples confirmed before the last run, but imported after it) is only
+picked up by the next full rebuild; the full pipeline is the fallback when there is no serving
+version (or it is too old), and serves as the correctness oracle for this module.
+
+As in the full pipeline, buckets include a metric from the first date it changes on, on every date
+its count is above 0 (and with whatever count it has, on dates between dates it changes on).
+"""
+
+import collections
+import json
+import logging
+import StringIO
+
+import clock
+import offline.metrics_export
+
+from datetime import datetime, timedelta
+from dateutil.relativedelta import relativedelta
+from sqlalchemy import func, text
+
+from dao.metrics_dao import MetricsBucketDao, MetricsVersionDao
+from model.metrics import MetricsBucket
+from offline.metrics_pipeline import map_csv_to_participant_and_date_metric, make_metrics_bucket
+from offline.metrics_pipeline import reduce_participant_data_to_hpo_metric_date_deltas
+from offline.metrics_pipeline import make_tuple, parse_tuple, parse_metrics_bucket_counts
+from offline.metrics_pipeline import DATE_FORMAT
+from offline.sql_exporter import SqlExporter, SqlExportFileWriter
+from participant_enums import AGE_BUCKETS
+
+# Serving versions older than this are rebuilt from scratch rather than updated, which bounds how
+# long data with a date before the since date can go uncounted.
+MAX_VERSION_AGE = timedelta(days=7)
+
+# Number of changed participants exported and reduced at a time.
+_PARTICIPANT_BATCH_SIZE = 1000
+
+# Ages at which participants move from one age range to the next.
+_AGE_RANGE_BOUNDARIES = [int(age_range.split('-')[0]) for age_range in AGE_BUCKETS][1:]
+
+# Participants with any data on or after the since date. The export queries take care of
+# filtering out test participants.
+_CHANGED_PARTICIPANTS_SQL = """
+SELECT ph.participant_id FROM participant_history ph WHERE ph.last_modified >= :since
+UNION
+SELECT qr.participant_id FROM questionnaire_response qr WHERE qr.created >= :since
+UNION
+SELECT pm.participant_id FROM physical_measurements pm WHERE pm.created >= :since
+UNION
+SELECT bo.participant_id FROM biobank_order bo WHERE bo.created >= :since
+UNION
+SELECT p.participant_id FROM participant p, biobank_stored_sample bs
+ WHERE bs.biobank_id = p.biobank_id AND bs.confirmed >= :since
+UNION
+SELECT ps.participant_id FROM participant_summary ps WHERE {}
+"""
+
+
+def update_serving_version(now=None):
+  """Updates the buckets of the serving metrics version through today.
+
+  Returns True if the serving version was updated, or False if a full rebuild is needed instead.
+  """
+  now = now or clock.CLOCK.now()
+  version_dao = MetricsVersionDao()
+  if version_dao.get_version_in_progress():
+    logging.info('Metrics pipeline is running; not updating metrics incrementally.')
+    return False
+  version = version_dao.get_serving_version()
+  if version is None or version.date + MAX_VERSION_AGE <= now:
+    logging.info('No recent metrics version to update; a full rebuild is needed.')
+    return False
+  bucket_dao = MetricsBucketDao()
+  with bucket_dao.session() as session:
+    since_date = (session.query(func.max(func.coalesce(MetricsBucket.endDate, MetricsBucket.date)))
+                  .filter(MetricsBucket.metricsVersionId == version.metricsVersionId)
+                  .scalar())
+  if since_date is None or since_date > now.date():
+    logging.info('Metrics version %s has no buckets to update.', version.metricsVersionId)
+    return False
+
+  counts = _get_counts(version.metricsVersionId, since_date - timedelta(days=1))
+  participant_ids = _get_changed_participant_ids(since_date, now)
+  logging.info('Updating metrics version %s from %s with %d changed participants.',
+               version.metricsVersionId, since_date, len(participant_ids))
+  date_deltas = collections.defaultdict(lambda: collections.defaultdict(lambda: 0))
+  earlier_keys = set()
+  for i in range(0, len(participant_ids), _PARTICIPANT_BATCH_SIZE):
+    _add_date_deltas(participant_ids[i:i + _PARTICIPANT_BATCH_SIZE], since_date, now, date_deltas,
+                     earlier_keys)
+
+  buckets = []
+  today_str = now.date().isoformat()
+  # Metrics counted in the buckets read back have changed before since_date, as have metrics
+  # with earlier deltas for the changed participants (even if they were left out of the buckets
+  # because their count was 0).
+  started_keys = set(counts) | earlier_keys
+  last_change_dates = {}
+  for date_str, deltas in date_deltas.iteritems():
+    if date_str <= today_str:
+      for key in deltas:
+        last_change_dates[key] = max(date_str, last_change_dates.get(key, date_str))
+  date = since_date
+  while date <= now.date():
+    date_str = date.isoformat()
+    deltas = date_deltas.get(date_str, {})
+    for key, delta in deltas.iteritems():
+      counts[key] += delta
+      started_keys.add(key)
+    # Match the counts the full pipeline emits for each date (see _get_all_date_counts).
+    date_counts = {}
+    for key in started_keys:
+      count = counts[key]
+      if count > 0:
+        date_counts[key] = count
+      elif key not in deltas and last_change_dates.get(key, '') > date_str:
+        date_counts[key] = 0
+    buckets.extend(_make_buckets(date_counts, date_str, version.metricsVersionId))
+    date = date + timedelta(days=1)
+
+  with bucket_dao.session() as session:
+    (session.query(MetricsBucket)
+     .filter(MetricsBucket.metricsVersionId == version.metricsVersionId)
+     .filter(MetricsBucket.date >= since_date)
+     .delete(synchronize_session=False))
+    (session.query(MetricsBucket)
+     .filter(MetricsBucket.metricsVersionId == version.metricsVersionId)
+     .filter(MetricsBucket.endDate >= since_date)
+     .update({MetricsBucket.endDate: since_date - timedelta(days=1)},
+             synchronize_session=False))
+    for bucket in buckets:
+      bucket_dao.insert_with_session(session, bucket)
+  return True
+
+
+def _get_counts(version_id, date):
+  """Returns (hpoId, participant_type, metric) -> count for the given version and date, from the
+  buckets for the date or for ranges of dates including it."""
+  counts = collections.defaultdict(lambda: 0)
+  with MetricsBucketDao().session() as session:
+    buckets = (session.query(MetricsBucket)
+               .filter(MetricsBucket.metricsVersionId == version_id)
+               .filter(MetricsBucket.date <= date)
+               .filter(func.coalesce(MetricsBucket.endDate, MetricsBucket.date) >= date)
+               .all())
+    for bucket in buckets:
+      if not bucket.hpoId:
+        # Cross-HPO counts are recalculated from the HPO counts.
+        continue
+      for participant_type, metric, count in parse_metrics_bucket_counts(
+          json.loads(bucket.metrics)):
+        counts[(bucket.hpoId, participant_type, metric)] = count
+  return counts
+
+
+def _get_changed_participant_ids(since_date, now):
+  """Returns IDs of participants whose metrics may change on or after since_date."""
+  # A participant's age range changes when they reach one of the boundary ages between since_date
+  # and now, i.e. when they were born in one of these windows. (The windows are padded by a day
+  # to account for leap days; including extra participants is harmless.)
+  date_of_birth_sql = []
+  params = {'since': datetime.combine(since_date, datetime.min.time())}
+  for i, age in enumerate(_AGE_RANGE_BOUNDARIES):
+    date_of_birth_sql.append('ps.date_of_birth BETWEEN :dob_start%d AND :dob_end%d' % (i, i))
+    params['dob_start%d' % i] = since_date - relativedelta(years=age, days=1)
+    params['dob_end%d' % i] = now.date() - relativedelta(years=age) + timedelta(days=1)
+  sql = _CHANGED_PARTICIPANTS_SQL.format(' OR '.join(date_of_birth_sql))
+  with MetricsVersionDao().session() as session:
+    return sorted(row[0] for row in session.execute(text(sql), params))
+
+
+def _add_date_deltas(participant_ids, since_date, now, date_deltas, earlier_keys):
+  """Adds deltas for the participants dated on or after since_date to
+  date -> (hpoId, participant_type, metric) -> delta, and the keys of earlier deltas to
+  earlier_keys."""
+  participant_values = collections.defaultdict(list)
+  for get_sql in (offline.metrics_export._get_participant_sql,
+                  offline.metrics_export._get_hpo_id_sql,
+                  offline.metrics_export._get_answer_sql):
+    sql, params = get_sql(1, 0, participant_ids=participant_ids)
+    csv_buffer = StringIO.StringIO()
+    SqlExporter(None).run_export_with_writer(SqlExportFileWriter(csv_buffer), sql, params)
+    csv_buffer.seek(0)
+    for participant_id, value in map_csv_to_participant_and_date_metric(csv_buffer):
+      participant_values[participant_id].append(value)
+
+  since_date_str = since_date.strftime(DATE_FORMAT)
+  for participant_id, values in participant_values.iteritems():
+    for result in reduce_participant_data_to_hpo_metric_date_deltas(participant_id, values,
+                                                                    now=now):
+      hpo_id, participant_type, metric, date_str, delta = parse_tuple(result.rstrip('\n'))
+      if date_str >= since_date_str:
+        date_deltas[date_str][(hpo_id, participant_type, metric)] += int(delta)
+      else:
+        earlier_keys.add((hpo_id, participant_type, metric))
+
+
+def _make_buckets(counts, date_str, version_id):
+  """Returns buckets for each HPO (and across HPOs) with the given counts for a date."""
+  hpo_metric_counts = collections.defaultdict(list)
+  for (hpo_id, participant_type, metric), count in counts.iteritems():
+    metric_count = make_tuple(participant_type, metric, str(count))
+    hpo_metric_counts[hpo_id].append(metric_count)
+    hpo_metric_counts['*'].append(metric_count)
+  return [make_metrics_bucket(make_tuple(hpo_id, date_str), metric_counts, version_id)
+          for hpo_id, metric_counts in hpo_metric_counts.iteritems()]
@@ -0,0 +1,222 @@
+"""Runs the metrics pipeline on local files, without App Engine's MapReduce library.
+
+The three MapReduces of the metrics pipeline (see metrics_pipeline.py) are run one after the other
+with the same mapper, combiner and reducer functions, on a multiprocessing pool:
+
+* Each input file of a stage is mapped by one task; mapped (key, value) pairs are written to one
+  temp file per partition, picking the partition by a hash of the key. (Stage two also combines
+  values for each key within a map task, like its MapReduce combiner.)
+* Each partition is then reduced by one task, which groups the values from all of the partition's
+  temp files by key and writes the reducer output to a file used as input to the next stage.
+* Instead of writing metrics buckets to SQL, the last stage writes them to newline-delimited JSON
+  files ({"hpoId": ..., "date": ..., "metrics": {...}} per line, plus "endDate" for bucket
+  ranges), which write_buckets() can load into a new metrics version.
+
+Stage outputs are in either of the pipeline's intermediate formats. Temp files of mapped pairs are
+CSV for the text format, and length-prefixed keys and values (see metrics_records.py) for the
+records format, whose values are binary.
+
+The inputs are the participant, HPO ID and answer CSV shards written by MetricsExport.
+"""
+
+import collections
+import csv
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import zlib
+
+from datetime import datetime
+from dao.metrics_dao import MetricsBucketDao, MetricsVersionDao
+from offline.metrics_pipeline import get_stage_functions, INTERMEDIATE_FORMAT_TEXT
+from offline.metrics_pipeline import make_metrics_bucket, make_tuple, parse_metrics_bucket_counts
+from offline.metrics_pipeline import make_metrics_bucket_ranges, DATE_FORMAT
+from offline.metrics_records import iter_frames, make_frame
+
+
+def _reduce_hpo_date_metric_counts_to_bucket_json(reducer_key, reducer_values, now=None):
+  """Like reduce_hpo_date_metric_counts_to_database_buckets, but emits buckets as JSON lines."""
+  #pylint: disable=unused-argument
+  bucket = make_metrics_bucket(reducer_key, reducer_values, None)
+  yield json.dumps({'hpoId': bucket.hpoId,
+                    'date': bucket.date.date().isoformat(),
+                    'metrics': json.loads(bucket.metrics)}, sort_keys=True) + '\n'
+
+
+def _reduce_hpo_metric_count_changes_to_bucket_range_json(reducer_key, reducer_values, now=None):
+  """Like reduce_hpo_metric_count_changes_to_database_bucket_ranges, but emits buckets as JSON
+  lines."""
+  for bucket in make_metrics_bucket_ranges(reducer_key, reducer_values, now, None):
+    yield json.dumps({'hpoId': bucket.hpoId,
+                      'date': bucket.date.date().isoformat(),
+                      'endDate': bucket.endDate.isoformat(),
+                      'metrics': json.loads(bucket.metrics)}, sort_keys=True) + '\n'
+
+
+def _get_stages(intermediate_format, bucket_ranges):
+  """Returns (mapper, combiner, reducer) for each of the MapReduces in the metrics pipeline."""
+  stages = get_stage_functions(intermediate_format, bucket_ranges)
+  mapper, combiner, _ = stages[-1]
+  if bucket_ranges:
+    reducer = _reduce_hpo_metric_count_changes_to_bucket_range_json
+  else:
+    reducer = _reduce_hpo_date_metric_counts_to_bucket_json
+  return stages[:-1] + [(mapper, combiner, reducer)]
+
+
+def run_pipeline(input_paths, output_dir, now, num_processes=None, num_partitions=None,
+                 intermediate_format=INTERMEDIATE_FORMAT_TEXT, bucket_ranges=False):
+  """Runs the metrics pipeline stages on local CSV files.
+
+  Args:
+    input_paths: paths to participant, HPO ID and answer CSV files written by MetricsExport.
+    output_dir: directory to write metrics bucket files to. Intermediate files are written to
+      temp directories inside it, and deleted once read.
+    now: the date to calculate metrics until.
+    num_processes: size of the multiprocessing pool (defaults to the number of CPUs); 0 runs all
+      tasks in this process, which is handy for tests and profiling.
+    num_partitions: number of reduce tasks per stage (defaults to the number of processes).
+    intermediate_format: format of the stage outputs; see metrics_pipeline.py.
+    bucket_ranges: if true, write a bucket for each range of dates an HPO's counts stay the same
+      for, rather than for every date.
+
+  Returns:
+    The paths of the metrics bucket files written.
+  """
+  num_stages = len(_get_stages(intermediate_format, bucket_ranges))
+  if num_processes is None:
+    num_processes = multiprocessing.cpu_count()
+  num_partitions = num_partitions or max(num_processes, 1)
+  pool = multiprocessing.Pool(num_processes) if num_processes else None
+  map_function = pool.map if pool else map
+  try:
+    stage_input_paths = input_paths
+    stage_dirs = []
+    for stage in range(num_stages):
+      stage_dir = tempfile.mkdtemp(prefix='stage%d_' % stage, dir=output_dir)
+      stage_dirs.append(stage_dir)
+      logging.info('Mapping %d files for stage %d.', len(stage_input_paths), stage)
+      map_function(_run_map_task, [(stage, i, path, stage_dir, num_partitions,
+                                    intermediate_format, bucket_ranges)
+                                   for i, path in enumerate(stage_input_paths)])
+      if stage == num_stages - 1:
+        output_paths = [os.path.join(output_dir, 'buckets_%d.json' % partition)
+                        for partition in range(num_partitions)]
+      else:
+        output_paths = [os.path.join(stage_dirs[stage], 'output_%d' % partition)
+                        for partition in range(num_partitions)]
+      logging.info('Reducing %d partitions for stage %d.', num_partitions, stage)
+      map_function(_run_reduce_task,
+                   [(stage, _get_partition_paths(stage_dir, len(stage_input_paths), partition),
+                     output_paths[partition], now, intermediate_format, bucket_ranges)
+                    for partition in range(num_partitions)])
+      if stage > 0:
+        shutil.rmtree(stage_dirs[stage - 1])
+      stage_input_paths = output_paths
+    shutil.rmtree(stage_dirs[-1])
+    return stage_input_paths
+  finally:
+    if pool:
+      pool.close()
+      pool.join()
+
+
+def write_buckets(bucket_paths):
+  """Writes buckets from files written by run_pipeline to a new serving metrics version."""
+  version_dao = MetricsVersionDao()
+  bucket_dao = MetricsBucketDao()
+  version_id = version_dao.set_pipeline_in_progress()
+  try:
+    for path in bucket_paths:
+      with open(path) as bucket_file, bucket_dao.session() as session:
+        for line in bucket_file:
+          bucket_json = json.loads(line)
+          hpo_date_key = make_tuple(bucket_json['hpoId'] or '*', bucket_json['date'])
+          metric_counts = [make_tuple(participant_type, metric, str(count))
+                           for participant_type, metric, count
+                           in parse_metrics_bucket_counts(bucket_json['metrics'])]
+          bucket = make_metrics_bucket(hpo_date_key, metric_counts, version_id)
+          if bucket_json.get('endDate'):
+            bucket.endDate = datetime.strptime(bucket_json['endDate'], DATE_FORMAT).date()
+          bucket_dao.insert_with_session(session, bucket)
+  except:
+    version_dao.set_pipeline_finished(False)
+    raise
+  version_dao.set_pipeline_finished(True)
+  version_dao.delete_old_versions()
+  return version_id
+
+
+def _get_partition(key, num_partitions):
+  # crc32 is stable across processes, unlike hash() of some types.
+  return (zlib.crc32(key) & 0xffffffff) % num_partitions
+
+
+def _get_partition_path(stage_dir, task_index, partition):
+  return os.path.join(stage_dir, 'map_%d_%d' % (task_index, partition))
+
+
+def _get_partition_paths(stage_dir, num_map_tasks, partition):
+  return [_get_partition_path(stage_dir, task_index, partition)
+          for task_index in range(num_map_tasks)]
+
+
+class _FrameWriter(object):
+  """Writes (key, value) rows as length-prefixed frames, like csv.writer does as CSV rows."""
+  def __init__(self, stream):
+    self._stream = stream
+
+  def writerow(self, row):
+    key, value = row
+    self._stream.write(make_frame(key))
+    self._stream.write(make_frame(value))
+
+
+def _read_key_values(stream, intermediate_format):
+  if intermediate_format == INTERMEDIATE_FORMAT_TEXT:
+    return csv.reader(stream)
+  frames = iter_frames(stream)
+  return ((key, next(frames)) for key in frames)
+
+
+def _run_map_task(args):
+  (stage, task_index, input_path, stage_dir, num_partitions, intermediate_format,
+   bucket_ranges) = args
+  mapper, combiner, _ = _get_stages(intermediate_format, bucket_ranges)[stage]
+  partition_files = [open(_get_partition_path(stage_dir, task_index, partition), 'wb')
+                     for partition in range(num_partitions)]
+  try:
+    if intermediate_format == INTERMEDIATE_FORMAT_TEXT:
+      writers = [csv.writer(partition_file) for partition_file in partition_files]
+    else:
+      writers = [_FrameWriter(partition_file) for partition_file in partition_files]
+    with open(input_path, 'rb') as input_file:
+      results = mapper(input_file)
+      if combiner:
+        key_values = collections.defaultdict(list)
+        for key, value in results:
+          key_values[key].append(value)
+        results = ((key, combined_value) for key, values in key_values.iteritems()
+                   for combined_value in combiner(key, values, []))
+      for key, value in results:
+        writers[_get_partition(key, num_partitions)].writerow((key, value))
+  finally:
+    for partition_file in partition_files:
+      partition_file.close()
+
+
+def _run_reduce_task(args):
+  stage, partition_paths, output_path, now, intermediate_format, bucket_ranges = args
+  _, _, reducer = _get_stages(intermediate_format, bucket_ranges)[stage]
+  key_values = collections.defaultdict(list)
+  for partition_path in partition_paths:
+    with open(partition_path, 'rb') as partition_file:
+      for key, value in _read_key_values(partition_file, intermediate_format):
+        key_values[key].append(value)
+  with open(output_path, 'wb') as output_file:
+    for key in sorted(key_values):
+      for result in reducer(key, key_values[key], now=now):
+        output_file.write(result)
@@ -50,6 +50,18 @@ The metrics to be collected are specified in the METRICS_CONFIGS dict.  In
 addition to the fields specified there, for every entity, a synthetic 'total'
 metric is generated.  This is to record the total number of entities over time.
 
+The output of the first two MRs is text as described above by default. When the
+metrics_intermediate_format config setting is "records" at the start of a run, they write compact
+binary blocks instead (see metrics_records.py), using the *_records variants of the functions
+below; the date|delta values of the second MR are then encoded the same way.
+
+When the metrics_bucket_ranges config setting is true at the start of a run, buckets are written
+for ranges of dates instead of for every date (see MetricsBucket.endDate):
+* The second MR also counts deltas for '*' (cross-HPO) keys, and emits counts only for the dates
+  they change on (0 when a metric stops applying), rather than for every date until today.
+* The third MR groups the count changes by hpoId, and writes a bucket for each range of dates that
+  all of the HPO's counts stay the same for. Metrics with a count of 0 are left out of buckets.
+
 """
 
 import collections
@@ -61,6 +73,7 @@ import pipeline
 import config
 import csv
 import offline.metrics_config
+import offline.metrics_records
 import offline.sql_exporter
 
 from cloudstorage import cloudstorage_api
@@ -84,7 +97,7 @@ from metrics_config import BIOSPECIMEN_METRIC, BIOSPECIMEN_SAMPLES_METRIC, HPO_I
 from metrics_config import PHYSICAL_MEASUREMENTS_METRIC, AGE_RANGE_METRIC, CENSUS_REGION_METRIC
 from metrics_config import SPECIMEN_COLLECTED_VALUE, RACE_METRIC, ENROLLMENT_STATUS_METRIC
 from metrics_config import SAMPLES_ARRIVED_VALUE, SUBMITTED_VALUE, PARTICIPANT_KIND
-from metrics_config import HPO_ID_FIELDS, ANSWER_FIELDS, get_participant_fields, get_fieldnames
+from metrics_config import HPO_ID_FIELDS, ANSWER_FIELDS, get_participant_fields
 from metrics_config import transform_participant_summary_field, SAMPLES_TO_ISOLATE_DNA_METRIC
 from metrics_config import FULL_PARTICIPANT_KIND, EHR_CONSENT_ANSWER_METRIC
 from participant_enums import get_bucketed_age, get_race, PhysicalMeasurementsStatus, SampleStatus
@@ -99,6 +112,15 @@ DATE_OF_BIRTH_PREFIX = "DOB"
 
 TOTAL_SENTINEL = '__total_sentinel__'
 _NUM_SHARDS = '_NUM_SHARDS'
+_INTERMEDIATE_FORMAT = '_INTERMEDIATE_FORMAT'
+_BUCKET_RANGES = '_BUCKET_RANGES'
+
+# Formats for the data written between MapReduces; see module comments.
+INTERMEDIATE_FORMAT_TEXT = 'text'
+INTERMEDIATE_FORMAT_RECORDS = 'records'
+
+# Count emitted in count changes from the date a metric no longer appears in buckets.
+_NO_COUNT = -1
 
 # Participant type constants
 _REGISTERED_PARTICIPANT = 'R'
@@ -108,7 +130,10 @@ def default_params():
   """These can be used in a snapshot to ensure they stay the same across
   all instances of a MapReduce pipeline, even if datastore changes"""
   return {
-        _NUM_SHARDS: int(config.getSetting(config.METRICS_SHARDS, 1))
+        _NUM_SHARDS: int(config.getSetting(config.METRICS_SHARDS, 1)),
+        _INTERMEDIATE_FORMAT: config.getSetting(config.METRICS_INTERMEDIATE_FORMAT,
+                                                INTERMEDIATE_FORMAT_TEXT),
+        _BUCKET_RANGES: bool(config.getSetting(config.METRICS_BUCKET_RANGES, False))
     }
 
 def get_config():
@@ -174,36 +199,40 @@ class SummaryPipeline(pipeline.Pipeline):
       mapper_params.update(parent_params)
 
     num_shards = mapper_params[_NUM_SHARDS]
+    intermediate_format = mapper_params.get(_INTERMEDIATE_FORMAT, INTERMEDIATE_FORMAT_TEXT)
+    stages = get_stage_functions(intermediate_format, mapper_params.get(_BUCKET_RANGES, False))
+    content_type = ('text/plain' if intermediate_format == INTERMEDIATE_FORMAT_TEXT
+                    else 'application/octet-stream')
     # Chain together three map reduces; see module comments
     blob_key_1 = (yield mapreduce_pipeline.MapreducePipeline(
         'Process Input CSV',
-        mapper_spec='offline.metrics_pipeline.map_csv_to_participant_and_date_metric',
+        mapper_spec=_get_spec(stages[0][0]),
         input_reader_spec='mapreduce.input_readers.GoogleCloudStorageInputReader',
         output_writer_spec='mapreduce.output_writers.GoogleCloudStorageOutputWriter',
         mapper_params=mapper_params,
-        reducer_spec='offline.metrics_pipeline.reduce_participant_data_to_hpo_metric_date_deltas',
+        reducer_spec=_get_spec(stages[0][2]),
         reducer_params={
             'now': now,
             'output_writer': {
                 'bucket_name': bucket_name,
-                'content_type': 'text/plain'
+                'content_type': content_type
             }
         },
         shards=num_shards))
 
     blob_key_2 = (yield mapreduce_pipeline.MapreducePipeline(
         'Calculate Counts',
-        mapper_spec='offline.metrics_pipeline.map_hpo_metric_date_deltas_to_hpo_metric_key',
+        mapper_spec=_get_spec(stages[1][0]),
         input_reader_spec='mapreduce.input_readers.GoogleCloudStorageInputReader',
         output_writer_spec='mapreduce.output_writers.GoogleCloudStorageOutputWriter',
         mapper_params=(yield BlobKeys(bucket_name, blob_key_1, now, version_id)),
-        combiner_spec='offline.metrics_pipeline.combine_hpo_metric_date_deltas',
-        reducer_spec='offline.metrics_pipeline.reduce_hpo_metric_date_deltas_to_all_date_counts',
+        combiner_spec=_get_spec(stages[1][1]),
+        reducer_spec=_get_spec(stages[1][2]),
         reducer_params={
             'now': now,
             'output_writer': {
                 'bucket_name': bucket_name,
-                'content_type': 'text/plain',
+                'content_type': content_type,
             }
         },
         shards=num_shards))
@@ -211,15 +240,63 @@ class SummaryPipeline(pipeline.Pipeline):
     # We need to find a way to delete data written above (DA-167)
     yield mapreduce_pipeline.MapreducePipeline(
         'Write Metrics',
-        mapper_spec='offline.metrics_pipeline.map_hpo_metric_date_counts_to_hpo_date_key',
+        mapper_spec=_get_spec(stages[2][0]),
         input_reader_spec='mapreduce.input_readers.GoogleCloudStorageInputReader',
         mapper_params=(yield BlobKeys(bucket_name, blob_key_2, now, version_id)),
-        reducer_spec='offline.metrics_pipeline.reduce_hpo_date_metric_counts_to_database_buckets',
+        reducer_spec=_get_spec(stages[2][2]),
         reducer_params={
+            'now': now,
             'version_id': version_id
         },
         shards=num_shards)
 
+def _get_spec(function):
+  return 'offline.metrics_pipeline.' + function.__name__
+
+def get_stage_functions(intermediate_format, bucket_ranges=False):
+  """Returns (mapper, combiner, reducer) functions for each of the three MapReduces, for the given
+  intermediate format, writing buckets for ranges of dates if bucket_ranges is true."""
+  if intermediate_format == INTERMEDIATE_FORMAT_TEXT and bucket_ranges:
+    return [
+        (map_csv_to_participant_and_date_metric, None,
+         reduce_participant_data_to_hpo_metric_date_deltas),
+        (map_hpo_metric_date_deltas_to_hpo_and_total_metric_keys, combine_hpo_metric_date_deltas,
+         reduce_hpo_metric_date_deltas_to_count_changes),
+        (map_hpo_metric_date_counts_to_hpo_key, None,
+         reduce_hpo_metric_count_changes_to_database_bucket_ranges),
+    ]
+  elif intermediate_format == INTERMEDIATE_FORMAT_TEXT:
+    return [
+        (map_csv_to_participant_and_date_metric, None,
+         reduce_participant_data_to_hpo_metric_date_deltas),
+        (map_hpo_metric_date_deltas_to_hpo_metric_key, combine_hpo_metric_date_deltas,
+         reduce_hpo_metric_date_deltas_to_all_date_counts),
+        (map_hpo_metric_date_counts_to_hpo_date_key, None,
+         reduce_hpo_date_metric_counts_to_database_buckets),
+    ]
+  elif intermediate_format == INTERMEDIATE_FORMAT_RECORDS and bucket_ranges:
+    return [
+        (map_csv_to_participant_and_date_metric, None,
+         reduce_participant_data_to_hpo_metric_date_delta_records),
+        (map_hpo_metric_date_delta_records_to_hpo_and_total_metric_keys,
+         combine_hpo_metric_date_delta_records,
+         reduce_hpo_metric_date_delta_records_to_count_change_records),
+        (map_hpo_metric_date_count_records_to_hpo_key, None,
+         reduce_hpo_metric_count_changes_to_database_bucket_ranges),
+    ]
+  elif intermediate_format == INTERMEDIATE_FORMAT_RECORDS:
+    return [
+        (map_csv_to_participant_and_date_metric, None,
+         reduce_participant_data_to_hpo_metric_date_delta_records),
+        (map_hpo_metric_date_delta_records_to_hpo_metric_key,
+         combine_hpo_metric_date_delta_records,
+         reduce_hpo_metric_date_delta_records_to_all_date_count_records),
+        (map_hpo_metric_date_count_records_to_hpo_date_key, None,
+         reduce_hpo_date_metric_counts_to_database_buckets),
+    ]
+  else:
+    raise ValueError('Unknown metrics intermediate format: %r' % intermediate_format)
+
 def map_csv_to_participant_and_date_metric(csv_buffer):
   """Takes a CSV file as input. Emits (participantId, date|metric) tuples.
   """
@@ -371,6 +448,12 @@ def sum_deltas(values, delta_map):
     else:
       delta_map[date] = int(delta)
 
+def _sum_day_deltas(values, delta_map):
+  decode_day_value = offline.metrics_records.decode_day_value
+  for value in values:
+    day, delta = decode_day_value(value)
+    delta_map[day] = delta_map.get(day, 0) + delta
+
 def _add_age_range_metrics(dates_and_metrics, date_of_birth, now):
   creation_date = dates_and_metrics[0][0].date()
   now = now or context.get().mapreduce_spec.mapper.params.get('now')
@@ -389,27 +472,120 @@ def _add_age_range_metrics(dates_and_metrics, date_of_birth, now):
     date = date + year
   return start_age_range
 
-def _update_summary_fields(summary_fields, new_state):
-  for summary_field in summary_fields:
-    new_state[summary_field.name] = summary_field.compute_func(new_state)
-
-def _process_metric(metrics_fields, summary_fields, metric, new_state):
-  metric_name, value = parse_metric(metric)
-  something_changed = False
-  if metric_name == EHR_CONSENT_ANSWER_METRIC:
-    metric_name = CONSENT_FOR_ELECTRONIC_HEALTH_RECORDS_FIELD
-    if value == CONSENT_PERMISSION_YES_CODE:
-      value = str(QuestionnaireStatus.SUBMITTED)
-    else:
-      value = str(QuestionnaireStatus.SUBMITTED_NO_CONSENT)
-  if metric_name in metrics_fields:
-    if new_state[metric_name] != value:
-      new_state[metric_name] = value
-      something_changed = True
+class _ParticipantStateLayout(object):
+  """Fixed slots for the metrics fields of a participant's state, plus value encodings per slot.
 
-  if something_changed:
-    _update_summary_fields(summary_fields, new_state)
-  return something_changed
+  reduce_participant_data_to_hpo_metric_date_deltas keeps a participant's state as a list with an
+  integer-encoded value for each slot; codes are assigned per slot, so that two states have equal
+  values for a field exactly when their codes for it are equal. Encodings and the result keys
+  emitted for them are kept for the lifetime of the reducer process.
+  """
+  def __init__(self, metrics_conf):
+    self.summary_fields = metrics_conf['summary_fields']
+    # Deltas are emitted in the same order as when state was kept in dicts: the initial state was
+    # built from the fields, the total and the summary fields, and each later state was a deep copy
+    # of the one before it. Copying a dict can change its iteration order, so the order depends on
+    # the number of changes so far; orders[i] is the order after i changes (see get_order).
+    state = {f.name: UNSET for f in metrics_conf['fields']}
+    state[TOTAL_SENTINEL] = 1
+    for summary_field in self.summary_fields:
+      state[summary_field.name] = None
+    self.names = list(state)
+    self.slots = {name: slot for slot, name in enumerate(self.names)}
+    self._orders = [range(len(self.names))]
+    while True:
+      state = copy.deepcopy(state)
+      order = [self.slots[name] for name in state]
+      if order in self._orders:
+        self._cycle_start = self._orders.index(order)
+        break
+      self._orders.append(order)
+    self.field_slots = {f.name: self.slots[f.name] for f in metrics_conf['fields']}
+    self.summary_slots = [self.slots[f.name] for f in self.summary_fields]
+    self.hpo_id_slot = self.slots[HPO_ID_METRIC]
+    self.age_range_slot = self.slots[AGE_RANGE_METRIC]
+    self._codes = [{} for _ in self.names]
+    self._values = [[] for _ in self.names]
+    self._result_keys = {}
+    self.initial_state = [self.encode(slot, state[name]) for slot, name in enumerate(self.names)]
+    enrollment_status_slot = self.slots.get(ENROLLMENT_STATUS_METRIC)
+    self.full_participant = (enrollment_status_slot,
+                             enrollment_status_slot is not None and
+                             self.encode(enrollment_status_slot,
+                                         EnrollmentStatus.FULL_PARTICIPANT))
+
+  def get_order(self, num_changes):
+    """Returns the order to emit slots in for a state that has changed num_changes times."""
+    if num_changes >= len(self._orders):
+      cycle_length = len(self._orders) - self._cycle_start
+      num_changes = self._cycle_start + (num_changes - self._cycle_start) % cycle_length
+    return self._orders[num_changes]
+
+  def encode(self, slot, value):
+    codes = self._codes[slot]
+    code = codes.get(value)
+    if code is None:
+      code = len(self._values[slot])
+      codes[value] = code
+      self._values[slot].append(value)
+    return code
+
+  def decode(self, slot, code):
+    return self._values[slot][code]
+
+  def result_key(self, hpo_id, participant_type, slot, code):
+    key = (hpo_id, participant_type, slot, code)
+    result_key = self._result_keys.get(key)
+    if result_key is None:
+      result_key = map_result_key(hpo_id, participant_type, self.names[slot],
+                                  self.decode(slot, code))
+      self._result_keys[key] = result_key
+    return result_key
+
+  def update_summary_fields(self, state):
+    view = _ParticipantStateView(self, state)
+    for slot, summary_field in zip(self.summary_slots, self.summary_fields):
+      state[slot] = self.encode(slot, summary_field.compute_func(view))
+
+  def process_metric(self, state, metric):
+    """Returns a new state with the metric applied, or None if it doesn't change anything."""
+    metric_name, value = parse_metric(metric)
+    if metric_name == EHR_CONSENT_ANSWER_METRIC:
+      metric_name = CONSENT_FOR_ELECTRONIC_HEALTH_RECORDS_FIELD
+      if value == CONSENT_PERMISSION_YES_CODE:
+        value = str(QuestionnaireStatus.SUBMITTED)
+      else:
+        value = str(QuestionnaireStatus.SUBMITTED_NO_CONSENT)
+    slot = self.field_slots.get(metric_name)
+    if slot is None:
+      return None
+    code = self.encode(slot, value)
+    if state[slot] == code:
+      return None
+    new_state = list(state)
+    new_state[slot] = code
+    self.update_summary_fields(new_state)
+    return new_state
+
+class _ParticipantStateView(object):
+  """Read-only dict-like view of a participant state, as expected by summary field functions."""
+  def __init__(self, layout, state):
+    self._layout = layout
+    self._state = state
+
+  def get(self, name, default=None):
+    slot = self._layout.slots.get(name)
+    if slot is None:
+      return default
+    return self._layout.decode(slot, self._state[slot])
+
+_PARTICIPANT_STATE_LAYOUT = None
+
+def _get_participant_state_layout():
+  global _PARTICIPANT_STATE_LAYOUT
+  if _PARTICIPANT_STATE_LAYOUT is None:
+    _PARTICIPANT_STATE_LAYOUT = _ParticipantStateLayout(get_config())
+  return _PARTICIPANT_STATE_LAYOUT
 
 def reduce_participant_data_to_hpo_metric_date_deltas(reducer_key, reducer_values, now=None):
   """Input:
@@ -421,11 +597,30 @@ def reduce_participant_data_to_hpo_metric_date_deltas(reducer_key, reducer_value
   increments or decrements of metrics based on this participant.
   """
   #pylint: disable=unused-argument
-  metrics_conf = get_config()
-  metric_fields = get_fieldnames()
-  summary_fields = metrics_conf['summary_fields']
-  last_state = {}
-  last_hpo_id = None
+  last_date = None
+  for result_key, date, delta in _get_participant_deltas(reducer_values, now):
+    if date is not last_date:
+      last_date = date
+      date_str = date.isoformat()
+    yield reduce_result_value(result_key, date_str, delta)
+
+def reduce_participant_data_to_hpo_metric_date_delta_records(reducer_key, reducer_values,
+                                                             now=None):
+  """Like reduce_participant_data_to_hpo_metric_date_deltas, but emits a block of records."""
+  #pylint: disable=unused-argument
+  records = []
+  last_date = None
+  for result_key, date, delta in _get_participant_deltas(reducer_values, now):
+    if date is not last_date:
+      last_date = date
+      day = date.toordinal()
+    records.append((result_key, day, delta))
+  if records:
+    yield offline.metrics_records.make_record_block(records)
+
+def _get_participant_deltas(reducer_values, now):
+  """Yields (hpoId|participant_type|metric, date, delta) for a participant's reducer values."""
+  layout = _get_participant_state_layout()
   dates_and_metrics = []
 
   date_of_birth = None
@@ -442,8 +637,7 @@ def reduce_participant_data_to_hpo_metric_date_deltas(reducer_key, reducer_value
   # Sort the dates and metrics, date first then metric.
   dates_and_metrics = sorted(dates_and_metrics)
 
-  initial_state = {f.name: UNSET for f in metrics_conf['fields']}
-  initial_state[TOTAL_SENTINEL] = 1
+  initial_state = list(layout.initial_state)
   last_hpo_id = UNSET
   # Look for the starting HPO, update the initial state with it, and remove it from
   # the list of date-and-metrics pairs.
@@ -452,65 +646,62 @@ def reduce_participant_data_to_hpo_metric_date_deltas(reducer_key, reducer_value
     metric_name, value = parse_metric(metric)
     if metric_name == HPO_ID_METRIC:
       last_hpo_id = value
-      initial_state[HPO_ID_METRIC] = last_hpo_id
+      initial_state[layout.hpo_id_slot] = layout.encode(layout.hpo_id_slot, last_hpo_id)
       break
 
   # If we know the participant's date of birth, and a starting age range
   # and entries for when it changes over time.
   if date_of_birth:
-    initial_state[AGE_RANGE_METRIC] = _add_age_range_metrics(dates_and_metrics, date_of_birth, now)
+    initial_state[layout.age_range_slot] = layout.encode(
+        layout.age_range_slot, _add_age_range_metrics(dates_and_metrics, date_of_birth, now))
     # Re-sort with the new entries for age range changes.
     dates_and_metrics = sorted(dates_and_metrics)
 
   # Run summary functions on the initial state.
-  _update_summary_fields(summary_fields, initial_state)
+  layout.update_summary_fields(initial_state)
 
   # Emit 1 values for the initial state before any metrics change.
-  initial_date = dates_and_metrics[0][0]
-  for k, v in initial_state.iteritems():
-    yield reduce_result_value(map_result_key(last_hpo_id, _REGISTERED_PARTICIPANT, k, v),
-                              initial_date.date().isoformat(), '1')
+  initial_date = dates_and_metrics[0][0].date()
+  for slot in layout.get_order(0):
+    yield (layout.result_key(last_hpo_id, _REGISTERED_PARTICIPANT, slot, initial_state[slot]),
+           initial_date, 1)
 
   last_state = initial_state
+  num_changes = 0
   full_participant = False
+  enrollment_status_slot, full_participant_code = layout.full_participant
   # Loop through all the metric changes for the participant.
   for dt, metric in dates_and_metrics:
-    date = dt.date()
-    new_state = copy.deepcopy(last_state)
-
-    if not _process_metric(metric_fields, summary_fields, metric, new_state):
+    new_state = layout.process_metric(last_state, metric)
+    if new_state is None:
       continue  # No changes so there's nothing to do.
-    hpo_id = new_state.get(HPO_ID_METRIC)
+    hpo_id = layout.decode(layout.hpo_id_slot, new_state[layout.hpo_id_slot])
     hpo_change = last_hpo_id != hpo_id
+    date = dt.date()
+    num_changes += 1
+    order = layout.get_order(num_changes)
 
     last_full_participant = full_participant
-    for k, v in new_state.iteritems():
+    for slot in order:
       # Output a delta for this field if it is either the first value we have,
       # or if it has changed. In the case that one of the facets has changed,
       # we need deltas for all fields.
-      old_val = last_state and last_state.get(k, None)
+      v = new_state[slot]
+      old_val = last_state[slot]
       if hpo_change or v != old_val:
-        formatted_date = date.isoformat()
-        if (k == ENROLLMENT_STATUS_METRIC and v == EnrollmentStatus.FULL_PARTICIPANT and
-            not full_participant):
+        if slot == enrollment_status_slot and v == full_participant_code and not full_participant:
           full_participant = True
           # Emit 1 values for the current state for all fields for the full participant type.
-          for k2, v2 in new_state.iteritems():
-            yield reduce_result_value(map_result_key(hpo_id, _FULL_PARTICIPANT, k2, v2),
-                                      formatted_date, '1')
-        yield reduce_result_value(map_result_key(hpo_id, _REGISTERED_PARTICIPANT, k, v),
-                                  formatted_date, '1')
+          for slot2 in order:
+            yield (layout.result_key(hpo_id, _FULL_PARTICIPANT, slot2, new_state[slot2]),
+                   date, 1)
+        yield layout.result_key(hpo_id, _REGISTERED_PARTICIPANT, slot, v), date, 1
         if last_full_participant:
-          yield reduce_result_value(map_result_key(hpo_id, _FULL_PARTICIPANT, k, v), formatted_date,
-                                    '1')
-        if last_state:
-          # If the value changed, output -1 delta for the old value.
-          yield reduce_result_value(map_result_key(last_hpo_id, _REGISTERED_PARTICIPANT,
-                                                   k, old_val),
-                                    formatted_date, '-1')
-          if last_full_participant:
-            yield reduce_result_value(map_result_key(last_hpo_id, _FULL_PARTICIPANT, k, old_val),
-                                      formatted_date, '-1')
+          yield layout.result_key(hpo_id, _FULL_PARTICIPANT, slot, v), date, 1
+        # If the value changed, output -1 delta for the old value.
+        yield layout.result_key(last_hpo_id, _REGISTERED_PARTICIPANT, slot, old_val), date, -1
+        if last_full_participant:
+          yield layout.result_key(last_hpo_id, _FULL_PARTICIPANT, slot, old_val), date, -1
 
     last_state = new_state
     last_hpo_id = hpo_id
@@ -530,6 +721,43 @@ def map_hpo_metric_date_deltas_to_hpo_metric_key(row_buffer):
     # Yield HPO ID|participant_type|metric -> date|delta
     yield (make_tuple(hpo_id, participant_type, metric_key), make_tuple(date_str, delta))
 
+def map_hpo_metric_date_delta_records_to_hpo_metric_key(row_buffer):
+  """Like map_hpo_metric_date_deltas_to_hpo_metric_key, for blocks of records; values are
+  encoded with metrics_records.encode_day_value."""
+  encoded_values = {}
+  for keys, records in offline.metrics_records.iter_record_blocks(row_buffer):
+    for key_index, day, delta in records:
+      encoded_value = encoded_values.get((day, delta))
+      if encoded_value is None:
+        encoded_value = offline.metrics_records.encode_day_value(day, delta)
+        encoded_values[(day, delta)] = encoded_value
+      yield (keys[key_index], encoded_value)
+
+def map_hpo_metric_date_deltas_to_hpo_and_total_metric_keys(row_buffer):
+  """Like map_hpo_metric_date_deltas_to_hpo_metric_key, but also emits each delta for the
+  *|participant_type|metric key, for cross-HPO counts when writing bucket ranges."""
+  for result in _add_total_metric_keys(map_hpo_metric_date_deltas_to_hpo_metric_key(row_buffer)):
+    yield result
+
+def map_hpo_metric_date_delta_records_to_hpo_and_total_metric_keys(row_buffer):
+  """Like map_hpo_metric_date_deltas_to_hpo_and_total_metric_keys, for blocks of records."""
+  for result in _add_total_metric_keys(
+      map_hpo_metric_date_delta_records_to_hpo_metric_key(row_buffer)):
+    yield result
+
+def _add_total_metric_keys(results):
+  # Cross-HPO counts come from the summed deltas rather than the per-HPO counts, so a '*' bucket
+  # can leave out a metric with a count of 0 that a daily '*' bucket has (when one HPO's count is
+  # 0 between the dates it changes on, while the total count has already dropped to 0).
+  total_keys = {}
+  for key, value in results:
+    yield (key, value)
+    total_key = total_keys.get(key)
+    if total_key is None:
+      total_key = '*' + key[key.index('|'):]
+      total_keys[key] = total_key
+    yield (total_key, value)
+
 def combine_hpo_metric_date_deltas(key, new_values, old_values):  # pylint: disable=unused-argument
   """ Combines deltas generated for users into a single delta per date
   Args:
@@ -545,6 +773,15 @@ def combine_hpo_metric_date_deltas(key, new_values, old_values):  # pylint: disa
   for date, delta in delta_map.iteritems():
     yield make_tuple(date, str(delta))
 
+def combine_hpo_metric_date_delta_records(key, new_values, old_values):
+  # pylint: disable=unused-argument
+  """Like combine_hpo_metric_date_deltas, for values encoded with encode_day_value."""
+  delta_map = {}
+  _sum_day_deltas(old_values, delta_map)
+  _sum_day_deltas(new_values, delta_map)
+  for day, delta in delta_map.iteritems():
+    yield offline.metrics_records.encode_day_value(day, delta)
+
 def reduce_hpo_metric_date_deltas_to_all_date_counts(reducer_key, reducer_values, now=None):
   """Emits hpoId|participant_type|metric|date|count for each date until today.
   Args:
@@ -552,34 +789,86 @@ def reduce_hpo_metric_date_deltas_to_all_date_counts(reducer_key, reducer_values
     reducer_values: list of date|delta strings
     now: use to set the clock for testing
   """
+  for day, count in _get_all_date_counts(_get_day_deltas(reducer_values), now):
+    yield reduce_result_value(reducer_key, datetime.fromordinal(day).date().isoformat(), count)
+
+def reduce_hpo_metric_date_deltas_to_count_changes(reducer_key, reducer_values, now=None):
+  """Like reduce_hpo_metric_date_deltas_to_all_date_counts, but only emits counts for the dates
+  they change on, with a count of _NO_COUNT from the date a metric is left out of buckets."""
+  for day, count in _get_count_changes(_get_day_deltas(reducer_values), now):
+    yield reduce_result_value(reducer_key, datetime.fromordinal(day).date().isoformat(), count)
+
+def reduce_hpo_metric_date_delta_records_to_all_date_count_records(reducer_key, reducer_values,
+                                                                   now=None):
+  """Like reduce_hpo_metric_date_deltas_to_all_date_counts, but for encoded day|delta values;
+  emits a block of records with the counts."""
   delta_map = {}
-  sum_deltas(reducer_values, delta_map)
-  # Walk over the deltas by date
-  last_date = None
+  _sum_day_deltas(reducer_values, delta_map)
+  records = [(reducer_key, day, count) for day, count in _get_all_date_counts(delta_map, now)]
+  if records:
+    yield offline.metrics_records.make_record_block(records)
+
+def reduce_hpo_metric_date_delta_records_to_count_change_records(reducer_key, reducer_values,
+                                                                 now=None):
+  """Like reduce_hpo_metric_date_deltas_to_count_changes, for encoded day|delta values; emits a
+  block of records with the count changes."""
+  delta_map = {}
+  _sum_day_deltas(reducer_values, delta_map)
+  records = [(reducer_key, day, count) for day, count in _get_count_changes(delta_map, now)]
+  if records:
+    yield offline.metrics_records.make_record_block(records)
+
+def _get_day_deltas(values):
+  """Returns day -> delta for date|delta strings."""
+  delta_map = {}
+  sum_deltas(values, delta_map)
+  return {datetime.strptime(date_str, DATE_FORMAT).toordinal(): delta
+          for date_str, delta in delta_map.iteritems()}
+
+def _get_count_changes(day_deltas, now):
+  """Yields (day, count) for the days until today that the count in daily buckets (see
+  _get_all_date_counts) changes on, given a dict of day -> delta. A count of _NO_COUNT means the
+  metric is left out of buckets from that day."""
+  now = now or context.get().mapreduce_spec.mapper.params.get('now')
+  today = now.date().toordinal()
+  days = [day for day in sorted(day_deltas) if day <= today]
   count = 0
-  one_day = timedelta(days=1)
+  last_count = _NO_COUNT
+  for i, day in enumerate(days):
+    count += day_deltas[day]
+    new_count = count if count > 0 else _NO_COUNT
+    if new_count != last_count:
+      yield day, new_count
+      last_count = new_count
+    if last_count == _NO_COUNT and i + 1 < len(days) and day + 1 < days[i + 1]:
+      # Dates between the days the count changes on have a count of 0.
+      yield day + 1, 0
+      last_count = 0
+
+def _get_all_date_counts(day_deltas, now):
+  """Yields (day, count) for each day until today, given a dict of day -> delta (days being date
+  ordinals)."""
   now = now or context.get().mapreduce_spec.mapper.params.get('now')
-  for date_str, delta in sorted(delta_map.items()):
-    date = datetime.strptime(date_str, DATE_FORMAT).date()
-    if date > now.date():
+  today = now.date().toordinal()
+  # Walk over the deltas by date
+  last_day = None
+  count = 0
+  for day, delta in sorted(day_deltas.items()):
+    if day > today:
       # Ignore any data after the current run date.
       break
     # Yield results for all the dates in between
-    if last_date:
-      middle_date = last_date + one_day
-      while middle_date < date:
-        yield reduce_result_value(reducer_key, middle_date.isoformat(), count)
-        middle_date = middle_date + one_day
+    if last_day is not None:
+      for middle_day in xrange(last_day + 1, day):
+        yield middle_day, max(count, 0)
     count += delta
     if count > 0:
-      yield reduce_result_value(reducer_key, date_str, count)
-    last_date = date
+      yield day, count
+    last_day = day
   # Yield results up until today.
-  if count > 0 and last_date:
-    last_date = last_date + one_day
-    while last_date <= now.date():
-      yield reduce_result_value(reducer_key, last_date.isoformat(), count)
-      last_date = last_date + one_day
+  if count > 0 and last_day is not None:
+    for next_day in xrange(last_day + 1, today + 1):
+      yield next_day, count
 
 def reduce_result_value(reducer_key, date_str, count):
   return reducer_key + '|' + date_str + '|' + str(count) + '\n'
@@ -601,37 +890,152 @@ def map_hpo_metric_date_counts_to_hpo_date_key(row_buffer):
     # Yield '*' + date -> metric + count (for all HPO counts)
     yield (make_tuple('*', date_str), make_tuple(participant_type, metric_key, count))
 
+def map_hpo_metric_date_count_records_to_hpo_date_key(row_buffer):
+  """Like map_hpo_metric_date_counts_to_hpo_date_key, for blocks of records."""
+  date_strs = {}
+  for keys, records in offline.metrics_records.iter_record_blocks(row_buffer):
+    hpo_ids_and_metric_keys = [key.split('|', 1) for key in keys]
+    for key_index, day, count in records:
+      hpo_id, metric_key = hpo_ids_and_metric_keys[key_index]
+      date_str = date_strs.get(day)
+      if date_str is None:
+        date_str = datetime.fromordinal(day).date().isoformat()
+        date_strs[day] = date_str
+      metric_count = make_tuple(metric_key, str(count))
+      yield (make_tuple(hpo_id, date_str), metric_count)
+      yield (make_tuple('*', date_str), metric_count)
+
+def map_hpo_metric_date_counts_to_hpo_key(row_buffer):
+  """Emits (hpoId, date|participant_type|metric|count) pairs for reducing into bucket ranges.
+  Args:
+     row_buffer: buffer containing hpoId|participant_type|metric|date|count lines, for the dates
+       counts change on (including '*' hpoIds for cross-HPO counts)
+  """
+  reader = csv.reader(row_buffer, delimiter='|')
+  for hpo_id, participant_type, metric_key, date_str, count in reader:
+    yield (hpo_id, make_tuple(date_str, participant_type, metric_key, count))
+
+def map_hpo_metric_date_count_records_to_hpo_key(row_buffer):
+  """Like map_hpo_metric_date_counts_to_hpo_key, for blocks of records."""
+  date_strs = {}
+  for keys, records in offline.metrics_records.iter_record_blocks(row_buffer):
+    hpo_ids_and_metric_keys = [key.split('|', 1) for key in keys]
+    for key_index, day, count in records:
+      hpo_id, metric_key = hpo_ids_and_metric_keys[key_index]
+      date_str = date_strs.get(day)
+      if date_str is None:
+        date_str = datetime.fromordinal(day).date().isoformat()
+        date_strs[day] = date_str
+      yield (hpo_id, make_tuple(date_str, metric_key, str(count)))
+
+def reduce_hpo_metric_count_changes_to_database_bucket_ranges(reducer_key, reducer_values,
+                                                              now=None, version_id=None):
+  """Writes metrics buckets for an hpoId covering the ranges of dates its counts stay the same for
+  to SQL.
+  Args:
+     reducer_key: hpoId ('*' for cross-HPO counts)
+     reducer_values: list of date|participant_type|metric|count strings
+  """
+  version_id = version_id or context.get().mapreduce_spec.mapper.params.get('version_id')
+  buckets = list(make_metrics_bucket_ranges(reducer_key, reducer_values, now, version_id))
+  dao = MetricsBucketDao()
+  # As in reduce_hpo_date_metric_counts_to_database_buckets, upsert so that retries replace any
+  # buckets written before.
+  def upsert(session):
+    for bucket in buckets:
+      dao.upsert_with_session(session, bucket)
+  dao._database.autoretry(upsert)
+
+def make_metrics_bucket_ranges(hpo_id, count_changes, now, version_id):
+  """Yields MetricsBuckets for the given version covering the ranges of dates that the counts for
+  an hpoId stay the same for, until today.
+  Args:
+     hpo_id: hpoId ('*' for cross-HPO counts)
+     count_changes: date|participant_type|metric|count strings for the dates counts change on; a
+       count of _NO_COUNT means the metric is left out of buckets from that date.
+  """
+  now = now or context.get().mapreduce_spec.mapper.params.get('now')
+  changes_by_date = collections.defaultdict(list)
+  for count_change in count_changes:
+    date_str, metric_count = count_change.split('|', 1)
+    changes_by_date[date_str].append(metric_count)
+  # participant_type|metric -> participant_type|metric|count for the current range
+  metric_counts = {}
+  bucket = None
+  bucket_metrics = None
+  for date_str in sorted(changes_by_date):
+    for metric_count in changes_by_date[date_str]:
+      metric, count = metric_count.rsplit('|', 1)
+      if int(count) == _NO_COUNT:
+        metric_counts.pop(metric, None)
+      else:
+        metric_counts[metric] = metric_count
+    next_bucket = None
+    next_bucket_metrics = None
+    if metric_counts:
+      next_bucket = make_metrics_bucket(make_tuple(hpo_id, date_str), metric_counts.values(),
+                                        version_id)
+      # Changes for different participant types can leave the bucket's counts the same.
+      next_bucket_metrics = json.loads(next_bucket.metrics)
+      if bucket and next_bucket_metrics == bucket_metrics:
+        continue
+    if bucket:
+      bucket.endDate = datetime.strptime(date_str, DATE_FORMAT).date() - timedelta(days=1)
+      yield bucket
+    bucket = next_bucket
+    bucket_metrics = next_bucket_metrics
+  if bucket:
+    bucket.endDate = now.date()
+    yield bucket
+
 def reduce_hpo_date_metric_counts_to_database_buckets(reducer_key, reducer_values, version_id=None):
   """Emits a metrics bucket with counts for metrics for a given hpoId + date to SQL
   Args:
      reducer_key: hpoId|date ('*' for hpoId for cross-HPO counts)
      reducer_values: list of participant_type|metric|count strings
   """
+  version_id = version_id or context.get().mapreduce_spec.mapper.params.get('version_id')
+  bucket = make_metrics_bucket(reducer_key, reducer_values, version_id)
+  dao = MetricsBucketDao()
+  # Use upsert here; when reducer shards retry, we will just replace any metrics bucket that was
+  # written before, rather than failing.
+  def upsert(session):
+    dao.upsert_with_session(session, bucket)
+  dao._database.autoretry(upsert)
+
+def make_metrics_bucket(hpo_date_key, metric_counts, version_id):
+  """Returns a MetricsBucket for the given version with the counts for a given hpoId + date.
+  Args:
+     hpo_date_key: hpoId|date ('*' for hpoId for cross-HPO counts)
+     metric_counts: list of participant_type|metric|count strings
+  """
   metrics_dict = collections.defaultdict(lambda: 0)
-  (hpo_id, date_str) = parse_tuple(reducer_key)
+  (hpo_id, date_str) = parse_tuple(hpo_date_key)
   if hpo_id == '*':
     hpo_id = ''
   date = datetime.strptime(date_str, DATE_FORMAT)
-  for reducer_value in reducer_values:
-    (participant_type, metric_key, count) = parse_tuple(reducer_value)
+  for metric_count in metric_counts:
+    (participant_type, metric_key, count) = parse_tuple(metric_count)
     if metric_key == PARTICIPANT_KIND:
       if participant_type == _REGISTERED_PARTICIPANT:
         metrics_dict[metric_key] += int(count)
     else:
       kind = FULL_PARTICIPANT_KIND if participant_type == _FULL_PARTICIPANT else PARTICIPANT_KIND
       metrics_dict['%s.%s' % (kind, metric_key)] += int(count)
-
-  version_id = version_id or context.get().mapreduce_spec.mapper.params.get('version_id')
-  bucket = MetricsBucket(metricsVersionId=version_id,
-                         date=date,
-                         hpoId=hpo_id,
-                         metrics=json.dumps(metrics_dict))
-  dao = MetricsBucketDao()
-  # Use upsert here; when reducer shards retry, we will just replace any metrics bucket that was
-  # written before, rather than failing.
-  def upsert(session):
-    dao.upsert_with_session(session, bucket)
-  dao._database.autoretry(upsert)
+  return MetricsBucket(metricsVersionId=version_id,
+                       date=date,
+                       hpoId=hpo_id,
+                       metrics=json.dumps(metrics_dict))
+
+def parse_metrics_bucket_counts(metrics):
+  """Returns the (participant_type, metric, count) tuples counted in a bucket's metrics dict."""
+  for metric_key, count in metrics.iteritems():
+    if metric_key == PARTICIPANT_KIND:
+      yield (_REGISTERED_PARTICIPANT, metric_key, count)
+    else:
+      kind, metric = metric_key.split('.', 1)
+      yield (_FULL_PARTICIPANT if kind == FULL_PARTICIPANT_KIND else _REGISTERED_PARTICIPANT,
+             metric, count)
 
 def parse_metric(metric):
   return metric.split('.')
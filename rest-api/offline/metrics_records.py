@@ -0,0 +1,260 @@
+"""Compact binary records passed between the stages of the metrics pipeline.
+
+By default the metrics pipeline writes hpoId|participant_type|metric|date|delta text lines between
+its MapReduces (see metrics_pipeline.py). With the "records" intermediate format, the same data is
+written as length-prefixed blocks of records instead; each reducer call writes one block.
+
+A block starts with a table of the keys (hpoId|participant_type|metric) used in it. Key parts are
+referred to by index: metric names defined in code (see get_interned_metrics) have the same index
+in every block, and any other strings (HPO IDs, answer codes...) are listed at the start of the
+block. Each record then holds a key index, a date as a day number (datetime.date.toordinal(),
+stored as the difference from the previous record's day) and a delta or count. All integers are
+varints; signed ones are zigzag-encoded, so the +1 / -1 deltas from the first MapReduce and the
+day-to-day steps of the second one take a byte each.
+
+  block := varint(len(body)) body
+  body := varint(num_strings) (varint(len(string)) string)*
+          varint(num_keys) (varint(hpo_ref) varint(participant_type_ref) varint(metric_ref))*
+          (varint(key_index) zigzag(day - previous_day) zigzag(value))*
+"""
+
+import participant_enums
+
+from census_regions import census_regions
+from code_constants import BASE_VALUES
+from field_mappings import QUESTIONNAIRE_MODULE_FIELD_NAMES
+from offline.metrics_config import get_config, PARTICIPANT_KIND, AGE_RANGE_METRIC
+from offline.metrics_config import CENSUS_REGION_METRIC, PHYSICAL_MEASUREMENTS_METRIC
+from offline.metrics_config import BIOSPECIMEN_METRIC, BIOSPECIMEN_SAMPLES_METRIC, RACE_METRIC
+from offline.metrics_config import SAMPLES_TO_ISOLATE_DNA_METRIC, BIOSPECIMEN_SUMMARY_METRIC
+from offline.metrics_config import CONSENT_FOR_STUDY_ENROLLMENT_AND_EHR_METRIC
+from offline.metrics_config import NUM_COMPLETED_BASELINE_PPI_MODULES_METRIC
+from offline.metrics_config import ENROLLMENT_STATUS_METRIC, SPECIMEN_COLLECTED_VALUE
+from offline.metrics_config import SAMPLES_ARRIVED_VALUE
+
+_READ_SIZE = 1024 * 1024
+_MAX_VARINT_LENGTH = 10
+
+
+def get_interned_metrics():
+  """Returns the metric names that are referred to by index in every block.
+
+  Only values defined in code are included (not HPO IDs or answer codes from the database, or
+  values that depend on config), so that all the tasks of a pipeline run agree on the list.
+  """
+  conf = get_config()
+  enum_values = lambda enum: [str(value) for value in enum]
+  values = {
+      AGE_RANGE_METRIC: participant_enums.AGE_BUCKETS,
+      CENSUS_REGION_METRIC: census_regions.values(),
+      PHYSICAL_MEASUREMENTS_METRIC: enum_values(participant_enums.PhysicalMeasurementsStatus),
+      BIOSPECIMEN_METRIC: [SPECIMEN_COLLECTED_VALUE],
+      BIOSPECIMEN_SAMPLES_METRIC: [SAMPLES_ARRIVED_VALUE],
+      RACE_METRIC: enum_values(participant_enums.Race),
+      SAMPLES_TO_ISOLATE_DNA_METRIC: enum_values(participant_enums.SampleStatus),
+      BIOSPECIMEN_SUMMARY_METRIC: [SPECIMEN_COLLECTED_VALUE, SAMPLES_ARRIVED_VALUE],
+      CONSENT_FOR_STUDY_ENROLLMENT_AND_EHR_METRIC:
+          enum_values(participant_enums.QuestionnaireStatus),
+      NUM_COMPLETED_BASELINE_PPI_MODULES_METRIC:
+          [str(i) for i in range(len(QUESTIONNAIRE_MODULE_FIELD_NAMES) + 1)],
+      ENROLLMENT_STATUS_METRIC: enum_values(participant_enums.EnrollmentStatus),
+  }
+  for field_name in QUESTIONNAIRE_MODULE_FIELD_NAMES:
+    values[field_name] = enum_values(participant_enums.QuestionnaireStatus)
+  metrics = set([PARTICIPANT_KIND])
+  for field in conf['fields'] + conf['summary_fields']:
+    for value in BASE_VALUES + values.get(field.name, []):
+      metrics.add('%s.%s' % (field.name, value))
+  return sorted(metrics)
+
+_INTERNED_STRINGS = None
+_INTERNED_REFS = None
+
+def _get_interned_strings():
+  global _INTERNED_STRINGS, _INTERNED_REFS
+  if _INTERNED_STRINGS is None:
+    _INTERNED_STRINGS = get_interned_metrics()
+    _INTERNED_REFS = {s: ref for ref, s in enumerate(_INTERNED_STRINGS)}
+  return _INTERNED_STRINGS, _INTERNED_REFS
+
+
+def _append_varint(buf, n):
+  while n >= 0x80:
+    buf.append((n & 0x7f) | 0x80)
+    n >>= 7
+  buf.append(n)
+
+def _read_varint(buf, pos):
+  result = 0
+  shift = 0
+  while True:
+    b = buf[pos]
+    pos += 1
+    result |= (b & 0x7f) << shift
+    if b < 0x80:
+      return result, pos
+    shift += 7
+
+def _zigzag(n):
+  return (n << 1) ^ (n >> 63)
+
+def _unzigzag(n):
+  return (n >> 1) ^ -(n & 1)
+
+
+def make_frame(data):
+  """Returns data prefixed with its length, for reading back with iter_frames."""
+  buf = bytearray()
+  _append_varint(buf, len(data))
+  return str(buf) + data
+
+def iter_frames(stream):
+  """Yields the strings written to a file-like object by make_frame."""
+  data = ''
+  pos = 0
+  eof = False
+  while True:
+    if len(data) - pos < _MAX_VARINT_LENGTH and not eof:
+      chunk = stream.read(_READ_SIZE)
+      eof = not chunk
+      data = data[pos:] + chunk
+      pos = 0
+      continue
+    if pos == len(data):
+      return
+    # The length prefix was read in full above, as varints are at most _MAX_VARINT_LENGTH bytes.
+    length, length_size = _read_varint(bytearray(data[pos:pos + _MAX_VARINT_LENGTH]), 0)
+    pos += length_size
+    while len(data) - pos < length:
+      chunk = stream.read(max(_READ_SIZE, length))
+      if not chunk:
+        raise ValueError('Truncated metrics record frame.')
+      data = data[pos:] + chunk
+      pos = 0
+    yield data[pos:pos + length]
+    pos += length
+
+
+def _get_key_parts(key):
+  """Returns the parts of a key: encoded indexes (bytearrays) for interned strings, and strings
+  for the others."""
+  key_parts = _KEY_PARTS.get(key)
+  if key_parts is None:
+    _, interned_refs = _get_interned_strings()
+    key_parts = []
+    for part in key.split('|', 2):
+      ref = interned_refs.get(part)
+      if ref is None:
+        key_parts.append(part)
+      else:
+        encoded_ref = bytearray()
+        _append_varint(encoded_ref, ref)
+        key_parts.append(encoded_ref)
+    _KEY_PARTS[key] = key_parts
+  return key_parts
+
+_KEY_PARTS = {}
+
+def make_record_block(records):
+  """Returns a block (frame) with the given (key, day, value) records.
+
+  Keys are hpoId|participant_type|metric strings; days are date ordinals; values are integers.
+  """
+  num_interned = len(_get_interned_strings()[0])
+  strings = []
+  string_refs = {}
+  key_indexes = {}
+  key_buf = bytearray()
+  record_buf = bytearray()
+  last_day = 0
+  for key, day, value in records:
+    key_index = key_indexes.get(key)
+    if key_index is None:
+      key_index = len(key_indexes)
+      key_indexes[key] = key_index
+      for part in _get_key_parts(key):
+        if isinstance(part, bytearray):
+          key_buf.extend(part)
+        else:
+          ref = string_refs.get(part)
+          if ref is None:
+            ref = num_interned + len(strings)
+            string_refs[part] = ref
+            strings.append(part)
+          _append_varint(key_buf, ref)
+    day_delta = day - last_day
+    day_delta = (day_delta << 1) ^ (day_delta >> 63)
+    value = (value << 1) ^ (value >> 63)
+    if key_index < 0x80 and day_delta < 0x80 and value < 0x80:
+      record_buf.extend((key_index, day_delta, value))
+    else:
+      _append_varint(record_buf, key_index)
+      _append_varint(record_buf, day_delta)
+      _append_varint(record_buf, value)
+    last_day = day
+  body = bytearray()
+  _append_varint(body, len(strings))
+  for string in strings:
+    _append_varint(body, len(string))
+    body.extend(string)
+  _append_varint(body, len(key_indexes))
+  body.extend(key_buf)
+  body.extend(record_buf)
+  return make_frame(str(body))
+
+def iter_record_blocks(stream):
+  """Yields (keys, records) for each block in a file-like object written by make_record_block.
+
+  keys is a list of hpoId|participant_type|metric strings, and records a list of
+  (key index, day, value) tuples.
+  """
+  interned_strings, _ = _get_interned_strings()
+  num_interned = len(interned_strings)
+  for block in iter_frames(stream):
+    buf = bytearray(block)
+    num_strings, pos = _read_varint(buf, 0)
+    strings = []
+    for _ in xrange(num_strings):
+      length, pos = _read_varint(buf, pos)
+      strings.append(block[pos:pos + length])
+      pos += length
+    num_keys, pos = _read_varint(buf, pos)
+    keys = []
+    for _ in xrange(num_keys):
+      parts = []
+      for _ in xrange(3):
+        ref, pos = _read_varint(buf, pos)
+        parts.append(interned_strings[ref] if ref < num_interned else strings[ref - num_interned])
+      keys.append('|'.join(parts))
+    records = []
+    day = 0
+    end = len(buf)
+    while pos < end:
+      # Inline the common case of one-byte varints for all three fields.
+      key_index = buf[pos]
+      day_delta = buf[pos + 1]
+      value = buf[pos + 2]
+      if key_index < 0x80 and day_delta < 0x80 and value < 0x80:
+        pos += 3
+      else:
+        key_index, pos = _read_varint(buf, pos)
+        day_delta, pos = _read_varint(buf, pos)
+        value, pos = _read_varint(buf, pos)
+      day += (day_delta >> 1) ^ -(day_delta & 1)
+      records.append((key_index, day, (value >> 1) ^ -(value & 1)))
+    yield keys, records
+
+
+def encode_day_value(day, value):
+  """Returns a (day, value) pair as a string, for use as an intermediate MapReduce value."""
+  buf = bytearray()
+  _append_varint(buf, day)
+  _append_varint(buf, _zigzag(value))
+  return str(buf)
+
+def decode_day_value(data):
+  """Returns the (day, value) pair in a string returned by encode_day_value."""
+  buf = bytearray(data)
+  day, pos = _read_varint(buf, 0)
+  value, _ = _read_varint(buf, pos)
+  return day, _unzigzag(value)
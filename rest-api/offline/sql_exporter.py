@@ -1,6 +1,10 @@
+import Queue
 import contextlib
 import csv
+import gzip
 import logging
+import sys
+import threading
 
 from dao import database_factory
 from cloudstorage import cloudstorage_api
@@ -9,7 +13,16 @@ from unicode_csv import UnicodeWriter
 
 # Delimiter used in CSVs written (use this when reading them back out).
 DELIMITER = ','
-_BATCH_SIZE = 1000
+# Rows fetched from the cursor at a time.
+DEFAULT_FETCH_SIZE = 1000
+# Batches of fetched rows that may wait to be written while the next batch is fetched.
+DEFAULT_MAX_PENDING_BATCHES = 2
+# Lower than gzip's default of 9, which is much slower for little gain on CSVs.
+_GZIP_COMPRESS_LEVEL = 6
+# How often a thread blocked on a full or empty queue checks whether the other thread has stopped.
+_QUEUE_POLL_SECONDS = 1
+# Queued after the last batch of rows.
+_END_OF_ROWS = object()
 
 class SqlExportFileWriter(object):
   """Writes rows to a CSV file, optionally filtering on a predicate."""
@@ -42,11 +55,80 @@ class CompositeSqlExportWriter(object):
     for writer in self._writers:
       writer.write_rows(results)
 
+class _PipelinedWriter(object):
+  """Transforms and writes batches of rows in a background thread, so that the next batch can be
+  fetched from the database while the last one is encoded and uploaded."""
+
+  def __init__(self, writer, transformf, max_pending_batches):
+    self._writer = writer
+    self._transformf = transformf
+    self._queue = Queue.Queue(max_pending_batches)
+    self._aborted = False
+    self._exc_info = None
+    self._thread = threading.Thread(target=self._run)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def write_rows(self, results):
+    self._put(results)
+    self._raise_if_failed()
+
+  def close(self):
+    """Waits for queued rows to be written, raising any error from writing them."""
+    self._put(_END_OF_ROWS)
+    self._thread.join()
+    self._raise_if_failed()
+
+  def abort(self):
+    """Stops writing, discarding queued rows."""
+    self._aborted = True
+    self._put(_END_OF_ROWS)
+    self._thread.join()
+
+  def _put(self, item):
+    # If writing failed, the thread stops taking rows from the queue.
+    while self._thread.is_alive():
+      try:
+        self._queue.put(item, timeout=_QUEUE_POLL_SECONDS)
+        return
+      except Queue.Full:
+        pass
+
+  def _raise_if_failed(self):
+    if self._exc_info:
+      raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+
+  def _run(self):
+    try:
+      while True:
+        results = self._queue.get()
+        if results is _END_OF_ROWS or self._aborted:
+          return
+        if self._transformf:
+          results = [self._transformf(r) for r in results]
+        self._writer.write_rows(results)
+    except Exception:  # pylint: disable=broad-except
+      self._exc_info = sys.exc_info()
+
+
 class SqlExporter(object):
-  """Executes a SQL query, fetches results in batches, and writes output to a CSV in GCS."""
-  def __init__(self, bucket_name, use_unicode=False):
+  """Executes a SQL query, fetches results in batches, and writes output to a CSV in GCS.
+
+  Args:
+    bucket_name: GCS bucket to write to.
+    use_unicode: whether to write CSVs with UnicodeWriter (for Unicode values).
+    compress: whether to gzip the files written (callers should name them .csv.gz).
+    fetch_size: the number of rows fetched from the cursor at a time.
+    max_pending_batches: how many fetched batches may wait to be written while the next is fetched
+      (by a thread that writes them); 0 fetches and writes batches in turn, in one thread.
+  """
+  def __init__(self, bucket_name, use_unicode=False, compress=False,
+               fetch_size=DEFAULT_FETCH_SIZE, max_pending_batches=DEFAULT_MAX_PENDING_BATCHES):
     self._bucket_name = bucket_name
     self._use_unicode = use_unicode
+    self._compress = compress
+    self._fetch_size = fetch_size
+    self._max_pending_batches = max_pending_batches
 
   def run_export(self, file_name, sql, query_params=None, transformf=None):
     with self.open_writer(file_name) as writer:
@@ -65,22 +147,41 @@ class SqlExporter(object):
     cursor = session.execute(text(sql), params=query_params)
     try:
       writer.write_header(cursor.keys())
-      results = cursor.fetchmany(_BATCH_SIZE)
+      if self._max_pending_batches:
+        self._write_pipelined(writer, cursor, transformf)
+        return
+      results = cursor.fetchmany(self._fetch_size)
       while results:
         if transformf:
           # Note: transformf accepts an iterable and returns an iterable, the output of this call
           # may no longer be a row proxy after this point.
           results = [transformf(r) for r in results]
         writer.write_rows(results)
-        results = cursor.fetchmany(_BATCH_SIZE)
+        results = cursor.fetchmany(self._fetch_size)
     finally:
       cursor.close()
 
+  def _write_pipelined(self, writer, cursor, transformf):
+    pipelined_writer = _PipelinedWriter(writer, transformf, self._max_pending_batches)
+    try:
+      results = cursor.fetchmany(self._fetch_size)
+      while results:
+        pipelined_writer.write_rows(results)
+        results = cursor.fetchmany(self._fetch_size)
+    except:
+      pipelined_writer.abort()
+      raise
+    pipelined_writer.close()
+
   @contextlib.contextmanager
   def open_writer(self, file_name, predicate=None):
     gcs_path = '/%s/%s' % (self._bucket_name, file_name)
     logging.info('Exporting data to %s...', gcs_path)
     with cloudstorage_api.open(gcs_path, mode='w') as dest:
-      writer = SqlExportFileWriter(dest, predicate, use_unicode=self._use_unicode)
-      yield writer
+      if self._compress:
+        with contextlib.closing(gzip.GzipFile(fileobj=dest, mode='wb',
+                                              compresslevel=_GZIP_COMPRESS_LEVEL)) as gzip_dest:
+          yield SqlExportFileWriter(gzip_dest, predicate, use_unicode=self._use_unicode)
+      else:
+        yield SqlExportFileWriter(dest, predicate, use_unicode=self._use_unicode)
     logging.info('Export to %s complete.', gcs_path)
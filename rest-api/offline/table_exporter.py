@@ -1,16 +1,48 @@
+import datetime
 import hashlib
+import json
+import logging
 import random
 import re
 import struct
 
+import clock
+import sql_instrumentation
+from cloudstorage import cloudstorage_api
 from dao.database_factory import get_database
-from google.appengine.api import app_identity
+from dao.database_utils import format_datetime, parse_datetime
+from google.appengine.api import app_identity, taskqueue
 from google.appengine.ext import deferred
 from offline.sql_exporter import SqlExporter
+from sqlalchemy import DateTime, inspect, Integer, text
 from werkzeug.exceptions import BadRequest
 
 _TABLE_PATTERN = re.compile("^[A-Za-z0-9_]+$")
 
+# A chunked export of a table writes <directory>/<table>/part-NNNNN.csv files (.csv.gz if
+# compressed), each with a checkpoints/<export ID>/part-NNNNN.json checkpoint (with the part's key
+# range, and its row count once it is complete), and then a manifest.json listing all the parts.
+_PART_NAME_FORMAT = 'part-%05d'
+_CHECKPOINT_DIR_FORMAT = 'checkpoints/%s'
+_MANIFEST_NAME = 'manifest.json'
+
+# An incremental export of a table writes <directory>/<table>/delta-NNNNN.csv files (.csv.gz if
+# compressed) of the rows changed since the previous one, each with a delta-NNNNN.json manifest,
+# and records how far it got in watermark.json.
+_DELTA_NAME_FORMAT = 'delta-%05d'
+_WATERMARK_NAME = 'watermark.json'
+# Columns that incremental exports use (in order of preference) to find changed rows. DAOs give
+# rows a new log position whenever they create or update them (see LogPosition), and set
+# last_modified on every write. Other columns (created, or primary keys) don't change when rows are
+# updated, so tables without these columns are always exported in full.
+_WATERMARK_COLUMNS = ('log_position_id', 'last_modified')
+# Watermark values are assigned when rows are written, before they are committed, so a row may
+# become visible to exports after rows with greater values were exported. Incremental exports look
+# back far enough to include such rows, assuming that no transaction stays open longer than this
+# after writing a row. API requests are ended by App Engine after a minute, and task queue tasks
+# after 10 minutes; the longest transactions, in offline jobs, take minutes.
+_MAX_TRANSACTION_DURATION = datetime.timedelta(hours=1)
+
 # TODO(calbach): Factor this out into the datastore config.
 _DEIDENTIFY_DB_TABLE_WHITELIST = {
   'rdr': set([
@@ -51,51 +83,328 @@ class TableExporter(object):
     b = h.digest()[0:8]
     return abs(struct.unpack('>q', b)[0])
 
-  @classmethod
-  def _export_csv(cls, bucket_name, database, directory, deidentify_salt, table_name):
+  @staticmethod
+  def _get_transform(deidentify_salt):
+    """Returns a row transform that obfuscates participant IDs, or None if not deidentifying."""
+    if not deidentify_salt:
+      return None
+    # Deidentification requested: hash outgoing participant IDs with a consistent salt across this
+    # export. Cache obfuscated participant IDs across row callbacks to avoid recomputation and to
+    # detect collisions.
+    pmi_to_obfuscated = {}
+    obfuscated_to_pmi = {}
+    def f(row_proxy):
+      out = [v for v in row_proxy]
+      for i, key in enumerate(row_proxy.keys()):
+        if key != 'participant_id':
+          continue
+
+        pmi_id = out[i]
+        if pmi_id not in pmi_to_obfuscated:
+          obf_id = TableExporter._obfuscate_id(pmi_id, deidentify_salt)
+          pmi_to_obfuscated[pmi_id] = obf_id
+          if obf_id in obfuscated_to_pmi:
+            raise ValueError('hash collision, {}, {} for salt {} both yield {}'.format(
+                pmi_id, obfuscated_to_pmi[obf_id], deidentify_salt, obf_id))
+          obfuscated_to_pmi[obf_id] = pmi_id
+        out[i] = pmi_to_obfuscated[pmi_id]
+        break
+      return out
+    return f
+
+  @staticmethod
+  def _get_sql_table(database, table_name):
     assert _TABLE_PATTERN.match(table_name)
     assert _TABLE_PATTERN.match(database)
-
-    transformf = None
-    if deidentify_salt:
-      # Deidentification requested: hash outgoing participant IDs with a consistent salt across this
-      # export. Cache obfuscated participant IDs across row callbacks to avoid recomputation and to
-      # detect collisions.
-      pmi_to_obfuscated = {}
-      obfuscated_to_pmi = {}
-      def f(row_proxy):
-        out = [v for v in row_proxy]
-        for i, key in enumerate(row_proxy.keys()):
-          if key != 'participant_id':
-            continue
-
-          pmi_id = out[i]
-          if pmi_id not in pmi_to_obfuscated:
-            obf_id = TableExporter._obfuscate_id(pmi_id, deidentify_salt)
-            pmi_to_obfuscated[pmi_id] = obf_id
-            if obf_id in obfuscated_to_pmi:
-              raise ValueError('hash collision, {}, {} for salt {} both yield {}'.format(
-                  pmi_id, obfuscated_to_pmi[obf_id], deidentify_salt, obf_id))
-            obfuscated_to_pmi[obf_id] = pmi_id
-          out[i] = pmi_to_obfuscated[pmi_id]
-          break
-        return out
-      transformf = f
-
-    output_path = '%s/%s.csv' % (directory, table_name)
-    sql_table = '%s.%s' % (database, table_name)
     if get_database().db_type == 'sqlite':
       # No schemas in SQLite.
-      sql_table = table_name
-    SqlExporter(bucket_name, use_unicode=True).run_export(
-        output_path, 'SELECT * FROM {}'.format(sql_table), transformf=transformf)
+      return table_name
+    return '%s.%s' % (database, table_name)
+
+  @classmethod
+  def _export_csv(cls, bucket_name, database, directory, deidentify_salt, table_name,
+                  compress=False):
+    sql_table = cls._get_sql_table(database, table_name)
+    output_path = '%s/%s%s' % (directory, table_name, _get_extension(compress))
+    with sql_instrumentation.record_job_query_stats('TableExporter %s' % sql_table):
+      SqlExporter(bucket_name, use_unicode=True, compress=compress).run_export(
+          output_path, 'SELECT * FROM {}'.format(sql_table),
+          transformf=cls._get_transform(deidentify_salt))
     return '%s/%s' % (bucket_name, output_path)
 
   @staticmethod
-  def export_tables(database, tables, directory, deidentify):
+  def _inspect_table(database, table_name):
+    """Returns the table's primary key column names, and a map of column name -> type."""
+    schema = None if get_database().db_type == 'sqlite' else database
+    inspector = inspect(get_database().get_engine())
+    key_columns = inspector.get_pk_constraint(table_name, schema=schema)['constrained_columns']
+    column_types = {column['name']: column['type']
+                    for column in inspector.get_columns(table_name, schema=schema)}
+    return key_columns, column_types
+
+  @classmethod
+  def _get_integer_primary_key(cls, database, table_name):
+    """Returns the name of the table's primary key column if it is a single integer column (that a
+    chunked export can split into ranges), or None."""
+    key_columns, column_types = cls._inspect_table(database, table_name)
+    if len(key_columns) == 1 and isinstance(column_types[key_columns[0]], Integer):
+      return key_columns[0]
+    return None
+
+  @staticmethod
+  def _get_part_end(sql_table, key_column, start_id, chunk_size):
+    """Returns the end of the [start_id, end) key range of the next chunk_size rows, and whether it
+    is the last part of the table (with up to chunk_size rows).
+
+    The end is found by skipping chunk_size keys from start_id in the primary key index, so however
+    sparse the keys are, each part has chunk_size rows.
+    """
+    with get_database().session() as session:
+      end_id = session.execute(
+          text('SELECT {0} FROM {1} WHERE {0} >= :start_id ORDER BY {0} LIMIT 1 OFFSET :offset'
+               .format(key_column, sql_table)),
+          {'start_id': start_id, 'offset': chunk_size}).scalar()
+      if end_id is not None:
+        return end_id, False
+      max_id = session.execute('SELECT MAX({0}) FROM {1}'.format(key_column, sql_table)).scalar()
+    if max_id is None or max_id < start_id:
+      # The table is empty, or its last rows were deleted.
+      return start_id, True
+    return max_id + 1, True
+
+  @classmethod
+  def _start_chunked_export(cls, bucket_name, database, directory, deidentify_salt, table_name,
+                            chunk_size, compress=False):
+    """Starts exporting a table in primary key ranges of chunk_size rows, by deferring a task to
+    export the first one. Each part's task defers the next part's (see _export_chunk).
+
+    Tables (or views) without an integer primary key are exported to one file, as by _export_csv.
+    """
+    sql_table = cls._get_sql_table(database, table_name)
+    key_column = cls._get_integer_primary_key(database, table_name)
+    if key_column is None:
+      logging.warning('%s has no integer primary key to split on; exporting it to one file.',
+                      sql_table)
+      return cls._export_csv(bucket_name, database, directory, deidentify_salt, table_name,
+                             compress)
+    with get_database().session() as session:
+      start_id = session.execute('SELECT MIN({0}) FROM {1}'.format(key_column, sql_table)).scalar()
+    # Identifies the checkpoints (and tasks) of this export, as opposed to those of earlier exports
+    # to the same directory.
+    export_id = '%016x' % random.getrandbits(64)
+    logging.info('Exporting %s in parts of up to %d rows (export %s).', sql_table, chunk_size,
+                 export_id)
+    # An empty table is exported to one empty part.
+    cls._defer_chunk(bucket_name, database, directory, deidentify_salt, table_name, key_column,
+                     export_id, 0, start_id or 0, chunk_size, compress)
+    return '%s/%s/%s' % (bucket_name, directory, table_name)
+
+  @staticmethod
+  def _defer_chunk(bucket_name, database, directory, deidentify_salt, table_name, key_column,
+                   export_id, part_index, start_id, chunk_size, compress):
+    """Defers the task exporting a part of a chunked export, unless it already has been."""
+    try:
+      deferred.defer(TableExporter._export_chunk, bucket_name, database, directory,
+                     deidentify_salt, table_name, key_column, export_id, part_index, start_id,
+                     chunk_size, compress,
+                     _name='export-%s-%s-%05d' % (table_name, export_id, part_index))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+      # Deferred by an earlier try of the previous part's task.
+      pass
+
+  @classmethod
+  def _export_chunk(cls, bucket_name, database, directory, deidentify_salt, table_name,
+                    key_column, export_id, part_index, start_id, chunk_size, compress=False):
+    """Exports the chunk_size rows from start_id of a chunked export to its part file, then writes
+    its checkpoint, and the manifest if all parts are done.
+
+    Before exporting its rows, the part records its key range in its checkpoint, and (unless it is
+    the last part) defers the task for the next part, which runs in parallel. If the task fails, the
+    task queue retries just this part, with the same key range; a part whose checkpoint is complete
+    is not exported again.
+    """
+    sql_table = cls._get_sql_table(database, table_name)
+    table_dir = '%s/%s' % (directory, table_name)
+    part_name = _PART_NAME_FORMAT % part_index
+    part_file = part_name + _get_extension(compress)
+    checkpoint_path = '%s/%s.json' % (_get_checkpoint_dir(table_dir, export_id), part_name)
+    checkpoint = _read_json(bucket_name, checkpoint_path)
+    if checkpoint is None:
+      end_id, last = cls._get_part_end(sql_table, key_column, start_id, chunk_size)
+      checkpoint = {
+        'exportId': export_id,
+        'file': part_file,
+        'startId': start_id,
+        'endId': end_id,
+        'last': last,
+      }
+      _write_json(bucket_name, checkpoint_path, checkpoint)
+    if not checkpoint['last']:
+      cls._defer_chunk(bucket_name, database, directory, deidentify_salt, table_name, key_column,
+                       export_id, part_index + 1, checkpoint['endId'], chunk_size, compress)
+
+    if 'rowCount' in checkpoint:
+      logging.info('Part %d of %s is already exported.', part_index, sql_table)
+    else:
+      sql = 'SELECT * FROM {0} WHERE {1} >= :start_id AND {1} < :end_id ORDER BY {1}'.format(
+          sql_table, key_column)
+      exporter = SqlExporter(bucket_name, use_unicode=True, compress=compress)
+      with sql_instrumentation.record_job_query_stats(
+          'TableExporter %s part %d' % (sql_table, part_index)):
+        with exporter.open_writer('%s/%s' % (table_dir, part_file)) as writer:
+          counting_writer = _RowCountingWriter(writer)
+          exporter.run_export_with_writer(counting_writer, sql,
+                                          {'start_id': start_id, 'end_id': checkpoint['endId']},
+                                          transformf=cls._get_transform(deidentify_salt))
+      checkpoint['rowCount'] = counting_writer.row_count
+      _write_json(bucket_name, checkpoint_path, checkpoint)
+
+    cls._write_manifest_if_complete(bucket_name, table_dir, key_column, export_id)
+    return '%s/%s/%s' % (bucket_name, table_dir, part_file)
+
+  @staticmethod
+  def _write_manifest_if_complete(bucket_name, table_dir, key_column, export_id):
+    """Writes the manifest of a chunked export if the checkpoints of all its parts, up to the last
+    one, are complete.
+
+    When the last parts finish at the same time, more than one may write the (same) manifest.
+    """
+    prefix = '/%s/%s/' % (bucket_name, _get_checkpoint_dir(table_dir, export_id))
+    checkpoint_paths = sorted(stat.filename for stat in cloudstorage_api.listbucket(prefix))
+    expected_paths = ['%s%s.json' % (prefix, _PART_NAME_FORMAT % part_index)
+                      for part_index in range(len(checkpoint_paths))]
+    if not checkpoint_paths or checkpoint_paths != expected_paths:
+      return
+    # Checkpoints are read from the last one, which is the only one read until the last part is
+    # complete.
+    parts = []
+    for checkpoint_path in reversed(checkpoint_paths):
+      with cloudstorage_api.open(checkpoint_path) as checkpoint_file:
+        checkpoint = json.load(checkpoint_file)
+      if 'rowCount' not in checkpoint or (not parts and not checkpoint['last']):
+        return
+      parts.insert(0, {key: checkpoint[key] for key in ('file', 'startId', 'endId', 'rowCount')})
+    manifest = {
+      'exportId': export_id,
+      'keyColumn': key_column,
+      'rowCount': sum(part['rowCount'] for part in parts),
+      'parts': parts,
+    }
+    _write_json(bucket_name, '%s/%s' % (table_dir, _MANIFEST_NAME), manifest)
+    logging.info('Export of %d parts (%d rows) to /%s/%s complete.', len(parts),
+                 manifest['rowCount'], bucket_name, table_dir)
+
+  @classmethod
+  def _export_delta(cls, bucket_name, database, directory, table_name, compress=False):
+    """Exports the rows of a table changed since the last incremental export to the same
+    directory, and writes a manifest describing how to apply them.
+
+    Changed rows are those with a greater log_position_id or last_modified (the first the table
+    has) than the watermark found from earlier exports (see _get_from_value). The first exports of
+    a table, and exports of tables with neither column, include all rows, and are marked "full" in
+    their manifest. Otherwise consumers should upsert the rows using the manifest's keyColumns;
+    deltas may repeat rows from earlier deltas.
+
+    Returns the path of the manifest.
+    """
+    sql_table = cls._get_sql_table(database, table_name)
+    table_dir = '%s/%s' % (directory, table_name)
+    key_columns, column_types = cls._inspect_table(database, table_name)
+    watermark_column = None
+    for column_name in _WATERMARK_COLUMNS:
+      if column_name in column_types:
+        watermark_column = column_name
+        break
+    watermark_type = column_types.get(watermark_column)
+
+    last_watermark = _read_json(bucket_name, '%s/%s' % (table_dir, _WATERMARK_NAME)) or {}
+    sequence = last_watermark.get('sequence', 0) + 1
+    exports = []
+    from_value = None
+    if watermark_column and last_watermark.get('column') == watermark_column:
+      exports = [(parse_datetime(export['time']),
+                  _parse_watermark_value(export['value'], watermark_type))
+                 for export in last_watermark['exports']]
+      from_value = _get_from_value(watermark_type, exports)
+    elif watermark_column is None:
+      logging.warning('%s has no log_position_id or last_modified column to find changed rows by; '
+                      'exporting all rows.', sql_table)
+
+    to_value = None
+    sql = 'SELECT * FROM {}'.format(sql_table)
+    params = {}
+    if watermark_column:
+      with get_database().session() as session:
+        to_value = session.execute(
+            text('SELECT MAX({0}) AS max_value FROM {1}'.format(watermark_column, sql_table))
+            .columns(max_value=watermark_type)).scalar()
+      # Read after to_value, so that all rows with lower values were written before this time.
+      now = clock.CLOCK.now()
+      if to_value is not None:
+        exports.append((now, to_value))
+      # Only the last export at least _MAX_TRANSACTION_DURATION before this one, and those after
+      # it, are needed by the next export.
+      old_exports = [export for export in exports if export[0] <= now - _MAX_TRANSACTION_DURATION]
+      if old_exports:
+        exports = exports[exports.index(old_exports[-1]):]
+      # Rows written after to_value was read are left for the next export.
+      sql += ' WHERE {0} <= :to_value'.format(watermark_column)
+      params['to_value'] = _to_bind_value(to_value, watermark_type)
+      if from_value is not None:
+        sql += ' AND {0} > :from_value'.format(watermark_column)
+        params['from_value'] = _to_bind_value(from_value, watermark_type)
+      sql += ' ORDER BY {0}'.format(watermark_column)
+      if to_value is None:
+        # An empty table; the next export starts from the same watermark.
+        to_value = from_value
+
+    delta_name = _DELTA_NAME_FORMAT % sequence
+    delta_file = delta_name + _get_extension(compress)
+    exporter = SqlExporter(bucket_name, use_unicode=True, compress=compress)
+    with sql_instrumentation.record_job_query_stats('TableExporter %s delta' % sql_table):
+      with exporter.open_writer('%s/%s' % (table_dir, delta_file)) as writer:
+        counting_writer = _RowCountingWriter(writer)
+        exporter.run_export_with_writer(counting_writer, sql, params)
+
+    manifest = {
+      'sequence': sequence,
+      'file': delta_file,
+      'full': from_value is None,
+      'keyColumns': key_columns,
+      'watermarkColumn': watermark_column,
+      'fromValue': _format_watermark_value(from_value),
+      'toValue': _format_watermark_value(to_value),
+      'rowCount': counting_writer.row_count,
+    }
+    manifest_path = '%s/%s.json' % (table_dir, delta_name)
+    _write_json(bucket_name, manifest_path, manifest)
+    # Written last, so that if the export fails it is retried from the same watermark.
+    _write_json(bucket_name, '%s/%s' % (table_dir, _WATERMARK_NAME), {
+      'sequence': sequence,
+      'column': watermark_column,
+      'exports': [{'time': format_datetime(time), 'value': _format_watermark_value(value)}
+                  for time, value in exports],
+    })
+    logging.info('Exported %d rows of %s changed since %s to /%s/%s/%s.',
+                 counting_writer.row_count, sql_table, manifest['fromValue'], bucket_name,
+                 table_dir, delta_file)
+    return '%s/%s' % (bucket_name, manifest_path)
+
+  @staticmethod
+  def export_tables(database, tables, directory, deidentify, chunk_size=None, compress=False,
+                    incremental=False):
     """
     Export the given tables from the given DB; deidentifying if requested.
 
+    If compress is set, files are gzipped (and named .csv.gz).
+
+    If chunk_size is set, each table is split into primary key ranges of chunk_size rows, exported
+    in parallel to numbered part files in <directory>/<table>/ (see _export_chunk).
+
+    If incremental is set, only the rows changed since the last incremental export of each table to
+    the same directory are exported, to numbered delta files in <directory>/<table>/ (see
+    _export_delta).
+
     A deidentified request outputs exports into a different bucket which may have less restrictive
     ACLs than the other export buckets; for this reason the tables for these requests are also more
     restrictive.
@@ -119,6 +428,11 @@ class TableExporter(object):
     for table_name in tables:
       if not _TABLE_PATTERN.match(table_name):
         raise BadRequest("Invalid table name: %s" % table_name)
+    if incremental and chunk_size:
+      raise BadRequest("incremental exports can't be chunked")
+    if incremental and deidentify:
+      # Obfuscated participant IDs differ between exports, so deltas couldn't be applied.
+      raise BadRequest("incremental exports can't be deidentified")
 
     deidentify_salt = None
     if deidentify:
@@ -136,6 +450,89 @@ class TableExporter(object):
       deidentify_salt = str(random.getrandbits(256)).encode('utf-8')
 
     for table_name in tables:
-      deferred.defer(TableExporter._export_csv, bucket_name,
-                     database, directory, deidentify_salt, table_name)
+      if incremental:
+        deferred.defer(TableExporter._export_delta, bucket_name,
+                       database, directory, table_name, compress)
+      elif chunk_size:
+        deferred.defer(TableExporter._start_chunked_export, bucket_name,
+                       database, directory, deidentify_salt, table_name, chunk_size, compress)
+      else:
+        deferred.defer(TableExporter._export_csv, bucket_name,
+                       database, directory, deidentify_salt, table_name, compress)
     return {'destination': 'gs://%s/%s' % (bucket_name, directory)}
+
+
+class _RowCountingWriter(object):
+  """Counts the rows written through a SqlExportFileWriter."""
+
+  def __init__(self, writer):
+    self._writer = writer
+    self.row_count = 0
+
+  def write_header(self, keys):
+    self._writer.write_header(keys)
+
+  def write_rows(self, results):
+    self.row_count += len(results)
+    self._writer.write_rows(results)
+
+
+def _get_extension(compress):
+  return '.csv.gz' if compress else '.csv'
+
+
+def _get_checkpoint_dir(table_dir, export_id):
+  return '%s/%s' % (table_dir, _CHECKPOINT_DIR_FORMAT % export_id)
+
+
+def _get_from_value(watermark_type, exports):
+  """Returns the watermark value that rows changed since the last of the given (time, max value)
+  exports have greater values than, or None if it can't be told (and all rows should be exported).
+
+  Rows not yet committed when the last export read its maximum value are committed within
+  _MAX_TRANSACTION_DURATION of being written, so were written less than that long before then.
+  Their last_modified times are greater than the maximum value less _MAX_TRANSACTION_DURATION;
+  and, as log positions are assigned in increasing order, their log positions are greater than the
+  maximum value read by an export at least _MAX_TRANSACTION_DURATION before the last one.
+  """
+  if not exports:
+    return None
+  last_time, last_value = exports[-1]
+  if isinstance(watermark_type, DateTime):
+    return last_value - _MAX_TRANSACTION_DURATION
+  for time, value in reversed(exports):
+    if time <= last_time - _MAX_TRANSACTION_DURATION:
+      return value
+  return None
+
+
+def _format_watermark_value(value):
+  return format_datetime(value) if isinstance(value, datetime.datetime) else value
+
+
+def _parse_watermark_value(value, column_type):
+  if value is not None and isinstance(column_type, DateTime):
+    return parse_datetime(value)
+  return value
+
+
+def _to_bind_value(value, column_type):
+  """Converts a value as SQLAlchemy would to compare it with the column in untyped SQL. (SQLite
+  stores datetimes as strings in a different format from the driver's.)"""
+  dialect = get_database().get_engine().dialect
+  processor = column_type.dialect_impl(dialect).bind_processor(dialect)
+  return processor(value) if processor and value is not None else value
+
+
+def _read_json(bucket_name, path):
+  """Returns the JSON in a GCS file, or None if it doesn't exist."""
+  gcs_path = '/%s/%s' % (bucket_name, path)
+  if not any(stat.filename == gcs_path for stat in cloudstorage_api.listbucket(gcs_path)):
+    return None
+  with cloudstorage_api.open(gcs_path) as json_file:
+    return json.load(json_file)
+
+
+def _write_json(bucket_name, path, obj):
+  with cloudstorage_api.open('/%s/%s' % (bucket_name, path), mode='w') as json_file:
+    json_file.write(json.dumps(obj, indent=2, sort_keys=True))
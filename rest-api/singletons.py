@@ -2,8 +2,11 @@ import threading
 from clock import CLOCK
 from datetime import timedelta
 
+# Guards singletons_map and _index_locks. Caches are constructed holding a lock for their index
+# (see _get_index_lock) instead, so that building one cache doesn't block getting the others.
 singletons_lock = threading.RLock()
 singletons_map = {}
+_index_locks = {}
 
 CODE_CACHE_INDEX = 0
 HPO_CACHE_INDEX = 1
@@ -13,6 +16,9 @@ ORGANIZATION_CACHE_INDEX = 4
 GENERIC_SQL_DATABASE_INDEX = 5
 MAIN_CONFIG_INDEX = 6
 DB_CONFIG_INDEX = 7
+QUERY_TOTAL_CACHE_INDEX = 8
+QUESTIONNAIRE_VERSION_CACHE_INDEX = 9
+SERVER_CURSOR_SQL_DATABASE_INDEX = 10
 
 def reset_for_tests():
   with singletons_lock:
@@ -24,27 +30,79 @@ def _get(cache_index):
     return existing_pair[0]
   return None
 
-def get(cache_index, constructor, cache_ttl_seconds=None, **kwargs):
+def _get_index_lock(cache_index):
+  lock = _index_locks.get(cache_index)
+  if lock is None:
+    with singletons_lock:
+      lock = _index_locks.setdefault(cache_index, threading.RLock())
+  return lock
+
+def _construct(cache_index, constructor, cache_ttl_seconds, kwargs):
+  new_instance = constructor(**kwargs)
+  expiration_time = None
+  if cache_ttl_seconds is not None:
+    expiration_time = CLOCK.now() + timedelta(seconds=cache_ttl_seconds)
+  with singletons_lock:
+    singletons_map[cache_index] = (new_instance, expiration_time)
+  return new_instance
+
+def get(cache_index, constructor, cache_ttl_seconds=None, serve_stale=False, **kwargs):
   """Get a cache with a specified index from the list above. If not initialized, use
-  constructor to initialize it; if cache_ttl_seconds is set, reload it after that period."""
+  constructor to initialize it; if cache_ttl_seconds is set, reload it after that period.
+
+  If serve_stale is true, an expired cache is returned while another thread reloads it, rather
+  than waiting for the reload; the thread that reloads it swaps in the new cache when done.
+  (Caches that were never loaded or have been invalidated are always waited for.)
+  """
   # First try without a lock
   result = _get(cache_index)
   if result:
     return result
 
-  # Then grab the lock and try again
-  with singletons_lock:
+  lock = _get_index_lock(cache_index)
+  if serve_stale:
+    stale_pair = singletons_map.get(cache_index)
+    if stale_pair:
+      if not lock.acquire(False):
+        # Another thread is reloading the cache.
+        return stale_pair[0]
+      try:
+        result = _get(cache_index)
+        if result:
+          return result
+        return _construct(cache_index, constructor, cache_ttl_seconds, kwargs)
+      finally:
+        lock.release()
+
+  # Then grab the lock for this index and try again
+  with lock:
     result = _get(cache_index)
     if result:
       return result
     else:
-      new_instance = constructor(**kwargs)
-      expiration_time = None
-      if cache_ttl_seconds is not None:
-        expiration_time = CLOCK.now() + timedelta(seconds=cache_ttl_seconds)
-      singletons_map[cache_index] = (new_instance, expiration_time)
-      return new_instance
+      return _construct(cache_index, constructor, cache_ttl_seconds, kwargs)
+
+def refresh(cache_index, refresher):
+  """Replaces a loaded cache with refresher(cache) (keeping its expiration time), and returns the
+  result. If another thread is already loading or refreshing the cache, returns the current cache
+  instead of waiting; returns None if the cache isn't loaded."""
+  lock = _get_index_lock(cache_index)
+  if not lock.acquire(False):
+    existing_pair = singletons_map.get(cache_index)
+    return existing_pair[0] if existing_pair else None
+  try:
+    existing_pair = singletons_map.get(cache_index)
+    if not existing_pair:
+      return None
+    new_instance = refresher(existing_pair[0])
+    if new_instance is not existing_pair[0]:
+      with singletons_lock:
+        singletons_map[cache_index] = (new_instance, existing_pair[1])
+    return new_instance
+  finally:
+    lock.release()
 
 def invalidate(cache_index):
-  with singletons_lock:
+  # Wait for any reload in progress, so that it doesn't replace the invalidated cache.
+  with _get_index_lock(cache_index), singletons_lock:
     singletons_map[cache_index] = None
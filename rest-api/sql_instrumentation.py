@@ -0,0 +1,194 @@
+"""Per-request SQL statistics, and detection of statements repeated within a request.
+
+Database engines report the statements they execute to the QueryStats being recorded on the current
+thread, if any. Requests record QueryStats when config.SQL_INSTRUMENTATION is set; offline jobs that
+don't run as requests can use record_query_stats().
+
+The stats are logged when the request or job is done; in nonprod, requests also return them in the
+X-SQL-Stats header. Statements executed many times with different parameters in one request (one
+query per entity in a loop) are logged as N+1 candidates.
+"""
+import collections
+import contextlib
+import json
+import logging
+import re
+import threading
+import time
+
+from flask import request
+from sqlalchemy import event
+
+# Statements executed at least this many times in one request are logged as N+1 candidates.
+DEFAULT_REPEATED_STATEMENT_THRESHOLD = 10
+SQL_STATS_HEADER = 'X-SQL-Stats'
+
+_MAX_STATEMENT_LENGTH = 500
+_WHITESPACE_RE = re.compile(r'\s+')
+# A parenthesized list of two or more bound parameters (e.g. from IN), in any paramstyle.
+_PARAMETER_LIST_RE = re.compile(r'\((?:\s*(?:\?|%s|:\w+)\s*,)+\s*(?:\?|%s|:\w+)\s*\)')
+
+_local = threading.local()
+
+
+def get_statement_shape(statement):
+  """Returns the statement with whitespace collapsed and lists of parameters replaced by (...), so
+  that executions of the same query with different parameters have the same shape."""
+  statement = _WHITESPACE_RE.sub(' ', statement).strip()
+  return _PARAMETER_LIST_RE.sub('(...)', statement)
+
+
+class QueryStats(object):
+  """Statistics on the SQL statements executed for one request or job."""
+
+  def __init__(self, name):
+    self.name = name
+    self.query_count = 0
+    self.total_seconds = 0.0
+    # Rows returned or affected, as reported by the database driver.
+    self.row_count = 0
+    self.slowest_seconds = 0.0
+    self.slowest_statement = None
+    self.shape_counts = collections.Counter()
+
+  def add(self, statement, seconds, row_count):
+    self.query_count += 1
+    self.total_seconds += seconds
+    if row_count > 0:
+      self.row_count += row_count
+    shape = get_statement_shape(statement)
+    self.shape_counts[shape] += 1
+    if self.slowest_statement is None or seconds > self.slowest_seconds:
+      self.slowest_seconds = seconds
+      self.slowest_statement = shape
+
+  def get_repeated_statements(self, threshold):
+    """Returns (statement shape, count) pairs for statements executed at least threshold times,
+    most frequent first."""
+    return [(shape, count) for shape, count in self.shape_counts.most_common()
+            if count >= threshold]
+
+  def to_json(self, threshold=DEFAULT_REPEATED_STATEMENT_THRESHOLD):
+    return {
+      'name': self.name,
+      'queryCount': self.query_count,
+      'dbMillis': int(self.total_seconds * 1000),
+      'rowCount': self.row_count,
+      'slowestMillis': int(self.slowest_seconds * 1000),
+      'slowestStatement': _truncate(self.slowest_statement),
+      'repeatedStatements': [{'statement': _truncate(shape), 'count': count}
+                             for shape, count in self.get_repeated_statements(threshold)],
+    }
+
+  def to_header(self):
+    return 'queries=%d; db_ms=%d; rows=%d' % (
+        self.query_count, int(self.total_seconds * 1000), self.row_count)
+
+  def log(self, threshold=DEFAULT_REPEATED_STATEMENT_THRESHOLD):
+    stats_json = self.to_json(threshold)
+    logging.info('SQL stats: %s', json.dumps(stats_json, sort_keys=True))
+    for repeated in stats_json['repeatedStatements']:
+      logging.warning('Possible N+1 query in %s, executed %d times: %s',
+                      self.name, repeated['count'], repeated['statement'])
+
+
+def _truncate(statement):
+  if statement and len(statement) > _MAX_STATEMENT_LENGTH:
+    return statement[:_MAX_STATEMENT_LENGTH] + '...'
+  return statement
+
+
+def get_current_stats():
+  """Returns the QueryStats being recorded on this thread, or None."""
+  return getattr(_local, 'stats', None)
+
+
+def instrument_engine(engine):
+  """Reports the statements an engine executes to the current thread's QueryStats."""
+  event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+  event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+  # pylint: disable=unused-argument
+  # The start time is kept on the statement's execution context rather than the connection, so
+  # statements that fail (and never reach _after_cursor_execute) leave nothing behind.
+  if context is not None and get_current_stats() is not None:
+    context.query_start_time = time.time()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+  # pylint: disable=unused-argument
+  stats = get_current_stats()
+  start_time = getattr(context, 'query_start_time', None)
+  if stats is None or start_time is None:
+    return
+  stats.add(statement, time.time() - start_time, cursor.rowcount)
+
+
+@contextlib.contextmanager
+def record_query_stats(name):
+  """Records QueryStats for the statements executed on this thread in the block, and logs them at
+  the end of it."""
+  previous_stats = get_current_stats()
+  stats = _local.stats = QueryStats(name)
+  try:
+    yield stats
+  finally:
+    _local.stats = previous_stats
+    stats.log(_get_repeated_statement_threshold())
+
+
+@contextlib.contextmanager
+def record_job_query_stats(name):
+  """Like record_query_stats if config.SQL_INSTRUMENTATION is set; otherwise records nothing (and
+  yields None). For offline jobs that don't run as requests."""
+  if not _is_enabled():
+    yield None
+    return
+  with record_query_stats(name) as stats:
+    yield stats
+
+
+def _is_enabled():
+  # Only import "config" on demand, as it depends on Datastore packages; model.database (which
+  # instruments engines) is also used by command line tools.
+  import config
+  return config.getSetting(config.SQL_INSTRUMENTATION, False)
+
+
+def _get_repeated_statement_threshold():
+  import config
+  return config.getSetting(config.SQL_REPEATED_STATEMENT_THRESHOLD,
+                           DEFAULT_REPEATED_STATEMENT_THRESHOLD)
+
+
+def start_request_stats():
+  """Starts recording QueryStats for the request, if enabled. Usage: app.before_request(...)"""
+  _local.stats = None
+  if _is_enabled():
+    _local.stats = QueryStats('%s %s' % (request.method, request.path))
+
+
+def finish_request_stats(response):
+  """Logs the request's QueryStats, and adds them to the response in nonprod.
+
+  Usage: app.after_request(...)
+  """
+  import config
+  stats = get_current_stats()
+  _local.stats = None
+  if stats is not None:
+    stats.log(_get_repeated_statement_threshold())
+    if config.getSettingJson(config.ALLOW_NONPROD_REQUESTS, False):
+      response.headers[SQL_STATS_HEADER] = stats.to_header()
+  return response
+
+
+def clear_request_stats(exception=None):
+  """Stops recording for requests that failed before finish_request_stats.
+
+  Usage: app.teardown_request(...)
+  """
+  # pylint: disable=unused-argument
+  _local.stats = None
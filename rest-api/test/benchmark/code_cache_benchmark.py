@@ -0,0 +1,130 @@
+"""Compares the memory use and lookup latency of CodeDao's compact cache with EntityCache.
+
+Run with:
+  test/run_tests.sh -g ${sdk_dir} -s benchmark -r code_cache_benchmark.py
+"""
+import datetime
+import gc
+import sys
+import timeit
+
+from dao.cache_all_dao import CompactEntityCache, EntityCache, _get_record_type
+from dao.code_dao import CodeDao
+from model.code import Code, CodeType
+from sqlalchemy import inspect
+from test.unit_test.unit_test_util import SqlTestBase
+
+_SYSTEM = 'http://terminology.pmi-ops.org/CodeSystem/ppi'
+_NUM_MODULES = 100
+_QUESTIONS_PER_MODULE = 50
+_ANSWERS_PER_QUESTION = 9
+_NUM_CODES = _NUM_MODULES * (1 + _QUESTIONS_PER_MODULE * (1 + _ANSWERS_PER_QUESTION))
+_NUM_REPETITIONS = 3
+_CREATED = datetime.datetime(2018, 1, 1)
+
+
+def _code_row(code_id, value, code_type, parent_id):
+  return {'code_id': code_id, 'system': _SYSTEM, 'value': value, 'short_value': value,
+          'display': u'Display for %s' % value, 'topic': u'Topic_%d' % (code_id % 20),
+          'code_type': code_type, 'mapped': True, 'created': _CREATED,
+          'code_book_id': None, 'parent_id': parent_id}
+
+
+def _make_code_rows():
+  """Returns rows for a codebook of modules, with questions, with answers."""
+  rows = []
+  for m in range(_NUM_MODULES):
+    module_id = len(rows) + 1
+    rows.append(_code_row(module_id, 'Module%d' % m, CodeType.MODULE, None))
+    for q in range(_QUESTIONS_PER_MODULE):
+      question_id = len(rows) + 1
+      question_value = 'Module%d_Question%d' % (m, q)
+      rows.append(_code_row(question_id, question_value, CodeType.QUESTION, module_id))
+      for a in range(_ANSWERS_PER_QUESTION):
+        rows.append(_code_row(len(rows) + 1, '%s_Answer%d' % (question_value, a),
+                              CodeType.ANSWER, question_id))
+  return rows
+
+
+def _get_reachable_ids(roots):
+  seen = set()
+  stack = list(roots)
+  while stack:
+    obj = stack.pop()
+    if id(obj) not in seen:
+      seen.add(id(obj))
+      stack.extend(gc.get_referents(obj))
+  return seen
+
+
+def _get_size(root, shared_ids):
+  """Returns the bytes used by the objects reachable from root, other than types and shared_ids
+  (objects such as the model's mapper, which all caches refer to)."""
+  seen = set(shared_ids)
+  size = 0
+  stack = [root]
+  while stack:
+    obj = stack.pop()
+    if id(obj) in seen or isinstance(obj, type):
+      continue
+    seen.add(id(obj))
+    size += sys.getsizeof(obj)
+    stack.extend(gc.get_referents(obj))
+  return size
+
+
+class CodeCacheBenchmark(SqlTestBase):
+  def setUp(self):
+    super(CodeCacheBenchmark, self).setUp()
+    self.dao = CodeDao()
+    with self.dao.session() as session:
+      session.execute(Code.__table__.insert(), _make_code_rows())
+
+  def _load_codes(self):
+    with self.dao.session() as session:
+      return session.query(Code).all()
+
+  def _make_cache(self, cache_type):
+    """Builds a cache of freshly loaded codes and links them the way CodeDao._load_cache does."""
+    cache = cache_type(self.dao, self._load_codes(), self.dao.index_field_keys)
+    for code in cache.id_to_entity.itervalues():
+      if code.parentId is not None:
+        parent = cache.id_to_entity[code.parentId]
+        parent.children.append(code)
+        code.parent = parent
+    return cache
+
+  def test_code_cache(self):
+    self.assertEquals(_NUM_CODES, len(self._load_codes()))
+    shared_ids = _get_reachable_ids(
+        [Code, inspect(Code), Code.__table__, CodeType,
+         _get_record_type(Code, self.dao.cache_record_relationships)])
+
+    results = {}
+    for cache_type in (EntityCache, CompactEntityCache):
+      load_seconds = min(timeit.repeat(lambda: self._make_cache(cache_type),
+                                       number=1, repeat=_NUM_REPETITIONS))
+      cache = self._make_cache(cache_type)
+      ids = sorted(cache.id_to_entity)
+      keys = [(code.system, code.value) for code in cache.id_to_entity.itervalues()]
+      code_map = cache.index_maps[self.dao.index_field_keys[0]]
+      get_seconds = min(timeit.repeat(
+          lambda: [cache.id_to_entity.get(code_id).value for code_id in ids],
+          number=1, repeat=_NUM_REPETITIONS))
+      get_code_seconds = min(timeit.repeat(
+          lambda: [code_map.get(key).codeId for key in keys],
+          number=1, repeat=_NUM_REPETITIONS))
+      ancestor_seconds = min(timeit.repeat(
+          lambda: [self.dao.find_ancestor_of_type(code, CodeType.MODULE)
+                   for code in cache.id_to_entity.itervalues()],
+          number=1, repeat=_NUM_REPETITIONS))
+      results[cache_type] = {
+          code_id: (code.asdict(), code.parent and code.parent.codeId,
+                    sorted(child.codeId for child in code.children))
+          for code_id, code in cache.id_to_entity.iteritems()}
+      size = _get_size(cache, shared_ids)
+      print ('%s for %d codes: %.1f MB, load %.3fs, get %.3fs, get_code %.3fs, '
+             'find_ancestor_of_type %.3fs' %
+             (cache_type.__name__, _NUM_CODES, size / 1e6, load_seconds, get_seconds,
+              get_code_seconds, ancestor_seconds))
+    self.assertEquals(results[EntityCache], results[CompactEntityCache])
@@ -0,0 +1,192 @@
+"""Measures the throughput of the API and offline jobs against a local database.
+
+Seeds the database with synthetic participants through the API (using FakeParticipantGenerator and
+the in-process client), then pages through participant summaries and physical measurements, and
+runs the Biobank samples import and public metrics export through the offline app. Reports ops/sec
+and p50/p99 latency for each operation, and writes them as JSON (to BENCHMARK_RESULTS_FILE, by
+default end_to_end_benchmark.json) for comparison across commits.
+
+Run with:
+  test/run_tests.sh -g ${sdk_dir} -s benchmark -r end_to_end_benchmark.py
+
+Set BENCHMARK_NUM_PARTICIPANTS to change the number of participants (default 200), and
+BENCHMARK_USE_MYSQL=true to use a local MySQL database (see tools/setup_local_database.sh) instead
+of SQLite.
+"""
+import collections
+import datetime
+import httplib
+import json
+import os
+import random
+import subprocess
+import time
+
+from testlib import testutil
+
+from data_gen.fake_biobank_samples_generator import generate_samples
+from data_gen.fake_participant_generator import FakeParticipantGenerator
+from data_gen.in_process_client import InProcessClient
+from dao.biobank_stored_sample_dao import BiobankStoredSampleDao
+from dao.participant_dao import ParticipantDao
+from offline import main as offline_main
+from test.unit_test.unit_test_util import FlaskTestBase
+
+_NUM_PARTICIPANTS = int(os.environ.get('BENCHMARK_NUM_PARTICIPANTS', 200))
+_USE_MYSQL = os.environ.get('BENCHMARK_USE_MYSQL') == 'true'
+_RESULTS_FILE = os.environ.get('BENCHMARK_RESULTS_FILE', 'end_to_end_benchmark.json')
+_NUM_REPETITIONS = 3
+_PAGE_SIZE = 100
+_QUESTIONNAIRE_FILES = ('study_consent.json', 'ehr_consent.json', 'the_basics_questionnaire.json',
+                        'questionnaire4.json')
+_CRON_HEADERS = {'X-Appengine-Cron': 'true'}
+
+_PARTICIPANT_CREATE = 'participantCreate'
+_QUESTIONNAIRE_RESPONSE_SUBMIT = 'questionnaireResponseSubmit'
+_SUMMARY_PAGE = 'participantSummaryPage'
+_PHYSICAL_MEASUREMENTS_SYNC_PAGE = 'physicalMeasurementsSyncPage'
+_BIOBANK_SAMPLES_IMPORT = 'biobankSamplesImport'
+_PUBLIC_METRICS_EXPORT = 'publicMetricsExport'
+
+
+def _percentile(sorted_values, percent):
+  """Returns the nearest-rank percentile of a sorted, non-empty list."""
+  index = max(0, int(round(percent / 100.0 * len(sorted_values))) - 1)
+  return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+def _get_commit():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD']).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def _get_local_path(url, resource):
+  """Returns the part of a bundle's next link that send_get expects (excluding main.PREFIX)."""
+  return url[url.find(resource):]
+
+
+class _Timings(object):
+  """Latencies of each operation, in seconds."""
+
+  def __init__(self):
+    self.seconds = collections.defaultdict(list)
+
+  def record(self, operation, func, *args, **kwargs):
+    start_time = time.time()
+    result = func(*args, **kwargs)
+    self.seconds[operation].append(time.time() - start_time)
+    return result
+
+  def to_json(self):
+    results = {}
+    for operation, seconds in sorted(self.seconds.iteritems()):
+      sorted_seconds = sorted(seconds)
+      total_seconds = sum(sorted_seconds)
+      results[operation] = {
+        'count': len(sorted_seconds),
+        'totalSeconds': round(total_seconds, 3),
+        'opsPerSecond': round(len(sorted_seconds) / total_seconds, 2) if total_seconds else None,
+        'p50Millis': round(_percentile(sorted_seconds, 50) * 1000, 1),
+        'p99Millis': round(_percentile(sorted_seconds, 99) * 1000, 1),
+      }
+    return results
+
+
+class _TimingClient(InProcessClient):
+  """Records the latency of the participant and questionnaire response requests that
+  FakeParticipantGenerator makes."""
+
+  def __init__(self, timings):
+    self._timings = timings
+
+  def request_json(self, local_path, method='GET', body=None, headers=None, pretend_date=None):
+    parent = super(_TimingClient, self)
+    if method == 'POST' and local_path == 'Participant':
+      operation = _PARTICIPANT_CREATE
+    elif method == 'POST' and local_path.endswith('/QuestionnaireResponse'):
+      operation = _QUESTIONNAIRE_RESPONSE_SUBMIT
+    else:
+      return parent.request_json(local_path, method, body, headers, pretend_date)
+    return self._timings.record(operation, parent.request_json, local_path, method, body, headers,
+                                pretend_date)
+
+
+class EndToEndBenchmark(testutil.CloudStorageTestBase, FlaskTestBase):
+  def setUp(self):
+    # Neither CloudStorageTestBase nor our FlaskTestBase correctly calls through to
+    # setup(..).setup(..), so explicitly call both here.
+    testutil.CloudStorageTestBase.setUp(self)
+    FlaskTestBase.setUp(self, use_mysql=_USE_MYSQL)
+    self._offline_app = offline_main.app.test_client()
+    self.timings = _Timings()
+    for filename in _QUESTIONNAIRE_FILES:
+      self.create_questionnaire(filename)
+    random.seed(1)
+
+  def _send_offline_get(self, local_path):
+    response = self._offline_app.get(offline_main.PREFIX + local_path, headers=_CRON_HEADERS)
+    self.assertEquals(response.status_code, httplib.OK, response.data)
+    return json.loads(response.data)
+
+  def _generate_participants(self):
+    generator = FakeParticipantGenerator(_TimingClient(self.timings), use_local_files=True)
+    for _ in range(_NUM_PARTICIPANTS):
+      generator.generate_participant(include_physical_measurements=True,
+                                     include_biobank_orders=True)
+
+  def _read_pages(self, operation, resource, first_page_path):
+    """Follows a bundle's next links from the first page, returning the number of entries."""
+    num_entries = 0
+    path = first_page_path
+    while path:
+      response = self.timings.record(operation, self.send_get, path)
+      num_entries += len(response.get('entry', []))
+      path = None
+      for link in response.get('link', []):
+        if link['relation'] == 'next':
+          path = _get_local_path(link['url'], resource)
+    return num_entries
+
+  def test_end_to_end(self):
+    start_time = time.time()
+    self._generate_participants()
+    seed_seconds = time.time() - start_time
+    self.assertEquals(_NUM_PARTICIPANTS, ParticipantDao().count())
+
+    for _ in range(_NUM_REPETITIONS):
+      self._read_pages(_SUMMARY_PAGE, 'ParticipantSummary',
+                       'ParticipantSummary?_count=%d' % _PAGE_SIZE)
+      self._read_pages(_PHYSICAL_MEASUREMENTS_SYNC_PAGE, 'PhysicalMeasurements/_history',
+                       'PhysicalMeasurements/_history?_count=%d' % _PAGE_SIZE)
+
+    generate_samples(0.1)
+    for _ in range(_NUM_REPETITIONS):
+      # Later imports of the same CSV update the samples the first one inserted.
+      self.timings.record(_BIOBANK_SAMPLES_IMPORT, self._send_offline_get, 'BiobankSamplesImport')
+    num_samples = BiobankStoredSampleDao().count()
+
+    for _ in range(_NUM_REPETITIONS):
+      self.timings.record(_PUBLIC_METRICS_EXPORT, self._send_offline_get,
+                          'PublicMetricsRecalculate')
+
+    results = {
+      'commit': _get_commit(),
+      'time': datetime.datetime.utcnow().isoformat(),
+      'database': 'mysql' if _USE_MYSQL else 'sqlite',
+      'numParticipants': _NUM_PARTICIPANTS,
+      'numBiobankStoredSamples': num_samples,
+      'seedSeconds': round(seed_seconds, 3),
+      'operations': self.timings.to_json(),
+    }
+    with open(_RESULTS_FILE, 'w') as results_file:
+      json.dump(results, results_file, indent=2, sort_keys=True)
+
+    print ('%d participants (%s), seeded in %.1fs:' %
+           (_NUM_PARTICIPANTS, results['database'], seed_seconds))
+    for operation, stats in sorted(results['operations'].iteritems()):
+      print ('  %-30s %6d ops, %8.2f ops/sec, p50 %8.1f ms, p99 %8.1f ms' %
+             (operation, stats['count'], stats['opsPerSecond'] or 0, stats['p50Millis'],
+              stats['p99Millis']))
+    print 'Wrote %s' % _RESULTS_FILE
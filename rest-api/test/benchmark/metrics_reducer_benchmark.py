@@ -0,0 +1,39 @@
+"""Compares the participant metrics reducer with the previous deepcopy()-per-event version.
+
+Run with:
+  test/run_tests.sh -g ${sdk_dir} -s benchmark -r metrics_reducer_benchmark.py
+"""
+import timeit
+
+from offline.metrics_pipeline import reduce_participant_data_to_hpo_metric_date_deltas
+from test.unit_test.offline_test.metrics_reducer_test import make_random_participants, NOW
+from test.unit_test.offline_test.metrics_reducer_test import reduce_with_deepcopy
+from test.unit_test.unit_test_util import NdbTestBase
+
+_NUM_PARTICIPANTS = 2000
+_NUM_REPETITIONS = 3
+
+
+class MetricsReducerBenchmark(NdbTestBase):
+  def setUp(self):
+    super(MetricsReducerBenchmark, self).setUp()
+    self.participants = make_random_participants(_NUM_PARTICIPANTS)
+
+  def _reduce_all(self, reducer):
+    results = []
+    for participant_id, values in enumerate(self.participants):
+      results.extend(reducer(str(participant_id), values, now=NOW))
+    return results
+
+  def test_reduce_participant_data(self):
+    self.assertEquals(self._reduce_all(reduce_with_deepcopy),
+                      self._reduce_all(reduce_participant_data_to_hpo_metric_date_deltas))
+
+    deepcopy_seconds = min(timeit.repeat(lambda: self._reduce_all(reduce_with_deepcopy),
+                                         number=1, repeat=_NUM_REPETITIONS))
+    state_vector_seconds = min(timeit.repeat(
+        lambda: self._reduce_all(reduce_participant_data_to_hpo_metric_date_deltas),
+        number=1, repeat=_NUM_REPETITIONS))
+    print ('Participant reducer for %d participants: deepcopy %.3fs, state vectors %.3fs (%.1fx)' %
+           (_NUM_PARTICIPANTS, deepcopy_seconds, state_vector_seconds,
+            deepcopy_seconds / state_vector_seconds))
@@ -0,0 +1,113 @@
+"""Compares ParticipantSummaryDao.to_client_json with the previous asdict()-based conversion.
+
+Run with:
+  test/run_tests.sh -g ${sdk_dir} -s benchmark -r participant_summary_json_benchmark.py
+"""
+import datetime
+import random
+import timeit
+
+import clock
+from api_util import format_json_date, format_json_enum, format_json_code, format_json_hpo
+from api_util import format_json_org, format_json_site
+from code_constants import UNSET
+from dao import participant_summary_dao
+from dao.participant_summary_dao import ParticipantSummaryDao
+from model.code import CodeType
+from model.config_utils import to_client_biobank_id
+from model.participant_summary import WITHDRAWN_PARTICIPANT_FIELDS
+from model.participant_summary import WITHDRAWN_PARTICIPANT_VISIBILITY_TIME
+from model.utils import to_client_participant_id
+from participant_enums import QuestionnaireStatus, SampleStatus, WithdrawalStatus
+from participant_enums import SuspensionStatus, get_bucketed_age
+from test.unit_test.unit_test_util import NdbTestBase, PITT_HPO_ID, PITT_ORG_ID
+
+_NUM_SUMMARIES = 10000
+_NUM_REPETITIONS = 3
+
+
+def _to_client_json_from_dict(dao, model):
+  """The asdict()-based conversion ParticipantSummaryDao.to_client_json used to do."""
+  result = model.asdict()
+  if (model.withdrawalStatus == WithdrawalStatus.NO_USE and
+      model.withdrawalTime < clock.CLOCK.now() - WITHDRAWN_PARTICIPANT_VISIBILITY_TIME):
+    result = {k: result.get(k) for k in WITHDRAWN_PARTICIPANT_FIELDS}
+
+  result['participantId'] = to_client_participant_id(model.participantId)
+  biobank_id = result.get('biobankId')
+  if biobank_id:
+    result['biobankId'] = to_client_biobank_id(biobank_id)
+  date_of_birth = result.get('dateOfBirth')
+  if date_of_birth:
+    result['ageRange'] = get_bucketed_age(date_of_birth, clock.CLOCK.now())
+  else:
+    result['ageRange'] = UNSET
+
+  if 'organizationId' in result:
+    result['organization'] = result['organizationId']
+    del result['organizationId']
+    format_json_org(result, dao.organization_dao, 'organization')
+
+  format_json_hpo(result, dao.hpo_dao, 'hpoId')
+  result['awardee'] = result['hpoId']
+  participant_summary_dao._initialize_field_type_sets()
+  for fieldname in participant_summary_dao._DATE_FIELDS:
+    format_json_date(result, fieldname)
+  for fieldname in participant_summary_dao._CODE_FIELDS:
+    format_json_code(result, dao.code_dao, fieldname)
+  for fieldname in participant_summary_dao._ENUM_FIELDS:
+    format_json_enum(result, fieldname)
+  for fieldname in participant_summary_dao._SITE_FIELDS:
+    format_json_site(result, dao.site_dao, fieldname)
+  if (model.withdrawalStatus == WithdrawalStatus.NO_USE or
+      model.suspensionStatus == SuspensionStatus.NO_CONTACT):
+    result['recontactMethod'] = 'NO_CONTACT'
+  return {k: v for k, v in result.iteritems() if v is not None}
+
+
+class ParticipantSummaryJsonBenchmark(NdbTestBase):
+  def setUp(self):
+    super(ParticipantSummaryJsonBenchmark, self).setUp()
+    self.setup_codes(['PIIState_MA', 'GenderIdentity_Woman', 'SexualOrientation_Straight'],
+                     CodeType.ANSWER)
+    self.dao = ParticipantSummaryDao()
+    rand = random.Random(1)
+    now = clock.CLOCK.now()
+    self.summaries = []
+    for i in range(_NUM_SUMMARIES):
+      withdrawn = i % 50 == 0
+      self.summaries.append(self._participant_summary_with_defaults(
+          participantId=i + 1,
+          biobankId=i + 1,
+          hpoId=PITT_HPO_ID,
+          organizationId=PITT_ORG_ID if i % 2 else None,
+          siteId=self.site_id if i % 3 else None,
+          firstName=self.fake.first_name(),
+          lastName=self.fake.last_name(),
+          email=self.fake.email(),
+          dateOfBirth=datetime.date(1930 + rand.randint(0, 70), 1, 1) if i % 5 else None,
+          stateId=rand.choice([None, 1, 2]),
+          genderIdentityId=rand.choice([None, 2]),
+          sexualOrientationId=rand.choice([None, 3]),
+          lastModified=now,
+          consentForStudyEnrollment=QuestionnaireStatus.SUBMITTED,
+          consentForStudyEnrollmentTime=now,
+          sampleStatus1SST8=rand.choice([None, SampleStatus.RECEIVED]),
+          withdrawalStatus=WithdrawalStatus.NO_USE if withdrawn else WithdrawalStatus.NOT_WITHDRAWN,
+          withdrawalTime=now - datetime.timedelta(days=3) if withdrawn else None))
+
+  def test_to_client_json(self):
+    # Load the caches and make sure both conversions agree before timing them.
+    for summary in self.summaries:
+      self.assertEquals(_to_client_json_from_dict(self.dao, summary),
+                        self.dao.to_client_json(summary))
+
+    from_dict_seconds = min(timeit.repeat(
+        lambda: [_to_client_json_from_dict(self.dao, s) for s in self.summaries],
+        number=1, repeat=_NUM_REPETITIONS))
+    field_writers_seconds = min(timeit.repeat(
+        lambda: [self.dao.to_client_json(s) for s in self.summaries],
+        number=1, repeat=_NUM_REPETITIONS))
+    print ('to_client_json for %d summaries: asdict() %.3fs, field writers %.3fs (%.1fx)' %
+           (_NUM_SUMMARIES, from_dict_seconds, field_writers_seconds,
+            from_dict_seconds / field_writers_seconds))
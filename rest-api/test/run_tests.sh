@@ -7,7 +7,7 @@ subset="all"
 
 function usage() {
   echo "Usage: run_test.sh -g /path/to/google/cloud/sdk_dir" \
-      "[-s all|unit|client]" \
+      "[-s all|unit|client|benchmark]" \
       "[-r <file name match glob, e.g. 'extraction_*'>]" >& 2
   exit 1
 }
@@ -68,6 +68,13 @@ then
   (cd ${BASE_DIR}; python $cmd)
 fi
 
+# Benchmarks are slow, so they only run when requested.
+if [[ "$subset" == "benchmark" ]];
+then
+  cmd="test/runner.py --test-path test/benchmark/ ${sdk_dir} --test-pattern ${substring:-*_benchmark.py}"
+  (cd ${BASE_DIR}; python $cmd)
+fi
+
 if [[ "$subset" == "all" || "$subset" == "client" ]];
 then
   # Run client tests against local dev_server.
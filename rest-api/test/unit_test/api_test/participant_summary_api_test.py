@@ -1,5 +1,6 @@
 import datetime
 import httplib
+import json
 import main
 import threading
 
@@ -502,6 +503,32 @@ class ParticipantSummaryApiTest(FlaskTestBase):
     self.assertEqual(response2['total'], response['total'])
     self.assertEqual(response2['total'], num_participants)
 
+  def test_export_summaries(self):
+    participant_ids = []
+    for _ in range(3):
+      participant = self.send_post('Participant', {"providerLink": [self.provider_link]})
+      participant_ids.append(participant['participantId'])
+      with FakeClock(TIME_1):
+        self.send_consent(participant['participantId'])
+    az_participant = self.send_post('Participant', {"providerLink": [self.az_provider_link]})
+    with FakeClock(TIME_1):
+      self.send_consent(az_participant['participantId'])
+
+    response = self._app.get(main.PREFIX + 'ParticipantSummary/$export?awardee=PITT')
+    self.assertEquals(httplib.OK, response.status_code, response.data)
+    self.assertEquals('application/x-ndjson', response.mimetype)
+    lines = response.data.splitlines()
+    summaries = [json.loads(line) for line in lines]
+    self.assertEquals(sorted(participant_ids), [s['participantId'] for s in summaries])
+    for summary in summaries:
+      self.assertEquals('PITT', summary['awardee'])
+      self.assertEquals(self.send_get('Participant/%s/Summary' % summary['participantId']),
+                        summary)
+
+    response = self._app.get(main.PREFIX + 'ParticipantSummary/$export?hpoId=UNSET')
+    self.assertEquals(httplib.OK, response.status_code, response.data)
+    self.assertEquals('', response.data)
+
   def test_get_summary_with_skip_codes(self):
     # Set up the codes so they are mapped later.
     SqlTestBase.setup_codes([PMI_SKIP_CODE], code_type=CodeType.ANSWER)
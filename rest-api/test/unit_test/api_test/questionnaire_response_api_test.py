@@ -1,12 +1,13 @@
 import datetime
 import httplib
 import json
+import mock
 
 from code_constants import PPI_EXTRA_SYSTEM
 from clock import FakeClock
 from dao.code_dao import CodeDao
 from dao.questionnaire_dao import QuestionnaireDao
-from dao.questionnaire_response_dao import QuestionnaireResponseAnswerDao
+from dao.questionnaire_response_dao import QuestionnaireResponseAnswerDao, QuestionnaireResponseDao
 from model.utils import from_client_participant_id
 from model.questionnaire_response import QuestionnaireResponseAnswer
 from test.unit_test.unit_test_util import (
@@ -211,3 +212,73 @@ class QuestionnaireResponseApiTest(FlaskTestBase):
                 'suspensionStatus': 'NOT_SUSPENDED',
               }
     self.assertJsonResponseMatches(expected, summary)
+
+  def test_insert_batch(self):
+    participant_id_1 = self.create_participant()
+    participant_id_2 = self.create_participant()
+    consent_questionnaire_id = self.create_questionnaire('study_consent.json')
+    questionnaire_id = self.create_questionnaire('questionnaire1.json')
+
+    def consent(participant_id):
+      return gen_response(participant_id, consent_questionnaire_id,
+                          string_answers=[('firstName', 'Bob'), ('lastName', 'Jones'),
+                                          ('email', 'bob@example.com')])
+    response = gen_response(participant_id_1, questionnaire_id,
+                            string_answers=[('nameOfChild', 'Sue')])
+    bad_subject = gen_response('Q1', questionnaire_id)
+    bundle = {'resourceType': 'Bundle', 'type': 'batch', 'entry': [
+        {'resource': consent(participant_id_1)},
+        {'resource': response},
+        # Responses from a participant who hasn't consented yet are rejected.
+        {'resource': gen_response(participant_id_2, questionnaire_id)},
+        {'resource': bad_subject},
+        {'resource': consent(participant_id_2)}]}
+    with FakeClock(TIME_1):
+      result = self.send_post('QuestionnaireResponse/$batch', bundle)
+
+    self.assertEquals('batch-response', result['type'])
+    statuses = [entry['response']['status'] for entry in result['entry']]
+    self.assertEquals(['201 Created', '201 Created', '400 Bad Request', '400 Bad Request',
+                       '201 Created'], statuses)
+    self.assertEquals('Invalid participant ID: Q1',
+                      result['entry'][3]['response']['outcome']['issue'][0]['diagnostics'])
+
+    location = result['entry'][1]['response']['location']
+    self.assertTrue(location.startswith(_questionnaire_response_url(participant_id_1)))
+    get_response = self.send_get(location)
+    self.assertEquals('Sue', get_response['group']['question'][0]['answer'][0]['valueString'])
+    for participant_id in (participant_id_1, participant_id_2):
+      summary = self.send_get('Participant/%s/Summary' % participant_id)
+      self.assertEquals('SUBMITTED', summary['consentForStudyEnrollment'])
+
+    self.send_post('QuestionnaireResponse/$batch', {'resourceType': 'Bundle', 'type': 'searchset'},
+                   expected_status=httplib.BAD_REQUEST)
+
+  def test_insert_batch_error_after_inserting_one_at_a_time(self):
+    participant_id = self.create_participant()
+    consent_questionnaire_id = self.create_questionnaire('study_consent.json')
+    questionnaire_id = self.create_questionnaire('questionnaire1.json')
+    bundle = {'resourceType': 'Bundle', 'type': 'batch', 'entry': [
+        # Rejected as the participant hasn't consented yet, so the responses are inserted one at a
+        # time.
+        {'resource': gen_response(participant_id, questionnaire_id)},
+        {'resource': gen_response(participant_id, consent_questionnaire_id,
+                                  string_answers=[('firstName', 'Bob'), ('lastName', 'Jones'),
+                                                  ('email', 'bob@example.com')])},
+        {'resource': gen_response(participant_id, questionnaire_id)}]}
+    insert = QuestionnaireResponseDao.insert
+    def fail_third_insert(dao, questionnaire_response):
+      fail_third_insert.calls += 1
+      if fail_third_insert.calls == 3:
+        raise ValueError('Failing the third insert for the test.')
+      return insert(dao, questionnaire_response)
+    fail_third_insert.calls = 0
+    with FakeClock(TIME_1), mock.patch.object(QuestionnaireResponseDao, 'insert',
+                                              autospec=True, side_effect=fail_third_insert):
+      result = self.send_post('QuestionnaireResponse/$batch', bundle)
+
+    # The consent inserted before the error keeps its result.
+    statuses = [entry['response']['status'] for entry in result['entry']]
+    self.assertEquals(['400 Bad Request', '201 Created', '500 Internal Server Error'], statuses)
+    summary = self.send_get('Participant/%s/Summary' % participant_id)
+    self.assertEquals('SUBMITTED', summary['consentForStudyEnrollment'])
@@ -0,0 +1,95 @@
+import random
+
+import mock
+
+import config
+import singletons
+from dao.participant_dao import ParticipantDao, ParticipantHistoryDao
+from dao.participant_summary_dao import ParticipantSummaryDao
+from dao.questionnaire_response_dao import QuestionnaireResponseDao
+from data_gen.bulk_participant_generator import generate_participants
+from model.questionnaire_response import QuestionnaireResponseAnswer
+from model.questionnaire_response import QuestionnaireResponseCurrentAnswer
+from model.utils import to_client_participant_id
+from participant_enums import QuestionnaireStatus
+from test.unit_test.unit_test_util import FlaskTestBase, read_dev_config
+
+_NUM_PARTICIPANTS = 20
+
+
+def _create_questionnaires(test):
+  for filename in ('study_consent.json', 'ehr_consent.json', 'the_basics_questionnaire.json',
+                   'questionnaire4.json'):
+    test.create_questionnaire(filename)
+
+
+class BulkParticipantGeneratorTest(FlaskTestBase):
+  def setUp(self):
+    super(BulkParticipantGeneratorTest, self).setUp()
+    _create_questionnaires(self)
+    random.seed(1)
+
+  def test_generate_participants(self):
+    id_starts = generate_participants(_NUM_PARTICIPANTS, num_processes=0, batch_size=7, seed=1)
+
+    participants = ParticipantDao().get_all()
+    self.assertEquals(
+        range(id_starts.participant_id, id_starts.participant_id + _NUM_PARTICIPANTS),
+        sorted(participant.participantId for participant in participants))
+    self.assertEquals(
+        sum(participant.version for participant in participants), ParticipantHistoryDao().count())
+
+    summaries = ParticipantSummaryDao().get_all()
+    self.assertTrue(summaries)
+    for summary in summaries:
+      self.assertEquals(QuestionnaireStatus.SUBMITTED, summary.consentForStudyEnrollment)
+    self.assertTrue(QuestionnaireResponseDao().count())
+
+    with ParticipantDao().session() as session:
+      current_answers = session.query(QuestionnaireResponseAnswer).filter(
+          QuestionnaireResponseAnswer.endTime == None).count()
+      self.assertEquals(current_answers, session.query(QuestionnaireResponseCurrentAnswer).count())
+
+    # Summaries of generated participants are served like those of participants created through
+    # the API.
+    for summary in summaries:
+      response = self.send_get('Participant/%s/Summary'
+                               % to_client_participant_id(summary.participantId))
+      self.assertEquals('SUBMITTED', response['consentForStudyEnrollment'])
+
+  def test_generate_participants_after_existing(self):
+    first_id_starts = generate_participants(3, num_processes=0, seed=1)
+    second_id_starts = generate_participants(3, num_processes=0, seed=1)
+    self.assertEquals(first_id_starts.participant_id + 3, second_id_starts.participant_id)
+    self.assertEquals(6, ParticipantDao().count())
+
+  @mock.patch('config.load')
+  def test_generate_participants_with_config_overrides(self, mock_load):
+    # As tools/generate_participants.py runs it, without Datastore.
+    singletons.invalidate(singletons.MAIN_CONFIG_INDEX)
+    for key, value in read_dev_config().iteritems():
+      config.override_setting(key, value)
+    generate_participants(3, num_processes=0, seed=1)
+    self.assertEquals(3, ParticipantDao().count())
+    self.assertFalse(mock_load.called)
+
+
+class BulkParticipantGeneratorMySqlTest(FlaskTestBase):
+  # Worker processes need a database they can connect to themselves.
+  def setUp(self):
+    super(BulkParticipantGeneratorMySqlTest, self).setUp(use_mysql=True)
+    _create_questionnaires(self)
+
+  def test_generate_participants_with_pool(self):
+    id_starts = generate_participants(_NUM_PARTICIPANTS, num_processes=3, batch_size=4, seed=1)
+
+    # Each process creates its own range of participants, and this process still uses the database
+    # after its connections are disposed of.
+    participants = ParticipantDao().get_all()
+    self.assertEquals(
+        range(id_starts.participant_id, id_starts.participant_id + _NUM_PARTICIPANTS),
+        sorted(participant.participantId for participant in participants))
+    self.assertEquals(
+        range(id_starts.biobank_id, id_starts.biobank_id + _NUM_PARTICIPANTS),
+        sorted(participant.biobankId for participant in participants))
+    self.assertTrue(ParticipantSummaryDao().count())
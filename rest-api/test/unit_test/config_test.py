@@ -4,6 +4,7 @@ import httplib
 from mock import patch
 
 import config
+import singletons
 from clock import FakeClock
 from test.unit_test.unit_test_util import FlaskTestBase
 
@@ -80,3 +81,55 @@ class TestConfig(FlaskTestBase):
   def test_POST_does_not_validate_random_config(self):
     rando_config = {'not_required': 'not a list'}
     self.send_post('Config/rando_config', request_data=rando_config)
+
+  def test_compiled_config(self):
+    compiled = config.CompiledConfig({
+      config.BASELINE_PPI_QUESTIONNAIRE_FIELDS: ['questionnaireOnTheBasics'],
+      config.DNA_SAMPLE_TEST_CODES: 'not a list',
+      config.USER_INFO: {
+        'example@example.com': {
+          'roles': ['role1'],
+          'whitelisted_ip_ranges': {'ip6': [], 'ip4': ['123.210.0.1/16']},
+        },
+      },
+    })
+    self.assertEquals(frozenset(['questionnaireOnTheBasics']),
+                      compiled.get(config.BASELINE_PPI_QUESTIONNAIRE_FIELDS))
+    with self.assertRaises(config.InvalidConfigException):
+      compiled.get(config.DNA_SAMPLE_TEST_CODES)
+    with self.assertRaises(config.MissingConfigException):
+      compiled.get(config.PPI_QUESTIONNAIRE_FIELDS)
+    self.assertEquals(frozenset(), compiled.get(config.PPI_QUESTIONNAIRE_FIELDS, frozenset()))
+
+    user_info = compiled.get_user_info('example@example.com')
+    self.assertEquals(['role1'], user_info['roles'])
+    self.assertEquals(frozenset(['role1']), user_info.roles)
+    self.assertEquals(1, len(user_info.whitelisted_ips))
+    self.assertIsNone(compiled.get_user_info('nobody@example.com'))
+
+    config.override_setting(config.PPI_QUESTIONNAIRE_FIELDS, ['questionnaireOnHealthcareAccess'])
+    self.assertEquals(frozenset(['questionnaireOnHealthcareAccess']),
+                      compiled.get(config.PPI_QUESTIONNAIRE_FIELDS))
+
+  @patch('config.load')
+  def test_request_config_with_overrides_does_not_load_config(self, mock_load):
+    singletons.invalidate(singletons.MAIN_CONFIG_INDEX)
+    config.override_setting(config.DNA_SAMPLE_TEST_CODES, ['1ED10'])
+    self.assertEquals(('1ED10',), config.get_request_config().get(config.DNA_SAMPLE_TEST_CODES))
+    self.assertEquals(['1ED10'], config.getSettingList(config.DNA_SAMPLE_TEST_CODES))
+    self.assertFalse(mock_load.called)
+
+    mock_load.return_value = config.Configuration(configuration={})
+    self.assertEquals(frozenset(), config.get_request_config().get(config.PPI_QUESTIONNAIRE_FIELDS,
+                                                                   frozenset()))
+    self.assertTrue(mock_load.called)
+
+  def test_compiled_config_reloaded_after_store(self):
+    before = config.get_compiled_config()
+    self.assertIs(before, config.get_compiled_config())
+    existing = dict(config.get_config())
+    existing['test'] = ['some', 'values']
+    config.store_current_config(existing)
+    after = config.get_compiled_config()
+    self.assertIsNot(before, after)
+    self.assertEquals(['some', 'values'], after.configuration['test'])
@@ -0,0 +1,65 @@
+import mock
+import unittest
+
+from model.connection_pool import MonitoredQueuePool, PoolStats
+from model.connection_pool import monitor_pool, ping_idle_connections
+
+
+class _FakeConnection(object):
+  """A DBAPI connection that fails when used after it is marked dead."""
+
+  def __init__(self):
+    self.alive = True
+
+  def cursor(self):
+    if not self.alive:
+      raise IOError('Connection lost')
+    return mock.MagicMock()
+
+  def rollback(self):
+    pass
+
+  def close(self):
+    pass
+
+
+class ConnectionPoolTest(unittest.TestCase):
+
+  def setUp(self):
+    self.connections = []
+    self.pool = MonitoredQueuePool(self._connect, pool_size=1, max_overflow=1)
+    self.stats = PoolStats('test', capacity=2)
+    self.pool.stats = self.stats
+    ping_idle_connections(self.pool, 0)
+    monitor_pool(self.pool, self.stats)
+
+  def _connect(self):
+    connection = _FakeConnection()
+    self.connections.append(connection)
+    return connection
+
+  def test_stats(self):
+    first = self.pool.connect()
+    second = self.pool.connect()
+    second.close()
+    first.close()
+    self.pool.connect().close()
+
+    stats_json = self.stats.to_json()
+    self.assertEquals(3, stats_json['checkouts'])
+    self.assertEquals(0, stats_json['checkedOut'])
+    self.assertEquals(2, stats_json['maxCheckedOut'])
+    self.assertEquals(1.0, stats_json['saturation'])
+    self.assertEquals(2, stats_json['connectionsOpened'])
+    self.assertEquals(0, stats_json['connectionsInvalidated'])
+
+  def test_dead_connection_replaced_on_checkout(self):
+    self.pool.connect().close()
+    self.connections[0].alive = False
+    self.pool.connect().close()
+
+    self.assertEquals(2, len(self.connections))
+    self.assertEquals(2, self.stats.checkouts)
+    self.assertEquals(0, self.stats.checked_out)
+    self.assertEquals(2, self.stats.connections_opened)
+    self.assertEquals(1, self.stats.connections_invalidated)
@@ -7,7 +7,7 @@ from unit_test_util import SqlTestBase
 
 
 class BiobankStoredSampleDaoTest(SqlTestBase):
-  """Tests only that a sample can be written and read; see the reconciliation pipeline."""
+  """Tests writing and reading samples; see also the reconciliation pipeline."""
 
   def setUp(self):
     super(BiobankStoredSampleDaoTest, self).setUp()
@@ -28,3 +28,25 @@ class BiobankStoredSampleDaoTest(SqlTestBase):
     fetched = self.dao.get(sample_id)
     self.assertEquals(test_code, created.test)
     self.assertEquals(test_code, fetched.test)
+
+  def _make_sample(self, sample_id, test, order_identifier='KIT'):
+    return BiobankStoredSample(
+        biobankStoredSampleId=sample_id,
+        biobankId=self.participant.biobankId,
+        biobankOrderIdentifier=order_identifier,
+        test=test)
+
+  def test_upsert_all(self):
+    self.dao.insert(self._make_sample('WEB1', '1ED10'))
+    written, skipped = self.dao.upsert_all([
+        self._make_sample('WEB1', '1ED10', order_identifier='KIT2'),
+        self._make_sample('WEB2', '1UR10'),
+        self._make_sample('WEB3', 'UNKNOWN'),
+        self._make_sample('WEB4', '1SAL'),
+    ], batch_size=2)
+    self.assertEquals(3, written)
+    self.assertEquals(1, skipped)
+    self.assertEquals(3, self.dao.count())
+    self.assertEquals('KIT2', self.dao.get('WEB1').biobankOrderIdentifier)
+    self.assertEquals('1SAL', self.dao.get('WEB4').test)
+    self.assertIsNone(self.dao.get('WEB3'))
@@ -1,9 +1,13 @@
 import datetime
+import mock
 
 from clock import FakeClock
 from unit_test_util import SqlTestBase
+from dao.cache_all_dao import CachedRecord, _get_cache_version, _write_cache_changes
 from dao.code_dao import CodeDao, CodeBookDao, CodeHistoryDao
+from model.cache_version import CacheChange
 from model.code import Code, CodeBook, CodeHistory, CodeType
+from sqlalchemy import event
 from werkzeug.exceptions import BadRequest
 
 TIME = datetime.datetime(2016, 1, 1, 10, 0)
@@ -39,6 +43,20 @@ class CodeDaoTest(SqlTestBase):
                                         mapped=True, created=TIME)
     self.assertEquals(expected_code_history.asdict(), self.code_history_dao.get(1).asdict())
 
+  def test_cache_version_only_changed_by_dao_writes(self):
+    with FakeClock(TIME):
+      self.code_dao.insert(Code(system="a", value="b", display=u"c", topic=u"d",
+                                codeType=CodeType.MODULE, mapped=True))
+    # Sessions that don't write through a CacheAllDao don't record cache changes.
+    with self.code_dao.session() as session:
+      session.add(Code(system="a", value="e", display=u"f", topic=u"d",
+                       codeType=CodeType.MODULE, mapped=True, created=TIME))
+      self.assertFalse(event.contains(session, 'before_commit', _write_cache_changes))
+    with self.code_dao.session() as session:
+      self.assertEquals(1, _get_cache_version(session, 'code'))
+      self.assertEquals([(1, 1)], session.query(CacheChange.version, CacheChange.entityId)
+                                  .filter(CacheChange.tableName == 'code').all())
+
   def test_insert_with_codebook_and_parent(self):
     code_book_1 = CodeBook(name="pmi", version="v1", system="a")
     with FakeClock(TIME):
@@ -187,6 +205,14 @@ class CodeDaoTest(SqlTestBase):
     with FakeClock(TIME):
       self.code_book_dao.import_codebook(codebook)
 
+    # The import changes the cached codes table once.
+    with self.code_dao.session() as session:
+      self.assertEquals(1, _get_cache_version(session, 'code'))
+      self.assertEquals(
+          [(1, code_id) for code_id in range(1, 9)],
+          sorted(session.query(CacheChange.version, CacheChange.entityId)
+                 .filter(CacheChange.tableName == 'code')))
+
     expectedCodeBook = CodeBook(codeBookId=1, latest=True, created=TIME, name="pmi", version="v1",
                                 system=system)
     self.assertEquals(expectedCodeBook.asdict(), self.code_book_dao.get(1).asdict())
@@ -217,6 +243,59 @@ class CodeDaoTest(SqlTestBase):
                            created=TIME, parentId=3)
     self.assertEquals(expectedAnswer1.asdict(), self.code_dao.get(4).asdict())
 
+  def test_compact_cache(self):
+    answer_1 = _make_concept(u"t1", "Answer", "c1", u"d1")
+    answer_2 = _make_concept(u"t1", "Answer", "c2", u"d2")
+    question_1 = _make_concept(u"t1", "Question", "q1", u"d3", [answer_1, answer_2])
+    module_1 = _make_concept(u"mt1", "Module Name", "m1", u"d4", [question_1])
+    system = 'http://blah/foo'
+    codebook = { 'name': 'pmi', 'version': 'v1', 'url': system, 'concept': [module_1]}
+    with FakeClock(TIME):
+      self.code_book_dao.import_codebook(codebook)
+
+    answer = self.code_dao.get_code(system, "c2")
+    self.assertIsInstance(answer, CachedRecord)
+    self.assertIs(answer, self.code_dao.get(answer.codeId))
+    self.assertEquals(Code(codeBookId=1, codeId=4, system=system, value="c2", shortValue="c2",
+                           display=u"d2", topic=u"t1", codeType=CodeType.ANSWER, mapped=True,
+                           created=TIME, parentId=2).asdict(),
+                      answer.asdict())
+    question = answer.parent
+    self.assertEquals("q1", question.value)
+    self.assertEquals(["c1", "c2"], sorted(code.value for code in question.children))
+    self.assertEquals([], answer.children)
+    self.assertIs(question.parent,
+                  self.code_dao.find_ancestor_of_type(answer, CodeType.MODULE))
+    # Equal strings are stored once.
+    self.assertIs(answer.system, question.system)
+    self.assertIs(answer.topic, question.topic)
+
+    # Without the compact cache, the same values are cached as Code objects.
+    self.code_dao.compact_cache = False
+    entity_cache = self.code_dao._load_cache()
+    self.assertEquals(
+        {code_id: code.asdict() for code_id, code in entity_cache.id_to_entity.iteritems()},
+        {code.codeId: code.asdict() for code in self.code_dao.get_all()})
+    self.assertIsInstance(entity_cache.id_to_entity[answer.codeId], Code)
+
+  def test_get_or_add_codes_finds_codes_missing_from_cache(self):
+    cached_code = Code(system="a", value="b", display=u"c", topic=u"d",
+                       codeType=CodeType.QUESTION, mapped=True)
+    uncached_code = Code(system="a", value="e", display=u"f", topic=u"d",
+                         codeType=CodeType.QUESTION, mapped=True)
+    with FakeClock(TIME):
+      self.code_dao.insert(cached_code)
+      self.code_dao.insert(uncached_code)
+    code_map = {("a", "b"): (u"c", CodeType.QUESTION, None),
+                ("a", "e"): (u"f", CodeType.QUESTION, None)}
+
+    # The second code was added since the cache was loaded, so it is read from the database.
+    with mock.patch.object(self.code_dao, 'get_code',
+                           side_effect=lambda system, value: cached_code if value == "b" else None):
+      self.assertEquals({("a", "b"): cached_code.codeId, ("a", "e"): uncached_code.codeId},
+                        self.code_dao.get_or_add_codes(code_map))
+    self.assertEquals(2, len(self.code_dao.get_all()))
+
 def _make_concept(concept_topic, concept_type, code, display, child_concepts=None):
   concept = { 'property': [{ 'code': 'concept-topic', 'valueCode': concept_topic },
                            { 'code': 'concept-type', 'valueCode': concept_type } ],
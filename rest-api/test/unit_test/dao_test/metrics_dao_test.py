@@ -121,6 +121,35 @@ class MetricsDaoTest(SqlTestBase):
     self.assertEquals(metrics_bucket_1.asdict(), active_buckets[0].asdict())
     self.assertEquals(metrics_bucket_2.asdict(), active_buckets[1].asdict())
 
+  def test_get_active_buckets_with_bucket_ranges(self):
+    with FakeClock(TIME):
+      self.metrics_version_dao.set_pipeline_in_progress()
+    day_1 = datetime.date(2016, 1, 1)
+    day_2 = datetime.date(2016, 1, 2)
+    day_3 = datetime.date(2016, 1, 3)
+    day_4 = datetime.date(2016, 1, 4)
+    self.metrics_bucket_dao.insert(MetricsBucket(metricsVersionId=1, date=day_1, endDate=day_3,
+                                                 hpoId='', metrics='foo'))
+    self.metrics_bucket_dao.insert(MetricsBucket(metricsVersionId=1, date=day_4, endDate=day_4,
+                                                 hpoId='', metrics='bar'))
+    self.metrics_bucket_dao.insert(MetricsBucket(metricsVersionId=1, date=day_2, hpoId=PITT,
+                                                 metrics='baz'))
+    with FakeClock(TIME_2):
+      self.metrics_version_dao.set_pipeline_finished(True)
+
+    def get_dates_and_metrics(**kwargs):
+      return [(bucket.date, bucket.hpoId, bucket.metrics)
+              for bucket in self.metrics_bucket_dao.get_active_buckets(**kwargs)]
+
+    self.assertEquals([(day_1, '', 'foo'), (day_2, '', 'foo'), (day_2, PITT, 'baz'),
+                       (day_3, '', 'foo'), (day_4, '', 'bar')],
+                      get_dates_and_metrics())
+    # Ranges are cut off at the start and end dates.
+    self.assertEquals([(day_2, '', 'foo'), (day_2, PITT, 'baz'), (day_3, '', 'foo')],
+                      get_dates_and_metrics(start_date=day_2, end_date=day_3))
+    self.assertEquals([(day_3, '', 'foo'), (day_4, '', 'bar')],
+                      get_dates_and_metrics(start_date=day_3))
+
   def test_insert_duplicate_bucket(self):
     with FakeClock(TIME):
       self.metrics_version_dao.set_pipeline_in_progress()
@@ -1,11 +1,15 @@
 import datetime
 import json
+import mock
 from base64 import urlsafe_b64encode, urlsafe_b64decode
 
 from query import Query, Operator, FieldFilter, OrderBy
+from sqlalchemy.dialects import mysql
 
 import config
-from dao.base_dao import json_serial
+import singletons
+from clock import FakeClock
+from dao.base_dao import json_serial, _make_keyset_filter, QueryTotalCache
 from dao.biobank_stored_sample_dao import BiobankStoredSampleDao
 from dao.participant_dao import ParticipantDao
 from dao.participant_summary_dao import ParticipantSummaryDao
@@ -13,7 +17,7 @@ from model.participant import Participant
 from model.participant_summary import ParticipantSummary
 from model.biobank_stored_sample import BiobankStoredSample
 from participant_enums import EnrollmentStatus, PhysicalMeasurementsStatus
-from participant_enums import SampleStatus, QuestionnaireStatus
+from participant_enums import SampleStatus, QuestionnaireStatus, WithdrawalStatus
 from unit_test_util import NdbTestBase, PITT_HPO_ID
 
 NUM_BASELINE_PPI_MODULES = 3
@@ -58,6 +62,94 @@ class ParticipantSummaryDaoTest(NdbTestBase):
     results = self.dao.query(query)
     self.assertEqual(results.total, num_participants)
 
+  def test_query_with_total_reused_for_later_pages(self):
+    now = datetime.datetime(2018, 1, 1)
+    with FakeClock(now):
+      for i in range(3):
+        self._insert(Participant(participantId=i, biobankId=i))
+      first_page = self.dao.query(Query([], None, 2, None, include_total=True))
+      self.assertEqual(3, first_page.total)
+      self._insert(Participant(participantId=3, biobankId=3))
+      second_page = self.dao.query(Query([], None, 2, first_page.pagination_token,
+                                         include_total=True))
+      # The total counted for the first page is reused while paging.
+      self.assertEqual(3, second_page.total)
+      # A first page, or a query with other filters, is counted again.
+      self.assertEqual(4, self.dao.query(Query([], None, 2, None, include_total=True)).total)
+      self.assertEqual(1, self.dao.query(
+          Query([FieldFilter('participantId', Operator.EQUALS, 1)], None, 2,
+                first_page.pagination_token, include_total=True)).total)
+    with FakeClock(now + datetime.timedelta(seconds=config.QUERY_TOTAL_CACHE_TTL_SECONDS + 1)):
+      self._insert(Participant(participantId=4, biobankId=4))
+      third_page = self.dao.query(Query([], None, 2, second_page.pagination_token,
+                                        include_total=True))
+      self.assertEqual(5, third_page.total)
+
+  def test_query_total_cache_removes_expired_and_least_recently_used(self):
+    now = datetime.datetime(2018, 1, 1)
+    cache = QueryTotalCache(max_size=2)
+    with FakeClock(now):
+      cache.put('a', 1, 10)
+      cache.put('b', 2, 100)
+    with FakeClock(now + datetime.timedelta(seconds=20)):
+      cache.put('c', 3, 100)
+      # 'a' expired, so was removed rather than 'b'.
+      self.assertEqual(2, cache.size())
+      self.assertIsNone(cache.get('a'))
+      self.assertEqual(2, cache.get('b'))
+      cache.put('d', 4, 100)
+      self.assertEqual(2, cache.size())
+      self.assertIsNone(cache.get('c'))
+      self.assertEqual(2, cache.get('b'))
+      self.assertEqual(4, cache.get('d'))
+
+  def test_query_total_cache_singleton_reused_while_empty(self):
+    cache = singletons.get(singletons.QUERY_TOTAL_CACHE_INDEX, QueryTotalCache)
+    self.assertEqual(0, cache.size())
+    self.assertIs(cache, singletons.get(singletons.QUERY_TOTAL_CACHE_INDEX, QueryTotalCache))
+
+  def test_keyset_filter_uses_row_values(self):
+    fields = [ParticipantSummary.hpoId, ParticipantSummary.lastName,
+              ParticipantSummary.participantId]
+    ascending_sql = str(_make_keyset_filter(fields, [PITT_HPO_ID, 'Smith', 1], False).compile(
+        dialect=mysql.dialect()))
+    self.assertEquals('(participant_summary.hpo_id, participant_summary.last_name, '
+                      'participant_summary.participant_id) > (%s, %s, %s)', ascending_sql)
+    descending_sql = str(_make_keyset_filter(fields, [PITT_HPO_ID, 'Smith', 1], True).compile(
+        dialect=mysql.dialect()))
+    self.assertIn('participant_summary.hpo_id < %s', descending_sql)
+    self.assertIn('participant_summary.hpo_id IS NULL', descending_sql)
+    self.assertIn('(participant_summary.last_name, participant_summary.participant_id) > (%s, %s)',
+                  descending_sql)
+
+  def test_to_client_json_withdrawn(self):
+    withdrawal_time = datetime.datetime(2018, 1, 1)
+    summary = self._participant_summary_with_defaults(
+        participantId=1, biobankId=2, hpoId=PITT_HPO_ID, firstName='Alice', lastName='Smith',
+        email='alice@example.com', dateOfBirth=datetime.date(1980, 1, 2),
+        lastModified=withdrawal_time, withdrawalStatus=WithdrawalStatus.NO_USE,
+        withdrawalTime=withdrawal_time)
+    with FakeClock(withdrawal_time + datetime.timedelta(days=1)):
+      recent_json = self.dao.to_client_json(summary)
+    self.assertEquals('alice@example.com', recent_json['email'])
+    self.assertEquals('UNSET', recent_json['state'])
+    self.assertEquals('UNSET', recent_json['organization'])
+    with FakeClock(withdrawal_time + datetime.timedelta(days=3)):
+      withdrawn_json = self.dao.to_client_json(summary)
+    self.assertNotIn('email', withdrawn_json)
+    self.assertNotIn('organization', withdrawn_json)
+    self.assertNotIn('lastModified', withdrawn_json)
+    self.assertEquals('P1', withdrawn_json['participantId'])
+    self.assertEquals('PITT', withdrawn_json['awardee'])
+    self.assertEquals('Smith', withdrawn_json['lastName'])
+    self.assertEquals('1980-01-02', withdrawn_json['dateOfBirth'])
+    self.assertEquals('2018-01-01T00:00:00', withdrawn_json['withdrawalTime'])
+    self.assertEquals('NO_USE', withdrawn_json['withdrawalStatus'])
+    self.assertEquals('UNSET', withdrawn_json['state'])
+    self.assertEquals('UNSET', withdrawn_json['suspensionStatus'])
+    self.assertEquals('UNSET', withdrawn_json['site'])
+    self.assertEquals('NO_CONTACT', withdrawn_json['recontactMethod'])
+
   def testQuery_noSummaries(self):
     self.assert_no_results(self.no_filter_query)
     self.assert_no_results(self.one_filter_query)
@@ -247,6 +339,25 @@ class ParticipantSummaryDaoTest(NdbTestBase):
     self.assertNotEqual(M_first_update.lastModified, M_second_update.lastModified)
     self.assertEquals(p_baseline_update.lastModified, test_last_modified_doesnt_change_below)
 
+  def test_update_from_samples_for_biobank_ids(self):
+    baseline_tests = ["1PST8", "2PST8"]
+    config.override_setting(config.BASELINE_SAMPLE_TEST_CODES, baseline_tests)
+    self.dao.update_from_biobank_stored_samples(biobank_ids=[])  # safe noop
+
+    p_updated = self._insert(Participant(participantId=1, biobankId=11))
+    p_not_updated = self._insert(Participant(participantId=2, biobankId=22))
+    sample_dao = BiobankStoredSampleDao()
+    for participant, sample_id in ((p_updated, '11111'), (p_not_updated, '22222')):
+      sample_dao.insert(BiobankStoredSample(
+          biobankStoredSampleId=sample_id, biobankId=participant.biobankId,
+          biobankOrderIdentifier='KIT', test=baseline_tests[0],
+          confirmed=datetime.datetime(2018, 3, 2)))
+
+    with mock.patch('dao.participant_summary_dao._BIOBANK_ID_BATCH_SIZE', 1):
+      self.dao.update_from_biobank_stored_samples(biobank_ids=set([11, 33]))
+    self.assertEquals(self.dao.get(p_updated.participantId).numBaselineSamplesArrived, 1)
+    self.assertEquals(self.dao.get(p_not_updated.participantId).numBaselineSamplesArrived, 0)
+
   def test_calculate_enrollment_status(self):
     self.assertEquals(EnrollmentStatus.FULL_PARTICIPANT,
                       self.dao.calculate_enrollment_status(True,
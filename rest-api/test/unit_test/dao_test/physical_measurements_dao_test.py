@@ -158,6 +158,10 @@ class PhysicalMeasurementsDaoTest(SqlTestBase):
     self.assertEquals('amended', amended_json['entry'][0]['resource']['status'])
     self.assertEquals('1', amended_json['id'])
 
+    # The amended measurements get a new log position, so that syncs see the change.
+    self.assertGreater(measurements.logPositionId, 1)
+    self.assertNotEqual(new_measurements.logPositionId, measurements.logPositionId)
+
     amendment_json = json.loads(new_measurements.resource)
     self.assertEquals('2', amendment_json['id'])
     self.assertTrue(new_measurements.final)
@@ -3,6 +3,7 @@ import datetime
 from dao.code_dao import CodeDao
 from dao.questionnaire_dao import QuestionnaireDao, QuestionnaireHistoryDao
 from dao.questionnaire_dao import QuestionnaireConceptDao, QuestionnaireQuestionDao
+from dao.questionnaire_dao import FrozenQuestion, QuestionnaireVersionCache
 from model.code import Code, CodeType
 from model.questionnaire import Questionnaire, QuestionnaireHistory
 from model.questionnaire import QuestionnaireConcept, QuestionnaireQuestion
@@ -179,4 +180,46 @@ class QuestionnaireDaoTest(SqlTestBase):
                         .questionnaireId)
     self.assertEquals(1,
                       self.dao.get_latest_questionnaire_with_concept(self.CODE_2.codeId)
-                        .questionnaireId)
\ No newline at end of file
+                        .questionnaireId)
+
+  def test_get_frozen(self):
+    self.assertIsNone(self.questionnaire_history_dao.get_frozen(1, 1))
+    self.assertIsNone(self.dao.get_version(1))
+    q = Questionnaire(resource=RESOURCE_1)
+    q.concepts.append(self.CONCEPT_1)
+    q.concepts.append(self.CONCEPT_2)
+    q.questions.append(self.QUESTION_1)
+    q.questions.append(self.QUESTION_2)
+    with FakeClock(TIME):
+      self.dao.insert(q)
+    self.assertEquals(1, self.dao.get_version(1))
+
+    frozen = self.questionnaire_history_dao.get_frozen(1, 1)
+    self.assertEquals((1, 1), (frozen.questionnaireId, frozen.version))
+    self.assertEquals(frozenset([1, 2]), frozen.question_ids)
+    self.assertEquals({1: 4, 2: 5}, frozen.question_id_to_code_id)
+    self.assertEquals({'a': FrozenQuestion(1, 'a', 4), 'd': FrozenQuestion(2, 'd', 5)},
+                      frozen.link_id_to_question)
+    self.assertEquals([1, 2], sorted(frozen.concept_code_ids))
+    self.assertIs(frozen, self.questionnaire_history_dao.get_frozen(1, 1))
+
+    q = Questionnaire(questionnaireId=1, version=1, resource=RESOURCE_2)
+    q.questions.append(QuestionnaireQuestion(linkId='e', codeId=6, repeats=False))
+    with FakeClock(TIME_2):
+      self.dao.update(q)
+    self.assertEquals(2, self.dao.get_version(1))
+    frozen_2 = self.questionnaire_history_dao.get_frozen(1, 2)
+    self.assertEquals(['e'], frozen_2.link_id_to_question.keys())
+    # The earlier version is unchanged.
+    self.assertEquals(['a', 'd'], sorted(self.questionnaire_history_dao.get_frozen(1, 1)
+                                         .link_id_to_question.keys()))
+
+  def test_questionnaire_version_cache_evicts_least_recently_used(self):
+    cache = QuestionnaireVersionCache(max_size=2)
+    cache.put((1, 1), 'q1')
+    cache.put((2, 1), 'q2')
+    self.assertEquals('q1', cache.get((1, 1)))
+    cache.put((3, 1), 'q3')
+    self.assertIsNone(cache.get((2, 1)))
+    self.assertEquals('q1', cache.get((1, 1)))
+    self.assertEquals('q3', cache.get((3, 1)))
@@ -556,6 +556,100 @@ class QuestionnaireResponseDaoTest(FlaskTestBase):
     # changes.
     self.assertEquals(expected_ps3.asdict(), self.participant_summary_dao.get(1).asdict())
 
+    # Only the latest answer to each question code is indexed as current.
+    with self.questionnaire_response_answer_dao.session() as session:
+      current_answers = self.questionnaire_response_answer_dao.get_current_answers_for_concepts(
+          session, 1, [1, 2])
+    self.assertEquals([2, 7], sorted(answer.questionnaireResponseAnswerId
+                                     for answer in current_answers))
+
+  def test_resubmit_ends_all_previous_answers(self):
+    """Resubmitting a questionnaire ends every answer to its questions, including multiple answers
+    to a repeating question, and only those answers."""
+    self.insert_codes()
+    p = Participant(participantId=1, biobankId=2)
+    with FakeClock(TIME):
+      self.participant_dao.insert(p)
+    self._setup_questionnaire()
+
+    def make_answers(response_id, first_answer_id, end_time=None):
+      return [QuestionnaireResponseAnswer(questionnaireResponseAnswerId=first_answer_id + i,
+                                          questionnaireResponseId=response_id,
+                                          questionId=question_id, valueSystem='a',
+                                          valueCodeId=value_code_id, endTime=end_time)
+              for i, (question_id, value_code_id) in enumerate([(1, 3), (2, 4), (2, 6)])]
+
+    def make_response(response_id, answers, **kwargs):
+      qr = QuestionnaireResponse(questionnaireResponseId=response_id, questionnaireId=1,
+                                 questionnaireVersion=1, participantId=1, **kwargs)
+      qr.answers.extend(answers)
+      return qr
+
+    with FakeClock(TIME_2):
+      self.questionnaire_response_dao.insert(make_response(
+          1, self._names_and_email_answers() + make_answers(1, 6),
+          resource=QUESTIONNAIRE_RESPONSE_RESOURCE))
+    with FakeClock(TIME_3):
+      self.questionnaire_response_dao.insert(make_response(
+          2, make_answers(2, 10), resource=QUESTIONNAIRE_RESPONSE_RESOURCE_2))
+
+    # The names and e-mail weren't answered again, so they are still current.
+    self.check_response(make_response(
+        1, self._names_and_email_answers() + make_answers(1, 6, end_time=TIME_3),
+        resource=with_id(QUESTIONNAIRE_RESPONSE_RESOURCE, 1), created=TIME_2))
+    self.check_response(make_response(
+        2, make_answers(2, 10),
+        resource=with_id(QUESTIONNAIRE_RESPONSE_RESOURCE_2, 2), created=TIME_3))
+
+  def test_insert_responses_with_session_ends_answers_together(self):
+    """Responses inserted in one transaction end the answers they supersede, including answers from
+    earlier responses in the transaction, with one lookup of the participant's current answers."""
+    self.insert_codes()
+    p = Participant(participantId=1, biobankId=2)
+    with FakeClock(TIME):
+      self.participant_dao.insert(p)
+    self._setup_questionnaire()
+
+    def make_response(response_id, first_answer_id, resource, end_time=None, other_answers=(),
+                      **kwargs):
+      qr = QuestionnaireResponse(questionnaireResponseId=response_id, questionnaireId=1,
+                                 questionnaireVersion=1, participantId=1, resource=resource,
+                                 **kwargs)
+      qr.answers.extend(other_answers)
+      qr.answers.extend(
+          QuestionnaireResponseAnswer(questionnaireResponseAnswerId=first_answer_id + i,
+                                      questionnaireResponseId=response_id,
+                                      questionId=question_id, valueSystem='a',
+                                      valueCodeId=value_code_id, endTime=end_time)
+          for i, (question_id, value_code_id) in enumerate([(1, 3), (2, 4)]))
+      return qr
+
+    with FakeClock(TIME_2):
+      self.questionnaire_response_dao.insert(make_response(
+          1, 6, QUESTIONNAIRE_RESPONSE_RESOURCE, other_answers=self._names_and_email_answers()))
+    with FakeClock(TIME_3), mock.patch.object(
+        QuestionnaireResponseAnswerDao, 'get_current_answer_ids_by_code_id',
+        wraps=QuestionnaireResponseAnswerDao.get_current_answer_ids_by_code_id) as get_current:
+      with self.questionnaire_response_dao.session() as session:
+        self.questionnaire_response_dao._insert_responses_with_session(session, 1, [
+            make_response(2, 10, QUESTIONNAIRE_RESPONSE_RESOURCE_2),
+            make_response(3, 12, QUESTIONNAIRE_RESPONSE_RESOURCE_3)])
+    self.assertEquals(1, get_current.call_count)
+
+    # The names and e-mail weren't answered again, so they are still current.
+    self.check_response(make_response(1, 6, with_id(QUESTIONNAIRE_RESPONSE_RESOURCE, 1),
+                                      end_time=TIME_3, created=TIME_2,
+                                      other_answers=self._names_and_email_answers()))
+    self.check_response(make_response(2, 10, with_id(QUESTIONNAIRE_RESPONSE_RESOURCE_2, 2),
+                                      end_time=TIME_3, created=TIME_3))
+    self.check_response(make_response(3, 12, with_id(QUESTIONNAIRE_RESPONSE_RESOURCE_3, 3),
+                                      created=TIME_3))
+    with self.questionnaire_response_answer_dao.session() as session:
+      current_answers = self.questionnaire_response_answer_dao.get_current_answers_for_concepts(
+          session, 1, [1, 2])
+    self.assertEquals([12, 13], sorted(answer.questionnaireResponseAnswerId
+                                       for answer in current_answers))
+
   def _get_questionnaire_response_with_consents(self, *consent_paths):
     self.insert_codes()
     questionnaire = self._setup_questionnaire()
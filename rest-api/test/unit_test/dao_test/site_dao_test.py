@@ -1,3 +1,6 @@
+import mock
+
+import singletons
 from unit_test_util import SqlTestBase, PITT_HPO_ID, UNSET_HPO_ID
 from dao.site_dao import SiteDao
 from model.site import Site
@@ -36,3 +39,23 @@ class SiteDaoTest(SqlTestBase):
                       self.site_dao.get_by_google_group('site2@googlegroups.com').asdict())
     self.assertIsNone(self.site_dao.get_by_google_group('site@googlegroups.com'))
 
+
+  def test_update_from_other_instance(self):
+    site = Site(siteName='site', googleGroup='site@googlegroups.com',
+                mayolinkClientNumber=12345, hpoId=PITT_HPO_ID)
+    created_site = self.site_dao.insert(site)
+    self.assertEquals('site', self.site_dao.get(created_site.siteId).siteName)
+    new_site = Site(siteId=created_site.siteId, siteName='site2',
+                    googleGroup='site2@googlegroups.com',
+                    mayolinkClientNumber=123456, hpoId=UNSET_HPO_ID)
+    # Update the site without invalidating this instance's cache, as another instance would.
+    with mock.patch.object(singletons, 'invalidate'):
+      self.site_dao.update(new_site)
+    self.assertEquals('site', self.site_dao.get(created_site.siteId).siteName)
+
+    # Once the cache version is checked, the updated site is reloaded.
+    with mock.patch('dao.cache_all_dao.CACHE_VERSION_CHECK_SECONDS', 0):
+      self.assertEquals(new_site.asdict(), self.site_dao.get(created_site.siteId).asdict())
+      self.assertEquals(new_site.asdict(),
+                        self.site_dao.get_by_google_group('site2@googlegroups.com').asdict())
+      self.assertIsNone(self.site_dao.get_by_google_group('site@googlegroups.com'))
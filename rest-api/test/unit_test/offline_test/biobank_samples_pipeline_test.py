@@ -58,8 +58,9 @@ class BiobankSamplesPipelineTest(CloudStorageSqlTestBase, NdbTestBase):
         biobank_samples_pipeline.INPUT_CSV_TIME_FORMAT)
     self._write_cloud_csv(input_filename, samples_file.read())
 
-    biobank_samples_pipeline.upsert_from_latest_csv()
+    written, skipped, _ = biobank_samples_pipeline.upsert_from_latest_csv()
 
+    self.assertEquals((3, 0), (written, skipped))
     self.assertEquals(dao.count(), 3)
     self._check_summary(participant_ids[0], test1, '2016-11-29T12:19:32')
     self._check_summary(participant_ids[1], test2, '2016-11-29T12:38:58')
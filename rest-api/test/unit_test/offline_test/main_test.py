@@ -22,7 +22,7 @@ class MainTest(TestBase):
       self, mock_send_mail, mock_get_app_id, mock_check_cron, mock_upsert):
     mock_get_app_id.return_value = 'all-of-us-rdr-unittests'
     # The return value should be unused, but it clarifies errors to have a realistic value.
-    mock_upsert.return_value = 25, clock.CLOCK.now()
+    mock_upsert.return_value = 25, 0, clock.CLOCK.now()
     mock_upsert.side_effect = ValueError('should be thrown for test')
     with self.assertRaises(ValueError):
       main.import_biobank_samples()
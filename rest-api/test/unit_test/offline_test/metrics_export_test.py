@@ -1,5 +1,6 @@
 from __future__ import print_function
 
+import config
 import datetime
 import json
 import offline.metrics_export
@@ -23,6 +24,7 @@ from model.participant import Participant
 from offline.metrics_config import ANSWER_FIELD_TO_QUESTION_CODE
 from offline.metrics_config import get_participant_fields, HPO_ID_FIELDS, ANSWER_FIELDS
 from offline.metrics_export import MetricsExport, _HPO_IDS_CSV, _PARTICIPANTS_CSV, _ANSWERS_CSV
+from offline.metrics_pipeline import INTERMEDIATE_FORMAT_RECORDS
 from offline_test.gcs_utils import assertCsvContents
 from test_data import load_biobank_order_json, load_measurement_json
 from unit_test_util import FlaskTestBase, CloudStorageSqlTestBase, SqlTestBase, TestBase
@@ -645,6 +647,24 @@ class MetricsExportTest(CloudStorageSqlTestBase, FlaskTestBase):
     # There is a biobank order on 1/4, but it gets ignored since it's after the run date.
     self.assertBucket(bucket_map, TIME_4, '')
 
+  def _run_export_and_pipeline(self):
+    with FakeClock(TIME_3):
+      MetricsExport.start_export_tasks(BUCKET_NAME, 2)
+      run_deferred_tasks(self)
+    with FakeClock(TIME_4):
+      test_support.execute_until_empty(self.taskqueue)
+    metrics_version = MetricsVersionDao().get_serving_version()
+    buckets = MetricsVersionDao().get_with_children(metrics_version.metricsVersionId).buckets
+    return {(bucket.date, bucket.hpoId): json.loads(bucket.metrics) for bucket in buckets}
+
+  def test_metric_export_with_records_format(self):
+    self._create_data()
+    text_buckets = self._run_export_and_pipeline()
+    config.override_setting(config.METRICS_INTERMEDIATE_FORMAT, [INTERMEDIATE_FORMAT_RECORDS])
+    records_buckets = self._run_export_and_pipeline()
+    self.assertTrue(text_buckets)
+    self.assertEquals(text_buckets, records_buckets)
+
   def assertBucket(self, bucket_map, dt, hpoId, metrics=None):
     bucket = bucket_map.get((dt.date(), hpoId))
     if metrics:
@@ -0,0 +1,131 @@
+import datetime
+import json
+import offline.metrics_export
+
+from clock import FakeClock
+from code_constants import CONSENT_PERMISSION_YES_CODE, EHR_CONSENT_QUESTION_CODE
+from code_constants import RACE_WHITE_CODE, RACE_NONE_OF_THESE_CODE, PMI_SKIP_CODE
+from field_mappings import FIELD_TO_QUESTIONNAIRE_MODULE_CODE
+from mapreduce import test_support
+from model.code import CodeType
+from model.hpo import HPO
+from dao.hpo_dao import HPODao
+from dao.metrics_dao import MetricsVersionDao
+from dao.participant_dao import ParticipantDao, make_primary_provider_link_for_name
+from model.participant import Participant
+from offline import metrics_incremental
+from offline.metrics_config import ANSWER_FIELD_TO_QUESTION_CODE
+from offline.metrics_export import MetricsExport
+from test_data import load_measurement_json
+from unit_test_util import FlaskTestBase, CloudStorageSqlTestBase, SqlTestBase, TestBase
+from unit_test_util import run_deferred_tasks, PITT_HPO_ID
+
+BUCKET_NAME = 'pmi-drc-biobank-test.appspot.com'
+TIME = datetime.datetime(2016, 1, 1)
+TIME_2 = datetime.datetime(2016, 1, 2)
+TIME_3 = datetime.datetime(2016, 1, 3)
+TIME_4 = datetime.datetime(2016, 1, 4)
+TIME_5 = datetime.datetime(2016, 1, 6)
+
+
+class MetricsIncrementalTest(CloudStorageSqlTestBase, FlaskTestBase):
+  """Tests incremental updates of metrics against full runs of the metrics pipeline."""
+
+  def setUp(self):
+    super(MetricsIncrementalTest, self).setUp()
+    FlaskTestBase.doSetUp(self)
+    TestBase.setup_fake(self)
+    offline.metrics_export._QUEUE_NAME = 'default'
+    self.taskqueue.FlushQueue('default')
+    self.maxDiff = None
+
+  def tearDown(self):
+    super(MetricsIncrementalTest, self).tearDown()
+    FlaskTestBase.doTearDown(self)
+
+  def _setup_codes_and_questionnaires(self):
+    HPODao().insert(HPO(hpoId=PITT_HPO_ID + 1, name='AZ_TUCSON_2'))
+    HPODao().insert(HPO(hpoId=PITT_HPO_ID + 4, name='TEST'))
+    SqlTestBase.setup_codes(
+        ANSWER_FIELD_TO_QUESTION_CODE.values() + [EHR_CONSENT_QUESTION_CODE],
+        code_type=CodeType.QUESTION)
+    SqlTestBase.setup_codes(
+        FIELD_TO_QUESTIONNAIRE_MODULE_CODE.values(), code_type=CodeType.MODULE)
+    SqlTestBase.setup_codes([
+      RACE_WHITE_CODE, CONSENT_PERMISSION_YES_CODE, RACE_NONE_OF_THESE_CODE, 'female',
+      PMI_SKIP_CODE
+    ], code_type=CodeType.ANSWER)
+    self.questionnaire_id = self.create_questionnaire('questionnaire3.json')
+    self.consent_questionnaire_id = self.create_questionnaire('all_consents_questionnaire.json')
+
+  def _run_pipeline(self, now):
+    with FakeClock(now):
+      MetricsExport.start_export_tasks(BUCKET_NAME, 2)
+      run_deferred_tasks(self)
+      test_support.execute_until_empty(self.taskqueue)
+
+  def _get_bucket_metrics(self, metrics_version_id):
+    """Returns (date, hpoId) -> metrics JSON for a version."""
+    buckets = MetricsVersionDao().get_with_children(metrics_version_id).buckets
+    return {(bucket.date, bucket.hpoId): json.loads(bucket.metrics) for bucket in buckets}
+
+  def test_update_without_serving_version(self):
+    self.assertFalse(metrics_incremental.update_serving_version(TIME))
+
+  def test_update_matches_full_rebuild(self):
+    self._setup_codes_and_questionnaires()
+    participant_dao = ParticipantDao()
+    pl_tucson = make_primary_provider_link_for_name('AZ_TUCSON')
+    pl_pitt = make_primary_provider_link_for_name('PITT')
+
+    with FakeClock(TIME):
+      participant_dao.insert(Participant(participantId=1, biobankId=2, providerLink=pl_tucson))
+      self.send_consent('P1', email='bob@gmail.com')
+      participant_dao.insert(Participant(participantId=2, biobankId=3))
+      self.send_consent('P2', email='larry@gmail.com')
+
+    with FakeClock(TIME_2):
+      self.submit_questionnaire_response('P1', self.questionnaire_id,
+                                         race_code=RACE_WHITE_CODE,
+                                         gender_code=PMI_SKIP_CODE,
+                                         state=None,
+                                         date_of_birth=datetime.date(1980, 1, 2))
+
+    self._run_pipeline(TIME_2)
+    version = MetricsVersionDao().get_serving_version()
+
+    with FakeClock(TIME_3):
+      # P2 gets paired, P1 changes their answers, and P3 signs up.
+      participant = participant_dao.get(2)
+      participant.providerLink = pl_pitt
+      participant_dao.update(participant)
+      self.send_post('Participant/P2/PhysicalMeasurements', load_measurement_json(2))
+      self.submit_questionnaire_response('P1', self.questionnaire_id,
+                                         race_code=RACE_NONE_OF_THESE_CODE,
+                                         gender_code='female',
+                                         state=None,
+                                         date_of_birth=None)
+      self.submit_consent_questionnaire_response('P1', self.consent_questionnaire_id,
+                                                  CONSENT_PERMISSION_YES_CODE)
+      participant_dao.insert(Participant(participantId=3, biobankId=4, providerLink=pl_tucson))
+      self.send_consent('P3', email='fred@gmail.com')
+
+    with FakeClock(TIME_5):
+      # P3 answers white as P1 (also in AZ_TUCSON) no longer does, so the count for white in
+      # AZ_TUCSON is 0 in between.
+      self.submit_questionnaire_response('P3', self.questionnaire_id,
+                                         race_code=RACE_WHITE_CODE,
+                                         gender_code=PMI_SKIP_CODE,
+                                         state=None,
+                                         date_of_birth=None)
+      self.assertTrue(metrics_incremental.update_serving_version())
+    self.assertEquals(version.metricsVersionId,
+                      MetricsVersionDao().get_serving_version().metricsVersionId)
+    updated_metrics = self._get_bucket_metrics(version.metricsVersionId)
+
+    self._run_pipeline(TIME_5)
+    rebuilt_version = MetricsVersionDao().get_serving_version()
+    self.assertNotEquals(version.metricsVersionId, rebuilt_version.metricsVersionId)
+    self.assertEquals(self._get_bucket_metrics(rebuilt_version.metricsVersionId), updated_metrics)
+    self.assertIn((TIME_5.date(), ''), updated_metrics)
+    self.assertIn(0, updated_metrics[(TIME_4.date(), 'AZ_TUCSON')].values())
@@ -0,0 +1,117 @@
+import csv
+import datetime
+import json
+import os
+import shutil
+import tempfile
+
+from dao.metrics_dao import MetricsBucketDao
+from offline import metrics_local_runner
+from offline.metrics_config import get_participant_fields, HPO_ID_FIELDS, ANSWER_FIELDS
+from offline.metrics_pipeline import INTERMEDIATE_FORMAT_RECORDS
+from unit_test_util import SqlTestBase
+
+NOW = datetime.datetime(2016, 1, 3)
+
+
+class MetricsLocalRunnerTest(SqlTestBase):
+
+  def setUp(self):
+    super(MetricsLocalRunnerTest, self).setUp()
+    self.input_dir = tempfile.mkdtemp()
+    self.output_dir = tempfile.mkdtemp()
+    self.input_paths = []
+    empty_participant_fields = [''] * (len(get_participant_fields()) - 1)
+    self._write_csv('participants_0.csv', get_participant_fields(), [
+        ['1'] + empty_participant_fields,
+    ])
+    self._write_csv('participants_1.csv', get_participant_fields(), [
+        ['2'] + empty_participant_fields,
+    ])
+    self._write_csv('hpo_ids_0.csv', HPO_ID_FIELDS, [
+        ['1', 'PITT', '2016-01-01T00:00:00Z'],
+        ['2', 'AZ_TUCSON', '2016-01-01T00:00:00Z'],
+        ['2', 'PITT', '2016-01-02T00:00:00Z'],
+    ])
+    self._write_csv('answers_0.csv', ANSWER_FIELDS, [])
+
+  def tearDown(self):
+    shutil.rmtree(self.input_dir)
+    shutil.rmtree(self.output_dir)
+    super(MetricsLocalRunnerTest, self).tearDown()
+
+  def _write_csv(self, file_name, header, rows):
+    path = os.path.join(self.input_dir, file_name)
+    with open(path, 'wb') as csv_file:
+      writer = csv.writer(csv_file)
+      writer.writerow(header)
+      writer.writerows(rows)
+    self.input_paths.append(path)
+
+  def _read_buckets(self, bucket_paths):
+    buckets = {}
+    for path in bucket_paths:
+      with open(path) as bucket_file:
+        for line in bucket_file:
+          bucket = json.loads(line)
+          buckets[(bucket['date'], bucket['hpoId'])] = bucket['metrics']
+    return buckets
+
+  def test_run_pipeline_in_process(self):
+    buckets = self._read_buckets(metrics_local_runner.run_pipeline(
+        self.input_paths, self.output_dir, NOW, num_processes=0, num_partitions=3))
+    self.assertEquals(1, buckets[('2016-01-01', 'PITT')]['Participant'])
+    self.assertEquals(1, buckets[('2016-01-01', 'AZ_TUCSON')]['Participant'])
+    self.assertEquals(2, buckets[('2016-01-03', 'PITT')]['Participant'])
+    self.assertEquals(2, buckets[('2016-01-03', '')]['Participant.hpoId.PITT'])
+    self.assertNotIn(('2016-01-02', 'AZ_TUCSON'), buckets)
+    # Only the bucket files are left behind.
+    self.assertEquals(['buckets_0.json', 'buckets_1.json', 'buckets_2.json'],
+                      sorted(os.listdir(self.output_dir)))
+
+  def test_run_pipeline_with_pool_matches_in_process(self):
+    in_process_buckets = self._read_buckets(metrics_local_runner.run_pipeline(
+        self.input_paths, self.output_dir, NOW, num_processes=0, num_partitions=2))
+    pool_buckets = self._read_buckets(metrics_local_runner.run_pipeline(
+        self.input_paths, self.output_dir, NOW, num_processes=2, num_partitions=4))
+    self.assertEquals(in_process_buckets, pool_buckets)
+
+  def test_run_pipeline_with_records_matches_text(self):
+    text_buckets = self._read_buckets(metrics_local_runner.run_pipeline(
+        self.input_paths, self.output_dir, NOW, num_processes=0, num_partitions=2))
+    records_buckets = self._read_buckets(metrics_local_runner.run_pipeline(
+        self.input_paths, self.output_dir, NOW, num_processes=0, num_partitions=2,
+        intermediate_format=INTERMEDIATE_FORMAT_RECORDS))
+    self.assertEquals(text_buckets, records_buckets)
+
+  def test_run_pipeline_with_bucket_ranges_matches_daily_buckets(self):
+    # Participant 3 joins AZ_TUCSON on 2016-01-04, after it has no participants for a day, so its
+    # bucket for 2016-01-03 has counts of 0.
+    empty_participant_fields = [''] * (len(get_participant_fields()) - 1)
+    self._write_csv('participants_2.csv', get_participant_fields(), [
+        ['3'] + empty_participant_fields,
+    ])
+    self._write_csv('hpo_ids_1.csv', HPO_ID_FIELDS, [
+        ['3', 'AZ_TUCSON', '2016-01-04T00:00:00Z'],
+    ])
+    now = datetime.datetime(2016, 1, 5)
+    daily_buckets = self._read_buckets(metrics_local_runner.run_pipeline(
+        self.input_paths, self.output_dir, now, num_processes=0, num_partitions=2))
+    self.assertEquals(0, daily_buckets[('2016-01-03', 'AZ_TUCSON')]['Participant'])
+    self.assertEquals(0, daily_buckets[('2016-01-03', '')]['Participant.hpoId.AZ_TUCSON'])
+    bucket_paths = metrics_local_runner.run_pipeline(self.input_paths, self.output_dir, now,
+                                                     num_processes=0, num_partitions=2,
+                                                     bucket_ranges=True)
+    metrics_local_runner.write_buckets(bucket_paths)
+    range_buckets = {(bucket.date.isoformat(), bucket.hpoId): json.loads(bucket.metrics)
+                     for bucket in MetricsBucketDao().get_active_buckets()}
+    self.assertEquals(daily_buckets, range_buckets)
+
+  def test_write_buckets(self):
+    bucket_paths = metrics_local_runner.run_pipeline(self.input_paths, self.output_dir, NOW,
+                                                     num_processes=0)
+    metrics_local_runner.write_buckets(bucket_paths)
+    buckets = MetricsBucketDao().get_active_buckets()
+    self.assertEquals(len(self._read_buckets(bucket_paths)), len(buckets))
+    cross_hpo_bucket = [b for b in buckets if b.date == NOW.date() and not b.hpoId][0]
+    self.assertEquals(2, json.loads(cross_hpo_bucket.metrics)['Participant'])
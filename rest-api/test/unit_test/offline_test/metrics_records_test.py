@@ -0,0 +1,56 @@
+import StringIO
+import unittest
+
+from offline import metrics_records
+
+_RECORDS = [
+    ('PITT|R|Participant', 736000, 1),
+    ('PITT|R|race.WHITE', 736000, 1),
+    ('PITT|F|hpoId.PITT', 736001, 1),
+    ('PITT|R|race.WHITE', 736300, -1),
+    ('AZ_TUCSON|R|race.WHITE', 735000, 123456789),
+]
+
+
+class MetricsRecordsTest(unittest.TestCase):
+
+  def _read_blocks(self, data):
+    blocks = []
+    for keys, records in metrics_records.iter_record_blocks(StringIO.StringIO(data)):
+      blocks.append([(keys[key_index], day, value) for key_index, day, value in records])
+    return blocks
+
+  def test_record_blocks_round_trip(self):
+    data = (metrics_records.make_record_block(_RECORDS) +
+            metrics_records.make_record_block(_RECORDS[:1]))
+    self.assertEquals([_RECORDS, _RECORDS[:1]], self._read_blocks(data))
+
+  def test_blocks_across_reads(self):
+    records = [('HPO_%d|R|state.PIIState_%d' % (i % 7, i), 736000 + i, i - 5000)
+               for i in range(2000)]
+    data = ''.join(metrics_records.make_record_block(records[i:i + 100])
+                   for i in range(0, len(records), 100))
+    read_size = metrics_records._READ_SIZE
+    # Blocks and their length prefixes are split across reads.
+    metrics_records._READ_SIZE = 7
+    try:
+      self.assertEquals(records, sum(self._read_blocks(data), []))
+    finally:
+      metrics_records._READ_SIZE = read_size
+
+  def test_interned_metrics_are_smaller(self):
+    interned = metrics_records.make_record_block([('PITT|R|race.WHITE', 736000, 1)])
+    not_interned = metrics_records.make_record_block([('PITT|R|race.NOT_A_RACE', 736000, 1)])
+    self.assertIn('race.WHITE', metrics_records.get_interned_metrics())
+    self.assertLess(len(interned), len(not_interned))
+    self.assertNotIn('race.WHITE', interned)
+
+  def test_truncated_block(self):
+    data = metrics_records.make_record_block(_RECORDS)
+    with self.assertRaises(ValueError):
+      self._read_blocks(data[:-2])
+
+  def test_day_values(self):
+    for day, value in [(0, 0), (736000, 1), (736000, -1), (1, -123456789)]:
+      self.assertEquals((day, value), metrics_records.decode_day_value(
+          metrics_records.encode_day_value(day, value)))
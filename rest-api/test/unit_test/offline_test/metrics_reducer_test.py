@@ -0,0 +1,181 @@
+import copy
+import datetime
+import random
+
+from code_constants import UNSET
+from dao.database_utils import format_datetime, parse_datetime
+from field_mappings import QUESTIONNAIRE_MODULE_FIELD_NAMES
+from offline.metrics_config import HPO_ID_METRIC, AGE_RANGE_METRIC, ENROLLMENT_STATUS_METRIC
+from offline.metrics_config import get_fieldnames
+from offline.metrics_pipeline import DATE_FORMAT, DATE_OF_BIRTH_PREFIX, TOTAL_SENTINEL
+from offline.metrics_pipeline import _REGISTERED_PARTICIPANT, _FULL_PARTICIPANT
+from offline.metrics_pipeline import _add_age_range_metrics, get_config, map_result_key
+from offline.metrics_pipeline import parse_metric, parse_tuple, reduce_result_value
+from offline.metrics_pipeline import reduce_participant_data_to_hpo_metric_date_deltas
+from participant_enums import EnrollmentStatus
+from test.unit_test.unit_test_util import NdbTestBase
+
+NOW = datetime.datetime(2018, 1, 1)
+HPOS = ['PITT', 'AZ_TUCSON', 'UNSET']
+METRICS = (['%s.%s' % (HPO_ID_METRIC, hpo) for hpo in HPOS] +
+           ['race.WHITE', 'race.OTHER_RACE', 'genderIdentity.PMI_Skip', 'state.PIIState_VA',
+            'censusRegion.SOUTH', 'ehrConsent.ConsentPermission_Yes',
+            'biospecimen.SPECIMEN_COLLECTED', 'biospecimenSamples.SAMPLES_ARRIVED',
+            'physicalMeasurements.COMPLETED', 'samplesToIsolateDNA.RECEIVED'] +
+           ['%s.SUBMITTED' % field_name for field_name in QUESTIONNAIRE_MODULE_FIELD_NAMES])
+
+
+def reduce_with_deepcopy(reducer_key, reducer_values, now=None):
+  """The dict-based version of reduce_participant_data_to_hpo_metric_date_deltas."""
+  #pylint: disable=unused-argument
+  metrics_conf = get_config()
+  metric_fields = get_fieldnames()
+  summary_fields = metrics_conf['summary_fields']
+  dates_and_metrics = []
+  date_of_birth = None
+  for reducer_value in reducer_values:
+    t = parse_tuple(reducer_value)
+    if t[0] == DATE_OF_BIRTH_PREFIX:
+      date_of_birth = datetime.datetime.strptime(t[1], DATE_FORMAT).date()
+    else:
+      dates_and_metrics.append((parse_datetime(t[0]), t[1]))
+  if not dates_and_metrics:
+    return
+  dates_and_metrics = sorted(dates_and_metrics)
+
+  def update_summary_fields(state):
+    for summary_field in summary_fields:
+      state[summary_field.name] = summary_field.compute_func(state)
+
+  initial_state = {f.name: UNSET for f in metrics_conf['fields']}
+  initial_state[TOTAL_SENTINEL] = 1
+  last_hpo_id = UNSET
+  for _, metric in dates_and_metrics:
+    metric_name, value = parse_metric(metric)
+    if metric_name == HPO_ID_METRIC:
+      last_hpo_id = value
+      initial_state[HPO_ID_METRIC] = last_hpo_id
+      break
+  if date_of_birth:
+    initial_state[AGE_RANGE_METRIC] = _add_age_range_metrics(dates_and_metrics, date_of_birth, now)
+    dates_and_metrics = sorted(dates_and_metrics)
+  update_summary_fields(initial_state)
+  initial_date = dates_and_metrics[0][0]
+  for k, v in initial_state.iteritems():
+    yield reduce_result_value(map_result_key(last_hpo_id, _REGISTERED_PARTICIPANT, k, v),
+                              initial_date.date().isoformat(), '1')
+
+  last_state = initial_state
+  full_participant = False
+  for dt, metric in dates_and_metrics:
+    new_state = copy.deepcopy(last_state)
+    metric_name, value = parse_metric(metric)
+    if metric_name == 'ehrConsent':
+      metric_name = 'consentForElectronicHealthRecords'
+      value = 'SUBMITTED' if value == 'ConsentPermission_Yes' else 'SUBMITTED_NO_CONSENT'
+    if metric_name not in metric_fields or new_state[metric_name] == value:
+      continue
+    new_state[metric_name] = value
+    update_summary_fields(new_state)
+    hpo_id = new_state.get(HPO_ID_METRIC)
+    hpo_change = last_hpo_id != hpo_id
+    last_full_participant = full_participant
+    for k, v in new_state.iteritems():
+      old_val = last_state.get(k, None)
+      if hpo_change or v != old_val:
+        formatted_date = dt.date().isoformat()
+        if (k == ENROLLMENT_STATUS_METRIC and v == EnrollmentStatus.FULL_PARTICIPANT and
+            not full_participant):
+          full_participant = True
+          for k2, v2 in new_state.iteritems():
+            yield reduce_result_value(map_result_key(hpo_id, _FULL_PARTICIPANT, k2, v2),
+                                      formatted_date, '1')
+        yield reduce_result_value(map_result_key(hpo_id, _REGISTERED_PARTICIPANT, k, v),
+                                  formatted_date, '1')
+        if last_full_participant:
+          yield reduce_result_value(map_result_key(hpo_id, _FULL_PARTICIPANT, k, v),
+                                    formatted_date, '1')
+        yield reduce_result_value(map_result_key(last_hpo_id, _REGISTERED_PARTICIPANT, k, old_val),
+                                  formatted_date, '-1')
+        if last_full_participant:
+          yield reduce_result_value(map_result_key(last_hpo_id, _FULL_PARTICIPANT, k, old_val),
+                                    formatted_date, '-1')
+    last_state = new_state
+    last_hpo_id = hpo_id
+
+
+def make_random_participants(num_participants, seed=1):
+  """Returns reducer values for participants with random histories drawn from METRICS."""
+  rand = random.Random(seed)
+  participants = []
+  for _ in range(num_participants):
+    start = datetime.datetime(2016, 1, 1) + datetime.timedelta(days=rand.randint(0, 365))
+    values = ['%s|%s.%s' % (format_datetime(start), HPO_ID_METRIC, rand.choice(HPOS))]
+    for _ in range(rand.randint(0, 40)):
+      event_time = start + datetime.timedelta(days=rand.randint(0, 365),
+                                              seconds=rand.randint(0, 86399))
+      values.append('%s|%s' % (format_datetime(event_time), rand.choice(METRICS)))
+    if rand.randint(0, 3):
+      values.append('%s|%d-01-%02d' % (DATE_OF_BIRTH_PREFIX, rand.randint(1930, 2000),
+                                       rand.randint(1, 28)))
+    participants.append(values)
+  return participants
+
+
+def _values(start, metrics, date_of_birth=None):
+  """Returns reducer values for metrics recorded a day apart from start."""
+  values = ['%s|%s' % (format_datetime(start + datetime.timedelta(days=i)), metric)
+            for i, metric in enumerate(metrics)]
+  if date_of_birth:
+    values.append('%s|%s' % (DATE_OF_BIRTH_PREFIX, date_of_birth))
+  return values
+
+
+class MetricsReducerTest(NdbTestBase):
+  """Checks that the participant reducer emits exactly what the deepcopy()-per-event version did."""
+
+  def assert_same_output(self, participant_id, values):
+    self.assertEquals(list(reduce_with_deepcopy(participant_id, values, now=NOW)),
+                      list(reduce_participant_data_to_hpo_metric_date_deltas(participant_id,
+                                                                            values, now=NOW)))
+
+  def test_no_metrics(self):
+    self.assert_same_output('1', [])
+    self.assert_same_output('1', ['%s|1980-01-01' % DATE_OF_BIRTH_PREFIX])
+
+  def test_hpo_changes(self):
+    start = datetime.datetime(2016, 1, 1)
+    self.assert_same_output('1', _values(start, ['hpoId.UNSET', 'race.WHITE', 'hpoId.PITT',
+                                                 'hpoId.PITT', 'hpoId.AZ_TUCSON']))
+
+  def test_repeated_and_unknown_metrics(self):
+    start = datetime.datetime(2016, 1, 1)
+    self.assert_same_output('1', _values(start, ['hpoId.PITT', 'race.WHITE', 'race.WHITE',
+                                                 'genderIdentity.PMI_Skip', 'race.OTHER_RACE',
+                                                 'notAMetric.FOO']))
+
+  def test_age_ranges(self):
+    start = datetime.datetime(2016, 6, 1)
+    self.assert_same_output('1', _values(start, ['hpoId.PITT', 'censusRegion.SOUTH'],
+                                         date_of_birth='1992-06-15'))
+
+  def test_full_participant(self):
+    start = datetime.datetime(2016, 1, 1)
+    metrics = (['hpoId.PITT', 'ehrConsent.ConsentPermission_Yes',
+                'physicalMeasurements.COMPLETED', 'biospecimen.SPECIMEN_COLLECTED',
+                'biospecimenSamples.SAMPLES_ARRIVED', 'samplesToIsolateDNA.RECEIVED'] +
+               ['%s.SUBMITTED' % field_name for field_name in QUESTIONNAIRE_MODULE_FIELD_NAMES] +
+               ['hpoId.AZ_TUCSON', 'samplesToIsolateDNA.UNSET', 'race.WHITE'])
+    values = _values(start, metrics, date_of_birth='1970-03-01')
+    self.assert_same_output('1', values)
+    self.assertTrue([line for line in reduce_with_deepcopy('1', values, now=NOW)
+                     if line.startswith('PITT|%s|' % _FULL_PARTICIPANT)])
+
+  def test_same_day_events(self):
+    day = format_datetime(datetime.datetime(2016, 1, 1, 10))
+    self.assert_same_output('1', ['%s|hpoId.PITT' % day, '%s|race.WHITE' % day,
+                                  '%s|ehrConsent.ConsentPermission_Yes' % day])
+
+  def test_random_participants(self):
+    for participant_id, values in enumerate(make_random_participants(300)):
+      self.assert_same_output(str(participant_id), values)
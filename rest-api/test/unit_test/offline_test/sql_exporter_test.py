@@ -1,3 +1,8 @@
+import StringIO
+import csv
+import gzip
+
+from cloudstorage import cloudstorage_api
 from offline.sql_exporter import SqlExporter
 from participant_enums import UNSET_HPO_ID
 from offline_test.gcs_utils import assertCsvContents
@@ -5,6 +10,11 @@ from unit_test_util import CloudStorageSqlTestBase, PITT_HPO_ID, AZ_HPO_ID
 
 _BUCKET_NAME = 'pmi-drc-biobank-test.appspot.com'
 _FILE_NAME = 'hpo_ids.csv'
+_HPO_SQL = 'SELECT hpo_id id, name name FROM hpo ORDER BY hpo_id'
+_HPO_ROWS = [['id', 'name'],
+             [str(UNSET_HPO_ID), 'UNSET'],
+             [str(AZ_HPO_ID), 'AZ_TUCSON'],
+             [str(PITT_HPO_ID), 'PITT']]
 
 class SqlExporterTest(CloudStorageSqlTestBase):
   def testHpoExport_withoutRows(self):
@@ -20,3 +30,27 @@ class SqlExporterTest(CloudStorageSqlTestBase):
                                                      [str(UNSET_HPO_ID), 'UNSET'],
                                                      [str(AZ_HPO_ID), 'AZ_TUCSON'],
                                                      [str(PITT_HPO_ID), 'PITT']])
+
+  def testHpoExport_unpipelinedSmallFetches(self):
+    SqlExporter(_BUCKET_NAME, fetch_size=1, max_pending_batches=0).run_export(_FILE_NAME,
+                                                                             _HPO_SQL)
+    assertCsvContents(self, _BUCKET_NAME, _FILE_NAME, _HPO_ROWS)
+
+  def testHpoExport_pipelinedSmallFetches(self):
+    SqlExporter(_BUCKET_NAME, fetch_size=1, max_pending_batches=1).run_export(_FILE_NAME,
+                                                                             _HPO_SQL)
+    assertCsvContents(self, _BUCKET_NAME, _FILE_NAME, _HPO_ROWS)
+
+  def testHpoExport_transformError(self):
+    def transformf(row):
+      raise ValueError('Bad row %s' % row)
+    with self.assertRaises(ValueError):
+      SqlExporter(_BUCKET_NAME, fetch_size=1).run_export(_FILE_NAME, _HPO_SQL,
+                                                         transformf=transformf)
+
+  def testHpoExport_compressed(self):
+    SqlExporter(_BUCKET_NAME, use_unicode=True, compress=True).run_export(_FILE_NAME + '.gz',
+                                                                          _HPO_SQL)
+    with cloudstorage_api.open('/%s/%s.gz' % (_BUCKET_NAME, _FILE_NAME), mode='r') as output:
+      rows = sorted(csv.reader(gzip.GzipFile(fileobj=StringIO.StringIO(output.read()))))
+    self.assertEquals(sorted(_HPO_ROWS), rows)
@@ -1,12 +1,18 @@
 import csv
+import datetime
+import json
 import os
 
+from clock import FakeClock
 from cloudstorage import cloudstorage_api
+from dao.database_factory import get_database
 from dao.participant_dao import ParticipantDao, make_primary_provider_link_for_name
+from model.log_position import LogPosition
 from offline.table_exporter import TableExporter
 from offline_test.gcs_utils import assertCsvContents
 from unit_test_util import CloudStorageSqlTestBase, FlaskTestBase
 from google.appengine.ext import deferred
+from werkzeug.exceptions import BadRequest
 
 class TableExporterTest(CloudStorageSqlTestBase, FlaskTestBase):
   def setUp(self):
@@ -52,3 +58,221 @@ class TableExporterTest(CloudStorageSqlTestBase, FlaskTestBase):
     self.assertFalse(pmi_ids.intersection(obf_ids),
                      'should be no overlap between pmi_ids and obfuscated IDs')
     self.assertEquals(2, len(obf_ids))
+
+  def _insert_participants(self, participant_ids):
+    for participant_id in participant_ids:
+      ParticipantDao().insert(self._participant_with_defaults(
+          participantId=participant_id,
+          biobankId=participant_id,
+          providerLink=make_primary_provider_link_for_name('PITT')))
+
+  def _run_chunked_export(self, chunk_size):
+    """Runs a chunked export of the participant table, and returns the paths of its parts."""
+    self.taskqueue_stub.FlushQueue('default')
+    TableExporter.export_tables('rdr', ['participant'], 'dir', deidentify=False,
+                                chunk_size=chunk_size)
+    tasks = self.taskqueue_stub.get_filtered_tasks()
+    self.assertEqual(len(tasks), 1)
+    deferred.run(tasks[0].payload)
+    # Each part's task defers the next one's.
+    run_task_names = set([tasks[0].name])
+    part_paths = []
+    while True:
+      tasks = [task for task in self.taskqueue_stub.get_filtered_tasks()
+               if task.name not in run_task_names]
+      if not tasks:
+        return part_paths
+      self.assertEqual(len(tasks), 1)
+      run_task_names.add(tasks[0].name)
+      part_paths.append(deferred.run(tasks[0].payload))
+
+  def _read_manifest(self, bucket_name):
+    with cloudstorage_api.open('/%s/dir/participant/manifest.json' % bucket_name) as output:
+      return json.load(output)
+
+  def testChunkedExport(self):
+    self._insert_participants([1, 2, 5, 900000000])
+
+    part_paths = self._run_chunked_export(3)
+
+    # Parts cover chunks of rows, however far apart their IDs are: participant IDs [1, 900000000)
+    # and [900000000, 900000001).
+    self.assertEqual(2, len(part_paths))
+    bucket_name = part_paths[0].split('/')[0]
+    self.assertEqual(['%s/dir/participant/part-%05d.csv' % (bucket_name, i) for i in range(2)],
+                     part_paths)
+    with cloudstorage_api.open('/' + part_paths[0], mode='r') as output:
+      rows = list(csv.DictReader(output))
+    self.assertEqual(['1', '2', '5'], [row['participant_id'] for row in rows])
+
+    manifest = self._read_manifest(bucket_name)
+    self.assertEqual('participant_id', manifest['keyColumn'])
+    self.assertEqual(4, manifest['rowCount'])
+    self.assertEqual([('part-00000.csv', 1, 900000000, 3),
+                      ('part-00001.csv', 900000000, 900000001, 1)],
+                     [(part['file'], part['startId'], part['endId'], part['rowCount'])
+                      for part in manifest['parts']])
+
+  def testChunkedExport_empty(self):
+    part_paths = self._run_chunked_export(3)
+
+    self.assertEqual(1, len(part_paths))
+    manifest = self._read_manifest(part_paths[0].split('/')[0])
+    self.assertEqual(0, manifest['rowCount'])
+    self.assertEqual([(0, 0, 0)],
+                     [(part['startId'], part['endId'], part['rowCount'])
+                      for part in manifest['parts']])
+
+  def testChunkedExport_retriedPartSkipsCompletedWork(self):
+    self._insert_participants([1, 2])
+    TableExporter.export_tables('rdr', ['participant'], 'dir', deidentify=False, chunk_size=1)
+    deferred.run(self.taskqueue_stub.get_filtered_tasks()[0].payload)
+    first_part_task = self.taskqueue_stub.get_filtered_tasks()[1]
+    part_path = deferred.run(first_part_task.payload)
+    with cloudstorage_api.open('/' + part_path, mode='w') as output:
+      output.write('not exported again')
+
+    self.assertEqual(part_path, deferred.run(first_part_task.payload))
+
+    # The next part is only deferred once.
+    self.assertEqual(3, len(self.taskqueue_stub.get_filtered_tasks()))
+    with cloudstorage_api.open('/' + part_path, mode='r') as output:
+      self.assertEqual('not exported again', output.read())
+
+  def testChunkedExport_rerunIgnoresEarlierCheckpoints(self):
+    self._insert_participants([1, 2])
+    part_paths = self._run_chunked_export(1)
+    self.assertEqual(2, len(part_paths))
+    bucket_name = part_paths[0].split('/')[0]
+    first_export_id = self._read_manifest(bucket_name)['exportId']
+
+    # The rerun has one part, and its manifest lists only it (not the second part of the first
+    # export).
+    self.assertEqual(part_paths[:1], self._run_chunked_export(2))
+    manifest = self._read_manifest(bucket_name)
+    self.assertNotEqual(first_export_id, manifest['exportId'])
+    self.assertEqual(2, manifest['rowCount'])
+    self.assertEqual([('part-00000.csv', 1, 3, 2)],
+                     [(part['file'], part['startId'], part['endId'], part['rowCount'])
+                      for part in manifest['parts']])
+
+  def testChunkedExport_viewWithoutPrimaryKey(self):
+    TableExporter.export_tables('rdr', ['ppi_participant_view'], 'dir', deidentify=True,
+                                chunk_size=2)
+
+    tasks = self.taskqueue_stub.get_filtered_tasks()
+    self.assertEqual(len(tasks), 1)
+    csv_path = deferred.run(tasks[0].payload)
+
+    self.assertEqual(1, len(self.taskqueue_stub.get_filtered_tasks()))
+    assertCsvContents(self, os.path.dirname(csv_path), os.path.basename(csv_path),
+                      [['participant_id', 'hpo', 'enrollment_status']])
+
+  def _run_incremental_export(self, table_name, now=datetime.datetime(2018, 2, 1)):
+    self.taskqueue_stub.FlushQueue('default')
+    TableExporter.export_tables('rdr', [table_name], 'dir', deidentify=False, incremental=True)
+    tasks = self.taskqueue_stub.get_filtered_tasks()
+    self.assertEqual(len(tasks), 1)
+    with FakeClock(now):
+      manifest_path = deferred.run(tasks[0].payload)
+    with cloudstorage_api.open('/' + manifest_path) as output:
+      manifest = json.load(output)
+    delta_path = '/%s/%s' % (os.path.dirname(manifest_path), manifest['file'])
+    with cloudstorage_api.open(delta_path, mode='r') as output:
+      rows = list(csv.DictReader(output))
+    self.assertEqual(manifest['rowCount'], len(rows))
+    return manifest, rows
+
+  def testIncrementalExport(self):
+    with FakeClock(datetime.datetime(2018, 1, 1)):
+      self._insert_participants([1, 2])
+
+    manifest, rows = self._run_incremental_export('participant')
+    self.assertEqual({
+      'sequence': 1,
+      'file': 'delta-00001.csv',
+      'full': True,
+      'keyColumns': ['participant_id'],
+      'watermarkColumn': 'last_modified',
+      'fromValue': None,
+      'toValue': '2018-01-01T00:00:00Z',
+      'rowCount': 2,
+    }, manifest)
+    self.assertEqual(['1', '2'], sorted(row['participant_id'] for row in rows))
+
+    with FakeClock(datetime.datetime(2018, 1, 2)):
+      self._insert_participants([3])
+
+    # Rows modified up to an hour before the watermark are exported again, in case any were
+    # committed after the last export.
+    manifest, rows = self._run_incremental_export('participant')
+    self.assertEqual(2, manifest['sequence'])
+    self.assertFalse(manifest['full'])
+    self.assertEqual('2017-12-31T23:00:00Z', manifest['fromValue'])
+    self.assertEqual('2018-01-02T00:00:00Z', manifest['toValue'])
+    self.assertEqual(['1', '2', '3'], sorted(row['participant_id'] for row in rows))
+
+    manifest, rows = self._run_incremental_export('participant')
+    self.assertEqual(3, manifest['sequence'])
+    self.assertEqual('2018-01-01T23:00:00Z', manifest['fromValue'])
+    self.assertEqual(['3'], [row['participant_id'] for row in rows])
+
+  def _insert_log_positions(self, num_log_positions):
+    with get_database().session() as session:
+      for _ in range(num_log_positions):
+        session.add(LogPosition())
+
+  def testIncrementalExport_logPosition(self):
+    now = datetime.datetime(2018, 1, 1)
+    self._insert_log_positions(3)
+    manifest, rows = self._run_incremental_export('log_position', now)
+    self.assertTrue(manifest['full'])
+    self.assertEqual('log_position_id', manifest['watermarkColumn'])
+    self.assertEqual(3, manifest['toValue'])
+    self.assertEqual(3, len(rows))
+
+    # Log positions are assigned before rows are committed, so deltas start from the log position
+    # read by an export at least an hour before the last one. Until there is one, all rows are
+    # exported.
+    self._insert_log_positions(1)
+    manifest, rows = self._run_incremental_export('log_position', now + datetime.timedelta(hours=2))
+    self.assertTrue(manifest['full'])
+    self.assertEqual(4, len(rows))
+
+    self._insert_log_positions(1)
+    manifest, rows = self._run_incremental_export('log_position', now + datetime.timedelta(hours=4))
+    self.assertFalse(manifest['full'])
+    self.assertEqual(3, manifest['fromValue'])
+    self.assertEqual(5, manifest['toValue'])
+    self.assertEqual(['4', '5'], [row['log_position_id'] for row in rows])
+
+  def testIncrementalExport_createdOnly(self):
+    # Questionnaire responses have a created time, but don't have one for updates.
+    for sequence in (1, 2):
+      manifest, _ = self._run_incremental_export('questionnaire_response')
+      self.assertEqual(sequence, manifest['sequence'])
+      self.assertTrue(manifest['full'])
+      self.assertIsNone(manifest['watermarkColumn'])
+
+  def testIncrementalExport_randomIdWithoutWatermarkColumn(self):
+    for sequence in (1, 2):
+      manifest, rows = self._run_incremental_export('hpo')
+      self.assertEqual(sequence, manifest['sequence'])
+      self.assertTrue(manifest['full'])
+      self.assertIsNone(manifest['watermarkColumn'])
+      self.assertTrue(rows)
+
+  def testIncrementalExport_noWatermarkColumn(self):
+    self._insert_participants([1])
+
+    for sequence in (1, 2):
+      manifest, rows = self._run_incremental_export('ppi_participant_view')
+      self.assertEqual(sequence, manifest['sequence'])
+      self.assertTrue(manifest['full'])
+      self.assertIsNone(manifest['watermarkColumn'])
+      self.assertEqual(1, len(rows))
+
+  def testIncrementalExport_deidentified(self):
+    with self.assertRaises(BadRequest):
+      TableExporter.export_tables('rdr', ['ppi_participant_view'], 'dir', deidentify=True,
+                                  incremental=True)
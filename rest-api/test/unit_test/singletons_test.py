@@ -1,5 +1,6 @@
 from clock import FakeClock
 import datetime
+import threading
 import unittest
 import singletons
 
@@ -37,3 +38,37 @@ class SingletonsTest(unittest.TestCase):
     with FakeClock(TIME_3):
       self.assertEquals(2, singletons.get(123, SingletonsTest.foo, 86401))
 
+
+  def test_get_serve_stale_while_reloading(self):
+    with FakeClock(TIME_1):
+      self.assertEquals(1, singletons.get(123, SingletonsTest.foo, 86401, serve_stale=True))
+
+    other_thread_results = []
+    def get_in_other_thread():
+      other_thread_results.append(
+          singletons.get(123, SingletonsTest.foo, 86401, serve_stale=True))
+    def reload_cache():
+      # While this thread reloads the cache, other threads get the stale one.
+      thread = threading.Thread(target=get_in_other_thread)
+      thread.start()
+      thread.join()
+      return SingletonsTest.foo()
+
+    with FakeClock(TIME_3):
+      self.assertEquals(2, singletons.get(123, reload_cache, 86401, serve_stale=True))
+      self.assertEquals([1], other_thread_results)
+      self.assertEquals(2, singletons.get(123, SingletonsTest.foo, 86401, serve_stale=True))
+
+  def test_get_other_index_while_loading(self):
+    other_thread_results = []
+    def get_in_other_thread():
+      other_thread_results.append(singletons.get(456, lambda: 'other'))
+    def load_cache():
+      # Loading a cache doesn't block other threads from loading other caches.
+      thread = threading.Thread(target=get_in_other_thread)
+      thread.start()
+      thread.join(5)
+      return 'loaded'
+
+    self.assertEquals('loaded', singletons.get(123, load_cache))
+    self.assertEquals(['other'], other_thread_results)
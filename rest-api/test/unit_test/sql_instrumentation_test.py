@@ -0,0 +1,48 @@
+import config
+from sqlalchemy.exc import OperationalError
+import sql_instrumentation
+from dao.database_factory import get_database
+from sql_instrumentation import get_statement_shape, record_query_stats
+from unit_test_util import SqlTestBase
+
+_PARTICIPANT_SQL = 'SELECT participant_id FROM participant WHERE participant_id = :participant_id'
+
+
+class SqlInstrumentationTest(SqlTestBase):
+
+  def test_statement_shape(self):
+    self.assertEquals('SELECT a FROM b WHERE c IN (...) AND d = ?',
+                      get_statement_shape('SELECT a\n  FROM b WHERE c IN (?, ?,?) AND d = ?'))
+    self.assertEquals('SELECT a FROM b WHERE c IN (...)',
+                      get_statement_shape('SELECT a FROM b WHERE c IN (%s, %s)'))
+
+  def test_record_query_stats(self):
+    config.override_setting(config.SQL_REPEATED_STATEMENT_THRESHOLD, [3])
+    self.addCleanup(config.CONFIG_OVERRIDES.pop, config.SQL_REPEATED_STATEMENT_THRESHOLD)
+    with record_query_stats('test') as stats:
+      self.assertIs(stats, sql_instrumentation.get_current_stats())
+      with get_database().session() as session:
+        for participant_id in range(3):
+          session.execute(_PARTICIPANT_SQL, {'participant_id': participant_id})
+        session.execute('SELECT COUNT(*) FROM participant')
+    self.assertIsNone(sql_instrumentation.get_current_stats())
+
+    self.assertEquals(4, stats.query_count)
+    repeated = stats.get_repeated_statements(3)
+    self.assertEquals(1, len(repeated))
+    shape, count = repeated[0]
+    self.assertTrue(shape.startswith('SELECT participant_id FROM participant WHERE'), shape)
+    self.assertEquals(3, count)
+    self.assertEquals([shape], [r['statement'] for r in stats.to_json(3)['repeatedStatements']])
+
+  def test_failed_statements_not_recorded(self):
+    config.override_setting(config.SQL_REPEATED_STATEMENT_THRESHOLD, [3])
+    self.addCleanup(config.CONFIG_OVERRIDES.pop, config.SQL_REPEATED_STATEMENT_THRESHOLD)
+    with record_query_stats('test') as stats:
+      with get_database().session() as session:
+        with self.assertRaises(OperationalError):
+          session.execute('SELECT * FROM no_such_table')
+      with get_database().session() as session:
+        session.execute('SELECT COUNT(*) FROM participant')
+    self.assertEquals(1, stats.query_count)
+    self.assertEquals('SELECT COUNT(*) FROM participant', stats.slowest_statement)
@@ -0,0 +1,51 @@
+"""Creates synthetic participants directly in the database (see bulk_participant_generator).
+
+Much faster than generating participants through the API (e.g. with the DataGen endpoint), for
+building datasets of millions of participants for scale tests. Questionnaires must already be in
+the database.
+"""
+
+import json
+import logging
+
+import config
+
+from data_gen import bulk_participant_generator
+from main_util import get_parser, configure_logging
+
+
+def main(args):
+  # Configuration normally comes from Datastore; read it from the given files instead.
+  for config_path in args.config:
+    with open(config_path) as config_file:
+      for key, value in json.load(config_file).iteritems():
+        config.override_setting(key, value)
+  id_starts = bulk_participant_generator.generate_participants(
+      args.num_participants,
+      num_processes=args.processes,
+      batch_size=args.batch_size,
+      include_physical_measurements=not args.no_physical_measurements,
+      include_biobank_orders=not args.no_biobank_orders,
+      seed=args.seed)
+  logging.info('Created participants P%d to P%d.', id_starts.participant_id,
+               id_starts.participant_id + args.num_participants - 1)
+
+if __name__ == '__main__':
+  configure_logging()
+  parser = get_parser()
+  parser.add_argument('--num_participants', help='Number of participants to create.', type=int,
+                      required=True)
+  parser.add_argument('--config', help='Config JSON file(s) to read settings from, in order.',
+                      nargs='+', default=['config/base_config.json'])
+  parser.add_argument('--processes', help='Number of processes to use (default: one per CPU).',
+                      type=int)
+  parser.add_argument('--batch_size', help='Participants to insert in each transaction.',
+                      type=int, default=bulk_participant_generator.DEFAULT_BATCH_SIZE)
+  parser.add_argument('--seed', help='Seed for the random number generators, for repeatable runs.',
+                      type=int)
+  parser.add_argument('--no_physical_measurements', help="Don't create physical measurements.",
+                      action='store_true')
+  parser.add_argument('--no_biobank_orders', help="Don't create biobank orders or samples.",
+                      action='store_true')
+
+  main(parser.parse_args())
@@ -0,0 +1,46 @@
+#!/bin/bash -e
+
+# Creates synthetic participants directly in the database, for building large datasets for scale
+# tests. Can be used for either your local database or Cloud SQL (nonprod only). Questionnaires
+# must already be imported (e.g. with tools/import_questionnaires.sh).
+
+USAGE="tools/generate_participants.sh --num_participants <NUMBER> [--account <ACCOUNT> --project <PROJECT> [--creds_account <ACCOUNT>]] [<other generate_participants.py args>]"
+while true; do
+  case "$1" in
+    --account) ACCOUNT=$2; shift 2;;
+    --creds_account) CREDS_ACCOUNT=$2; shift 2;;
+    --project) PROJECT=$2; shift 2;;
+    -- ) shift; break ;;
+    * ) break ;;
+  esac
+done
+
+if [ "${PROJECT}" ]
+then
+  if [ "${PROJECT}" == "all-of-us-rdr-prod" ]
+  then
+    echo "Synthetic participants cannot be generated in prod."
+    exit 1
+  fi
+  if [ -z "${ACCOUNT}" ]
+  then
+    echo "Usage: $USAGE"
+    exit 1
+  fi
+  if [ -z "${CREDS_ACCOUNT}" ]
+  then
+    CREDS_ACCOUNT="${ACCOUNT}"
+  fi
+  source tools/auth_setup.sh
+  run_cloud_sql_proxy
+  set_db_connection_string
+else
+  if [ -z "${DB_CONNECTION_STRING}" ]
+  then
+    source tools/setup_local_vars.sh
+    set_local_db_connection_string
+  fi
+fi
+
+source tools/set_path.sh
+python tools/generate_participants.py "$@"
@@ -0,0 +1,65 @@
+"""Runs the metrics pipeline on a single machine, on metrics export CSVs copied locally.
+
+Copy the CSVs written by a metrics export from GCS first, e.g.:
+gsutil cp 'gs://<bucket>/<export timestamp>/*.csv' /tmp/metrics_input/
+"""
+
+import glob
+import json
+import logging
+import os
+
+import config
+
+from dao.database_utils import parse_datetime
+from main_util import get_parser, configure_logging
+from offline import metrics_local_runner
+from offline.metrics_pipeline import INTERMEDIATE_FORMAT_TEXT, INTERMEDIATE_FORMAT_RECORDS
+
+
+def main(args):
+  # Configuration normally comes from Datastore; read it from the given files instead.
+  for config_path in args.config:
+    with open(config_path) as config_file:
+      for key, value in json.load(config_file).iteritems():
+        config.override_setting(key, value)
+  input_paths = sorted(glob.glob(os.path.join(args.input_dir, '*.csv')))
+  if not input_paths:
+    raise ValueError('No CSV files found in %r.' % args.input_dir)
+  if not os.path.isdir(args.output_dir):
+    os.makedirs(args.output_dir)
+  bucket_paths = metrics_local_runner.run_pipeline(input_paths, args.output_dir,
+                                                   parse_datetime(args.now),
+                                                   num_processes=args.processes,
+                                                   num_partitions=args.partitions,
+                                                   intermediate_format=args.intermediate_format,
+                                                   bucket_ranges=args.bucket_ranges)
+  logging.info('Wrote metrics buckets to %s.', ', '.join(bucket_paths))
+  if args.write_to_database:
+    version_id = metrics_local_runner.write_buckets(bucket_paths)
+    logging.info('Wrote metrics version %d.', version_id)
+
+if __name__ == '__main__':
+  configure_logging()
+  parser = get_parser()
+  parser.add_argument('--input_dir', help='Directory containing metrics export CSVs.',
+                      required=True)
+  parser.add_argument('--output_dir', help='Directory to write metrics buckets to.',
+                      required=True)
+  parser.add_argument('--now', help='Date to calculate metrics until, like 2017-01-01T00:00:00Z.',
+                      required=True)
+  parser.add_argument('--config', help='Config JSON file(s) to read settings from, in order.',
+                      nargs='+', default=['config/base_config.json'])
+  parser.add_argument('--processes', help='Number of processes to use (default: one per CPU).',
+                      type=int)
+  parser.add_argument('--partitions', help='Number of reduce partitions per stage.', type=int)
+  parser.add_argument('--intermediate_format', help='Format of the output of each stage.',
+                      choices=[INTERMEDIATE_FORMAT_TEXT, INTERMEDIATE_FORMAT_RECORDS],
+                      default=INTERMEDIATE_FORMAT_TEXT)
+  parser.add_argument('--bucket_ranges',
+                      help='Write a bucket per HPO for each range of dates with unchanged counts.',
+                      action='store_true')
+  parser.add_argument('--write_to_database', help='Write buckets to a new metrics version.',
+                      action='store_true')
+
+  main(parser.parse_args())
@@ -0,0 +1,40 @@
+#!/bin/bash -e
+
+# Runs the metrics pipeline locally on metrics export CSVs, optionally writing the resulting
+# buckets to the database. Can be used for either your local database or Cloud SQL.
+
+USAGE="tools/run_metrics_locally.sh --input_dir <DIR> --output_dir <DIR> --now <TIMESTAMP> [--account <ACCOUNT> --project <PROJECT> [--creds_account <ACCOUNT>]] [<other run_metrics_locally.py args>]"
+while true; do
+  case "$1" in
+    --account) ACCOUNT=$2; shift 2;;
+    --creds_account) CREDS_ACCOUNT=$2; shift 2;;
+    --project) PROJECT=$2; shift 2;;
+    -- ) shift; break ;;
+    * ) break ;;
+  esac
+done
+
+if [ "${PROJECT}" ]
+then
+  if [ -z "${ACCOUNT}" ]
+  then
+    echo "Usage: $USAGE"
+    exit 1
+  fi
+  if [ -z "${CREDS_ACCOUNT}" ]
+  then
+    CREDS_ACCOUNT="${ACCOUNT}"
+  fi
+  source tools/auth_setup.sh
+  run_cloud_sql_proxy
+  set_db_connection_string
+else
+  if [ -z "${DB_CONNECTION_STRING}" ]
+  then
+    source tools/setup_local_vars.sh
+    set_local_db_connection_string
+  fi
+fi
+
+source tools/set_path.sh
+python tools/run_metrics_locally.py "$@"
@@ -21,22 +21,33 @@ class UnicodeWriter:
     self.writer = csv.writer(self.queue, dialect=dialect, **kwds)
     self.stream = f
     self.encoder = codecs.getincrementalencoder(encoding)()
+    # The queue already holds UTF-8, which needs no reencoding.
+    self.reencode = codecs.lookup(encoding).name != 'utf-8'
 
-  def writerow(self, row):
-    self.writer.writerow([s.encode("utf-8") if isinstance(s, unicode) else s for s in row])
+  @staticmethod
+  def _encode_row(row):
+    return [s.encode("utf-8") if isinstance(s, unicode) else s for s in row]
+
+  def _write_queue(self):
     # Fetch UTF-8 output from the queue ...
     data = self.queue.getvalue()
-    data = data.decode("utf-8")
-    # ... and reencode it into the target encoding
-    data = self.encoder.encode(data)
+    if self.reencode:
+      # ... and reencode it into the target encoding
+      data = self.encoder.encode(data.decode("utf-8"))
     # write to the target stream
     self.stream.write(data)
     # empty queue
     self.queue.truncate(0)
 
+  def writerow(self, row):
+    self.writer.writerow(self._encode_row(row))
+    self._write_queue()
+
   def writerows(self, rows):
-    for row in rows:
-      self.writerow(row)
+    # Write all the rows to the stream at once, rather than making a (possibly remote) write for
+    # each row.
+    self.writer.writerows([self._encode_row(row) for row in rows])
+    self._write_queue()
 
 class UTF8Recoder:
   """
@@ -0,0 +1,23 @@
+"""Handler for App Engine warmup requests (/_ah/warmup).
+
+App Engine sends a warmup request to new instances before routing traffic to them; loading the
+caches here saves the first requests on an instance from waiting for them.
+"""
+
+import logging
+
+import config
+from dao.code_dao import CodeDao
+from dao.database_factory import get_database
+from dao.hpo_dao import HPODao
+from dao.organization_dao import OrganizationDao
+from dao.site_dao import SiteDao
+
+
+def warmup():
+  config.get_config()
+  get_database()
+  for dao in (CodeDao(), HPODao(), SiteDao(), OrganizationDao()):
+    dao.warm_cache()
+  logging.info('Loaded caches for warmup.')
+  return ''